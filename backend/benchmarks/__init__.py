@@ -0,0 +1,68 @@
+"""
+性能ベンチマーク
+
+backend ディレクトリで実行する (例: python -m benchmarks.beds24_sync)
+テストと同じく一時的なデータベースを作成して実行するため、開発用の db.sqlite3 には影響しない
+"""
+
+import os
+import platform
+import subprocess
+from contextlib import contextmanager
+from pathlib import Path
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    import django
+    django.setup()
+
+
+@contextmanager
+def temporary_database():
+    """テスト用データベースを作成し、終了時に削除する"""
+    from django.db import connection
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def print_table(headers, rows):
+    """結果を列を揃えて表示する"""
+    rows = [[str(value) for value in row] for row in rows]
+    widths = [max(len(header), *(len(row[i]) for row in rows)) if rows else len(header)
+              for i, header in enumerate(headers)]
+    print("  ".join(header.rjust(width) for header, width in zip(headers, widths)))
+    for row in rows:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+def environment():
+    return f"Python {platform.python_version()} / {platform.system()} {platform.machine()} / {os.cpu_count()} CPUs"
+
+
+def percentile(values, q):
+    """q (0〜1) の分位点 (最も近い順位の値)"""
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def git_revision():
+    """(コミットのハッシュ, 未コミットの変更があるか)。gitが使えなければ (None, None)"""
+    cwd = Path(__file__).resolve().parent
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=cwd, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+        status = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=cwd, capture_output=True, text=True, check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
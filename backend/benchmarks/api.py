@@ -0,0 +1,248 @@
+"""
+APIのベンチマーク: 生成したポートフォリオ(benchmarks.portfolio)に対して、DRFのAPIのシナリオを実行する
+
+    python -m benchmarks.api --facilities 10000 --requests 200 --output results/$(git rev-parse --short HEAD).json
+    python -m benchmarks.compare results/before.json results/after.json
+
+シナリオごとに、スループット(1クライアントで連続して送った場合のリクエスト/秒)、応答時間の
+p50/p95/p99、1リクエストあたりのSQLの実行回数を計測する。リクエストはプロセス内のテストクライアントで送る
+(ネットワークやサーバーの影響は含まない。同時接続の負荷は benchmarks.asgi_load を使う)。
+
+--output を指定すると結果をJSONで保存する (コミットのハッシュ・環境・パラメータ付き)。
+データもリクエストもシードで決まるため、同じ引数で実行した結果はコミット間で比較できる。
+"""
+
+import argparse
+import io
+import json
+import random
+import shutil
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from . import environment, git_revision, percentile, print_table, setup_django, temporary_database
+from .portfolio import AREAS, FEATURES, KINDS
+
+SCHEMA_VERSION = 1
+
+
+class Context:
+    """シナリオ間で共有するデータ (施設・アメニティのID、アップロードする画像など)"""
+
+    def __init__(self, rng):
+        from facilities.models import Amenity, Facility
+
+        self.rng = rng
+        self.facility_ids = list(Facility.objects.order_by('pk').values_list('pk', flat=True))
+        self.amenity_ids = list(Amenity.objects.order_by('pk').values_list('pk', flat=True))
+        self.warm_ids = rng.sample(self.facility_ids, min(20, len(self.facility_ids)))
+        self.next_page = None
+        self.created = 0
+
+    def facility_id(self):
+        return self.rng.choice(self.facility_ids)
+
+    def amenities(self, low=3, high=8):
+        return self.rng.sample(self.amenity_ids, min(len(self.amenity_ids), self.rng.randint(low, high)))
+
+
+def make_image():
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (1600, 1200), (180, 120, 60)).save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+
+# シナリオ: (client, context) -> (レスポンス, 期待するステータス)
+
+def list_pages(client, ctx):
+    """一覧をカーソルで1ページ目から順にたどる (最後まで行ったら1ページ目に戻る)"""
+    url = ctx.next_page or '/api/facilities/?page_size=50'
+    response = client.get(url)
+    ctx.next_page = response.json().get('next') if response.status_code == 200 else None
+    return response, 200
+
+
+def list_filtered(client, ctx):
+    query = f"page_size=50&capacity__gte={ctx.rng.choice([2, 4, 6])}&amenities={ctx.amenities(1, 2)[0]}"
+    return client.get(f'/api/facilities/?{query}'), 200
+
+
+def search(client, ctx):
+    word = ctx.rng.choice([*KINDS, *FEATURES, *(area[3:] for area, _, _ in AREAS)])
+    return client.get('/api/facilities/', {'q': word, 'fields': 'id,facility_name,short_description'}), 200
+
+
+def detail(client, ctx):
+    """ランダムな施設 (ペイロードキャッシュにはほとんど載っていない)"""
+    return client.get(f'/api/facilities/{ctx.facility_id()}/'), 200
+
+
+def detail_warm(client, ctx):
+    """同じ20件の施設を繰り返し取得する (ペイロードキャッシュに載った状態)"""
+    return client.get(f'/api/facilities/{ctx.rng.choice(ctx.warm_ids)}/'), 200
+
+
+def create(client, ctx):
+    ctx.created += 1
+    return client.post('/api/facilities/', {
+        'facility_name': f"ベンチマーク施設{ctx.created}",
+        'capacity': ctx.rng.randint(1, 10),
+        'address': "京都府京都市下京区",
+        'description': "ベンチマークで作成した施設です。" * 10,
+        'amenities': ctx.amenities(),
+    }, content_type='application/json'), 201
+
+
+def update_amenities(client, ctx):
+    return client.patch(
+        f'/api/facilities/{ctx.facility_id()}/', {'amenities': ctx.amenities()}, content_type='application/json'
+    ), 200
+
+
+def rename_amenity(client, ctx):
+    """アメニティの名前の変更 (そのアメニティを持つすべての施設のキャッシュが無効になる)"""
+    amenity_id = ctx.rng.choice(ctx.amenity_ids)
+    return client.patch(
+        f'/api/amenities/{amenity_id}/', {'name': f"アメニティ{amenity_id}-{ctx.rng.getrandbits(32):x}"},
+        content_type='application/json',
+    ), 200
+
+
+def image_upload(client, ctx):
+    """1600x1200のJPEGを1枚アップロードする (派生画像の生成もリクエスト内で同期実行する)"""
+    from django.core.files.uploadedfile import SimpleUploadedFile
+
+    if not hasattr(ctx, 'image'):
+        ctx.image = make_image()
+    upload = SimpleUploadedFile('photo.jpg', ctx.image, content_type='image/jpeg')
+    return client.post(f'/api/facilities/{ctx.facility_id()}/images/', {'images': [upload]}), 201
+
+
+# 読み取りのシナリオを先に、データを変更するシナリオを後に実行する
+SCENARIOS = {
+    'list': list_pages,
+    'list_filtered': list_filtered,
+    'search': search,
+    'detail': detail,
+    'detail_warm': detail_warm,
+    'create': create,
+    'update_amenities': update_amenities,
+    'rename_amenity': rename_amenity,
+    'image_upload': image_upload,
+}
+
+
+def run_scenario(client, ctx, scenario, requests, warmup):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    for _ in range(warmup):
+        scenario(client, ctx)
+
+    latencies, queries, errors = [], [], 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        with CaptureQueriesContext(connection) as captured:
+            request_started = time.perf_counter()
+            response, expected = scenario(client, ctx)
+            latencies.append(time.perf_counter() - request_started)
+        queries.append(len(captured))
+        if response.status_code != expected:
+            errors += 1
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': requests,
+        'errors': errors,
+        'throughput': round(requests / elapsed, 2),
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies) * 1000, 3),
+            'p50': round(percentile(latencies, 0.50) * 1000, 3),
+            'p95': round(percentile(latencies, 0.95) * 1000, 3),
+            'p99': round(percentile(latencies, 0.99) * 1000, 3),
+            'max': round(max(latencies) * 1000, 3),
+        },
+        'queries': {
+            'mean': round(sum(queries) / len(queries), 2),
+            'max': max(queries),
+        },
+    }
+
+
+def run(args):
+    from django.test import Client, override_settings
+    from facilities import cache, search as search_index
+    from .portfolio import generate
+
+    started = time.perf_counter()
+    counts = generate(args.facilities, seed=args.seed, amenities=args.amenities)
+    if 'search' in args.scenarios:
+        search_index.rebuild()
+    generated_in = time.perf_counter() - started
+
+    media_root = tempfile.mkdtemp(prefix='benchmark-media-')
+    try:
+        with override_settings(MEDIA_ROOT=media_root, FACILITIES_TASKS_EAGER=True, ALLOWED_HOSTS=['*']):
+            cache.clear()
+            ctx = Context(random.Random(args.seed))
+            client = Client(HTTP_ACCEPT='application/json')
+            results = {}
+            for name in SCENARIOS:
+                if name in args.scenarios:
+                    results[name] = run_scenario(client, ctx, SCENARIOS[name], args.requests, args.warmup)
+    finally:
+        shutil.rmtree(media_root, ignore_errors=True)
+    return counts, generated_in, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--facilities', type=int, default=10000, help="生成する施設数 (10000〜100000程度)")
+    parser.add_argument('--amenities', type=int, default=60, help="アメニティの種類")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=200, help="シナリオごとに計測するリクエスト数")
+    parser.add_argument('--warmup', type=int, default=10, help="計測の前に送るリクエスト数")
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--output', type=Path, help="結果を保存するJSONファイル")
+    args = parser.parse_args()
+
+    setup_django()
+    with temporary_database():
+        counts, generated_in, results = run(args)
+
+    commit, dirty = git_revision()
+    report = {
+        'schema': SCHEMA_VERSION,
+        'commit': commit,
+        'dirty': dirty,
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'environment': environment(),
+        'parameters': {
+            'facilities': args.facilities, 'amenities': args.amenities, 'seed': args.seed,
+            'requests': args.requests, 'warmup': args.warmup,
+        },
+        'dataset': {**counts, 'generated_in_s': round(generated_in, 1)},
+        'scenarios': results,
+    }
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(report, ensure_ascii=False, indent=2) + "\n")
+
+    print(f"API benchmark ({counts['facilities']} facilities, {counts['images']} images, "
+          f"{args.requests} requests per scenario, commit {(commit or 'unknown')[:12]}{' (dirty)' if dirty else ''}, "
+          f"{environment()})")
+    print_table(
+        ['scenario', 'req/s', 'p50[ms]', 'p95[ms]', 'p99[ms]', 'queries', 'errors'],
+        [
+            [name, result['throughput'], result['latency_ms']['p50'], result['latency_ms']['p95'],
+             result['latency_ms']['p99'], result['queries']['mean'], result['errors']]
+            for name, result in results.items()
+        ],
+    )
+
+
+if __name__ == '__main__':
+    main()
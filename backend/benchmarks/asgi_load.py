@@ -0,0 +1,205 @@
+"""
+負荷試験: 同じgunicornの設定(gunicorn.conf.py)で、WSGI(gthread)とASGI(uvicornのワーカー + 非同期版のビュー)を比較する
+
+    python -m benchmarks.asgi_load --clients 8 32 --slow-clients 0 16 --duration 10
+
+各条件でサーバーを起動し、次の負荷をかける。
+
+- 通常のクライアント: GET /api/facilities/{id}/ と GET /api/facilities/?page_size=20 を繰り返す
+- 遅いクライアント: リクエストヘッダーを少しずつ(--trickle 秒ごとに1行)送り続ける接続
+
+WSGIのワーカーはリクエストを読み終えるまでスレッドを占有するため、遅いクライアントが
+スレッド数を超えると通常のクライアントが待たされる。
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from . import environment, percentile, print_table
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+SERVERS = {
+    'wsgi (gthread)': {'app': 'config.wsgi:application', 'worker_class': 'gthread'},
+    'asgi (uvicorn)': {'app': 'config.asgi:application', 'worker_class': 'uvicorn_worker.UvicornWorker'},
+}
+
+
+def create_database(path, count):
+    """ベンチマーク用のデータベースを別プロセスで作成する (マイグレーション + データ投入)"""
+    env = {**os.environ, 'DJANGO_SETTINGS_MODULE': 'benchmarks.settings', 'BENCHMARK_DATABASE': str(path)}
+    subprocess.run([sys.executable, 'manage.py', 'migrate', '-v', '0'], cwd=BACKEND_DIR, env=env, check=True)
+    script = (
+        "import django; django.setup();"
+        "from benchmarks.facility_list import populate;"
+        f"populate({count})"
+    )
+    subprocess.run([sys.executable, '-c', script], cwd=BACKEND_DIR, env=env, check=True)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Server:
+    def __init__(self, app, worker_class, database, workers, threads):
+        self.port = free_port()
+        env = {
+            **os.environ,
+            'DJANGO_SETTINGS_MODULE': 'benchmarks.settings',
+            'BENCHMARK_DATABASE': str(database),
+            'GUNICORN_BIND': f'127.0.0.1:{self.port}',
+            'GUNICORN_WORKERS': str(workers),
+            'GUNICORN_THREADS': str(threads),
+            'GUNICORN_WORKER_CLASS': worker_class,
+            'GUNICORN_ACCESSLOG': '',
+        }
+        # 遅いクライアントの影響を見るため、ASGI版でもgunicornのタイムアウトは同じにする
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', app, '-c', 'gunicorn.conf.py', '--access-logfile', '/dev/null'],
+            cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+
+    def wait_ready(self, timeout=20):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                with socket.create_connection(('127.0.0.1', self.port), timeout=0.2):
+                    return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("server did not start")
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait(timeout=30)
+
+
+async def request(port, path, timeout):
+    reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+    try:
+        writer.write(
+            f"GET {path} HTTP/1.1\r\nHost: localhost\r\nAccept: application/json\r\nConnection: close\r\n\r\n".encode()
+        )
+        await writer.drain()
+        data = await asyncio.wait_for(reader.read(), timeout)
+        return data.split(b' ', 2)[1] == b'200'
+    finally:
+        writer.close()
+
+
+async def slow_client(port, trickle, stop):
+    """ヘッダーを少しずつ送り続け、リクエストを完了させない接続"""
+    while not stop.is_set():
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b"GET /api/facilities/ HTTP/1.1\r\nHost: localhost\r\n")
+            await writer.drain()
+            while not stop.is_set() and not reader.at_eof():
+                await asyncio.sleep(trickle)
+                writer.write(f"X-Slow-{random.randrange(10 ** 6)}: 1\r\n".encode())
+                await writer.drain()
+            writer.close()
+        except OSError:
+            await asyncio.sleep(trickle)
+
+
+async def fast_client(port, paths, stop, latencies, counters, timeout):
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            ok = await request(port, random.choice(paths), timeout)
+        except (OSError, asyncio.TimeoutError, IndexError):
+            ok = False
+        if ok:
+            latencies.append(time.perf_counter() - started)
+            counters['ok'] += 1
+        else:
+            counters['errors'] += 1
+
+
+async def load(port, paths, clients, slow_clients, duration, trickle, timeout):
+    stop = asyncio.Event()
+    latencies, counters = [], {'ok': 0, 'errors': 0}
+    slow = [asyncio.create_task(slow_client(port, trickle, stop)) for _ in range(slow_clients)]
+    await asyncio.sleep(min(1.0, trickle * 2))     # 遅いクライアントが先に接続する
+    fast = [
+        asyncio.create_task(fast_client(port, paths, stop, latencies, counters, timeout))
+        for _ in range(clients)
+    ]
+    started = time.perf_counter()
+    await asyncio.sleep(duration)
+    stop.set()
+    await asyncio.gather(*fast, return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    for task in slow:
+        task.cancel()
+    await asyncio.gather(*slow, return_exceptions=True)
+    return latencies, counters, elapsed
+
+
+def run(args, database):
+    paths = [f"/api/facilities/{pk}/" for pk in range(1, args.facilities + 1)] + ["/api/facilities/?page_size=20"]
+    rows = []
+    for name, server_args in SERVERS.items():
+        server = Server(database=database, workers=args.workers, threads=args.threads, **server_args)
+        try:
+            server.wait_ready()
+            # ウォームアップ (ペイロードキャッシュを埋める)
+            asyncio.run(load(server.port, paths, 4, 0, 2, args.trickle, args.timeout))
+            for slow_clients in args.slow_clients:
+                for clients in args.clients:
+                    latencies, counters, elapsed = asyncio.run(
+                        load(server.port, paths, clients, slow_clients, args.duration, args.trickle, args.timeout)
+                    )
+                    rows.append([
+                        name, clients, slow_clients,
+                        f"{counters['ok'] / elapsed:.0f}",
+                        f"{percentile(latencies, 0.5) * 1000:.1f}",
+                        f"{percentile(latencies, 0.95) * 1000:.1f}",
+                        f"{percentile(latencies, 0.99) * 1000:.1f}",
+                        counters['errors'],
+                    ])
+        finally:
+            server.stop()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--facilities', type=int, default=200)
+    parser.add_argument('--clients', type=int, nargs='+', default=[8, 32], help="同時に接続する通常のクライアント数")
+    parser.add_argument('--slow-clients', type=int, nargs='+', default=[0, 16], help="遅いクライアント数")
+    parser.add_argument('--duration', type=float, default=10, help="各条件の計測時間(秒)")
+    parser.add_argument('--workers', type=int, default=1, help="gunicornのワーカー数")
+    parser.add_argument('--threads', type=int, default=4, help="WSGI(gthread)のスレッド数")
+    parser.add_argument('--trickle', type=float, default=0.5, help="遅いクライアントがヘッダーを送る間隔(秒)")
+    parser.add_argument('--timeout', type=float, default=10, help="通常のクライアントのタイムアウト(秒)")
+    args = parser.parse_args()
+
+    directory = Path(tempfile.mkdtemp(prefix='asgi-load-'))
+    try:
+        database = directory / 'db.sqlite3'
+        create_database(database, args.facilities)
+        rows = run(args, database)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print(f"ASGI/WSGI load test ({args.facilities} facilities, {args.workers} worker(s), "
+          f"{args.threads} threads for WSGI, {environment()})")
+    print_table(['server', 'clients', 'slow clients', 'req/s', 'p50[ms]', 'p95[ms]', 'p99[ms]', 'errors'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+空き施設検索のベンチマーク: 施設数 × 2年分のカレンダーに対する検索の所要時間
+
+    python -m benchmarks.availability_search --facilities 5000 --repeat 20
+
+各施設の各夜を --occupancy の確率で埋まっているものとしてランダムに生成する (シード固定)。
+比較のため、日付ごとの在庫を保持した Beds24SyncState.calendar (JSON) を走査する素朴な方法も計測する。
+"""
+
+import argparse
+import datetime
+import random
+import statistics
+import time
+
+from . import environment, print_table, setup_django, temporary_database
+
+YEARS = (2026, 2027)
+
+# (名前, チェックイン, チェックアウト)
+SCENARIOS = [
+    ('1 night', datetime.date(2026, 7, 10), datetime.date(2026, 7, 11)),
+    ('3 nights', datetime.date(2026, 8, 1), datetime.date(2026, 8, 4)),
+    ('2 weeks', datetime.date(2026, 9, 1), datetime.date(2026, 9, 15)),
+    ('new year', datetime.date(2026, 12, 29), datetime.date(2027, 1, 3)),
+    ('90 nights', datetime.date(2027, 3, 1), datetime.date(2027, 5, 30)),
+]
+
+
+def populate(count, occupancy, seed):
+    from facilities.availability import to_bytes
+    from facilities.models import Beds24SyncState, Facility, FacilityAvailability
+
+    rng = random.Random(seed)
+    facilities = Facility.objects.bulk_create([
+        Facility(facility_name=f"施設{i}", address="住所", capacity=rng.randint(1, 10))
+        for i in range(count)
+    ])
+    rows, states = [], []
+    for facility in facilities:
+        calendar = {}
+        for year in YEARS:
+            days = (datetime.date(year + 1, 1, 1) - datetime.date(year, 1, 1)).days
+            value = 0
+            for day in range(days):
+                available = rng.random() >= occupancy
+                value |= available << day
+                calendar[(datetime.date(year, 1, 1) + datetime.timedelta(days=day)).isoformat()] = {
+                    'available': int(available),
+                }
+            rows.append(FacilityAvailability(facility=facility, year=year, nights=to_bytes(value)))
+        states.append(Beds24SyncState(facility=facility, calendar=calendar))
+    FacilityAvailability.objects.bulk_create(rows, batch_size=2000)
+    Beds24SyncState.objects.bulk_create(states, batch_size=500)
+
+
+def naive_search(check_in, check_out, guests):
+    """Beds24SyncState.calendar を施設ごとに1日ずつ確認する"""
+    from facilities.models import Beds24SyncState
+
+    days = [(check_in + datetime.timedelta(days=i)).isoformat() for i in range((check_out - check_in).days)]
+    found = []
+    states = Beds24SyncState.objects.filter(facility__capacity__gte=guests).values_list('facility_id', 'calendar')
+    for facility_id, calendar in states.iterator(chunk_size=500):
+        if all(calendar.get(day, {}).get('available', 0) > 0 for day in days):
+            found.append(facility_id)
+    return sorted(found)
+
+
+def measure(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        timings.append((time.perf_counter() - started) * 1000)
+    return result, statistics.median(timings), max(timings)
+
+
+def run(count, occupancy, guests, repeat, seed):
+    from facilities import availability
+
+    populate(count, occupancy, seed)
+    rows = []
+    for name, check_in, check_out in SCENARIOS:
+        found, median, worst = measure(lambda: availability.search(check_in, check_out, guests), repeat)
+        expected, naive_median, _ = measure(lambda: naive_search(check_in, check_out, guests), max(1, repeat // 10))
+        assert found == expected, name
+        rows.append([
+            name, len(found),
+            f"{median:.1f}", f"{worst:.1f}", f"{naive_median:.1f}", f"{naive_median / median:.0f}x",
+        ])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--facilities', type=int, default=5000)
+    parser.add_argument('--occupancy', type=float, default=0.3, help="各夜が埋まっている確率")
+    parser.add_argument('--guests', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    setup_django()
+    with temporary_database():
+        rows = run(args.facilities, args.occupancy, args.guests, args.repeat, args.seed)
+
+    print(f"Availability search benchmark ({args.facilities} facilities x {len(YEARS)} years, "
+          f"occupancy {args.occupancy:.0%}, guests {args.guests}, {environment()})")
+    print_table(['range', 'found', 'bitmap p50[ms]', 'bitmap max[ms]', 'json calendar p50[ms]', 'speedup'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Beds24同期のベンチマーク: 施設数・同時実行数ごとの全件同期/差分同期の所要時間
+
+    python -m benchmarks.beds24_sync --facilities 100 500 2000 --concurrency 1 8 32 --latency 0.02
+
+ローカルのスタブサーバー(応答遅延 --latency 秒)に対して実行する。
+"""
+
+import argparse
+
+from . import environment, print_table, setup_django, temporary_database
+
+
+def run(facility_counts, concurrencies, latency, horizon_days):
+    from facilities.beds24 import Beds24Client
+    from facilities.beds24_stub import Beds24Stub
+    from facilities.models import Beds24SyncState, Facility
+    from facilities.sync import Beds24Sync
+
+    rows = []
+    for count in facility_counts:
+        Facility.objects.all().delete()
+        Facility.objects.bulk_create([
+            Facility(facility_name=f"施設{i}", address="住所", prop_key=f"prop{i}", room_key=f"room{i}")
+            for i in range(count)
+        ])
+        for concurrency in concurrencies:
+            Beds24SyncState.objects.all().delete()
+            with Beds24Stub(latency=latency) as stub, \
+                    Beds24Client(base_url=stub.url, api_key='bench', pool_size=concurrency) as client:
+                sync = Beds24Sync(client=client, concurrency=concurrency, horizon_days=horizon_days)
+                full = sync.run()
+                incremental = sync.run()
+                rows.append([
+                    count, concurrency,
+                    f"{full.elapsed:.2f}", full.requests, f"{count / full.elapsed:.0f}",
+                    f"{incremental.elapsed:.2f}", incremental.requests,
+                    stub.connections,
+                ])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--facilities', type=int, nargs='+', default=[100, 500, 2000])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--latency', type=float, default=0.02, help="スタブサーバーの応答遅延(秒)")
+    parser.add_argument('--horizon-days', type=int, default=365)
+    args = parser.parse_args()
+
+    setup_django()
+    with temporary_database():
+        rows = run(args.facilities, args.concurrency, args.latency, args.horizon_days)
+
+    print(f"Beds24 sync benchmark (stub latency {args.latency * 1000:.0f} ms, {environment()})")
+    print_table(
+        ['facilities', 'concurrency', 'full[s]', 'requests', 'facilities/s',
+         'incremental[s]', 'requests', 'connections'],
+        rows,
+    )
+
+
+if __name__ == '__main__':
+    main()
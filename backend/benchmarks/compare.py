@@ -0,0 +1,82 @@
+"""
+benchmarks.api の結果(JSON)を比較する
+
+    python -m benchmarks.compare results/before.json results/after.json --threshold 10
+
+シナリオごとに、スループット・p50/p95/p99・SQLの実行回数の変化を表示する。
+p50/p95が --threshold %以上遅くなったか、SQLの実行回数が増えたシナリオがあれば終了コード1で終わる (CI用)。
+p99は少ないリクエスト数ではばらつきが大きいため、表示だけで判定には使わない。
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+from . import print_table
+
+LATENCIES = ('p50', 'p95', 'p99')
+GATED_LATENCIES = ('p50', 'p95')
+
+
+def load(path):
+    report = json.loads(Path(path).read_text())
+    if report.get('schema') != 1:
+        raise SystemExit(f"{path}: unsupported result schema {report.get('schema')!r}")
+    return report
+
+
+def change(before, after):
+    if not before:
+        return "n/a"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def compare(before, after, threshold):
+    """(表の行, 悪化したシナリオの説明のリスト) を返す"""
+    rows, regressions = [], []
+    for name, new in after['scenarios'].items():
+        old = before['scenarios'].get(name)
+        if old is None:
+            rows.append([name, '(new)', new['throughput'], '', *(new['latency_ms'][q] for q in LATENCIES), new['queries']['mean']])
+            continue
+        row = [name, old['throughput'], new['throughput'], change(old['throughput'], new['throughput'])]
+        for q in LATENCIES:
+            old_ms, new_ms = old['latency_ms'][q], new['latency_ms'][q]
+            row.append(f"{old_ms} -> {new_ms} ({change(old_ms, new_ms)})")
+            if q in GATED_LATENCIES and old_ms and (new_ms - old_ms) / old_ms * 100 >= threshold:
+                regressions.append(f"{name}: {q} {old_ms}ms -> {new_ms}ms")
+        row.append(f"{old['queries']['mean']} -> {new['queries']['mean']}")
+        if new['queries']['mean'] > old['queries']['mean']:
+            regressions.append(f"{name}: queries {old['queries']['mean']} -> {new['queries']['mean']}")
+        if new['errors'] > old['errors']:
+            regressions.append(f"{name}: errors {old['errors']} -> {new['errors']}")
+        rows.append(row)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('before', type=Path)
+    parser.add_argument('after', type=Path)
+    parser.add_argument('--threshold', type=float, default=10, help="悪化とみなすp50/p95の増加率(%%)")
+    args = parser.parse_args()
+
+    before, after = load(args.before), load(args.after)
+    if before['parameters'] != after['parameters']:
+        print(f"warning: parameters differ: {before['parameters']} / {after['parameters']}")
+    if before['environment'] != after['environment']:
+        print(f"warning: environments differ: {before['environment']} / {after['environment']}")
+
+    print(f"{(before['commit'] or 'unknown')[:12]} -> {(after['commit'] or 'unknown')[:12]}")
+    rows, regressions = compare(before, after, args.threshold)
+    print_table(['scenario', 'req/s before', 'req/s after', 'change', *LATENCIES, 'queries'], rows)
+    if regressions:
+        print("\nRegressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
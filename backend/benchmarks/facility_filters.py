@@ -0,0 +1,159 @@
+"""
+施設一覧の絞り込みのベンチマーク: インデックスの有無と「すべてのアメニティを持つ」の実装方法の比較
+
+    python -m benchmarks.facility_filters --facilities 10000 50000 --repeat 20
+
+施設ごとに人数・駐車場・管理形態・アメニティ(--amenities 種類から数個)をランダムに割り当てる (シード固定)。
+各シナリオについて、次を計測する。
+
+- 絞り込み結果のID取得 (インデックスあり / なし)
+- 「すべてのアメニティを持つ」を GROUP BY 1回で行う場合と、アメニティごとにJOINを重ねる場合
+- API (GET /api/facilities/?page_size=50&...) の応答時間
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+from . import environment, print_table, setup_django, temporary_database
+
+INDEXES = [
+    ('facilities_facility', 'facility_capacity_idx', 'capacity'),
+    ('facilities_facility', 'facility_parking_idx', 'num_parking'),
+    ('facilities_facility', 'facility_mgmt_capacity_idx', 'management_entity, capacity'),
+    ('facilities_facility_amenities', 'facility_amenity_lookup_idx', 'amenity_id, facility_id'),
+]
+
+
+def populate(count, amenity_count, seed):
+    from facilities.models import Amenity, Facility
+
+    rng = random.Random(seed)
+    amenities = Amenity.objects.bulk_create([Amenity(name=f"アメニティ{i}") for i in range(amenity_count)])
+    facilities = Facility.objects.bulk_create([
+        Facility(
+            facility_name=f"施設{i}", address="住所",
+            capacity=rng.randint(1, 20), num_parking=rng.choice([0, 0, 1, 1, 2, 3, 5]),
+            management_entity=rng.choice(Facility.ManagementType.values),
+        )
+        for i in range(count)
+    ], batch_size=2000)
+    # 上位のアメニティほど多くの施設が持つようにする (Wi-Fiは多く、サウナは少ない、など)
+    weights = [1 / (i + 1) for i in range(amenity_count)]
+    Through = Facility.amenities.through
+    rows = []
+    for facility in facilities:
+        chosen = {amenity.pk for amenity in rng.choices(amenities, weights=weights, k=rng.randint(2, 8))}
+        rows += [Through(facility_id=facility.pk, amenity_id=pk) for pk in chosen]
+    Through.objects.bulk_create(rows, batch_size=5000)
+    return [amenity.pk for amenity in amenities]
+
+
+def scenarios(amenity_ids):
+    return [
+        ('capacity>=16', {'capacity__gte': 16}),
+        ('parking>=3', {'num_parking__gte': 3}),
+        ('contract, capacity>=10', {'management_entity': 'CM', 'capacity__gte': 10}),
+        ('2 amenities', {'amenities': amenity_ids[:2]}),
+        ('4 amenities', {'amenities': amenity_ids[:4]}),
+        ('4 amenities, capacity>=8', {'amenities': amenity_ids[:4], 'capacity__gte': 8}),
+    ]
+
+
+def filtered(params, chained=False):
+    from facilities.filters import facilities_with_all_amenities
+    from facilities.models import Facility
+
+    queryset = Facility.objects.filter(**{k: v for k, v in params.items() if k != 'amenities'})
+    amenity_ids = params.get('amenities')
+    if amenity_ids and chained:
+        # 比較用: アメニティごとにJOINを重ねる素朴な方法
+        for pk in amenity_ids:
+            queryset = queryset.filter(amenities=pk)
+    elif amenity_ids:
+        queryset = queryset.filter(pk__in=facilities_with_all_amenities(amenity_ids))
+    return queryset
+
+
+def measure(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return result, statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def set_indexes(enabled):
+    from django.db import connection
+
+    with connection.cursor() as cursor:
+        for table, name, columns in INDEXES:
+            if enabled:
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+            else:
+                cursor.execute(f"DROP INDEX IF EXISTS {name}")
+        cursor.execute("ANALYZE")
+
+
+def run(count, amenity_count, repeat, seed):
+    from django.test import Client
+    from facilities import cache
+
+    amenity_ids = populate(count, amenity_count, seed)
+    client = Client()
+    rows = []
+    for name, params in scenarios(amenity_ids):
+        ids = lambda **kwargs: list(filtered(params, **kwargs).values_list('id', flat=True))
+
+        set_indexes(False)
+        expected, no_index, _ = measure(ids, repeat)
+        set_indexes(True)
+        found, indexed, indexed_p95 = measure(ids, repeat)
+        chained_ids, chained, _ = measure(lambda: ids(chained=True), repeat)
+        assert sorted(found) == sorted(expected) == sorted(chained_ids), name
+
+        query = {k: ','.join(map(str, v)) if isinstance(v, list) else v for k, v in params.items()}
+        query['page_size'] = 50
+
+        def request():
+            cache.clear()
+            response = client.get('/api/facilities/', query, HTTP_HOST='localhost')
+            assert response.status_code == 200, response.content
+        _, api, api_p95 = measure(request, repeat)
+
+        rows.append([
+            count, name, len(found),
+            f"{no_index:.2f}", f"{indexed:.2f}", f"{indexed_p95:.2f}",
+            f"{chained:.2f}" if 'amenities' in params else '-',
+            f"{api:.1f}", f"{api_p95:.1f}",
+        ])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--facilities', type=int, nargs='+', default=[10000])
+    parser.add_argument('--amenities', type=int, default=30, help="アメニティの種類数")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    setup_django()
+    rows = []
+    for count in args.facilities:
+        with temporary_database():
+            rows += run(count, args.amenities, args.repeat, args.seed)
+
+    print(f"Facility filter benchmark ({args.amenities} amenities, {environment()})")
+    print_table(
+        ['facilities', 'filter', 'matched', 'no index p50[ms]', 'indexed p50[ms]', 'indexed p95[ms]',
+         'chained joins p50[ms]', 'API p50[ms]', 'API p95[ms]'],
+        rows,
+    )
+
+
+if __name__ == '__main__':
+    main()
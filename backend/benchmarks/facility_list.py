@@ -0,0 +1,110 @@
+"""
+施設一覧(GET /api/facilities/)のシリアライズのベンチマーク: 変更前(FacilitySerializer + JSONRenderer)と
+.values() から組み立てる経路(facilities.payloads + FastJSONRenderer)の比較
+
+    python -m benchmarks.facility_list --facilities 1000 5000 --repeat 10
+
+- cold: 毎回ペイロードキャッシュを空にする (全施設を組み立てる)
+- warm: ペイロードキャッシュに載った状態 (出力のレンダリングのみ)
+"""
+
+import argparse
+import time
+
+from . import environment, print_table, setup_django, temporary_database
+
+
+def populate(count):
+    from facilities.models import Amenity, Facility, FacilityImage
+
+    amenities = Amenity.objects.bulk_create([Amenity(name=f"アメニティ{i}") for i in range(20)])
+    facilities = Facility.objects.bulk_create([
+        Facility(
+            facility_name=f"施設{i}", address=f"京都府京都市下京区{i}", capacity=4, num_parking=1,
+            short_description="駅から徒歩5分", description="観光に便利な町家です。" * 20,
+            map_url="https://maps.google.com/?q=35.0,135.7",
+        )
+        for i in range(count)
+    ], batch_size=2000)
+    Through = Facility.amenities.through
+    Through.objects.bulk_create([
+        Through(facility_id=facility.pk, amenity_id=amenities[(facility.pk + j) % 20].pk)
+        for facility in facilities for j in range(5)
+    ], batch_size=5000)
+    variants = [
+        {'name': f"facilities/images/photo__w{width}.{ext}", 'width': width, 'height': width * 3 // 4, 'format': fmt}
+        for width in (320, 640, 1280) for fmt, ext in (('webp', 'webp'), ('jpeg', 'jpg'))
+    ]
+    FacilityImage.objects.bulk_create([
+        FacilityImage(facility=facility, image=f"facilities/images/{facility.pk}_{j}.jpg", variants=variants)
+        for facility in facilities for j in range(3)
+    ], batch_size=2000)
+
+
+def measure(client, count, repeat, cold):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from facilities import cache
+
+    wall = cpu = 0.0
+    size = queries = 0
+    for _ in range(repeat):
+        if cold:
+            cache.clear()
+        with CaptureQueriesContext(connection) as captured:
+            started, started_cpu = time.perf_counter(), time.process_time()
+            response = client.get('/api/facilities/', HTTP_HOST='localhost')
+            wall += time.perf_counter() - started
+            cpu += time.process_time() - started_cpu
+        assert response.status_code == 200
+        size, queries = len(response.content), len(captured)
+    return [
+        f"{repeat / wall:.2f}", f"{cpu / repeat / count * 1000 * 1000:.1f}", queries, f"{size / 1024:.0f}",
+    ], response.content
+
+
+def run(counts, repeat):
+    from django.test import Client, override_settings
+    from rest_framework.renderers import BrowsableAPIRenderer, JSONRenderer
+    from facilities.views import FacilityViewSet
+
+    client = Client()
+    fast_renderers = FacilityViewSet.renderer_classes
+    rows = []
+    for count in counts:
+        populate(count)
+        for cold in (True, False):
+            client.get('/api/facilities/', HTTP_HOST='localhost')   # ウォームアップ
+            try:
+                FacilityViewSet.renderer_classes = [JSONRenderer, BrowsableAPIRenderer]
+                with override_settings(FACILITIES_FAST_PAYLOADS=False):
+                    before, before_content = measure(client, count, repeat, cold)
+            finally:
+                FacilityViewSet.renderer_classes = fast_renderers
+            after, after_content = measure(client, count, repeat, cold)
+            assert before_content == after_content, "出力が一致しません"
+            mode = 'cold' if cold else 'warm'
+            rows.append([count, mode, 'serializer + json', *before])
+            rows.append([count, mode, 'values + orjson', *after])
+        from facilities.models import Amenity, Facility
+        Facility.objects.all().delete()
+        Amenity.objects.all().delete()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--facilities', type=int, nargs='+', default=[1000, 5000])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    setup_django()
+    with temporary_database():
+        rows = run(args.facilities, args.repeat)
+
+    print(f"Facility list serialization benchmark (3 images, 5 amenities per facility, {environment()})")
+    print_table(['facilities', 'cache', 'path', 'requests/s', 'CPU ms/1000 facilities', 'queries', 'KiB'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+位置による検索(?bbox= / ?near=)のベンチマーク: グリッドの索引と、索引を使わない方法の比較
+
+    python -m benchmarks.geo_queries --facilities 10000 50000 --repeat 20
+
+ポートフォリオ(benchmarks.portfolio、地図のURLは10の地域に集中する)を生成し、
+地図のURLから座標を設定(geocode_facilities と同じ処理)してから、各シナリオについて次を計測する。
+
+- 範囲: グリッドの索引 (facilities.geo.within) と、索引を削除して緯度・経度だけで絞り込む場合 (全件の走査)
+- 近傍: 半径を広げながらの検索 (facilities.geo.nearest) と、全施設の座標を読んで距離で並べる場合
+- API (GET /api/facilities/?bbox=...&page_size=50 / ?near=...&k=N) の応答時間
+"""
+
+import argparse
+import time
+
+from . import environment, print_table, setup_django, temporary_database
+from .facility_filters import measure
+
+INDEX = ('facility_geo_cell_idx', 'facilities_facility', 'geo_cell, latitude, longitude')
+
+# (名前, 範囲 min_lat,min_lng,max_lat,max_lng)。京都府京都市東山区の施設は (35.00, 135.78) の周り ±0.05度に集中する
+BBOXES = [
+    ('bbox 1km', (34.995, 135.775, 35.005, 135.786)),
+    ('bbox 5km', (34.98, 135.75, 35.02, 135.80)),
+    ('bbox area', (34.95, 135.73, 35.05, 135.83)),
+    ('bbox Kansai', (34.0, 135.0, 35.5, 136.5)),
+    ('bbox Nagoya (empty)', (35.1, 136.8, 35.3, 137.0)),
+]
+# (名前, 中心, k)
+NEAREST = [
+    ('near k=10', (35.00, 135.78), 10),
+    ('near k=100', (35.00, 135.78), 100),
+    ('near k=10 sparse', (35.17, 136.88), 10),      # 名古屋: 近くに施設がなく、京都・金沢まで広げる
+]
+
+
+def set_index(enabled):
+    from django.db import connection
+
+    name, table, columns = INDEX
+    with connection.cursor() as cursor:
+        if enabled:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+        else:
+            cursor.execute(f"DROP INDEX IF EXISTS {name}")
+        cursor.execute("ANALYZE")
+
+
+def bbox_ids(box, indexed):
+    from django.db.models import Q
+    from facilities import geo
+    from facilities.models import Facility
+
+    if indexed:
+        condition = geo.within(*box)
+    else:
+        min_lat, min_lng, max_lat, max_lng = box
+        condition = Q(latitude__gte=min_lat, latitude__lte=max_lat, longitude__gte=min_lng, longitude__lte=max_lng)
+    return sorted(Facility.objects.filter(condition).values_list('pk', flat=True))
+
+
+def nearest_ids(center, k, indexed):
+    from facilities import geo
+    from facilities.models import Facility
+
+    if indexed:
+        return [pk for pk, _ in geo.nearest(Facility.objects.all(), *center, k)]
+    # 比較用: 全施設の座標を読み、距離で並べる
+    rows = Facility.objects.exclude(latitude=None).values_list('pk', 'latitude', 'longitude')
+    return [pk for _, pk in sorted((geo.distance(*center, lat, lng), pk) for pk, lat, lng in rows)[:k]]
+
+
+def run(count, repeat, seed):
+    from django.test import Client
+    from facilities import cache, geo
+    from .portfolio import generate
+
+    generate(count, seed=seed)
+    started = time.perf_counter()
+    report = geo.fill_coordinates()
+    geocoded_in = time.perf_counter() - started
+    assert report.updated == count, report
+
+    client = Client()
+    scenarios = [(name, 'bbox', box) for name, box in BBOXES] + [(name, 'near', (center, k)) for name, center, k in NEAREST]
+    rows = []
+    for name, kind, params in scenarios:
+        if kind == 'bbox':
+            find = lambda indexed: bbox_ids(params, indexed)
+            query = {'bbox': ','.join(map(str, params)), 'page_size': 50}
+        else:
+            center, k = params
+            find = lambda indexed: nearest_ids(center, k, indexed)
+            query = {'near': ','.join(map(str, center)), 'k': k}
+
+        set_index(False)
+        expected, scan, _ = measure(lambda: find(False), repeat)
+        set_index(True)
+        found, indexed, indexed_p95 = measure(lambda: find(True), repeat)
+        assert found == expected, name
+
+        def request():
+            cache.clear()
+            response = client.get('/api/facilities/', query, HTTP_HOST='localhost')
+            assert response.status_code == 200, response.content
+        _, api, api_p95 = measure(request, repeat)
+
+        rows.append([
+            count, name, len(found),
+            f"{scan:.2f}", f"{indexed:.2f}", f"{indexed_p95:.2f}", f"{scan / indexed:.0f}x",
+            f"{api:.1f}", f"{api_p95:.1f}",
+        ])
+    return geocoded_in, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--facilities', type=int, nargs='+', default=[50000])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    setup_django()
+    rows, geocoded = [], []
+    for count in args.facilities:
+        with temporary_database():
+            geocoded_in, result = run(count, args.repeat, args.seed)
+        geocoded.append(f"{count}: {geocoded_in:.1f}s")
+        rows += result
+
+    print(f"Geo query benchmark ({environment()})")
+    print(f"Coordinates from map_url (geocode_facilities): {', '.join(geocoded)}")
+    print_table(
+        ['facilities', 'query', 'matched', 'scan p50[ms]', 'grid p50[ms]', 'grid p95[ms]', 'speedup',
+         'API p50[ms]', 'API p95[ms]'],
+        rows,
+    )
+
+
+if __name__ == '__main__':
+    main()
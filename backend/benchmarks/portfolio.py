@@ -0,0 +1,136 @@
+"""
+ベンチマーク用の施設データ(ポートフォリオ)の生成
+
+シードを固定すれば同じデータになる。施設ごとに人数・駐車場・管理形態・説明文・住所・地図のURLを変え、
+アメニティ(既定で60種類)から数個、画像(派生画像の情報付き)を0〜8枚割り当てる。
+画像のファイル自体は作らない (一覧・詳細の出力にはファイル名しか使わないため)。
+
+別プロセスのサーバー用にデータベースファイルを作る場合:
+
+    python -m benchmarks.portfolio --facilities 100000 --database /tmp/portfolio.sqlite3
+"""
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+AREAS = [
+    ("北海道函館市", 41.77, 140.73), ("北海道札幌市中央区", 43.06, 141.35), ("京都府京都市東山区", 35.00, 135.78),
+    ("京都府京都市下京区", 34.99, 135.76), ("東京都台東区", 35.71, 139.79), ("大阪府大阪市中央区", 34.68, 135.51),
+    ("沖縄県那覇市", 26.21, 127.68), ("長野県白馬村", 36.70, 137.86), ("石川県金沢市", 36.56, 136.66),
+    ("福岡県福岡市博多区", 33.59, 130.42),
+]
+KINDS = ["町家", "一棟貸し", "ゲストハウス", "コンドミニアム", "古民家", "ヴィラ", "アパートメント"]
+FEATURES = ["駅近", "オーシャンビュー", "庭付き", "温泉付き", "ファミリー向け", "ペット可", "長期滞在向け", "リノベーション済み"]
+AMENITY_NAMES = [
+    "Wi-Fi", "駐車場", "キッチン", "洗濯機", "乾燥機", "エアコン", "暖房", "テレビ", "電子レンジ", "冷蔵庫",
+    "ドライヤー", "アイロン", "バスタブ", "シャワー", "ベビーベッド", "ワークスペース", "BBQ設備", "庭", "バルコニー", "暖炉",
+]
+VARIANT_WIDTHS = (320, 640, 1280)
+VARIANT_FORMATS = (('webp', 'webp'), ('jpeg', 'jpg'))
+
+
+def amenity_names(count):
+    names = AMENITY_NAMES[:count]
+    return names + [f"アメニティ{i}" for i in range(len(names), count)]
+
+
+def image_row(rng, facility_id, index):
+    stem = f"facilities/images/{facility_id}_{index}.{rng.getrandbits(48):012x}"
+    return {
+        'name': f"{stem}.jpg",
+        'caption': rng.choice(["外観", "リビング", "寝室", "キッチン", "浴室", "眺望", ""]),
+        'variants': [
+            {
+                'name': f"{stem}__w{width}.{rng.getrandbits(48):012x}.{ext}",
+                'width': width, 'height': width * 2 // 3, 'format': fmt,
+            }
+            for width in VARIANT_WIDTHS for fmt, ext in VARIANT_FORMATS
+        ],
+    }
+
+
+def generate(facilities, seed=0, amenities=60, max_images=8, batch_size=5000):
+    """
+    施設・アメニティ・画像を登録し、件数を返す
+    bulk_create で登録するため、検索インデックスなどのシグナルによる後処理は行わない (必要なら呼び出し側で作る)
+    """
+    from facilities.models import Amenity, Facility, FacilityImage
+
+    rng = random.Random(seed)
+    amenity_ids = [
+        amenity.pk for amenity in Amenity.objects.bulk_create([Amenity(name=name) for name in amenity_names(amenities)])
+    ]
+    Through = Facility.amenities.through
+    counts = {'facilities': 0, 'amenities': len(amenity_ids), 'facility_amenities': 0, 'images': 0}
+
+    for start in range(0, facilities, batch_size):
+        rows = []
+        for i in range(start, min(start + batch_size, facilities)):
+            area, lat, lng = rng.choice(AREAS)
+            kind, feature = rng.choice(KINDS), rng.choice(FEATURES)
+            rows.append(Facility(
+                facility_name=f"{area[3:]}の{kind} {i}",
+                capacity=rng.choice([2, 2, 3, 4, 4, 4, 5, 6, 6, 8, 10, 12]),
+                num_parking=rng.choice([0, 0, 1, 1, 1, 2, 3]),
+                management_entity=rng.choice(Facility.ManagementType.values),
+                short_description=f"{feature}の{kind}",
+                description=f"{area}にある{feature}の{kind}です。" * rng.randint(3, 30),
+                address=f"{area}{rng.randint(1, 9)}丁目{rng.randint(1, 30)}-{rng.randint(1, 20)}",
+                map_url=(
+                    f"https://www.google.com/maps?q={lat + rng.uniform(-0.05, 0.05):.6f},"
+                    f"{lng + rng.uniform(-0.05, 0.05):.6f}"
+                ),
+            ))
+        created = Facility.objects.bulk_create(rows)
+
+        links, images = [], []
+        for facility in created:
+            for amenity_id in rng.sample(amenity_ids, rng.randint(3, min(12, len(amenity_ids)))):
+                links.append(Through(facility_id=facility.pk, amenity_id=amenity_id))
+            for index in range(rng.randint(0, max_images)):
+                row = image_row(rng, facility.pk, index)
+                images.append(FacilityImage(
+                    facility_id=facility.pk, image=row['name'], caption=row['caption'], variants=row['variants'],
+                ))
+        Through.objects.bulk_create(links, batch_size=batch_size)
+        FacilityImage.objects.bulk_create(images, batch_size=batch_size)
+        counts['facilities'] += len(created)
+        counts['facility_amenities'] += len(links)
+        counts['images'] += len(images)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--facilities', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--amenities', type=int, default=60)
+    parser.add_argument('--database', required=True, help="作成するSQLiteのファイル (既存のファイルは上書きする)")
+    args = parser.parse_args()
+
+    database = Path(args.database).resolve()
+    database.unlink(missing_ok=True)
+    env = {**os.environ, 'DJANGO_SETTINGS_MODULE': 'benchmarks.settings', 'BENCHMARK_DATABASE': str(database)}
+    subprocess.run([sys.executable, 'manage.py', 'migrate', '-v', '0'], cwd=BACKEND_DIR, env=env, check=True)
+
+    os.environ.update(env)
+    import django
+    django.setup()
+    from facilities import geo, search
+
+    started = time.perf_counter()
+    counts = generate(args.facilities, seed=args.seed, amenities=args.amenities)
+    search.rebuild()
+    geo.fill_coordinates()
+    print(f"Generated {counts} in {time.perf_counter() - started:.1f}s -> {database}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+"""
+別プロセスでサーバーを起動するベンチマーク用の設定 (DJANGO_SETTINGS_MODULE=benchmarks.settings)
+
+config.settings と同じで、データベースだけを環境変数 BENCHMARK_DATABASE のファイルに切り替える
+"""
+import os
+
+from config.settings import *  # noqa: F401,F403
+from config.settings import DATABASES
+
+DATABASES['default']['NAME'] = os.environ['BENCHMARK_DATABASE']
+DEBUG = False
@@ -0,0 +1,199 @@
+"""
+変更のイベントの配信(GET /api/events/)のベンチマーク: 待機中の接続を数千本開いた状態で、変更がどれだけ速く全員に届くかを計測する
+
+    python -m benchmarks.sse_fanout --connections 1000 5000 --rounds 20
+
+各条件でASGIサーバー(gunicorn + uvicornのワーカー、既定の LocalBroker はワーカー内で配信するため1ワーカー)を起動し、
+
+1. --connections 本のSSEの接続(?types=facility)を開いて待機させる (接続にかかった時間とサーバーのメモリを計測)
+2. PATCH /api/facilities/{id}/ を --rounds 回送り、送信してから各接続にイベントが届くまでの時間を計測する
+
+クライアントも同じマシンの1プロセス(asyncio)で動かすため、届くまでの時間にはクライアント側の受信処理の待ちも含まれる。
+"""
+
+import argparse
+import asyncio
+import json
+import resource
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from . import environment, percentile, print_table
+from .asgi_load import Server, create_database
+
+
+def raise_open_files_limit(connections):
+    """接続数がファイルディスクリプタの上限を超えないようにする (サーバーのプロセスにも引き継がれる)"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = connections * 2 + 256
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def rss_kb(pid):
+    """プロセスとその子プロセス(gunicornのワーカー)の常駐メモリの合計 (KB、Linuxのみ)"""
+    total = 0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            status = Path(f'/proc/{current}/status').read_text()
+            children = Path(f'/proc/{current}/task/{current}/children').read_text().split()
+        except OSError:
+            continue
+        total += next((int(line.split()[1]) for line in status.splitlines() if line.startswith('VmRSS:')), 0)
+        pids += [int(child) for child in children]
+    return total
+
+
+class Listener:
+    """1本のSSEの接続 (届いた施設のイベントの時刻を記録する)"""
+
+    def __init__(self, port, received):
+        self.port = port
+        self.received = received    # {施設ID: [届いた時刻, ...]}
+        self.reader = self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        self.writer.write(
+            b"GET /api/events/?types=facility HTTP/1.1\r\nHost: localhost\r\nAccept: text/event-stream\r\n\r\n"
+        )
+        await self.writer.drain()
+        # ヘッダーと最初のメッセージ(retry / resync)が届いたら接続完了
+        await self.reader.readuntil(b"event: resync\n")
+
+    async def listen(self):
+        # チャンク転送の区切り(長さの行)は data: で始まらないため、行単位で読めばよい
+        while line := await self.reader.readline():
+            if line.startswith(b'data: {"type":"facility"'):
+                event = json.loads(line[len(b'data: '):])
+                self.received.setdefault(event['id'], []).append(time.perf_counter())
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def patch(port, facility_id, capacity):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        body = json.dumps({'capacity': capacity}).encode()
+        writer.write(
+            f"PATCH /api/facilities/{facility_id}/ HTTP/1.1\r\nHost: localhost\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+        return (await reader.read()).split(b' ', 2)[1] == b'200'
+    finally:
+        writer.close()
+
+
+async def fanout(server, connections, rounds, interval, batch):
+    received = {}
+    listeners = [Listener(server.port, received) for _ in range(connections)]
+    rss_before = rss_kb(server.process.pid)
+    started = time.perf_counter()
+    # 同時に接続を始める数を batch 本までにする (listen のバックログがあふれないように)
+    for start in range(0, connections, batch):
+        await asyncio.gather(*(listener.connect() for listener in listeners[start:start + batch]))
+    connected_in = time.perf_counter() - started
+    tasks = [asyncio.create_task(listener.listen()) for listener in listeners]
+    await asyncio.sleep(1)
+    rss_after = rss_kb(server.process.pid)
+
+    sent_at, errors = {}, 0
+    for facility_id in range(1, rounds + 1):
+        sent_at[facility_id] = time.perf_counter()
+        if not await patch(server.port, facility_id, 2 + facility_id % 8):
+            errors += 1
+        await asyncio.sleep(interval)
+    # 最後の変更が全員に届くのを待つ
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and len(received.get(rounds, ())) < connections:
+        await asyncio.sleep(0.05)
+
+    for listener in listeners:
+        listener.close()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    latencies = [at - sent_at[pk] for pk, times in received.items() if pk in sent_at for at in times]
+    # 最後の接続まで届いた時刻 (1回の変更ごと)
+    last = [max(times) - sent_at[pk] for pk, times in received.items() if pk in sent_at]
+    return {
+        'connected_in': connected_in,
+        'rss_kb': (rss_before, rss_after),
+        'delivered': len(latencies),
+        'expected': connections * rounds,
+        'latencies': latencies,
+        'last': last,
+        'errors': errors,
+    }
+
+
+def run(args, database):
+    rows = []
+    for connections in args.connections:
+        server = Server(
+            app='config.asgi:application', worker_class='uvicorn_worker.UvicornWorker',
+            database=database, workers=1, threads=1,
+        )
+        try:
+            server.wait_ready()
+            result = asyncio.run(fanout(server, connections, args.rounds, args.interval, args.batch))
+        finally:
+            server.stop()
+        rss_before, rss_after = result['rss_kb']
+        rows.append([
+            connections,
+            f"{result['connected_in']:.2f}",
+            f"{rss_after / 1024:.1f}",
+            f"{(rss_after - rss_before) / connections:.1f}",
+            f"{result['delivered']}/{result['expected']}",
+            f"{percentile(result['latencies'], 0.5) * 1000:.1f}",
+            f"{percentile(result['latencies'], 0.95) * 1000:.1f}",
+            f"{percentile(result['latencies'], 0.99) * 1000:.1f}",
+            f"{percentile(result['last'], 0.5) * 1000:.1f}",
+            result['errors'],
+        ])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--facilities', type=int, default=100)
+    parser.add_argument('--connections', type=int, nargs='+', default=[1000, 5000], help="待機させるSSEの接続数")
+    parser.add_argument('--rounds', type=int, default=20, help="送る変更の数")
+    parser.add_argument('--interval', type=float, default=0.2, help="変更を送る間隔(秒)")
+    parser.add_argument('--batch', type=int, default=200, help="同時に接続を始める数")
+    args = parser.parse_args()
+    args.rounds = min(args.rounds, args.facilities)
+
+    limit = raise_open_files_limit(max(args.connections))
+    if limit < max(args.connections) + 64:
+        parser.error(f"ファイルディスクリプタの上限({limit})が足りません (ulimit -n を上げてください)")
+
+    directory = Path(tempfile.mkdtemp(prefix='sse-fanout-'))
+    try:
+        database = directory / 'db.sqlite3'
+        create_database(database, args.facilities)
+        rows = run(args, database)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print(f"SSE fan-out ({args.rounds} changes every {args.interval}s, 1 uvicorn worker, {environment()})")
+    print_table(
+        ['connections', 'connect[s]', 'server RSS[MB]', 'KB/conn', 'delivered',
+         'p50[ms]', 'p95[ms]', 'p99[ms]', 'all[ms]', 'errors'],
+        rows,
+    )
+
+
+if __name__ == '__main__':
+    main()
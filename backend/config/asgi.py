@@ -12,5 +12,9 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+# 施設・アメニティの読み取りに非同期版のビューを使う (facilities.async_views)
+os.environ.setdefault('DJANGO_ROOT_URLCONF', 'config.asgi_urls')
+# 非同期のリクエストはリクエストごとに別のスレッドで接続を開くため、接続を使い回さない (Djangoの推奨)
+os.environ.setdefault('DATABASE_CONN_MAX_AGE', '0')
 
 application = get_asgi_application()
@@ -0,0 +1,14 @@
+"""
+ASGIサーバーで動かすときのURL設定 (config.asgi で ROOT_URLCONF に指定する)
+
+読み取りの多いエンドポイントだけ非同期版のビュー(facilities.async_views)を先に登録し、
+それ以外は config.urls と同じ。
+"""
+from django.urls import include, path
+
+from . import urls
+
+urlpatterns = [
+    path("api/", include("facilities.async_views")),
+    *urls.urlpatterns,
+]
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -71,6 +72,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'facilities.instrumentation.InstrumentationMiddleware',    # リクエストごとの計測 (先頭に置く)
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware', # 修正: CommonMiddlewareより上に移動
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -79,9 +81,11 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'facilities.routers.ReplicaRoutingMiddleware',
 ]
 
-ROOT_URLCONF = 'config.urls'
+# ASGIサーバーでは config.asgi が非同期版のビューを含む config.asgi_urls に切り替える
+ROOT_URLCONF = os.environ.get('DJANGO_ROOT_URLCONF', 'config.urls')
 
 TEMPLATES = [
     {
@@ -104,13 +108,60 @@ WSGI_APPLICATION = 'config.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# WSGIでは接続をリクエストをまたいで使い回す (CONN_MAX_AGE秒)。使う前に切れていないか確認する
+# ASGIでは config.asgi が既定を0(リクエストごとに閉じる)にする
+DATABASE_CONN_MAX_AGE = int(os.environ.get('DATABASE_CONN_MAX_AGE', 60))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# 読み取り用のレプリカ (facilities.routers)
+# 環境変数 DATABASE_REPLICAS にSQLiteのファイルをカンマ区切りで指定すると、施設・アメニティのAPIの読み取りを振り分ける。
+# レプリカは読み取り専用で開く。ローカルでは `python manage.py sync_replicas` でプライマリの内容をコピーして試せる
+FACILITIES_DATABASE_REPLICAS = []
+for _index, _path in enumerate(filter(None, os.environ.get('DATABASE_REPLICAS', '').split(',')), start=1):
+    DATABASES[f'replica{_index}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': f'file:{Path(_path).resolve()}?mode=ro',
+        'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'TEST': {'MIRROR': 'default'},
+    }
+    FACILITIES_DATABASE_REPLICAS.append(f'replica{_index}')
+
+DATABASE_ROUTERS = ['facilities.routers.PrimaryReplicaRouter']
+FACILITIES_REPLICA_PIN_SECONDS = 5          # 書き込んだクライアントの読み取りをプライマリで行う時間(秒)
+FACILITIES_REPLICA_HEALTH_INTERVAL = 5      # レプリカが使えるかを確認し直す間隔(秒)
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # 施設ごとのシリアライズ結果のキャッシュ (facilities.cache)
+    # LocMemCacheは上限(MAX_ENTRIES)を超えると、最も長く使われていないエントリから 1/CULL_FREQUENCY を削除する(LRU)
+    # 複数プロセスで共有したい場合は 'django.core.cache.backends.filebased.FileBasedCache' などに変更する
+    'facilities': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'facility-payloads',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+            'CULL_FREQUENCY': 10,
+        },
+    },
+}
+FACILITIES_PAYLOAD_CACHE = 'facilities'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -157,4 +208,98 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 # MEDIA_ROOT: アップロードされたファイルが実際に保存されるサーバ上のフォルダの場所を定義
-# MEDIA_URL: ブラウザがそのファイルにアクセスするためのURLの接頭辞を定義
\ No newline at end of file
+# MEDIA_URL: ブラウザがそのファイルにアクセスするためのURLの接頭辞を定義
+
+# アップロードされたファイルのSHA-256を受信しながら計算する (facilities.storage で重複を判定するため)
+FILE_UPLOAD_HANDLERS = [
+    'facilities.uploads.HashingMemoryFileUploadHandler',
+    'facilities.uploads.HashingTemporaryFileUploadHandler',
+]
+
+# 施設画像は中身のハッシュを入れた名前で保存し、中身が同じファイルは1つだけ保存する (facilities.storage)
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    'facility_images': {'BACKEND': 'facilities.storage.DeduplicatingFileSystemStorage'},
+}
+
+# メディアファイルの配信の設定 (facilities.media)
+FACILITIES_SERVE_MEDIA = True           # Falseにすると MEDIA_URL をDjangoで配信しない (Webサーバーで直接配信する場合)
+FACILITIES_MEDIA_MAX_AGE = 60 * 60 * 24 * 365   # ハッシュ付きの名前のファイルのキャッシュ期間(秒)
+# ファイルの送信をWebサーバーに任せる: None / 'x-accel-redirect' (nginx) / 'x-sendfile' (Apache, lighttpd)
+FACILITIES_MEDIA_ACCEL = os.environ.get('FACILITIES_MEDIA_ACCEL') or None
+FACILITIES_MEDIA_ACCEL_PREFIX = '/protected-media/'    # X-Accel-Redirect の転送先 (nginxのinternalのlocation)
+
+# ページネーションの設定 (facilities.pagination.OptInCursorPagination)
+FACILITIES_PAGE_SIZE = 50               # ?page_size= を省略した場合の件数
+FACILITIES_MAX_PAGE_SIZE = 200          # ?page_size= で指定できる最大件数
+FACILITIES_PAGINATE_BY_DEFAULT = False  # Trueにするとパラメータなしでもページ分割する (?paginate=false で従来形式)
+
+# 施設一覧のペイロードをシリアライザーを使わずに .values() から組み立てる (facilities.payloads)
+FACILITIES_FAST_PAYLOADS = True
+
+# 全文検索の設定 (facilities.search)
+FACILITIES_SEARCH_LIMIT = 100           # ?q= で返す最大件数
+
+# 位置による検索の設定 (facilities.geo)
+FACILITIES_GEO_NEAREST_LIMIT = 100      # ?near= で指定できる最大件数(k)
+
+# 一括更新・一括削除の設定 (facilities.bulk)
+FACILITIES_BULK_MAX_IDS = 1000          # 1回のリクエストで指定できる施設IDの上限
+
+# 変更フィードの設定 (facilities.changes)
+FACILITIES_CHANGE_FEED_LAG = 2              # この秒数より新しい変更はまだ返さない (コミット前の変更を取りこぼさないため)
+FACILITIES_TOMBSTONE_RETENTION_DAYS = 30    # 削除の記録を残す日数 (これより古いトークンは全件の取得し直しになる)
+
+# 変更のイベントの配信の設定 (facilities.events、GET /api/events/)
+FACILITIES_EVENTS_BACKEND = 'facilities.events.LocalBroker'    # プロセス内だけで配信する
+FACILITIES_EVENTS_QUEUE_SIZE = 1000     # 1接続で送信待ちにできるイベント数 (超えたら捨てて resync を送る)
+FACILITIES_EVENTS_KEEPALIVE = 15        # イベントがないときに接続を保つためのコメントを送る間隔(秒)
+FACILITIES_EVENTS_RETRY_MS = 3000       # 切断されたときにクライアントが再接続するまでの時間(ミリ秒)
+FACILITIES_EVENTS_MAX_CONNECTIONS = None    # 1プロセスで受け付ける接続数の上限 (Noneなら制限しない)
+
+# バックグラウンド処理の設定 (facilities.tasks)
+FACILITIES_TASK_WORKERS = 2             # 処理を実行するスレッド数
+FACILITIES_TASKS_EAGER = False          # Trueにするとリクエスト内で同期実行する (テスト用)
+
+# 施設画像の派生画像の設定 (facilities.images)
+FACILITIES_IMAGE_VARIANT_WIDTHS = (320, 640, 1280)
+FACILITIES_IMAGE_VARIANT_FORMATS = ('webp', 'jpeg')
+FACILITIES_IMAGE_VARIANT_QUALITY = 80
+
+# リクエストごとの計測の設定 (facilities.instrumentation)
+FACILITIES_SLOW_REQUEST_MS = 500        # これ以上かかったリクエストを、時間のかかったSQLと一緒に警告としてログに出す
+
+# ログの設定: facilities.requests にはリクエストごとの計測結果がJSONで出力される (INFO)
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'plain': {'format': '%(asctime)s %(levelname)s %(name)s %(message)s'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'plain'},
+    },
+    'loggers': {
+        'facilities': {
+            'handlers': ['console'],
+            'level': os.environ.get('FACILITIES_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+        # 全リクエストの記録は環境変数 FACILITIES_REQUEST_LOG_LEVEL=INFO で出力する (既定は遅いリクエストだけ)
+        'facilities.requests': {
+            'handlers': ['console'],
+            'level': os.environ.get('FACILITIES_REQUEST_LOG_LEVEL', 'WARNING'),
+            'propagate': False,
+        },
+    },
+}
+
+# Beds24との同期の設定 (facilities.beds24 / facilities.sync)
+BEDS24_API_URL = os.environ.get('BEDS24_API_URL', 'https://api.beds24.com')
+BEDS24_API_KEY = os.environ.get('BEDS24_API_KEY', '')
+BEDS24_SYNC_CONCURRENCY = 8             # 同時に実行するリクエスト数の上限 (接続プールのサイズ)
+BEDS24_SYNC_HORIZON_DAYS = 365          # 今日から何日先までの在庫・料金を取得するか
+BEDS24_FULL_SYNC_INTERVAL_HOURS = 24    # 差分同期を続けていても、この間隔で全件同期し直す
+BEDS24_TIMEOUT = 10                     # 1リクエストのタイムアウト(秒)
+BEDS24_MAX_RETRIES = 5                  # レート制限・一時的なエラーの再試行回数
@@ -17,13 +17,14 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
-from django.conf.urls.static import static
+
+from facilities import media
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path("api/", include("facilities.urls")),
 ]
 
-# 開発環境でのみメディアファイルを提供するための設定
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+# メディアファイル(施設画像)の配信: DEBUGに関わらず、キャッシュ・Rangeに対応したビューで配信する
+if settings.FACILITIES_SERVE_MEDIA:
+    urlpatterns += media.media_urlpatterns()
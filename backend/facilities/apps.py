@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class FacilitiesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'facilities'
+
+    def ready(self):
+        # シグナルの登録
+        from . import instrumentation, signals  # noqa: F401
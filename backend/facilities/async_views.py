@@ -0,0 +1,215 @@
+# 読み取りの多いエンドポイント(施設の一覧・詳細、アメニティの一覧)の非同期版
+#
+# ASGIサーバー(config.asgi)で動かすときに、同期のDRFのビューと同じURLで使う (config.asgi_urls)。
+# GET/HEADは非同期ORMで処理し、応答の遅いクライアントがいてもワーカーのスレッドを占有しない。
+# 書き込みや、非同期版が対応していないパラメータ(?fields= / ?expand= / ?q= / ?format= など)の
+# リクエストは、同期のDRFのビューにそのまま任せる (レスポンスは同期版と同じ)。
+# 変更のイベントの配信(GET /api/events/)は接続を開いたままにするため、ASGIサーバーでだけ提供する。
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import path
+from django.utils.decorators import classonlymethod
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+
+from . import cache, events, instrumentation, payloads, routers
+from .filters import FacilityFilterBackend
+from .mixins import (
+    FACILITY_LIST_SUMMARY, UPDATED_AT_LIST_SUMMARY, check_conditional, facility_list_token,
+    set_validator_headers, updated_at_list_token,
+)
+from .models import Amenity, Facility
+from .pagination import OptInCursorPagination
+from .renderers import FastJSONRenderer
+from .views import AmenityViewSet, FacilityViewSet
+
+
+class AsyncReadView(View):
+    """GET/HEADを非同期で処理し、それ以外は fallback (同期のDRFのビュー) に任せる"""
+    fallback = None     # staticmethod(ViewSet.as_view({...}))
+    # 非同期版で扱うクエリパラメータ (これ以外が指定されたら同期版に任せる)
+    supported_params = frozenset()
+
+    @classonlymethod
+    def as_view(cls, **initkwargs):
+        # CSRFの検証は、同期版に任せたときにDRFが行う (DRFのビューと同じ扱い)
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        if request.method in ('GET', 'HEAD') and self.can_handle(request):
+            routers.use_replicas()
+            try:
+                return await self.get(request, *args, **kwargs)
+            except ValidationError as exc:
+                return self.render(exc.detail, status=400)
+        return await sync_to_async(self.fallback)(request, *args, **kwargs)
+
+    def can_handle(self, request):
+        # ブラウザで開いた場合(Browsable API)も同期版に任せる
+        if 'text/html' in request.headers.get('Accept', ''):
+            return False
+        return set(request.GET) <= self.supported_params
+
+    async def get(self, request, *args, **kwargs):
+        raise NotImplementedError
+
+    def render(self, data, status=200):
+        response = HttpResponse(FastJSONRenderer().render(data), status=status, content_type='application/json')
+        response.headers['Vary'] = 'Accept'
+        return response
+
+    async def paginate(self, queryset, request):
+        """?page_size= などでページ分割を求められていれば (行, ページネーター) を返す"""
+        paginator = OptInCursorPagination()
+        drf_request = Request(request)
+        if not paginator.is_requested(drf_request):
+            return [row async for row in queryset], None
+        # カーソルの解釈と次ページのURLの作成はDRFの実装をそのまま使う (クエリは1回)
+        page = await sync_to_async(paginator.paginate_queryset)(queryset, drf_request)
+        return page, paginator
+
+    def render_list(self, data, paginator):
+        if paginator is not None:
+            data = paginator.get_paginated_response(data).data
+        return self.render(data)
+
+
+class FacilityPayloadMixin:
+
+    async def get_payloads(self, request, stamps):
+        """PayloadCacheMixin.get_payloads() の非同期版"""
+        variant = request.build_absolute_uri('/')
+        found = cache.get_payloads(stamps, variant)
+        missing = [pk for pk in stamps if pk not in found]
+        if missing:
+            with instrumentation.section('serialize'):
+                fresh, versions = await payloads.abuild_payloads(missing, request)
+            cache.set_payloads(
+                fresh,
+                {pk: cache.stamp(version, updated_at) for pk, (version, updated_at) in versions.items()},
+                variant,
+            )
+            found.update(fresh)
+        return found
+
+
+class FacilityListView(FacilityPayloadMixin, AsyncReadView):
+    fallback = staticmethod(FacilityViewSet.as_view({'get': 'list', 'post': 'create'}))
+    supported_params = frozenset({
+        'capacity__gte', 'num_parking__gte', 'management_entity', 'amenities',
+        'page_size', 'cursor', 'paginate',
+    })
+
+    async def get(self, request):
+        queryset = FacilityFilterBackend().filter_queryset(Request(request), Facility.objects.all(), self)
+        summary = await queryset.order_by().aaggregate(**FACILITY_LIST_SUMMARY)
+        etag, last_modified, response = check_conditional(request, facility_list_token(summary))
+        if response is None:
+            rows, paginator = await self.paginate(queryset.only('id', 'version', 'updated_at'), request)
+            found = await self.get_payloads(
+                request, {row.pk: cache.stamp(row.version, row.updated_at) for row in rows}
+            )
+            response = self.render_list([found[row.pk] for row in rows if row.pk in found], paginator)
+        return set_validator_headers(response, etag, last_modified)
+
+
+class FacilityDetailView(FacilityPayloadMixin, AsyncReadView):
+    fallback = staticmethod(FacilityViewSet.as_view({
+        'get': 'retrieve', 'put': 'update', 'patch': 'partial_update', 'delete': 'destroy',
+    }))
+
+    async def get(self, request, pk):
+        row = await Facility.objects.filter(pk=pk).values_list('pk', 'version', 'updated_at').afirst()
+        if row is None:
+            # 404のレスポンスは同期版で作る
+            return await sync_to_async(self.fallback)(request, pk=pk)
+        pk, version, updated_at = row
+        etag, last_modified, response = check_conditional(request, (f"{pk}-{version}-{updated_at}", updated_at))
+        if response is None:
+            found = await self.get_payloads(request, {pk: cache.stamp(version, updated_at)})
+            if pk not in found:
+                # 直前に削除された場合など
+                return await sync_to_async(self.fallback)(request, pk=pk)
+            response = self.render(found[pk])
+        return set_validator_headers(response, etag, last_modified)
+
+
+class AmenityListView(AsyncReadView):
+    fallback = staticmethod(AmenityViewSet.as_view({'get': 'list', 'post': 'create'}))
+    supported_params = frozenset({'page_size', 'cursor', 'paginate'})
+
+    async def get(self, request):
+        queryset = Amenity.objects.all()
+        summary = await queryset.order_by().aaggregate(**UPDATED_AT_LIST_SUMMARY)
+        etag, last_modified, response = check_conditional(request, updated_at_list_token(summary))
+        if response is None:
+            rows, paginator = await self.paginate(queryset.values('id', 'name'), request)
+            response = self.render_list(list(rows), paginator)
+        return set_validator_headers(response, etag, last_modified)
+
+
+class EventStreamView(View):
+    """
+    変更のイベント(facilities.events)をServer-Sent Eventsで送り続ける
+    ?types=facility,image で種類を、?facility=ID でその施設(と画像)のイベントだけに絞れる
+
+    接続の直後と、送信が追いつかずにイベントを捨てたときは、resync のイベントを送る。
+    クライアントはそのとき(再接続したときも)に状態を取り直す (変更フィードの GET /api/changes/ など)。
+    """
+
+    async def get(self, request):
+        try:
+            types, facility = self.parse_filters(request.GET)
+        except ValueError as e:
+            return JsonResponse({'detail': str(e)}, status=400)
+        broker = events.get_broker()
+        max_connections = getattr(settings, 'FACILITIES_EVENTS_MAX_CONNECTIONS', None)
+        if max_connections is not None and broker.count() >= max_connections:
+            response = JsonResponse({'detail': "接続数が上限に達しています。"}, status=503)
+            response.headers['Retry-After'] = '10'
+            return response
+        response = StreamingHttpResponse(self.stream(broker, types, facility), content_type='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        # nginxなどのプロキシでバッファリングさせない
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    def parse_filters(self, params):
+        types = [name for name in params.get('types', '').split(',') if name]
+        if unknown := set(types) - set(events.TYPES):
+            raise ValueError(f"types に指定できない値です: {', '.join(sorted(unknown))}")
+        facility = params.get('facility')
+        if facility is not None:
+            if not facility.isdigit():
+                raise ValueError("facility には施設のIDを指定してください。")
+            facility = int(facility)
+        return types or None, facility
+
+    async def stream(self, broker, types, facility):
+        keepalive = getattr(settings, 'FACILITIES_EVENTS_KEEPALIVE', 15)
+        retry = getattr(settings, 'FACILITIES_EVENTS_RETRY_MS', 3000)
+        subscription = broker.subscribe(types=types, facility=facility)
+        try:
+            yield f"retry: {retry}\nevent: resync\ndata: {{}}\n\n".encode()
+            while True:
+                messages, overflowed = await subscription.get(keepalive)
+                if overflowed:
+                    messages.insert(0, b"event: resync\ndata: {}\n\n")
+                # 届いているイベントはまとめて1回で送る。何もなければ接続を保つためのコメントを送る
+                yield b''.join(messages) if messages else b": keep-alive\n\n"
+        finally:
+            # クライアントが切断すると、送信中のタスクがキャンセルされてここに来る
+            subscription.close()
+
+
+# config.asgi_urls で /api/ の下に、同期版のURLより先に登録する
+urlpatterns = [
+    path('facilities/', FacilityListView.as_view(), name='async-facility-list'),
+    path('facilities/<int:pk>/', FacilityDetailView.as_view(), name='async-facility-detail'),
+    path('amenities/', AmenityListView.as_view(), name='async-amenity-list'),
+    path('events/', EventStreamView.as_view(), name='event-stream'),
+]
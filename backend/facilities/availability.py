@@ -0,0 +1,104 @@
+# 施設の空き状況カレンダー (FacilityAvailability) の読み書きと検索
+#
+# 1施設・1年分の空き状況を366ビットのビットマップで保存している。
+# 検索では宿泊する夜の範囲をビットマスクにしておき、各施設のビットマップとのAND 1回で判定する
+# (Pythonの整数演算なので、何泊でも1施設あたりの判定コストは変わらない)。
+
+import datetime
+from collections import Counter, defaultdict
+
+from .models import FacilityAvailability
+
+BITMAP_BYTES = 46   # 366日分
+
+
+def day_index(day):
+    """1月1日を0とした、その年の何日目か"""
+    return day.timetuple().tm_yday - 1
+
+
+def to_int(bitmap):
+    return int.from_bytes(bytes(bitmap or b''), 'little')
+
+
+def to_bytes(value):
+    return value.to_bytes(BITMAP_BYTES, 'little')
+
+
+def nights_by_year(check_in, check_out):
+    """check_in から check_out の前日までの夜を、年ごとのビットマスク {年: マスク} にする"""
+    masks = {}
+    day = check_in
+    while day < check_out:
+        end = min(check_out, datetime.date(day.year + 1, 1, 1))
+        masks[day.year] = ((1 << (end - day).days) - 1) << day_index(day)
+        day = end
+    return masks
+
+
+def set_range(facility_id, check_in, check_out, available=True):
+    """check_in から check_out の前日までの夜を、宿泊可能/不可にする"""
+    changes = {}
+    for year, mask in nights_by_year(check_in, check_out).items():
+        changes[year] = (mask, 0) if available else (0, mask)
+    _apply(facility_id, changes)
+
+
+def apply_calendar(facility_id, calendar):
+    """
+    日付ごとの在庫 {"YYYY-MM-DD": {"available": 在庫数}} を反映する (Beds24との同期結果など)
+    含まれていない日付は変更しない
+    """
+    changes = defaultdict(lambda: [0, 0])   # {年: [宿泊可能にするビット, 宿泊不可にするビット]}
+    for day, values in calendar.items():
+        day = datetime.date.fromisoformat(day)
+        bit = 1 << day_index(day)
+        changes[day.year][0 if values.get('available', 0) > 0 else 1] |= bit
+    _apply(facility_id, changes)
+
+
+def _apply(facility_id, changes):
+    """{年: (立てるビット, 落とすビット)} をまとめて保存する (年の数に関わらず最大3クエリ)"""
+    if not changes:
+        return
+    rows = {
+        row.year: row
+        for row in FacilityAvailability.objects.filter(facility_id=facility_id, year__in=changes)
+    }
+    created, updated = [], []
+    for year, (set_bits, clear_bits) in changes.items():
+        row = rows.get(year)
+        value = (to_int(row.nights) if row else 0) | set_bits
+        value &= ~clear_bits
+        if row is None:
+            created.append(FacilityAvailability(facility_id=facility_id, year=year, nights=to_bytes(value)))
+        else:
+            row.nights = to_bytes(value)
+            updated.append(row)
+    FacilityAvailability.objects.bulk_create(created)
+    FacilityAvailability.objects.bulk_update(updated, ['nights'])
+
+
+def is_available(facility_id, check_in, check_out):
+    return facility_id in search(check_in, check_out, facility_ids=[facility_id])
+
+
+def search(check_in, check_out, guests=1, facility_ids=None):
+    """
+    check_in から check_out まで guests 人で宿泊できる施設のIDを返す (1クエリ)
+    空き状況が登録されていない期間は宿泊不可として扱う
+    """
+    masks = nights_by_year(check_in, check_out)
+    if not masks:
+        return []
+    rows = FacilityAvailability.objects.filter(year__in=masks, facility__capacity__gte=guests)
+    if facility_ids is not None:
+        rows = rows.filter(facility_id__in=facility_ids)
+
+    # 年をまたぐ場合は、すべての年で条件を満たした施設だけを返す
+    satisfied = Counter()
+    for facility_id, year, nights in rows.values_list('facility_id', 'year', 'nights').iterator(chunk_size=2000):
+        mask = masks[year]
+        if to_int(nights) & mask == mask:
+            satisfied[facility_id] += 1
+    return sorted(facility_id for facility_id, count in satisfied.items() if count == len(masks))
@@ -0,0 +1,202 @@
+# Beds24 JSON API (v1) のクライアント
+#
+# - http.client の接続をプールして再利用する (keep-alive、同時接続数はプールのサイズまで)
+# - レート制限(429)や一時的なエラー(5xx・接続断)は指数バックオフで再試行する
+#   レート制限を受けたときは、同じクライアントを使う全スレッドのリクエストを一時停止する
+
+import http.client
+import json
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+# 再試行するHTTPステータス
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class Beds24Error(Exception):
+    """Beds24 APIの呼び出しに失敗した"""
+
+
+class Beds24RateLimited(Beds24Error):
+    """再試行してもレート制限が解除されなかった"""
+
+
+class ConnectionPool:
+    """同じホストへのHTTP接続を使い回すための、スレッドセーフな接続プール"""
+
+    def __init__(self, base_url, size, timeout):
+        parsed = urlsplit(base_url)
+        self.connection_class = (
+            http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+        )
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.path_prefix = parsed.path.rstrip('/')
+        self.timeout = timeout
+        self.created = 0
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self.connection_class(self.host, self.port, timeout=self.timeout)
+                with self._lock:
+                    self.created += 1
+            try:
+                yield conn
+            except BaseException:
+                # 途中で失敗した接続は状態が分からないため再利用しない
+                conn.close()
+                raise
+            self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class Beds24Client:
+
+    def __init__(self, base_url=None, api_key=None, pool_size=None, timeout=None,
+                 max_retries=None, backoff_base=0.5, backoff_max=30.0, sleep=time.sleep):
+        self.base_url = base_url or settings.BEDS24_API_URL
+        self.api_key = settings.BEDS24_API_KEY if api_key is None else api_key
+        self.pool = ConnectionPool(
+            self.base_url,
+            size=pool_size or settings.BEDS24_SYNC_CONCURRENCY,
+            timeout=timeout or settings.BEDS24_TIMEOUT,
+        )
+        self.max_retries = settings.BEDS24_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.sleep = sleep
+        self.request_count = 0
+        self.retry_count = 0
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # --- APIメソッド ---
+
+    def get_property(self, prop_key):
+        """物件と部屋タイプの情報"""
+        return self.call('getProperty', prop_key, {'includeRooms': True})
+
+    def get_room_dates(self, prop_key, room_id, date_from, date_to):
+        """日付ごとの在庫(i)と料金(p1など) {"YYYYMMDD": {...}}"""
+        return self.call('getRoomDates', prop_key, {
+            'roomId': room_id,
+            'from': date_from.strftime('%Y%m%d'),
+            'to': date_to.strftime('%Y%m%d'),
+        })
+
+    def get_bookings(self, prop_key, room_id, modified_since):
+        """modified_since 以降に作成・変更された予約"""
+        return self.call('getBookings', prop_key, {
+            'roomId': room_id,
+            'modifiedSince': modified_since.strftime('%Y%m%d %H:%M:%S'),
+        })
+
+    # --- 共通処理 ---
+
+    def call(self, method, prop_key, payload):
+        body = json.dumps({
+            'authentication': {'apiKey': self.api_key, 'propKey': prop_key},
+            **payload,
+        }).encode()
+        path = f"{self.pool.path_prefix}/json/{method}"
+
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_rate_limit()
+            try:
+                status, retry_after, data = self._post(path, body)
+            except (http.client.HTTPException, OSError) as e:
+                if attempt == self.max_retries:
+                    raise Beds24Error(f"{method}: {e}") from e
+                self._backoff(attempt)
+                continue
+
+            if status in RETRY_STATUSES:
+                if attempt == self.max_retries:
+                    error_class = Beds24RateLimited if status == 429 else Beds24Error
+                    raise error_class(f"{method}: HTTP {status}")
+                delay = self._backoff_delay(attempt) if retry_after is None else retry_after
+                if status == 429:
+                    self._pause_all(delay)
+                else:
+                    self._count_retry()
+                    self.sleep(delay)
+                continue
+            if status != 200:
+                raise Beds24Error(f"{method}: HTTP {status}")
+
+            try:
+                result = json.loads(data)
+            except ValueError as e:
+                raise Beds24Error(f"{method}: invalid JSON response ({e})") from e
+            if isinstance(result, dict) and 'error' in result:
+                raise Beds24Error(f"{method}: {result['error']} ({result.get('errorCode', '-')})")
+            return result
+
+    def _post(self, path, body):
+        with self._lock:
+            self.request_count += 1
+        with self.pool.connection() as conn:
+            conn.request('POST', path, body=body, headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            # keep-aliveで接続を使い回すため、レスポンスは必ず最後まで読む
+            data = response.read()
+        retry_after = response.getheader('Retry-After')
+        try:
+            retry_after = float(retry_after) if retry_after is not None else None
+        except ValueError:
+            retry_after = None
+        return response.status, retry_after, data
+
+    def _backoff_delay(self, attempt):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return delay * (0.5 + random.random() / 2)
+
+    def _backoff(self, attempt):
+        self._count_retry()
+        self.sleep(self._backoff_delay(attempt))
+
+    def _count_retry(self):
+        with self._lock:
+            self.retry_count += 1
+
+    def _pause_all(self, delay):
+        """レート制限を受けたら、全スレッドの次のリクエストをdelay秒後まで止める"""
+        with self._lock:
+            self.retry_count += 1
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+
+    def _wait_for_rate_limit(self):
+        wait = self._resume_at - time.monotonic()
+        if wait > 0:
+            self.sleep(wait)
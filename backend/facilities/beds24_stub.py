@@ -0,0 +1,167 @@
+# ローカル開発・テスト・ベンチマーク用のBeds24 JSON APIスタブサーバー
+#
+#   with Beds24Stub(latency=0.02) as stub:
+#       client = Beds24Client(base_url=stub.url, api_key='test')
+#
+# どの prop_key / roomId にも応答する。在庫は book() で登録した予約の日付だけ0になる。
+# `python manage.py beds24_stub` で単体でも起動できる。
+
+import datetime
+import json
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-aliveで接続を使い回せるようにする
+    disable_nagle_algorithm = True  # ヘッダーと本文を別々に送るため、遅延ACKで待たされないようにする
+
+    def setup(self):
+        super().setup()
+        self.server.stub._count_connection()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        method = self.path.rstrip('/').rsplit('/', 1)[-1]
+        status, headers, payload = self.server.stub.handle(method, json.loads(body or b'{}'))
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class Beds24Stub:
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, price='10000.00'):
+        self.latency = latency
+        self.price = price
+        self.calls = Counter()
+        self.connections = 0
+        self._bookings = []
+        self._forced = deque()
+        self._corrupted = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # --- テストからの操作 ---
+
+    def book(self, room_id, first_night, last_night, modified=None):
+        """予約を登録する (該当する日付の在庫が0になり、getBookingsで返るようになる)"""
+        with self._lock:
+            self._bookings.append({
+                'bookId': len(self._bookings) + 1,
+                'roomId': str(room_id),
+                'firstNight': first_night.isoformat(),
+                'lastNight': last_night.isoformat(),
+                'modified': modified or datetime.datetime.now(datetime.timezone.utc),
+            })
+
+    def fail_next(self, status=429, count=1, retry_after=None):
+        """次のcount件のリクエストにエラーを返す"""
+        headers = {} if retry_after is None else {'Retry-After': str(retry_after)}
+        with self._lock:
+            self._forced.extend([(status, headers)] * count)
+
+    def corrupt(self, prop_key, body, method=None):
+        """prop_key へのリクエスト(method を指定するとそのメソッドだけ)に、本文 body(bytes) をそのまま返す"""
+        with self._lock:
+            self._corrupted[(prop_key, method)] = body
+
+    # --- リクエストの処理 ---
+
+    def _count_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def handle(self, method, payload):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[method] += 1
+            if self._forced:
+                status, headers = self._forced.popleft()
+                return status, headers, {'error': 'forced error'}
+
+            prop_key = payload.get('authentication', {}).get('propKey')
+            corrupted = self._corrupted.get((prop_key, method), self._corrupted.get((prop_key, None)))
+        if corrupted is not None:
+            return 200, {}, corrupted
+
+        if not payload.get('authentication', {}).get('apiKey'):
+            return 200, {}, {'error': 'Unauthorized', 'errorCode': '1000'}
+        handler = getattr(self, f'_{method}', None)
+        if handler is None:
+            return 404, {}, {'error': f'Unknown method {method}'}
+        return 200, {}, handler(payload)
+
+    def _getProperty(self, payload):
+        prop_key = payload['authentication']['propKey']
+        return {'getProperty': [{
+            'propId': prop_key,
+            'name': f'Property {prop_key}',
+            'roomTypes': [{'roomId': prop_key.replace('prop', 'room'), 'name': 'Room', 'qty': '1', 'maxPeople': '4'}],
+        }]}
+
+    def _getRoomDates(self, payload):
+        room_id = str(payload['roomId'])
+        day = datetime.datetime.strptime(payload['from'], '%Y%m%d').date()
+        last = datetime.datetime.strptime(payload['to'], '%Y%m%d').date()
+        booked = self._booked_nights(room_id)
+        dates = {}
+        while day <= last:
+            dates[day.strftime('%Y%m%d')] = {'i': '0' if day in booked else '1', 'p1': self.price}
+            day += datetime.timedelta(days=1)
+        return dates
+
+    def _getBookings(self, payload):
+        room_id = str(payload['roomId'])
+        since = datetime.datetime.strptime(payload['modifiedSince'], '%Y%m%d %H:%M:%S').replace(
+            tzinfo=datetime.timezone.utc
+        )
+        with self._lock:
+            bookings = [b for b in self._bookings if b['roomId'] == room_id and b['modified'] >= since]
+        return [{**b, 'modified': b['modified'].strftime('%Y-%m-%d %H:%M:%S')} for b in bookings]
+
+    def _booked_nights(self, room_id):
+        nights = set()
+        with self._lock:
+            bookings = [b for b in self._bookings if b['roomId'] == room_id]
+        for booking in bookings:
+            day = datetime.date.fromisoformat(booking['firstNight'])
+            last = datetime.date.fromisoformat(booking['lastNight'])
+            while day <= last:
+                nights.add(day)
+                day += datetime.timedelta(days=1)
+        return nights
@@ -0,0 +1,383 @@
+# 施設の一括登録(インポート)・一括出力(エクスポート)・一括更新・一括削除
+#
+# - 入力(CSV / JSON Lines)は1行ずつ読み、chunk_size 件ごとに1トランザクションで登録する (ファイル全体をメモリに載せない)
+#   検証は FacilityImportSerializer (FacilityWriteSerializer と同じ検証) で行い、不正な行は行番号とエラーを報告して飛ばす
+#   アメニティは名前で指定し、チャンクごとにまとめて解決する (存在しない名前は作成する)
+#   施設は bulk_create、アメニティとの関連は中間テーブルへの bulk_create で登録する
+# - 出力は施設IDの順に batch_size 件ずつ読み出しながら書き出す (StreamingHttpResponse 用のジェネレーター)
+#   出力の形式は入力と同じなので、そのまま取り込み直せる
+# - 一括更新・一括削除は、施設の数に関わらず一定の回数のSQL (update()、中間テーブルへのまとめたINSERT/DELETE) を
+#   1トランザクションで実行する。シグナルは発火しないため、バージョン・キャッシュ・検索の索引・イベントへの反映もまとめて行う
+
+import codecs
+import csv
+import io
+import json
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+from asgiref.sync import sync_to_async
+from django.db import connections, router, transaction
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import BaseParser
+
+from . import cache, cleanup, events, geo, search
+from .models import Amenity, Beds24SyncState, Facility, FacilityAvailability, FacilityImage, Tombstone
+from .serializers import FacilityImportSerializer
+
+FORMATS = ('csv', 'jsonl')
+CONTENT_TYPES = {'csv': 'text/csv; charset=utf-8', 'jsonl': 'application/x-ndjson; charset=utf-8'}
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 100       # 報告に含めるエラーの行数の上限 (件数はすべて数える)
+
+# 入出力する列 (CSVの見出しの順)。amenities はアメニティ名のリスト (CSVでは AMENITY_SEPARATOR 区切り)
+COLUMNS = (
+    'facility_name', 'capacity', 'description', 'short_description', 'address', 'num_parking',
+    'map_url', 'latitude', 'longitude', 'management_entity', 'prop_key', 'room_key', 'amenities',
+)
+AMENITY_SEPARATOR = '|'
+
+
+class ImportFormatError(ValueError):
+    """入力をCSV / JSON Linesとして読めない (行単位の検証エラーとは別に、取り込みを中止する)"""
+
+
+@dataclass
+class ImportReport:
+    rows: int = 0
+    created: int = 0
+    failed: int = 0
+    dry_run: bool = False
+    # 入力を読めずに途中で中止した場合の理由 (それまでのチャンクは登録済み)
+    error: str = None
+    # [{'line': 行番号, 'errors': {フィールド: [メッセージ, ...]}}, ...] (先頭の MAX_REPORTED_ERRORS 件)
+    errors: list = field(default_factory=list)
+
+    def add_error(self, line, errors):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'errors': errors})
+
+    def as_dict(self):
+        return {
+            'rows': self.rows, 'created': self.created, 'failed': self.failed,
+            'dry_run': self.dry_run, 'error': self.error, 'errors': self.errors,
+        }
+
+
+def guess_format(filename=None, content_type=None):
+    """ファイル名の拡張子またはContent-Typeから入力の形式を決める (分からなければNone)"""
+    if filename:
+        extension = filename.rsplit('.', 1)[-1].lower()
+        if extension in ('csv', 'jsonl', 'ndjson'):
+            return 'csv' if extension == 'csv' else 'jsonl'
+    content_type = (content_type or '').split(';', 1)[0].strip().lower()
+    if content_type in ('text/csv', 'application/csv'):
+        return 'csv'
+    if content_type in ('application/x-ndjson', 'application/jsonl', 'application/x-jsonlines'):
+        return 'jsonl'
+    return None
+
+
+class UnreadBodyParser(BaseParser):
+    """
+    本体をそのまま送る一括登録 (CSV / JSON Lines) 用: 本体を読まずに空のデータを返す
+    ビューが本体を1行ずつ直接読むため、request.data を参照されても(セッション認証のCSRFの検査など)読み切らない
+    """
+    media_type = '*/*'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        return {}
+
+
+def text_lines(stream):
+    """バイト列のストリーム(ファイル・リクエスト本体)を1行ずつ文字列にする (UTF-8、BOMは取り除く)"""
+    return codecs.iterdecode(iter(stream.readline, b''), 'utf-8-sig')
+
+
+def read_csv(lines):
+    """(行番号, 行のdict, エラー) を返す。空の値は省略したもの(モデルの既定値)として扱う"""
+    reader = csv.DictReader(lines)
+    if reader.fieldnames is None:
+        return
+    unknown = set(reader.fieldnames) - {*COLUMNS, 'id'}
+    if unknown:
+        raise ImportFormatError(f"Unknown CSV columns: {', '.join(sorted(unknown))}")
+    for row in reader:
+        # 値の中に改行がある場合、行番号はその記録の最後の行になる
+        if None in row:
+            yield reader.line_num, None, "列の数が見出しより多くなっています。"
+            continue
+        data = {key: value for key, value in row.items() if value not in (None, '')}
+        if 'amenities' in data:
+            data['amenities'] = [name for name in data['amenities'].split(AMENITY_SEPARATOR) if name.strip()]
+        yield reader.line_num, data, None
+
+
+def read_jsonl(lines):
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError:
+            yield line_number, None, "JSONとして読めません。"
+            continue
+        if not isinstance(data, dict):
+            yield line_number, None, "JSONのオブジェクトを指定してください。"
+            continue
+        yield line_number, data, None
+
+
+def read_rows(stream, fmt):
+    """ストリームから (行番号, 行のdict, エラー) を順に返す。行として解釈できない行はdictがNoneでエラーのメッセージが入る"""
+    if fmt not in FORMATS:
+        raise ImportFormatError(f"Unsupported import format: {fmt}")
+    reader = read_csv if fmt == 'csv' else read_jsonl
+    try:
+        yield from reader(text_lines(stream))
+    except UnicodeDecodeError as e:
+        raise ImportFormatError(f"The input is not valid UTF-8: {e}") from None
+    except csv.Error as e:
+        raise ImportFormatError(f"Invalid CSV: {e}") from None
+
+
+def import_facilities(rows, chunk_size=DEFAULT_CHUNK_SIZE, dry_run=False):
+    """
+    rows: (行番号, 行のdict, エラー) のイテラブル (read_rows())
+    検証した行を chunk_size 件ずつ登録し、ImportReport を返す
+    登録済みのチャンクは、後のチャンクで失敗しても取り消さない (dry_run では検証だけ行う)
+    入力を読めなくなった場合 (ImportFormatError) は、それまでの行を登録して report.error に理由を入れる
+    """
+    # シリアライザーは1つだけ作り、行ごとに run_validation() で検証する (行ごとにフィールドを作り直さない)
+    serializer = FacilityImportSerializer()
+    report = ImportReport(dry_run=dry_run)
+    chunk = []
+    try:
+        for line, data, error in rows:
+            report.rows += 1
+            if error is not None:
+                report.add_error(line, {'non_field_errors': [error]})
+                continue
+            try:
+                chunk.append(serializer.run_validation(data))
+            except ValidationError as e:
+                report.add_error(line, e.detail)
+                continue
+            if len(chunk) >= chunk_size:
+                save_chunk(chunk, report)
+                chunk = []
+    except ImportFormatError as e:
+        report.error = str(e)
+    if chunk:
+        save_chunk(chunk, report)
+    return report
+
+
+def save_chunk(chunk, report):
+    """
+    検証済みの行をまとめて登録する (アメニティの解決 最大3クエリ + 施設 + 中間テーブル + 検索の索引)
+    """
+    if report.dry_run:
+        report.created += len(chunk)
+        return
+    with transaction.atomic():
+        names = [name for row in chunk for name in row.get('amenities', [])]
+        amenities = {amenity.name: amenity.pk for amenity in Amenity.objects.get_or_create_by_names(names)}
+
+        facilities = [Facility(**{key: value for key, value in row.items() if key != 'amenities'}) for row in chunk]
+        for facility in facilities:
+            # bulk_createでは save() を通らないため、グリッドのセルをここで決める
+            facility.geo_cell = geo.cell_for(facility.latitude, facility.longitude)
+        facilities = Facility.objects.bulk_create(facilities)
+        Through = Facility.amenities.through
+        Through.objects.bulk_create([
+            Through(facility_id=facility.pk, amenity_id=amenity_id)
+            for facility, row in zip(facilities, chunk)
+            for amenity_id in dict.fromkeys(amenities[name.strip()] for name in row.get('amenities', []))
+        ], batch_size=DEFAULT_BATCH_SIZE)
+
+        # bulk_createではシグナルが発火しないため、post_saveと同じ後処理をここで行う
+        # (新しい施設なのでキャッシュの破棄は不要)
+        search.index_facilities([facility.pk for facility in facilities])
+        events.publish([events.facility_event(facility.pk, 'created', facility.version) for facility in facilities])
+    report.created += len(facilities)
+
+
+def update_facilities(ids, values=None, add_amenities=(), remove_amenities=()):
+    """
+    ids の施設をまとめて更新し、IDごとの結果を返す (1トランザクション、最大5クエリ + 検索の索引)
+    values: すべての施設に設定する値 (検証済み)
+    add_amenities / remove_amenities: 追加・削除するアメニティのID (検証済み)
+    結果: [{'id': ID, 'status': 'updated' | 'unchanged' | 'not_found', 'amenities_added': 件数, 'amenities_removed': 件数}, ...]
+    """
+    Through = Facility.amenities.through
+    added, removed = defaultdict(int), defaultdict(int)
+    with transaction.atomic():
+        found = set(Facility.objects.filter(pk__in=ids).values_list('pk', flat=True))
+        if found and add_amenities:
+            existing = set(
+                Through.objects.filter(facility_id__in=found, amenity_id__in=add_amenities)
+                .values_list('facility_id', 'amenity_id')
+            )
+            links = [
+                Through(facility_id=facility_id, amenity_id=amenity_id)
+                for facility_id in sorted(found) for amenity_id in add_amenities
+                if (facility_id, amenity_id) not in existing
+            ]
+            Through.objects.bulk_create(links, batch_size=DEFAULT_BATCH_SIZE)
+            for link in links:
+                added[link.facility_id] += 1
+        if found and remove_amenities:
+            links = Through.objects.filter(facility_id__in=found, amenity_id__in=remove_amenities)
+            for facility_id in links.values_list('facility_id', flat=True):
+                removed[facility_id] += 1
+            links.delete()
+
+        # 値を設定した施設と、アメニティが変わった施設のバージョンを1回のUPDATEで進める
+        changed = found if values else {*added, *removed}
+        if values and {'latitude', 'longitude'} & set(values):
+            values = {**values, 'geo_cell': geo.cell_for(values.get('latitude'), values.get('longitude'))}
+        if changed:
+            Facility.objects.filter(pk__in=changed).touch(**(values or {}))
+            cache.invalidate(changed)
+            events.publish_facilities(changed)
+            if values and set(values) & set(search.FIELDS):
+                search.index_facilities(changed)
+
+    results = []
+    for pk in ids:
+        if pk not in found:
+            results.append({'id': pk, 'status': 'not_found'})
+            continue
+        results.append({
+            'id': pk,
+            'status': 'updated' if pk in changed else 'unchanged',
+            'amenities_added': added[pk],
+            'amenities_removed': removed[pk],
+        })
+    return results
+
+
+def delete_facilities(ids):
+    """
+    ids の施設を、画像・空き状況・同期状態・アメニティとの関連と一緒に削除し、IDごとの結果を返す (1トランザクション)
+
+    QuerySet.delete() は画像を1件ずつ読み込んでシグナルを送り、画像ごとに(削除する)施設を更新してしまう。
+    ここでは関連するテーブルごとに1回のDELETEで削除し、キャッシュ・検索の索引・削除の記録・画像のファイルにはまとめて反映する。
+    結果: [{'id': ID, 'status': 'deleted' | 'not_found', 'images': 削除した画像の数}, ...]
+    """
+    with transaction.atomic():
+        found = set(Facility.objects.filter(pk__in=ids).values_list('pk', flat=True))
+        images = FacilityImage.objects.filter(facility_id__in=found)
+        image_ids, files = defaultdict(list), []
+        for image_id, facility_id, name, variants in images.values_list('pk', 'facility_id', 'image', 'variants'):
+            image_ids[facility_id].append(image_id)
+            files.append((name, variants))
+        if found:
+            # シグナルの受信者がないモデルは、QuerySet.delete() でも1回のDELETEになる
+            Facility.amenities.through.objects.filter(facility_id__in=found).delete()
+            FacilityAvailability.objects.filter(facility_id__in=found).delete()
+            Beds24SyncState.objects.filter(facility_id__in=found).delete()
+            # 画像と施設はシグナルを送らずに削除する (後処理は下でまとめて行う)
+            delete_rows(FacilityImage, 'facility', found)
+            delete_rows(Facility, 'id', found)
+            cache.invalidate(found)
+            search.remove_facilities(found)
+            Tombstone.objects.bulk_create([
+                *(Tombstone(kind=Tombstone.Kind.IMAGE, object_id=pk) for ids in image_ids.values() for pk in ids),
+                *(Tombstone(kind=Tombstone.Kind.FACILITY, object_id=pk) for pk in sorted(found)),
+            ], batch_size=DEFAULT_BATCH_SIZE)
+            events.publish([
+                *(events.image_event(pk, 'deleted', facility_id) for facility_id, ids in image_ids.items() for pk in ids),
+                *(events.facility_event(pk, 'deleted') for pk in sorted(found)),
+            ])
+            # ファイルの参照を減らす (参照がなくなったファイルはコミット後にバックグラウンドで削除する)
+            cleanup.release_images(files)
+
+    return [
+        {'id': pk, 'status': 'deleted', 'images': len(image_ids[pk])} if pk in found
+        else {'id': pk, 'status': 'not_found'}
+        for pk in ids
+    ]
+
+
+def delete_rows(model, field_name, values, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    model のうち field_name が values のいずれかである行を、シグナルを送らずに削除する (batch_size 件ごとに1回のDELETE)
+    QuerySet.delete() はシグナルの受信者がいるモデルでは行を1件ずつ読み込んでシグナルを送るため、DELETE文を直接実行する
+    (関連する行は呼び出し元が先に削除しておく)
+    """
+    values = sorted(values)
+    connection = connections[router.db_for_write(model)]
+    table = connection.ops.quote_name(model._meta.db_table)
+    column = connection.ops.quote_name(model._meta.get_field(field_name).column)
+    with connection.cursor() as cursor:
+        for start in range(0, len(values), batch_size):
+            batch = values[start:start + batch_size]
+            cursor.execute(f"DELETE FROM {table} WHERE {column} IN ({', '.join(['%s'] * len(batch))})", batch)
+
+
+def export_batches(queryset, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    querysetの施設を batch_size 件ずつ [(ID, 列の値のdict), ...] で返す
+    施設IDの順にキーセットで読み出す (1バッチにつき2クエリ。途中で変更された施設は変更後の値になることがある)
+    """
+    columns = [column for column in COLUMNS if column != 'amenities']
+    last_pk = 0
+    while True:
+        batch = list(
+            queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', *columns)[:batch_size]
+        )
+        if not batch:
+            return
+        facility_ids = [row[0] for row in batch]
+        amenities = {}
+        for facility_id, name in (
+            Facility.amenities.through.objects.filter(facility_id__in=facility_ids)
+            .order_by('amenity_id').values_list('facility_id', 'amenity__name')
+        ):
+            amenities.setdefault(facility_id, []).append(name)
+        yield [(row[0], {**dict(zip(columns, row[1:])), 'amenities': amenities.get(row[0], [])}) for row in batch]
+        if len(batch) < batch_size:
+            return
+        last_pk = facility_ids[-1]
+
+
+def iter_export(queryset, fmt, batch_size=DEFAULT_BATCH_SIZE):
+    """エクスポートの本文をバッチごとに返す (文字列のジェネレーター)"""
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # Excelで文字化けしないようにBOMを付ける (取り込み時は取り除く)
+        buffer.write('\ufeff')
+        writer.writerow(['id', *COLUMNS])
+        yield buffer.getvalue()
+        for batch in export_batches(queryset, batch_size):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(
+                [facility_id, *(values[column] for column in COLUMNS[:-1]), AMENITY_SEPARATOR.join(values['amenities'])]
+                for facility_id, values in batch
+            )
+            yield buffer.getvalue()
+    else:
+        for batch in export_batches(queryset, batch_size):
+            yield ''.join(
+                json.dumps({'id': facility_id, **values}, ensure_ascii=False) + '\n' for facility_id, values in batch
+            )
+
+
+async def aiter_export(queryset, fmt, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    iter_export() の非同期版 (ASGI用)
+    ASGIで同期のイテレーターを返すと、Djangoはすべて読み込んでから送るため使わない
+    """
+    iterator = iter_export(queryset, fmt, batch_size)
+    read = sync_to_async(next)
+    try:
+        while (chunk := await read(iterator, None)) is not None:
+            yield chunk
+    finally:
+        await sync_to_async(iterator.close)()
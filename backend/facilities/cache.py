@@ -0,0 +1,91 @@
+# 施設ごとのシリアライズ結果(JSONにする前のdict)のキャッシュ
+#
+# - Djangoのキャッシュフレームワークを利用する (settings.CACHES の 'facilities')
+# - エントリには施設のバージョンと更新日時(スタンプ)を一緒に保存し、読み出し時にDB上の値と一致するものだけを使う
+# - 施設・画像・アメニティが変わったときはシグナルから invalidate() で明示的に削除する
+
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class CacheStats:
+    """ヒット数・ミス数などのカウンタ (プロセス単位)"""
+
+    FIELDS = ('hits', 'misses', 'sets', 'invalidations')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counts = dict.fromkeys(self.FIELDS, 0)
+
+    def incr(self, name, amount=1):
+        if amount:
+            with self._lock:
+                self._counts[name] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+stats = CacheStats()
+
+
+def get_cache():
+    return caches[getattr(settings, 'FACILITIES_PAYLOAD_CACHE', 'facilities')]
+
+
+def _key(pk):
+    return f"facility-payload:{pk}"
+
+
+def stamp(version, updated_at):
+    """エントリが最新かどうかを判定するための値"""
+    return (version, updated_at)
+
+
+def get_payloads(stamps, variant):
+    """
+    stamps: {施設ID: stamp()}
+    variant: 表現の違い(画像URLのホストなど)を区別する文字列
+    キャッシュにある最新のペイロードを {施設ID: dict} で返す
+    """
+    if not stamps:
+        return {}
+    entries = get_cache().get_many([_key(pk) for pk in stamps])
+    payloads = {}
+    for pk, current in stamps.items():
+        entry = entries.get(_key(pk))
+        if entry is not None and entry['stamp'] == current and entry['variant'] == variant:
+            payloads[pk] = entry['payload']
+    stats.incr('hits', len(payloads))
+    stats.incr('misses', len(stamps) - len(payloads))
+    return payloads
+
+
+def set_payloads(payloads, stamps, variant):
+    """payloads: {施設ID: dict}、stamps: {施設ID: stamp()}"""
+    if not payloads:
+        return
+    get_cache().set_many({
+        _key(pk): {'stamp': stamps[pk], 'variant': variant, 'payload': payload}
+        for pk, payload in payloads.items()
+    })
+    stats.incr('sets', len(payloads))
+
+
+def invalidate(facility_ids):
+    keys = [_key(pk) for pk in facility_ids]
+    if keys:
+        get_cache().delete_many(keys)
+        stats.incr('invalidations', len(keys))
+
+
+def clear():
+    get_cache().clear()
+    stats.reset()
@@ -0,0 +1,163 @@
+# 変更フィード: 指定した時点以降に作成・変更・削除された施設・アメニティ・画像だけを返す (GET /api/changes/)
+#
+# - 施設・アメニティ・画像の updated_at と、削除の記録(Tombstone)の deleted_at を (日時, ID) の索引で読む
+#   返す件数は変更の数で決まり、施設の総数には比例しない (1回につき 4 + 3 クエリ)
+# - 位置(カーソル)は (日時, 種類, ID) で、日時の順に並べた変更のどこまで返したかを表す。
+#   クライアントにはトークン(文字列)で返し、次の呼び出しで updated_since に指定してもらう
+# - updated_at は書き込みのトランザクションの中で付けられるため、コミットが遅れた変更の日時が
+#   すでに返した位置より前になることがある。取りこぼさないように、FACILITIES_CHANGE_FEED_LAG 秒より
+#   新しい変更はまだ返さない (トークンもその時点までしか進めない)
+# - 削除の記録は FACILITIES_TOMBSTONE_RETENTION_DAYS 日で消えるため、それより古いトークンは
+#   ResyncRequired にする (クライアントは updated_since なしで全件を取得し直す)
+
+import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import payloads
+from .models import Amenity, Facility, FacilityImage, Tombstone
+
+DEFAULT_LIMIT = 500
+MAX_LIMIT = 1000
+DEFAULT_LAG = 2
+DEFAULT_RETENTION_DAYS = 30
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# (種類, モデル, 日時の列, 読み込む列)。カーソルの「種類」はこの並びの番号
+SOURCES = (
+    ('amenity', Amenity, 'updated_at', ('name',)),
+    ('facility', Facility, 'updated_at', ()),
+    ('image', FacilityImage, 'updated_at', ('facility_id', 'image', 'caption', 'variants')),
+    ('deleted', Tombstone, 'deleted_at', ('kind', 'object_id')),
+)
+# カーソルの種類がこの値なら、その日時の変更はすべて返したことを表す
+END_OF_TIMESTAMP = len(SOURCES)
+
+
+class ResyncRequired(Exception):
+    """トークンが古く、その後の削除の記録が残っていない"""
+
+
+def to_microseconds(value):
+    return (value - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def from_microseconds(value):
+    return EPOCH + datetime.timedelta(microseconds=value)
+
+
+def encode_cursor(cursor):
+    return "{}.{}.{}".format(*cursor)
+
+
+def parse_since(value):
+    """
+    updated_since の値 (トークン、またはISO 8601の日時) をカーソル (マイクロ秒, 種類, ID) にする
+    日時を指定した場合は、その日時より後の変更を返す。不正な値は ValueError
+    """
+    parts = value.split('.')
+    if len(parts) == 3 and all(part.isdigit() for part in parts):
+        cursor = tuple(int(part) for part in parts)
+        if cursor[1] > END_OF_TIMESTAMP:
+            raise ValueError(value)
+        return cursor
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(value)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, datetime.timezone.utc)
+    return (to_microseconds(parsed), END_OF_TIMESTAMP, 0)
+
+
+def after_cursor(column, source, cursor):
+    """source 番目の種類のうち、カーソルより後の行の条件"""
+    if cursor is None:
+        return Q()
+    timestamp, cursor_source, cursor_pk = cursor
+    timestamp = from_microseconds(timestamp)
+    condition = Q(**{f'{column}__gt': timestamp})
+    if source > cursor_source:
+        condition |= Q(**{column: timestamp})
+    elif source == cursor_source:
+        condition |= Q(**{column: timestamp, 'pk__gt': cursor_pk})
+    return condition
+
+
+def get_changes(since=None, limit=DEFAULT_LIMIT, request=None, now=None):
+    """
+    since (parse_since() のカーソル、Noneなら最初から) より後の変更を、古い順に最大limit件返す
+    戻り値: {'changes': [...], 'next_since': トークン, 'has_more': まだ変更が残っているか}
+    """
+    now = now or timezone.now()
+    lag = getattr(settings, 'FACILITIES_CHANGE_FEED_LAG', DEFAULT_LAG)
+    retention = getattr(settings, 'FACILITIES_TOMBSTONE_RETENTION_DAYS', DEFAULT_RETENTION_DAYS)
+    if since is not None and from_microseconds(since[0]) < now - datetime.timedelta(days=retention):
+        raise ResyncRequired()
+    # この時刻までの変更を返す
+    until = now - datetime.timedelta(seconds=lag)
+    if since is not None and to_microseconds(until) < since[0]:
+        return {'changes': [], 'next_since': encode_cursor(since), 'has_more': False}
+
+    # 種類ごとに limit + 1 件まで読み、日時の順に並べ直して先頭の limit 件を返す
+    rows = []
+    for source, (kind, model, column, extra) in enumerate(SOURCES):
+        queryset = (
+            model.objects.filter(after_cursor(column, source, since), **{f'{column}__lte': until})
+            .order_by(column, 'pk')
+            .values_list(column, 'pk', *extra)[:limit + 1]
+        )
+        rows += [(to_microseconds(row[0]), source, row[1], row) for row in queryset]
+    rows.sort(key=lambda row: row[:3])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if has_more:
+        next_cursor = rows[-1][:3]
+    else:
+        next_cursor = (to_microseconds(until), END_OF_TIMESTAMP, 0)
+    return {
+        'changes': build_changes(rows, request),
+        'next_since': encode_cursor(next_cursor),
+        'has_more': has_more,
+    }
+
+
+def build_changes(rows, request=None):
+    facility_ids = [pk for _, source, pk, _ in rows if SOURCES[source][0] == 'facility']
+    facility_payloads = payloads.build_payloads(facility_ids, request)[0] if facility_ids else {}
+    image_rows = [(pk, *row[2:]) for _, source, pk, row in rows if SOURCES[source][0] == 'image']
+    image_payloads = {
+        image['id']: (facility_id, image)
+        for facility_id, images in payloads.image_payloads(image_rows, request).items()
+        for image in images
+    }
+
+    changes = []
+    for _, source, pk, row in rows:
+        kind, at = SOURCES[source][0], row[0]
+        if kind == 'deleted':
+            changes.append({'type': row[2], 'id': row[3], 'action': 'deleted', 'at': at})
+        elif kind == 'amenity':
+            changes.append({'type': kind, 'id': pk, 'action': 'upserted', 'at': at, 'data': {'id': pk, 'name': row[2]}})
+        elif kind == 'facility':
+            # 読み込みの間に削除された施設は、削除の記録の方で返す
+            if pk in facility_payloads:
+                changes.append({'type': kind, 'id': pk, 'action': 'upserted', 'at': at, 'data': facility_payloads[pk]})
+        else:
+            facility_id, image = image_payloads[pk]
+            changes.append({
+                'type': kind, 'id': pk, 'action': 'upserted', 'at': at, 'facility': facility_id, 'data': image,
+            })
+    return changes
+
+
+def prune_tombstones(now=None):
+    """保存期間を過ぎた削除の記録を削除し、件数を返す"""
+    retention = getattr(settings, 'FACILITIES_TOMBSTONE_RETENTION_DAYS', DEFAULT_RETENTION_DAYS)
+    cutoff = (now or timezone.now()) - datetime.timedelta(days=retention)
+    deleted, _ = Tombstone.objects.filter(deleted_at__lt=cutoff).delete()
+    return deleted
@@ -0,0 +1,359 @@
+# 施設画像のファイルの削除
+#
+# - 画像の行を削除したとき(施設の削除に伴うCASCADE・一括削除・元画像の差し替えを含む)は、元画像のファイルの参照数
+#   (FacilityImageBlob.ref_count、同じ中身のアップロードは1つのファイルを共有する)を同じトランザクションで減らし、
+#   コミット後にバックグラウンド(facilities.tasks)で、参照がなくなったファイルを派生画像と一緒に削除する。
+#   リクエストの中ではファイルを削除せず、ロールバックされた場合は何もしない
+# - どの行からも参照されていないファイル(孤立したファイル)は collect_garbage() で探して削除する
+#   (python manage.py collect_media_garbage)
+#   1. DBの参照(元画像・派生画像の名前)を画像IDの順に batch_size 件ずつ読み、名前のハッシュ(8バイト)を整列した配列にする
+#      (名前の文字列を集合に持つより小さい。ハッシュの衝突では参照されていると判定するだけなので、誤って削除はしない)
+#   2. ストレージのファイルを1件ずつ読み、配列にない名前を batch_size 件ずつ、DBの元画像の名前と照合し直してから削除する
+#      参照数(FacilityImageBlob.ref_count)が残っているファイルも消さない (参照数のずれは dedupe_images で数え直す)
+#   アップロードの途中(ファイルの保存から行の登録まで)や派生画像の生成中のファイルを消さないように、
+#   min_age 秒より新しいファイルは対象にしない
+# - 重複を排除する前に保存されたファイルは deduplicate_images() で中身ごとに1つにまとめる
+#   (python manage.py dedupe_images)
+
+import logging
+import os
+import posixpath
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from dataclasses import asdict, dataclass
+
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from . import events, tasks
+from .models import FacilityImage, FacilityImageBlob
+from .storage import content_digest
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_MIN_AGE = 60 * 60       # これより新しいファイルは孤立していても削除しない(秒)
+
+
+def image_storage():
+    return FacilityImage._meta.get_field('image').storage
+
+
+def image_directory():
+    """施設画像を保存するディレクトリ (FacilityImage.image の upload_to)"""
+    return FacilityImage._meta.get_field('image').upload_to.rstrip('/')
+
+
+def image_file_names(name, variants):
+    """1件の画像が使うファイルの名前 (元画像と派生画像)"""
+    return [file_name for file_name in [name, *(variant['name'] for variant in variants or ())] if file_name]
+
+
+def release_images(images):
+    """
+    削除・差し替えた画像が使っていたファイルの参照を減らし、コミット後に参照がなくなったファイルを削除する
+    images: [(元画像の名前, 派生画像のリスト), ...]
+    """
+    counts, files = Counter(), defaultdict(set)
+    for name, variants in images:
+        if name:
+            counts[name] += 1
+            files[name].update(image_file_names(name, variants))
+    if not counts:
+        return
+    # 減らす数ごとに1回のUPDATE (ほとんどの場合は1回)
+    names_by_count = defaultdict(list)
+    for name, count in counts.items():
+        names_by_count[count].append(name)
+    for count, names in names_by_count.items():
+        FacilityImageBlob.objects.filter(name__in=names).update(ref_count=Greatest(F('ref_count') - count, 0))
+    tasks.schedule_on_commit(delete_released, {name: sorted(names) for name, names in files.items()})
+
+
+def discard_rolled_back(names):
+    """
+    ロールバックしたアップロードで保存したファイルを、(外側の)コミット後に削除する
+    保存時に増やした参照数はロールバックで元に戻るため減らさない。同じ中身を共有するほかの画像が使っている
+    ファイル(参照数が残っているもの)は delete_released() が残す。ロールバックした atomic の外で呼ぶ
+    """
+    names = sorted({name for name in names if name})
+    if names:
+        tasks.schedule_on_commit(delete_released, {name: [name] for name in names})
+
+
+def delete_released(files, storage=None):
+    """
+    参照がなくなった元画像のファイルを、派生画像と一緒に削除する (コミット後に実行する)
+    files: {元画像の名前: [元画像と派生画像の名前, ...]}
+    戻り値: (削除したファイルの数, 合計バイト数)
+    """
+    in_use = set(FacilityImage.objects.filter(image__in=list(files)).values_list('image', flat=True))
+    registered = set(FacilityImageBlob.objects.filter(name__in=list(files)).values_list('name', flat=True))
+    names = []
+    for name, file_names in files.items():
+        if name in in_use:
+            continue
+        # 参照数が0のままなら削除する (その間に同じ中身がアップロードされていたら参照が増えているため残す)
+        # 登録されていないファイル (重複の排除より前に保存されたもの) は、使っている画像が残っていなければ削除する
+        if name in registered and not FacilityImageBlob.objects.filter(name=name, ref_count=0).delete()[0]:
+            continue
+        names += file_names
+    return delete_files(names, storage)
+
+
+def delete_files(names, storage=None):
+    """ファイルを削除し、(削除した数, 合計バイト数) を返す (存在しないファイルは数えない)"""
+    storage = storage or image_storage()
+    deleted = reclaimed = 0
+    for name in names:
+        try:
+            size = storage.size(name)
+            storage.delete(name)
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            logger.warning("Could not delete media file %s: %s", name, e)
+            continue
+        deleted += 1
+        reclaimed += size
+    return deleted, reclaimed
+
+
+def file_sizes(names, storage):
+    """存在するファイルの合計サイズ"""
+    total = 0
+    for name in names:
+        try:
+            total += storage.size(name)
+        except OSError:
+            continue
+    return total
+
+
+def name_key(name):
+    # 同じプロセスの中で比較するだけなので、組み込みのハッシュで十分
+    return hash(name)
+
+
+def referenced_keys(batch_size=DEFAULT_BATCH_SIZE):
+    """DBから参照されているファイルの名前のハッシュ (整列済み)"""
+    keys = array('q')
+    last_pk = 0
+    while True:
+        rows = list(
+            FacilityImage.objects.filter(pk__gt=last_pk).order_by('pk')
+            .values_list('pk', 'image', 'variants')[:batch_size]
+        )
+        if not rows:
+            break
+        for _, name, variants in rows:
+            keys.extend(name_key(file_name) for file_name in image_file_names(name, variants))
+        last_pk = rows[-1][0]
+    return array('q', sorted(keys))
+
+
+def contains(keys, key):
+    index = bisect_left(keys, key)
+    return index < len(keys) and keys[index] == key
+
+
+def walk_files(storage, directory):
+    """
+    ストレージの directory 以下のファイルを (名前, サイズ, 更新日時のUNIX時間) で1件ずつ返す
+    ファイルシステムのストレージは os.scandir で読む (ディレクトリ全体の一覧をメモリに載せない)
+    """
+    try:
+        root = storage.path(directory)
+    except NotImplementedError:
+        root = None
+    if root is None:
+        directories, files = storage.listdir(directory)
+        for file_name in files:
+            name = posixpath.join(directory, file_name)
+            yield name, storage.size(name), storage.get_modified_time(name).timestamp()
+        for child in directories:
+            yield from walk_files(storage, posixpath.join(directory, child))
+        return
+    try:
+        entries = os.scandir(root)
+    except FileNotFoundError:
+        return
+    with entries:
+        for entry in entries:
+            name = posixpath.join(directory, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk_files(storage, name)
+            elif entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                yield name, stat.st_size, stat.st_mtime
+
+
+@dataclass
+class GarbageReport:
+    scanned: int = 0
+    recent: int = 0             # 孤立していたが min_age より新しいため残したファイル
+    orphaned: int = 0
+    orphaned_bytes: int = 0
+    deleted: int = 0
+    reclaimed_bytes: int = 0
+    dry_run: bool = False
+
+    def as_dict(self):
+        return asdict(self)
+
+
+def collect_garbage(dry_run=False, min_age=DEFAULT_MIN_AGE, batch_size=DEFAULT_BATCH_SIZE,
+                    storage=None, directory=None, now=None, on_orphan=None):
+    """
+    どの画像からも参照されていないファイルを削除し、GarbageReport を返す (dry_run=True なら数えるだけ)
+    on_orphan: 孤立したファイルごとに (名前, サイズ) で呼ぶ (一覧の表示用)
+    """
+    storage = storage or image_storage()
+    directory = image_directory() if directory is None else directory
+    cutoff = (now or time.time()) - min_age
+    report = GarbageReport(dry_run=dry_run)
+    keys = referenced_keys(batch_size)
+
+    def flush(batch):
+        # 1. の後に登録された画像が使っているファイルと、参照数が残っている(アップロード中の)ファイルは消さない
+        reused = set(FacilityImage.objects.filter(image__in=list(batch)).values_list('image', flat=True))
+        reused |= set(
+            FacilityImageBlob.objects.filter(name__in=list(batch), ref_count__gt=0).values_list('name', flat=True)
+        )
+        names = [name for name in batch if name not in reused]
+        for name in names:
+            report.orphaned += 1
+            report.orphaned_bytes += batch[name]
+            if on_orphan is not None:
+                on_orphan(name, batch[name])
+        if not dry_run:
+            FacilityImageBlob.objects.filter(name__in=names, ref_count=0).delete()
+            deleted, reclaimed = delete_files(names, storage)
+            report.deleted += deleted
+            report.reclaimed_bytes += reclaimed
+
+    batch = {}
+    for name, size, modified in walk_files(storage, directory):
+        report.scanned += 1
+        if contains(keys, name_key(name)):
+            continue
+        if modified > cutoff:
+            report.recent += 1
+            continue
+        batch[name] = size
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = {}
+    if batch:
+        flush(batch)
+    return report
+
+
+@dataclass
+class DedupeReport:
+    scanned: int = 0            # 中身を読んだ元画像のファイル
+    duplicates: int = 0         # 同じ中身のファイルが別にあった元画像のファイル
+    images: int = 0             # 残すファイルに付け替えた画像
+    deleted: int = 0
+    saved_bytes: int = 0
+    failed: int = 0             # 読めなかったファイル
+    dry_run: bool = False
+
+    def as_dict(self):
+        return asdict(self)
+
+
+def deduplicate_images(dry_run=False, batch_size=DEFAULT_BATCH_SIZE, storage=None, on_duplicate=None):
+    """
+    中身が同じ元画像のファイルを1つにまとめ、DedupeReport を返す (dry_run=True なら数えるだけ)
+
+    1. 画像が使う元画像の名前を batch_size 件ずつ読み、ファイルの中身のSHA-256を計算する
+       登録済み(FacilityImageBlob)のファイルか、最初に見つかったファイルを残す
+    2. 重複したファイルを使う画像を残すファイルに付け替え(残すファイルに派生画像があればそれも共有する)、
+       重複したファイルを削除する
+    3. 登録したファイルの参照数を、画像の行から数え直す
+    on_duplicate: 重複したファイルごとに (名前, 残すファイルの名前, サイズ) で呼ぶ (一覧の表示用)
+    """
+    storage = storage or image_storage()
+    report = DedupeReport(dry_run=dry_run)
+    seen = {}       # {中身のSHA-256: 残すファイルの名前}
+    last_name = ''
+    while True:
+        names = list(
+            FacilityImage.objects.filter(image__gt=last_name).order_by('image')
+            .values_list('image', flat=True).distinct()[:batch_size]
+        )
+        if not names:
+            break
+        last_name = names[-1]
+
+        files = []
+        for name in names:
+            try:
+                with storage.open(name, 'rb') as f:
+                    files.append((name, content_digest(f), f.size))
+            except OSError as e:
+                report.failed += 1
+                logger.warning("Could not read media file %s: %s", name, e)
+        report.scanned += len(files)
+        registered = dict(
+            FacilityImageBlob.objects.filter(digest__in=[digest for _, digest, _ in files]).values_list('digest', 'name')
+        )
+
+        blobs = []
+        for name, digest, size in files:
+            keep = seen.get(digest) or registered.get(digest)
+            if keep is None or keep == name or not storage.exists(keep):
+                seen[digest] = name
+                if keep is None:
+                    blobs.append(FacilityImageBlob(digest=digest, name=name, size=size))
+                elif keep != name and not dry_run:
+                    # 登録済みのファイルが失われている: このファイルを残す
+                    FacilityImageBlob.objects.filter(digest=digest).update(name=name)
+                continue
+            report.duplicates += 1
+            if on_duplicate is not None:
+                on_duplicate(name, keep, size)
+            merge_duplicate(name, keep, storage, report)
+        if blobs and not dry_run:
+            FacilityImageBlob.objects.bulk_create(blobs, ignore_conflicts=True)
+
+    if not dry_run:
+        counts = (
+            FacilityImage.objects.filter(image=OuterRef('name')).order_by()
+            .values('image').annotate(count=Count('pk')).values('count')
+        )
+        FacilityImageBlob.objects.update(ref_count=Coalesce(Subquery(counts), 0))
+    return report
+
+
+def merge_duplicate(name, keep, storage, report):
+    """元画像 name を使う画像を keep に付け替え、name のファイルを削除する"""
+    rows = FacilityImage.objects.filter(image=name)
+    targets = list(rows.values_list('pk', 'facility_id', 'variants'))
+    shared = FacilityImage.objects.filter(image=keep).exclude(variants=[]).values_list('variants', flat=True).first()
+    names = [name]
+    if shared is not None:
+        # 残すファイルの派生画像を共有し、重複したファイルの派生画像は削除する
+        names += sorted({variant['name'] for _, _, variants in targets for variant in variants or ()})
+    report.images += len(targets)
+    if report.dry_run:
+        report.saved_bytes += file_sizes(names, storage)
+        return
+
+    from .signals import touch_facilities
+
+    with transaction.atomic():
+        changes = {'image': keep, 'updated_at': timezone.now()}
+        if shared is not None:
+            changes['variants'] = shared
+        rows.update(**changes)
+        touch_facilities({facility_id for _, facility_id, _ in targets})
+        events.publish([events.image_event(pk, 'updated', facility_id) for pk, facility_id, _ in targets])
+    deleted, saved = delete_files(names, storage)
+    report.deleted += deleted
+    report.saved_bytes += saved
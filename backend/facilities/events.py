@@ -0,0 +1,197 @@
+# 施設・画像・アメニティの変更の通知 (Server-Sent Events: GET /api/events/、ASGIサーバーのみ)
+#
+# - 変更はモデルのシグナルや一括処理から publish() で送り、トランザクションのコミット後に配信する
+#   イベントは種類・ID・操作と、施設ならバージョンだけの小さなもの
+#   {"type": "facility", "id": 12, "action": "updated", "version": 8}
+#   {"type": "image", "id": 301, "action": "created", "facility": 12}
+#   {"type": "amenity", "id": 4, "action": "deleted"}
+#   内容が必要なクライアントは、変更フィード(GET /api/changes/)や詳細のAPIで取り直す
+# - 配信先の管理(バックエンド)は settings.FACILITIES_EVENTS_BACKEND で差し替えられる。
+#   既定の LocalBroker はプロセス内だけで配信するため、ワーカーを複数起動した場合は
+#   同じワーカーで行われた変更しか届かない (複数のワーカー間で配信するには別のバックエンドを用意する)
+# - 購読者がいないときは、イベントの組み立て(施設のバージョンを読むクエリ)もコミット後の処理の登録もしない
+
+import asyncio
+import json
+import threading
+import weakref
+from collections import deque
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+DEFAULT_BACKEND = 'facilities.events.LocalBroker'
+DEFAULT_QUEUE_SIZE = 1000
+TYPES = ('facility', 'image', 'amenity')
+
+
+def encode(event):
+    """SSEの1件分のメッセージ (イベント名は種類)"""
+    data = json.dumps(event, ensure_ascii=False, separators=(',', ':'))
+    return f"event: {event['type']}\ndata: {data}\n\n".encode()
+
+
+class Subscription:
+    """1接続分の未送信のイベント (購読したイベントループの中だけで読み書きする)"""
+
+    def __init__(self, broker, types=None, facility=None, max_queue=None):
+        self.broker = broker
+        self.types = frozenset(types) if types else None
+        self.facility = facility
+        self.max_queue = max_queue or getattr(settings, 'FACILITIES_EVENTS_QUEUE_SIZE', DEFAULT_QUEUE_SIZE)
+        self.messages = deque()
+        self.ready = asyncio.Event()
+        # 送信が追いつかずにイベントを捨てた (クライアントは状態を取り直す必要がある)
+        self.overflowed = False
+
+    def matches(self, event):
+        if self.types is not None and event['type'] not in self.types:
+            return False
+        if self.facility is not None:
+            return event.get('facility', event['id'] if event['type'] == 'facility' else None) == self.facility
+        return True
+
+    def put(self, event, message):
+        if not self.matches(event):
+            return
+        if len(self.messages) >= self.max_queue:
+            self.messages.clear()
+            self.overflowed = True
+        self.messages.append(message)
+        self.ready.set()
+
+    async def get(self, timeout=None):
+        """
+        届いているメッセージをまとめて返す (なければ timeout 秒まで待ち、届かなければ空のリスト)
+        戻り値: (メッセージのリスト, 取りこぼしがあったか)
+        """
+        if not self.messages:
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return [], False
+        messages, overflowed = list(self.messages), self.overflowed
+        self.messages.clear()
+        self.ready.clear()
+        self.overflowed = False
+        return messages, overflowed
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """
+    プロセス内の購読者にイベントを配信する
+
+    購読者はイベントループごとに管理し、publish() はどのスレッドから呼んでもよい。
+    メッセージへの変換はイベントごとに1回だけ行い、ループごとに1回 call_soon_threadsafe() で渡す。
+    購読は弱参照で持つ (close() されないまま接続が破棄されても残らない)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}    # {イベントループ: WeakSet(Subscription, ...)}
+
+    def subscribe(self, **kwargs):
+        """実行中のイベントループの中で呼ぶ"""
+        loop = asyncio.get_running_loop()
+        subscription = Subscription(self, **kwargs)
+        with self._lock:
+            self._subscriptions.setdefault(loop, weakref.WeakSet()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for loop, subscriptions in list(self._subscriptions.items()):
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[loop]
+
+    def has_subscribers(self):
+        with self._lock:
+            return any(self._subscriptions.values())
+
+    def count(self):
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+    def publish(self, events):
+        messages = [(event, encode(event)) for event in events]
+        with self._lock:
+            targets = [(loop, tuple(subscriptions)) for loop, subscriptions in self._subscriptions.items()]
+        try:
+            current = asyncio.get_running_loop()
+        except RuntimeError:
+            current = None
+        for loop, subscriptions in targets:
+            if loop is current:
+                deliver(subscriptions, messages)
+                continue
+            try:
+                loop.call_soon_threadsafe(deliver, subscriptions, messages)
+            except RuntimeError:
+                # ループが終了している (購読の解除が済んでいない接続)
+                pass
+
+
+def deliver(subscriptions, messages):
+    for subscription in subscriptions:
+        for event, message in messages:
+            subscription.put(event, message)
+
+
+@lru_cache(maxsize=None)
+def _load_broker(path):
+    return import_string(path)()
+
+
+def get_broker():
+    return _load_broker(getattr(settings, 'FACILITIES_EVENTS_BACKEND', DEFAULT_BACKEND))
+
+
+def publish(events):
+    """現在のトランザクションがコミットされた後にイベントを配信する"""
+    broker = get_broker()
+    if events and broker.has_subscribers():
+        events = list(events)
+        transaction.on_commit(lambda: broker.publish(events))
+
+
+def publish_facilities(ids, action='updated'):
+    """
+    施設のイベントを配信する。バージョンはコミット後に読む (同じトランザクションで何度更新されても最新の値になる)
+    """
+    broker = get_broker()
+    ids = sorted(set(ids))
+    if not ids or not broker.has_subscribers():
+        return
+
+    def send():
+        from .models import Facility
+
+        if not broker.has_subscribers():
+            return
+        versions = dict(Facility.objects.filter(pk__in=ids).values_list('pk', 'version'))
+        broker.publish([
+            facility_event(pk, action, versions[pk]) for pk in ids if pk in versions
+        ])
+
+    transaction.on_commit(send)
+
+
+def facility_event(pk, action, version=None):
+    event = {'type': 'facility', 'id': pk, 'action': action}
+    if version is not None:
+        event['version'] = version
+    return event
+
+
+def image_event(pk, action, facility_id):
+    return {'type': 'image', 'id': pk, 'action': action, 'facility': facility_id}
+
+
+def amenity_event(pk, action):
+    return {'type': 'amenity', 'id': pk, 'action': action}
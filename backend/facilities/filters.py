@@ -0,0 +1,194 @@
+import math
+
+from django.conf import settings
+from django.db.models import Case, Count, IntegerField, When
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+
+from . import geo, search
+from .models import Facility
+
+
+def facilities_with_all_amenities(amenity_ids):
+    """
+    指定したアメニティをすべて持つ施設IDのサブクエリ
+
+    アメニティごとにJOINを重ねるのではなく、中間テーブルを1回だけ走査して
+    `WHERE amenity_id IN (...) GROUP BY facility_id HAVING COUNT(*) = アメニティ数` で絞り込む
+    ((amenity_id, facility_id) のインデックスだけで完結する)
+    """
+    through = Facility.amenities.through
+    return (
+        through.objects
+        .filter(amenity_id__in=amenity_ids)
+        .values('facility_id')
+        .annotate(matched=Count('amenity_id'))
+        .filter(matched=len(amenity_ids))
+        .values('facility_id')
+    )
+
+
+class FacilityFilterBackend(BaseFilterBackend):
+    """
+    施設一覧のサーバー側フィルター
+
+    - `?capacity__gte=N`      最大宿泊人数がN人以上
+    - `?num_parking__gte=N`   駐車場がN台以上
+    - `?management_entity=IH` 管理形態 (IH: 自社管理, CM: 委託管理)
+    - `?amenities=1,2,3`      指定したアメニティ(ID)をすべて持つ
+    """
+    integer_filters = ('capacity__gte', 'num_parking__gte')
+
+    def filter_queryset(self, request, queryset, view):
+        params = request.query_params
+        errors = {}
+
+        for name in self.integer_filters:
+            value = params.get(name)
+            if value in (None, ''):
+                continue
+            try:
+                queryset = queryset.filter(**{name: int(value)})
+            except ValueError:
+                errors[name] = ['整数を指定してください。']
+
+        management_entity = params.get('management_entity')
+        if management_entity:
+            if management_entity in Facility.ManagementType.values:
+                queryset = queryset.filter(management_entity=management_entity)
+            else:
+                errors['management_entity'] = [
+                    f"{', '.join(Facility.ManagementType.values)} のいずれかを指定してください。"
+                ]
+
+        amenities = params.get('amenities')
+        if amenities:
+            try:
+                amenity_ids = sorted({int(value) for value in amenities.split(',') if value.strip()})
+            except ValueError:
+                errors['amenities'] = ['アメニティのIDをカンマ区切りで指定してください。']
+            else:
+                if amenity_ids:
+                    queryset = queryset.filter(pk__in=facilities_with_all_amenities(amenity_ids))
+
+        if errors:
+            raise ValidationError(errors)
+        return queryset
+
+
+class FacilityBoundingBoxFilter(BaseFilterBackend):
+    """
+    `?bbox=min_lat,min_lng,max_lat,max_lng` 範囲の中にある施設 (facilities.geo。座標のない施設は対象にならない)
+    min_lng > max_lng なら日付変更線をまたぐ範囲。全文検索で順位を付ける前に絞り込む
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        bbox = request.query_params.get('bbox', '').strip()
+        if not bbox:
+            return queryset
+        box = parse_numbers(bbox, 4)
+        if box is None or not (geo.valid_coordinates(*box[:2]) and geo.valid_coordinates(*box[2:])):
+            raise ValidationError({'bbox': ['最小の緯度,最小の経度,最大の緯度,最大の経度 を指定してください。']})
+        if box[0] > box[2]:
+            raise ValidationError({'bbox': ['最小の緯度は最大の緯度以下を指定してください。']})
+        return queryset.filter(geo.within(*box))
+
+
+class FacilitySearchFilter(BaseFilterBackend):
+    """
+    `?q=` 施設名・短い説明文・住所・説明文の全文検索 (facilities.search)
+
+    ほかのフィルターで絞り込んだ施設の中で、一致した施設を関連度の高い順に最大 FACILITIES_SEARCH_LIMIT 件返す。
+    順位で並べるため、検索時はカーソルページネーションを行わない。
+    `?near=` と一緒に指定した場合は、順位を付けずに一致するすべての施設に絞り込み、近い順に並べる
+    """
+    search_param = 'q'
+
+    @classmethod
+    def get_query(cls, request):
+        return request.query_params.get(cls.search_param, '').strip()
+
+    def filter_queryset(self, request, queryset, view):
+        query = self.get_query(request)
+        if not query:
+            return queryset
+        if FacilityNearestFilter.get_near(request):
+            matching = search.matching(query)
+            return queryset.none() if matching is None else queryset.filter(pk__in=matching)
+        # 条件付きGETの照合と一覧の取得で2回呼ばれるため、検索結果はビューに保持して使い回す
+        results = view.__dict__.setdefault('_search_results', {})
+        key = (query, str(queryset.query))
+        if key not in results:
+            results[key] = search.search(query, within=queryset)
+        return in_order(queryset, results[key])
+
+
+class FacilityNearestFilter(BaseFilterBackend):
+    """
+    `?near=lat,lng&k=N` 近い順にN件 (facilities.geo。既定10件、最大 FACILITIES_GEO_NEAREST_LIMIT 件)
+    `&radius=km` を指定すると、それより遠い施設は返さない。ほかのすべてのフィルターで絞り込んだ施設から選ぶ
+
+    近い順に並べるため、カーソルページネーションを行わない。
+    """
+    default_k = 10
+
+    @classmethod
+    def get_near(cls, request):
+        return request.query_params.get('near', '').strip()
+
+    def filter_queryset(self, request, queryset, view):
+        params = request.query_params
+        near = self.get_near(request)
+        if not near:
+            return queryset
+        errors = {}
+        center = parse_numbers(near, 2)
+        if center is None or not geo.valid_coordinates(*center):
+            errors['near'] = ['緯度,経度 を指定してください。']
+        limit = getattr(settings, 'FACILITIES_GEO_NEAREST_LIMIT', 100)
+        try:
+            k = int(params.get('k') or self.default_k)
+            if not 1 <= k <= limit:
+                raise ValueError(k)
+        except ValueError:
+            errors['k'] = [f'1から{limit}までの整数を指定してください。']
+        radius = params.get('radius')
+        if radius not in (None, ''):
+            radius = parse_numbers(radius, 1)
+            if radius is None or radius[0] <= 0:
+                errors['radius'] = ['正の数(km)を指定してください。']
+            else:
+                radius = radius[0]
+        else:
+            radius = None
+        if errors:
+            raise ValidationError(errors)
+
+        # 条件付きGETの照合と一覧の取得で2回呼ばれるため、結果はビューに保持して使い回す
+        results = view.__dict__.setdefault('_nearest_results', {})
+        key = (*center, k, radius, str(queryset.query))
+        if key not in results:
+            results[key] = [pk for pk, _ in geo.nearest(queryset, *center, k, max_distance=radius)]
+        return in_order(queryset, results[key])
+
+
+def parse_numbers(value, count):
+    """カンマ区切りの count 個の数 (不正ならNone)"""
+    try:
+        numbers = [float(part) for part in value.split(',')]
+    except ValueError:
+        return None
+    if len(numbers) != count or not all(math.isfinite(number) for number in numbers):
+        return None
+    return numbers
+
+
+def in_order(queryset, facility_ids):
+    """facility_ids の施設を、その順に並べる"""
+    if not facility_ids:
+        return queryset.none()
+    ranking = Case(
+        *[When(pk=pk, then=position) for position, pk in enumerate(facility_ids)],
+        output_field=IntegerField(),
+    )
+    return queryset.filter(pk__in=facility_ids).order_by(ranking)
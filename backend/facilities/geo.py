@@ -0,0 +1,226 @@
+# 施設の位置(緯度・経度)と、範囲(bbox)・近傍(k件)の検索
+#
+# - 緯度・経度は GoogleマップのURL(map_url)から読み取る。既存の施設には python manage.py geocode_facilities で
+#   一括で設定し、APIで map_url だけを指定した場合も読み取れれば設定する (facilities.serializers)
+# - 索引はグリッド: 緯度・経度を CELL_SIZE 度ごとのセルに分け、施設の行にセルの番号(行 * COLUMNS + 列)を持たせて
+#   (セル, 緯度, 経度) のインデックスを張る (座標の読み込みもインデックスだけで済む)。
+#   同じ緯度帯のセルは番号が連続するため、範囲の検索は「緯度帯ごとのセル番号の範囲」のORになり、
+#   範囲に重なるセルの施設だけを読む (施設の総数には比例しない)。
+#   SQLiteのR*TreeやPostGISを使わないため、どちらのデータベースでも同じように動く
+# - 近傍の検索は、中心からの半径を広げながら範囲の検索を繰り返し、半径の円の中で k 件見つかった時点で
+#   距離(大円距離)の近い順に返す
+
+import math
+import re
+from bisect import bisect_right
+from dataclasses import asdict, dataclass
+from urllib.parse import parse_qs, urlsplit
+
+from django.db.models import Q
+
+CELL_SIZE = 0.01                            # セルの大きさ(度)。南北に約1.1km
+ROWS = round(180 / CELL_SIZE)
+COLUMNS = round(360 / CELL_SIZE)
+# 範囲がこれより多くの緯度帯にまたがる場合は、緯度帯全体のセル番号を1つの範囲で読む
+MAX_BAND_ROWS = 64
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+MAX_DISTANCE_KM = math.pi * EARTH_RADIUS_KM     # 地球の裏側までの距離
+
+DEFAULT_BATCH_SIZE = 1000
+
+# 座標の指定 "35.0,135.7" ("loc:" や空白を含むものも)
+_PAIR = re.compile(r'^\s*(?:loc:\s*)?([-+]?\d{1,3}(?:\.\d+)?)\s*,\s*([-+]?\d{1,3}(?:\.\d+)?)\s*$')
+# 場所のページのピンの位置 ".../data=!3m1!4b1!4m6!3m5!...!3d35.0!4d135.7..."
+_PIN = re.compile(r'!3d([-+]?\d{1,3}(?:\.\d+)?)!4d([-+]?\d{1,3}(?:\.\d+)?)')
+# 地図の中心 ".../@35.0,135.7,15z"
+_CENTER = re.compile(r'/@([-+]?\d{1,3}(?:\.\d+)?),([-+]?\d{1,3}(?:\.\d+)?)(?:,|$)')
+# 座標を指定するクエリパラメータ (優先する順)
+COORDINATE_PARAMS = ('q', 'query', 'll', 'sll', 'center', 'destination', 'daddr', 'viewpoint')
+
+
+def valid_coordinates(latitude, longitude):
+    return -90 <= latitude <= 90 and -180 <= longitude <= 180
+
+
+def parse_map_url(url):
+    """
+    GoogleマップのURLから (緯度, 経度) を読み取る。座標を含まないURL(短縮URLや住所の検索など)は None
+
+        https://www.google.com/maps?q=35.0,135.7
+        https://www.google.com/maps/search/?api=1&query=35.0,135.7
+        https://www.google.com/maps/place/.../@35.0,135.7,17z/data=!3m1!4b1!4m6!3m5!1s...!8m2!3d35.01!4d135.71
+    """
+    if not url:
+        return None
+    parts = urlsplit(url.strip())
+    candidates = [_PIN.search(parts.path) or _PIN.search(parts.query)]
+    params = parse_qs(parts.query)
+    candidates += [_PAIR.match(params[name][0]) for name in COORDINATE_PARAMS if name in params]
+    candidates.append(_CENTER.search(parts.path))
+    for match in candidates:
+        if match is None:
+            continue
+        latitude, longitude = float(match[1]), float(match[2])
+        if valid_coordinates(latitude, longitude):
+            return latitude, longitude
+    return None
+
+
+def cell_row(latitude):
+    return min(max(math.floor((latitude + 90) / CELL_SIZE), 0), ROWS - 1)
+
+
+def cell_column(longitude):
+    return min(max(math.floor((longitude + 180) / CELL_SIZE), 0), COLUMNS - 1)
+
+
+def cell_for(latitude, longitude):
+    """座標を含むセルの番号 (座標がなければ None)"""
+    if latitude is None or longitude is None:
+        return None
+    return cell_row(latitude) * COLUMNS + cell_column(longitude)
+
+
+def cell_ranges(min_lat, min_lng, max_lat, max_lng):
+    """範囲に重なるセルの番号の範囲 [(最小, 最大), ...] (経度は min_lng > max_lng なら日付変更線をまたぐ)"""
+    first_row, last_row = cell_row(min_lat), cell_row(max_lat)
+    if last_row - first_row + 1 > MAX_BAND_ROWS:
+        return [(first_row * COLUMNS, (last_row + 1) * COLUMNS - 1)]
+    if min_lng <= max_lng:
+        columns = [(cell_column(min_lng), cell_column(max_lng))]
+    else:
+        columns = [(0, cell_column(max_lng)), (cell_column(min_lng), COLUMNS - 1)]
+    ranges = []
+    for row in range(first_row, last_row + 1):
+        for first, last in columns:
+            low, high = row * COLUMNS + first, row * COLUMNS + last
+            # 隣り合う範囲(経度の全体を覆う場合など)はつなげる
+            if ranges and ranges[-1][1] + 1 >= low:
+                ranges[-1] = (ranges[-1][0], high)
+            else:
+                ranges.append((low, high))
+    return ranges
+
+
+def within(min_lat, min_lng, max_lat, max_lng):
+    """範囲の中にある施設の条件 (Q)。経度は min_lng > max_lng なら日付変更線をまたぐ範囲"""
+    cells = Q()
+    for low, high in cell_ranges(min_lat, min_lng, max_lat, max_lng):
+        cells |= Q(geo_cell__gte=low, geo_cell__lte=high)
+    if min_lng <= max_lng:
+        longitude = Q(longitude__gte=min_lng, longitude__lte=max_lng)
+    else:
+        longitude = Q(longitude__gte=min_lng) | Q(longitude__lte=max_lng)
+    return cells & Q(latitude__gte=min_lat, latitude__lte=max_lat) & longitude
+
+
+def distance(lat1, lng1, lat2, lng2):
+    """2点間の大円距離 (km、ハーバーサインの公式)"""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(latitude, longitude, radius):
+    """中心から半径 radius(km) の円を含む範囲 (min_lat, min_lng, max_lat, max_lng)"""
+    delta_lat = radius / KM_PER_DEGREE
+    min_lat, max_lat = latitude - delta_lat, latitude + delta_lat
+    angle = radius / EARTH_RADIUS_KM
+    if min_lat <= -90 or max_lat >= 90 or angle >= math.pi / 2:
+        # 極を含む: 経度はすべて
+        return max(min_lat, -90), -180, min(max_lat, 90), 180
+    ratio = math.sin(angle) / math.cos(math.radians(latitude))
+    if ratio >= 1:
+        return min_lat, -180, max_lat, 180
+    delta_lng = math.degrees(math.asin(ratio))
+    min_lng, max_lng = longitude - delta_lng, longitude + delta_lng
+    if min_lng < -180:
+        min_lng += 360
+    if max_lng > 180:
+        max_lng -= 360
+    return min_lat, min_lng, max_lat, max_lng
+
+
+def nearest(queryset, latitude, longitude, k, max_distance=None):
+    """
+    queryset の施設のうち (緯度, 経度) に近い順に最大 k 件の [(施設ID, 距離km), ...] を返す
+    max_distance(km) を指定すると、それより遠い施設は返さない
+
+    半径 radius の円を含む範囲の施設を読み、円の中に k 件あれば近い順に返す。
+    範囲の四隅(円の外)の施設は、それより近い施設がまだ読んでいない範囲にありうるため数えない。
+    足りなければ、範囲の中で k 番目に近い施設までの距離(k件あれば次で必ず見つかる)か、倍の半径で読み直す
+    """
+    limit = min(max_distance or MAX_DISTANCE_KM, MAX_DISTANCE_KM)
+    radius = min(CELL_SIZE * KM_PER_DEGREE, limit)
+    while True:
+        rows = queryset.filter(within(*bounding_box(latitude, longitude, radius))).order_by().values_list(
+            'pk', 'latitude', 'longitude'
+        )
+        found = sorted((distance(latitude, longitude, lat, lng), pk) for pk, lat, lng in rows)
+        inside = bisect_right(found, (radius, math.inf))
+        if inside >= k or radius >= limit:
+            return [(pk, d) for d, pk in found[:min(inside, k)]]
+        radius = min(found[k - 1][0] if len(found) >= k else radius * 2, limit)
+
+
+@dataclass
+class GeocodeReport:
+    scanned: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    unparsed: int = 0           # 座標を読み取れなかった map_url
+    dry_run: bool = False
+
+    def as_dict(self):
+        return asdict(self)
+
+
+def fill_coordinates(overwrite=False, dry_run=False, batch_size=DEFAULT_BATCH_SIZE, on_unparsed=None):
+    """
+    map_url から施設の緯度・経度を設定し、GeocodeReport を返す
+    overwrite=False なら座標のない施設だけを対象にする。座標が変わった施設はバージョンを進める
+    on_unparsed: 座標を読み取れなかった施設ごとに (施設ID, map_url) で呼ぶ
+    """
+    from django.db import transaction
+
+    from . import cache, events
+    from .models import Facility
+
+    report = GeocodeReport(dry_run=dry_run)
+    queryset = Facility.objects.exclude(map_url='')
+    if not overwrite:
+        queryset = queryset.filter(latitude__isnull=True)
+    last_pk = 0
+    while True:
+        rows = list(
+            queryset.filter(pk__gt=last_pk).order_by('pk')
+            .values_list('pk', 'map_url', 'latitude', 'longitude')[:batch_size]
+        )
+        if not rows:
+            break
+        last_pk = rows[-1][0]
+        report.scanned += len(rows)
+        changed = []
+        for pk, map_url, old_latitude, old_longitude in rows:
+            coordinates = parse_map_url(map_url)
+            if coordinates is None:
+                report.unparsed += 1
+                if on_unparsed is not None:
+                    on_unparsed(pk, map_url)
+            elif coordinates == (old_latitude, old_longitude):
+                report.unchanged += 1
+            else:
+                changed.append(Facility(pk=pk, latitude=coordinates[0], longitude=coordinates[1],
+                                        geo_cell=cell_for(*coordinates)))
+        report.updated += len(changed)
+        if changed and not dry_run:
+            ids = [facility.pk for facility in changed]
+            with transaction.atomic():
+                Facility.objects.bulk_update(changed, ['latitude', 'longitude', 'geo_cell'])
+                # シリアライズ結果が変わるため、バージョンを進めてキャッシュを破棄する
+                Facility.objects.filter(pk__in=ids).touch()
+                cache.invalidate(ids)
+                events.publish_facilities(ids)
+    return report
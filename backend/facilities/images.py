@@ -0,0 +1,170 @@
+# 施設画像の派生画像(リサイズ版)の生成
+#
+# アップロードされた元画像から、幅ごと・フォーマットごとの画像を作り、元画像と同じディレクトリに保存する。
+#   facilities/images/DSC_0041.JPG -> facilities/images/DSC_0041__w640.webp, DSC_0041__w640.jpg ...
+# ハッシュ付きの名前で保存するストレージ(facilities.storage)では、派生画像の名前にもそれぞれの中身のハッシュが入る。
+#   DSC_0041.3f2a9c0b1d4e.JPG -> DSC_0041.3f2a9c0b1d4e__w640.8c1d0e2f3a4b.webp ...
+# ファイル名は元画像の名前(と中身)から決まるため、何度実行しても同じファイルが使われるだけになる。
+# 同じ中身のアップロードは元画像のファイルを共有する(facilities.storage)ため、派生画像も同じ元画像を使う画像の間で共有する。
+
+import io
+import logging
+import posixpath
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from . import events
+from .models import FacilityImage
+from .storage import unhashed_name
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_VARIANT_WIDTHS = (320, 640, 1280)
+DEFAULT_VARIANT_FORMATS = ('webp', 'jpeg')
+
+# Pillowのフォーマット名 -> 拡張子
+EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg'}
+
+
+def variant_widths():
+    return tuple(getattr(settings, 'FACILITIES_IMAGE_VARIANT_WIDTHS', DEFAULT_VARIANT_WIDTHS))
+
+
+def variant_formats():
+    return tuple(getattr(settings, 'FACILITIES_IMAGE_VARIANT_FORMATS', DEFAULT_VARIANT_FORMATS))
+
+
+def variant_name(original_name, width, fmt):
+    """元画像の名前から派生画像の名前を決める"""
+    stem, _ = posixpath.splitext(original_name)
+    return f"{stem}__w{width}.{EXTENSIONS[fmt]}"
+
+
+def target_widths(original_width):
+    """元画像より大きい幅には拡大しない (元画像が最小幅より小さければ元の幅で1つだけ作る)"""
+    widths = [w for w in variant_widths() if w < original_width]
+    return widths or [original_width]
+
+
+def is_up_to_date(image):
+    """保存済みの派生画像が現在の元画像から作られ、ファイルも揃っているか"""
+    if not image.variants:
+        return False
+    storage = image.image.storage
+    expected_formats = set(variant_formats())
+    for variant in image.variants:
+        if unhashed_name(variant['name']) != variant_name(image.image.name, variant['width'], variant['format']):
+            return False
+        if not storage.exists(variant['name']):
+            return False
+    return {v['format'] for v in image.variants} == expected_formats
+
+
+def render_variants(source, original_name):
+    """PillowのImageから派生画像を作り、(メタデータ, ファイルの中身) のリストを返す"""
+    source = ImageOps.exif_transpose(source)
+    if source.mode not in ('RGB', 'L'):
+        source = source.convert('RGB')
+
+    results = []
+    for width in target_widths(source.width):
+        height = max(1, round(source.height * width / source.width))
+        resized = source.resize((width, height), Image.LANCZOS) if width != source.width else source
+        for fmt in variant_formats():
+            buffer = io.BytesIO()
+            resized.save(buffer, format=fmt.upper(), quality=getattr(settings, 'FACILITIES_IMAGE_VARIANT_QUALITY', 80))
+            results.append((
+                {'name': variant_name(original_name, width, fmt), 'width': width, 'height': height, 'format': fmt},
+                buffer.getvalue(),
+            ))
+    return results
+
+
+def generate_variants(image_id, force=False):
+    """
+    FacilityImage 1件分の派生画像を作って保存する
+    作成済みで最新なら何もしない (force=True で作り直す)。戻り値は保存した派生画像の情報
+    同じ元画像のファイルを使う画像(重複したアップロード)があれば、派生画像も共有する
+    """
+    image = FacilityImage.objects.filter(pk=image_id).first()
+    if image is None or not image.image:
+        return []
+    if not force and is_up_to_date(image):
+        return image.variants
+    if not force and (shared := shared_variants(image)) is not None:
+        # 作成済みの派生画像をそのまま使う (画像を変換し直さない)
+        save_variants(FacilityImage.objects.filter(pk=image.pk), shared)
+        return shared
+
+    storage = image.image.storage
+    try:
+        with storage.open(image.image.name, 'rb') as f:
+            with Image.open(f) as source:
+                rendered = render_variants(source, image.image.name)
+    except (OSError, UnidentifiedImageError) as e:
+        logger.warning("Could not generate variants for image %s (%s): %s", image.pk, image.image.name, e)
+        return []
+
+    hashed_name = getattr(storage, 'hashed_name', None)
+    save = getattr(storage, 'save_derivative', storage.save)
+    variants = []
+    for metadata, content in rendered:
+        content = ContentFile(content)
+        if hashed_name is not None and storage.exists(name := hashed_name(metadata['name'], content)):
+            # ハッシュ付きの名前が同じなら中身も同じため、既存のファイルをそのまま使う
+            metadata['name'] = name
+        else:
+            # 同じ名前で上書きするため、既存のファイルは先に削除する
+            if storage.exists(metadata['name']):
+                storage.delete(metadata['name'])
+            metadata['name'] = save(metadata['name'], content)
+        variants.append(metadata)
+
+    # 同じ元画像を使うすべての画像に反映する
+    rows = FacilityImage.objects.filter(image=image.image.name)
+    old = {variant['name'] for variants_ in rows.values_list('variants', flat=True) for variant in variants_}
+    save_variants(rows, variants)
+
+    # 作り直して名前(ハッシュ)が変わった派生画像の古いファイルを削除する
+    # (別の元画像から作られたものは、元画像と一緒に facilities.cleanup が削除する)
+    current = {variant['name'] for variant in variants}
+    for name in old - current:
+        if is_variant_of(name, image.image.name):
+            storage.delete(name)
+    return variants
+
+
+def is_variant_of(name, original_name):
+    stem, _ = posixpath.splitext(original_name)
+    return unhashed_name(name).startswith(f"{stem}__w")
+
+
+def shared_variants(image):
+    """同じ元画像のファイルを使う別の画像の、最新の派生画像 (なければNone)"""
+    siblings = FacilityImage.objects.filter(image=image.image.name).exclude(pk=image.pk).exclude(variants=[])
+    sibling = siblings.only('pk', 'image', 'variants').first()
+    if sibling is not None and is_up_to_date(sibling):
+        return sibling.variants
+    return None
+
+
+def save_variants(rows, variants):
+    """rows (FacilityImageのQuerySet) の派生画像を更新し、施設のバージョン・イベントに反映する"""
+    from .signals import touch_facilities
+
+    targets = list(rows.values_list('pk', 'facility_id'))
+    rows.update(variants=variants, updated_at=timezone.now())
+    # 施設のシリアライズ結果が変わるため、バージョンを進めてキャッシュを破棄する
+    touch_facilities({facility_id for _, facility_id in targets})
+    events.publish([events.image_event(pk, 'updated', facility_id) for pk, facility_id in targets])
+
+
+def build_srcset(variants, build_url):
+    """派生画像のリストから、フォーマットごとのsrcset文字列を作る"""
+    srcset = {}
+    for variant in sorted(variants, key=lambda v: v['width']):
+        srcset.setdefault(variant['format'], []).append(f"{build_url(variant['name'])} {variant['width']}w")
+    return {fmt: ", ".join(entries) for fmt, entries in srcset.items()}
@@ -0,0 +1,247 @@
+# リクエストごとの性能の計測
+#
+# InstrumentationMiddleware がリクエストごとに RequestMetrics を作り、次を記録する。
+# - SQL: 実行回数と実行時間 (すべての接続に登録した execute_wrapper で計測する)
+# - serialize: シリアライズ(ペイロードの組み立て)の時間 (section('serialize') の区間。区間内のSQLの時間は除く)
+# - render: レスポンスのレンダリング(JSONへの変換など)の時間
+# 結果は Server-Timing ヘッダー、構造化ログ(ロガー facilities.requests にJSONで1行)、
+# ルートごとの応答時間のヒストグラム(GET /api/metrics/requests/)に出力する。
+# FACILITIES_SLOW_REQUEST_MS を超えたリクエストは、時間のかかったSQLの上位と一緒に警告としてログに出す。
+
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+logger = logging.getLogger('facilities.requests')
+
+DEFAULT_SLOW_REQUEST_MS = 500
+SLOW_REQUEST_TOP_QUERIES = 5
+MAX_DISTINCT_QUERIES = 200      # 1リクエストで記録するSQLの種類の上限 (超えた分は件数・時間だけ数える)
+
+# 応答時間のヒストグラムの区切り(秒)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current = ContextVar('facilities_request_metrics', default=None)
+
+
+class RequestMetrics:
+    """1リクエスト分の計測値 (sync_to_async で別スレッドに渡っても同じオブジェクトに記録する)"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_count = 0
+        self.db_time = 0.0
+        # SQL(パラメータを含まない文)ごとの [回数, 合計時間]
+        self.queries = {}
+        self.sections = defaultdict(float)
+        self._active_sections = set()
+        self.render_started = None
+
+    def add_query(self, sql, duration):
+        self.db_count += 1
+        self.db_time += duration
+        entry = self.queries.get(sql)
+        if entry is None:
+            if len(self.queries) >= MAX_DISTINCT_QUERIES:
+                sql = '(other)'
+            entry = self.queries.setdefault(sql, [0, 0.0])
+        entry[0] += 1
+        entry[1] += duration
+
+    def top_queries(self, limit=SLOW_REQUEST_TOP_QUERIES):
+        ranked = sorted(self.queries.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        return [
+            {'sql': sql[:500], 'count': count, 'ms': round(total * 1000, 3)}
+            for sql, (count, total) in ranked
+        ]
+
+
+@contextmanager
+def section(name):
+    """区間の時間を name の時間として記録する (入れ子になった同名の区間は外側だけを数える)"""
+    metrics = _current.get()
+    if metrics is None or name in metrics._active_sections:
+        yield
+        return
+    metrics._active_sections.add(name)
+    started, db_before = time.perf_counter(), metrics.db_time
+    try:
+        yield
+    finally:
+        metrics._active_sections.discard(name)
+        metrics.sections[name] += (time.perf_counter() - started) - (metrics.db_time - db_before)
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.add_query(sql, time.perf_counter() - started)
+
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    # 接続し直すたびに呼ばれるため、登録済みなら何もしない
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class RouteHistograms:
+    """(メソッド, ルート)ごとの応答時間のヒストグラムとSQLの合計 (プロセス内)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def observe(self, method, route, status_code, duration, db_count, db_time):
+        key = (method, route, f"{status_code // 100}xx")
+        with self._lock:
+            entry = self._routes.get(key)
+            if entry is None:
+                entry = self._routes[key] = {'buckets': [0] * len(BUCKETS), 'count': 0, 'sum': 0.0,
+                                             'db_queries': 0, 'db_seconds': 0.0}
+            for index, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    entry['buckets'][index] += 1
+            entry['count'] += 1
+            entry['sum'] += duration
+            entry['db_queries'] += db_count
+            entry['db_seconds'] += db_time
+
+    def snapshot(self):
+        with self._lock:
+            return {key: {**entry, 'buckets': list(entry['buckets'])} for key, entry in self._routes.items()}
+
+    def clear(self):
+        with self._lock:
+            self._routes.clear()
+
+    def prometheus(self):
+        """Prometheusのテキスト形式"""
+        entries = [
+            (f'method="{method}",route="{escape_label(route)}",status="{status}"', entry)
+            for (method, route, status), entry in sorted(self.snapshot().items())
+        ]
+        lines = ["# TYPE facilities_request_duration_seconds histogram"]
+        for labels, entry in entries:
+            for bound, count in zip(BUCKETS, entry['buckets']):
+                lines.append(f'facilities_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'facilities_request_duration_seconds_bucket{{{labels},le="+Inf"}} {entry["count"]}')
+            lines.append(f'facilities_request_duration_seconds_sum{{{labels}}} {entry["sum"]:.6f}')
+            lines.append(f'facilities_request_duration_seconds_count{{{labels}}} {entry["count"]}')
+        lines.append("# TYPE facilities_request_db_queries_total counter")
+        lines += [f'facilities_request_db_queries_total{{{labels}}} {entry["db_queries"]}' for labels, entry in entries]
+        lines.append("# TYPE facilities_request_db_seconds_total counter")
+        lines += [f'facilities_request_db_seconds_total{{{labels}}} {entry["db_seconds"]:.6f}' for labels, entry in entries]
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+histograms = RouteHistograms()
+
+
+def describe_route(request):
+    """
+    (ルート, ビュー名, アクション)
+    ルートはURLのパターン (DRFのルーターなら "api/facilities/(?P<pk>[^/.]+)/") で、IDなどの値によって種類が増えない
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '(unmatched)', None, None
+    actions = getattr(match.func, 'actions', None)     # DRFのViewSetなら {メソッド: アクション}
+    action = actions.get(request.method.lower()) if actions else None
+    return match.route.lstrip('^').rstrip('$'), match.view_name, action
+
+
+class InstrumentationMiddleware:
+    """リクエストごとの計測 (MIDDLEWARE の先頭に置く)"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(metrics, request, response)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(metrics, request, response)
+
+    def process_template_response(self, request, response):
+        # DRFのResponseはこの後でレンダリングされる
+        metrics = _current.get()
+        if metrics is not None:
+            metrics.render_started = time.perf_counter()
+            response.add_post_render_callback(lambda rendered: self.rendered(metrics))
+        return response
+
+    def rendered(self, metrics):
+        metrics.sections['render'] += time.perf_counter() - metrics.render_started
+
+    def finish(self, metrics, request, response):
+        total = time.perf_counter() - metrics.started
+        serialize, render = metrics.sections['serialize'], metrics.sections['render']
+        app = max(0.0, total - metrics.db_time - serialize - render)
+        response.headers['Server-Timing'] = ", ".join([
+            f'db;dur={metrics.db_time * 1000:.2f};desc="{metrics.db_count} queries"',
+            f'serialize;dur={serialize * 1000:.2f}',
+            f'render;dur={render * 1000:.2f}',
+            f'app;dur={app * 1000:.2f}',
+            f'total;dur={total * 1000:.2f}',
+        ])
+
+        route, view, action = describe_route(request)
+        histograms.observe(request.method, route, response.status_code, total, metrics.db_count, metrics.db_time)
+
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'route': route,
+            'view': view,
+            'action': action,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 3),
+            'db_queries': metrics.db_count,
+            'db_ms': round(metrics.db_time * 1000, 3),
+            'serialize_ms': round(serialize * 1000, 3),
+            'render_ms': round(render * 1000, 3),
+        }
+        slow_ms = getattr(settings, 'FACILITIES_SLOW_REQUEST_MS', DEFAULT_SLOW_REQUEST_MS)
+        if slow_ms is not None and total * 1000 >= slow_ms:
+            record['top_queries'] = metrics.top_queries()
+            logger.warning("slow request %s", json.dumps(record, ensure_ascii=False), extra={'request_metrics': record})
+        elif logger.isEnabledFor(logging.INFO):
+            logger.info("%s", json.dumps(record, ensure_ascii=False), extra={'request_metrics': record})
+        return response
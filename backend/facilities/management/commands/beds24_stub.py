@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from facilities.beds24_stub import Beds24Stub
+
+
+class Command(BaseCommand):
+    help = "ローカル確認用のBeds24 APIスタブサーバーを起動する (sync_beds24 --url で接続先に指定する)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8081)
+        parser.add_argument('--latency', type=float, default=0.0, help="各リクエストの応答遅延(秒)")
+
+    def handle(self, *args, port=8081, latency=0.0, **options):
+        with Beds24Stub(port=port, latency=latency) as stub:
+            self.stdout.write(f"Beds24 stub listening on {stub.url} (Ctrl+C to stop)")
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                pass
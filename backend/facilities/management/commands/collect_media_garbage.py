@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+
+from facilities import cleanup
+
+
+class Command(BaseCommand):
+    help = (
+        "どの施設画像からも参照されていない画像ファイル(元画像・派生画像)を探して削除する"
+        "(--dry-run で削除せずに一覧と合計サイズだけを表示する)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="削除せずに、削除するファイルを表示する")
+        parser.add_argument(
+            '--min-age', type=int, default=cleanup.DEFAULT_MIN_AGE,
+            help="これより新しいファイル(秒)は対象にしない (アップロードの途中のファイルを消さないため)",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=cleanup.DEFAULT_BATCH_SIZE, help="一度に読み込む画像・ファイルの件数",
+        )
+
+    def handle(self, *args, dry_run=False, min_age=cleanup.DEFAULT_MIN_AGE,
+               batch_size=cleanup.DEFAULT_BATCH_SIZE, verbosity=1, **options):
+        def show(name, size):
+            if dry_run or verbosity >= 2:
+                self.stdout.write(f"{name} ({size} bytes)")
+
+        report = cleanup.collect_garbage(dry_run=dry_run, min_age=min_age, batch_size=batch_size, on_orphan=show)
+        summary = (
+            f"Scanned {report.scanned} files: {report.orphaned} orphaned "
+            f"({filesizeformat(report.orphaned_bytes)}), {report.recent} skipped as newer than {min_age}s"
+        )
+        if dry_run:
+            self.stdout.write(self.style.SUCCESS(f"{summary} (dry run, nothing deleted)"))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f"{summary}; deleted {report.deleted} files, reclaimed {report.reclaimed_bytes} bytes "
+                f"({filesizeformat(report.reclaimed_bytes)})"
+            ))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+
+from facilities import cleanup
+
+
+class Command(BaseCommand):
+    help = (
+        "中身が同じ施設画像のファイルを1つにまとめ、重複したファイルを削除して参照数を数え直す"
+        "(--dry-run で変更せずに一覧と削減できるサイズだけを表示する)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="変更せずに、まとめるファイルを表示する")
+        parser.add_argument(
+            '--batch-size', type=int, default=cleanup.DEFAULT_BATCH_SIZE, help="一度に読み込む元画像の件数",
+        )
+
+    def handle(self, *args, dry_run=False, batch_size=cleanup.DEFAULT_BATCH_SIZE, verbosity=1, **options):
+        def show(name, keep, size):
+            if dry_run or verbosity >= 2:
+                self.stdout.write(f"{name} -> {keep} ({size} bytes)")
+
+        report = cleanup.deduplicate_images(dry_run=dry_run, batch_size=batch_size, on_duplicate=show)
+        summary = (
+            f"Scanned {report.scanned} files: {report.duplicates} duplicates used by {report.images} images, "
+            f"{report.failed} unreadable"
+        )
+        if dry_run:
+            self.stdout.write(self.style.SUCCESS(
+                f"{summary}; would save {report.saved_bytes} bytes ({filesizeformat(report.saved_bytes)}) "
+                f"(dry run, nothing changed)"
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f"{summary}; deleted {report.deleted} files, saved {report.saved_bytes} bytes "
+                f"({filesizeformat(report.saved_bytes)})"
+            ))
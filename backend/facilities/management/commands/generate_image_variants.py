@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from facilities.images import generate_variants
+from facilities.models import FacilityImage
+
+
+class Command(BaseCommand):
+    help = "既存の施設画像の派生画像(リサイズ版)を生成する。作成済みで最新の画像はスキップする"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="作成済みの派生画像も作り直す")
+        parser.add_argument('--facility', type=int, help="対象を指定した施設IDの画像に限定する")
+        parser.add_argument('--batch-size', type=int, default=500, help="一度に読み込む画像の件数")
+
+    def handle(self, *args, force=False, facility=None, batch_size=500, **options):
+        queryset = FacilityImage.objects.order_by('pk')
+        if facility is not None:
+            queryset = queryset.filter(facility_id=facility)
+
+        processed = failed = 0
+        for image_id in queryset.values_list('pk', flat=True).iterator(chunk_size=batch_size):
+            if generate_variants(image_id, force=force):
+                processed += 1
+            else:
+                failed += 1
+                self.stderr.write(f"Skipped image {image_id} (could not read the original)")
+
+        self.stdout.write(self.style.SUCCESS(f"{processed} images processed, {failed} skipped"))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from facilities import geo
+
+
+class Command(BaseCommand):
+    help = (
+        "施設の地図のURL(map_url)から緯度・経度を読み取って設定する"
+        "(既定では座標のない施設だけ。--all で設定済みの施設も読み直す)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="座標が設定済みの施設もURLから読み直す")
+        parser.add_argument('--dry-run', action='store_true', help="変更せずに、読み取れなかったURLを表示する")
+        parser.add_argument('--batch-size', type=int, default=geo.DEFAULT_BATCH_SIZE, help="一度に読み込む施設の件数")
+
+    def handle(self, *args, all=False, dry_run=False, batch_size=geo.DEFAULT_BATCH_SIZE, verbosity=1, **options):
+        def show(pk, map_url):
+            if dry_run or verbosity >= 2:
+                self.stdout.write(f"Facility {pk}: no coordinates in {map_url}")
+
+        report = geo.fill_coordinates(overwrite=all, dry_run=dry_run, batch_size=batch_size, on_unparsed=show)
+        summary = (
+            f"Scanned {report.scanned} facilities: {report.updated} updated, {report.unchanged} unchanged, "
+            f"{report.unparsed} without coordinates in map_url"
+        )
+        if dry_run:
+            summary += " (dry run, nothing changed)"
+        self.stdout.write(self.style.SUCCESS(summary))
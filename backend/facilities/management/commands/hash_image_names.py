@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from facilities.images import generate_variants
+from facilities.models import FacilityImage
+from facilities.signals import touch_facilities
+from facilities.storage import name_hash
+
+
+class Command(BaseCommand):
+    help = (
+        "ハッシュのない名前で保存されている既存の施設画像を、中身のハッシュ付きの名前で保存し直す"
+        "(派生画像も作り直し、古いファイルは削除する)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="一度に読み込む画像の件数")
+
+    def handle(self, *args, batch_size=500, **options):
+        storage = FacilityImage._meta.get_field('image').storage
+        if not hasattr(storage, 'hashed_name'):
+            self.stderr.write("The facility image storage does not use hashed names")
+            return
+
+        renamed = failed = 0
+        queryset = FacilityImage.objects.order_by('pk').values_list('pk', 'facility_id', 'image')
+        for image_id, facility_id, old_name in queryset.iterator(chunk_size=batch_size):
+            if not old_name or name_hash(old_name):
+                continue
+            try:
+                with storage.open(old_name, 'rb') as f:
+                    new_name = storage.save(old_name, f)
+            except OSError as e:
+                failed += 1
+                self.stderr.write(f"Skipped image {image_id} ({old_name}): {e}")
+                continue
+            FacilityImage.objects.filter(pk=image_id).update(image=new_name, updated_at=timezone.now())
+            touch_facilities([facility_id])
+            generate_variants(image_id, force=True)
+            storage.delete(old_name)
+            renamed += 1
+
+        self.stdout.write(self.style.SUCCESS(f"{renamed} images renamed, {failed} skipped"))
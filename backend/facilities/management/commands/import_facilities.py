@@ -0,0 +1,41 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from facilities import bulk
+
+
+class Command(BaseCommand):
+    help = "CSV / JSON Lines の施設をまとめて登録する (1行ずつ読み、--chunk-size 件ごとに登録する)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="入力ファイル (- なら標準入力)")
+        parser.add_argument('--format', choices=bulk.FORMATS, help="入力の形式 (省略時は拡張子から判断する)")
+        parser.add_argument('--chunk-size', type=int, default=bulk.DEFAULT_CHUNK_SIZE, help="1トランザクションで登録する件数")
+        parser.add_argument('--dry-run', action='store_true', help="検証だけを行い、登録しない")
+
+    def handle(self, *args, path, format=None, chunk_size=bulk.DEFAULT_CHUNK_SIZE, dry_run=False, **options):
+        fmt = format or bulk.guess_format(path)
+        if fmt is None:
+            raise CommandError("Could not determine the input format (use --format csv or --format jsonl)")
+
+        started = time.perf_counter()
+        try:
+            stream = sys.stdin.buffer if path == '-' else open(path, 'rb')
+        except OSError as e:
+            raise CommandError(f"Could not open {path}: {e}")
+        with stream:
+            report = bulk.import_facilities(bulk.read_rows(stream, fmt), chunk_size=chunk_size, dry_run=dry_run)
+
+        for error in report.errors:
+            self.stderr.write(f"Line {error['line']}: {error['errors']}")
+        if report.failed > len(report.errors):
+            self.stderr.write(f"... and {report.failed - len(report.errors)} more rows with errors")
+        summary = (
+            f"{report.created} facilities {'validated' if dry_run else 'created'}, {report.failed} failed "
+            f"({report.rows} rows in {time.perf_counter() - started:.2f}s)"
+        )
+        if report.error is not None:
+            raise CommandError(f"{report.error} ({summary})")
+        self.stdout.write(self.style.SUCCESS(summary))
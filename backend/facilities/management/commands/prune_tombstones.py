@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from facilities import changes
+
+
+class Command(BaseCommand):
+    help = "保存期間(FACILITIES_TOMBSTONE_RETENTION_DAYS)を過ぎた削除の記録を削除する (定期的に実行する)"
+
+    def handle(self, *args, **options):
+        deleted = changes.prune_tombstones()
+        self.stdout.write(self.style.SUCCESS(f"Pruned {deleted} tombstones"))
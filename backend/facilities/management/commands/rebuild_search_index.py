@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from facilities import search
+
+
+class Command(BaseCommand):
+    help = "施設の全文検索の索引をすべて作り直す"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="一度に登録する施設の件数")
+
+    def handle(self, *args, batch_size=1000, **options):
+        started = time.perf_counter()
+        count = search.rebuild(batch_size=batch_size)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} facilities in {elapsed:.2f}s"))
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from facilities.beds24 import Beds24Client
+from facilities.models import Facility
+from facilities.sync import Beds24Sync
+
+
+class Command(BaseCommand):
+    help = "Beds24から部屋情報・在庫・料金を同期する (前回のチェックポイントからの差分のみ)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--facility', type=int, nargs='*', help="同期する施設ID (省略時はキーが設定された全施設)")
+        parser.add_argument('--full', action='store_true', help="チェックポイントを使わずに全件同期する")
+        parser.add_argument('--concurrency', type=int, help="同時に実行するリクエスト数の上限")
+        parser.add_argument('--url', help="Beds24 APIのURL (スタブサーバーを使う場合など)")
+
+    def handle(self, *args, facility=None, full=False, concurrency=None, url=None, **options):
+        facilities = Facility.objects.filter(pk__in=facility) if facility else None
+        concurrency = concurrency or settings.BEDS24_SYNC_CONCURRENCY
+
+        with Beds24Client(base_url=url, pool_size=concurrency) as client:
+            report = Beds24Sync(client=client, concurrency=concurrency).run(facilities, full=full)
+
+        for facility_id, error in sorted(report.errors.items()):
+            self.stderr.write(f"Facility {facility_id}: {error}")
+        self.stdout.write(self.style.SUCCESS(
+            f"{report.facilities} facilities ({report.full} full, {report.incremental} incremental, "
+            f"{report.failed} failed) in {report.elapsed:.2f}s, "
+            f"{report.requests} requests, {report.retries} retries"
+        ))
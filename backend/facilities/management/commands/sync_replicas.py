@@ -0,0 +1,47 @@
+import sqlite3
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from facilities import routers
+
+
+def sqlite_path(name):
+    """"file:/path/db.sqlite3?mode=ro" のようなURI形式の名前からファイルのパスを取り出す"""
+    name = str(name)
+    if name.startswith('file:'):
+        name = name[len('file:'):].split('?', 1)[0]
+    return name
+
+
+class Command(BaseCommand):
+    help = (
+        "プライマリ(default)のSQLiteデータベースの内容を、読み取り用のレプリカのファイルにコピーする"
+        "(ローカルでレプリカへの振り分けを試すため。本番ではデータベースのレプリケーションを使う)"
+    )
+
+    def handle(self, *args, **options):
+        aliases = routers.replica_aliases()
+        if not aliases:
+            raise CommandError("No replicas are configured (set DATABASE_REPLICAS)")
+        primary = connections[DEFAULT_DB_ALIAS]
+        if primary.vendor != 'sqlite':
+            raise CommandError("sync_replicas only supports SQLite databases")
+
+        primary.ensure_connection()
+        for alias in aliases:
+            replica = connections[alias]
+            if replica.vendor != 'sqlite':
+                raise CommandError(f"Replica {alias} is not an SQLite database")
+            # 読み取り専用の接続は閉じ、書き込み可能な接続で上書きする
+            replica.close()
+            path = sqlite_path(replica.settings_dict['NAME'])
+            started = time.perf_counter()
+            target = sqlite3.connect(path)
+            try:
+                primary.connection.backup(target)
+            finally:
+                target.close()
+            self.stdout.write(f"Copied {DEFAULT_DB_ALIAS} to {alias} ({path}) in {time.perf_counter() - started:.2f}s")
+        routers.health.clear()
@@ -0,0 +1,195 @@
+# メディアファイル(施設画像と派生画像)の配信
+#
+# DEBUGに関わらず、MEDIA_URL の下のファイルを配信する (config.urls)。
+# - ハッシュ付きの名前(facilities.storage)のファイルは中身が変わらないため、1年間のキャッシュ(immutable)を指定する
+# - ETag / Last-Modified による条件付きリクエスト(304)と、Range リクエスト(206)に対応する
+# - WSGIでは FileResponse を返し、サーバーの wsgi.file_wrapper (gunicornなら sendfile) でコピーせずに送る
+# - FACILITIES_MEDIA_ACCEL を設定すると、ファイルの送信は X-Accel-Redirect(nginx) / X-Sendfile に任せる
+
+import mimetypes
+import os
+import re
+import stat
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import FileSystemStorage
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.urls import re_path
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.encoding import escape_uri_path
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+from django.views.decorators.http import require_safe
+
+from .models import FacilityImage
+from .storage import name_hash
+
+DEFAULT_MAX_AGE = 60 * 60 * 24 * 365
+CHUNK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+def parse_range(header, size):
+    """
+    Range ヘッダーから (開始, 終了) の位置を返す (終了の位置を含む)
+    単一の範囲以外(複数の範囲など)は解釈せずNoneを返し、ファイル全体を返す (RFC 9110 で認められている)
+    """
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # bytes=-500: 末尾の500バイト
+        length = int(last)
+        if length == 0 or size == 0:
+            raise RangeNotSatisfiable
+        return max(0, size - length), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable
+    end = int(last) if last else size - 1
+    return start, min(end, size - 1)
+
+
+def if_range_matches(request, etag, last_modified):
+    """If-Range がなければTrue、あればETag(強い比較)か更新日時が一致する場合だけTrue"""
+    if_range = request.headers.get('If-Range')
+    if if_range is None:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def iter_file(path, offset, length):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+async def aiter_file(path, offset, length):
+    """
+    iter_file() の非同期版
+    ASGIで同期のイテレーターを返すと、Djangoはファイル全体をメモリに読み込んでから送るため使わない
+    """
+    iterator = iter_file(path, offset, length)
+    read = sync_to_async(next, thread_sensitive=False)
+    try:
+        while (chunk := await read(iterator, None)) is not None:
+            yield chunk
+    finally:
+        iterator.close()
+
+
+def get_storage():
+    storage = FacilityImage._meta.get_field('image').storage
+    return storage if isinstance(storage, FileSystemStorage) else None
+
+
+def cache_control(name):
+    if name_hash(name):
+        max_age = getattr(settings, 'FACILITIES_MEDIA_MAX_AGE', DEFAULT_MAX_AGE)
+        return {'public': True, 'max_age': max_age, 'immutable': True}
+    # ハッシュのない(以前にアップロードされた)ファイルは、毎回ETagで再検証させる
+    return {'public': True, 'no_cache': True}
+
+
+def set_headers(response, name, etag, last_modified):
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = http_date(last_modified)
+    response.headers['Accept-Ranges'] = 'bytes'
+    patch_cache_control(response, **cache_control(name))
+    return response
+
+
+def accel_response(name, path, content_type):
+    """ファイルの送信をWebサーバーに任せるレスポンス (RangeはWebサーバーが処理する)"""
+    accel = getattr(settings, 'FACILITIES_MEDIA_ACCEL', None)
+    response = HttpResponse(content_type=content_type)
+    if accel == 'x-accel-redirect':
+        prefix = getattr(settings, 'FACILITIES_MEDIA_ACCEL_PREFIX', '/protected-media/')
+        response.headers['X-Accel-Redirect'] = prefix + escape_uri_path(name)
+    elif accel == 'x-sendfile':
+        # ヘッダーにはASCII以外を入れられないため、パーセントエンコードする (mod_xsendfileなどはデコードして扱う)
+        response.headers['X-Sendfile'] = escape_uri_path(path)
+    else:
+        return None
+    return response
+
+
+@require_safe
+def serve(request, path):
+    """GET/HEAD {MEDIA_URL}<path>"""
+    storage = get_storage()
+    if storage is None:
+        raise Http404
+    try:
+        full_path = storage.path(path)
+        stat_result = os.stat(full_path)
+    except (SuspiciousFileOperation, OSError, ValueError):
+        raise Http404
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise Http404
+
+    size = stat_result.st_size
+    last_modified = int(stat_result.st_mtime)
+    # ハッシュ付きの名前なら中身のハッシュ、そうでなければ更新日時とサイズから作る
+    etag = quote_etag(name_hash(path) or f"{stat_result.st_mtime_ns:x}-{size:x}")
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        return set_headers(not_modified, path, etag, last_modified)
+
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    response = accel_response(path, full_path, content_type)
+    if response is not None:
+        return set_headers(response, path, etag, last_modified)
+
+    byte_range = None
+    if 'Range' in request.headers and if_range_matches(request, etag, last_modified):
+        try:
+            byte_range = parse_range(request.headers['Range'], size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response.headers['Content-Range'] = f'bytes */{size}'
+            return set_headers(response, path, etag, last_modified)
+
+    start, end = byte_range or (0, size - 1)
+    length = end - start + 1 if size else 0
+    if request.method == 'HEAD':
+        response = HttpResponse(content_type=content_type)
+    elif isinstance(request, ASGIRequest):
+        response = StreamingHttpResponse(aiter_file(full_path, start, length), content_type=content_type)
+    elif byte_range is None:
+        response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+    else:
+        response = StreamingHttpResponse(iter_file(full_path, start, length), content_type=content_type)
+    response.headers['Content-Length'] = str(length)
+    if byte_range is not None:
+        response.status_code = 206
+        response.headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    return set_headers(response, path, etag, last_modified)
+
+
+def media_urlpatterns():
+    """MEDIA_URL がこのサーバーのパス("/media/" など)の場合だけ配信のURLを登録する"""
+    prefix = settings.MEDIA_URL
+    if not prefix or urlsplit(prefix).netloc:
+        return []
+    return [re_path(r'^%s(?P<path>.+)$' % re.escape(prefix.lstrip('/')), serve, name='media')]
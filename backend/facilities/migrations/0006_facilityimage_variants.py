@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0005_facility_version_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='facilityimage',
+            name='variants',
+            field=models.JSONField(blank=True, default=list, editable=False, verbose_name='派生画像'),
+        ),
+    ]
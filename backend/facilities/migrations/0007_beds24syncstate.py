@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0006_facilityimage_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Beds24SyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('synced_keys', models.CharField(blank=True, max_length=251, verbose_name='同期したキー')),
+                ('room', models.JSONField(blank=True, default=dict, verbose_name='部屋情報')),
+                ('calendar', models.JSONField(blank=True, default=dict, verbose_name='在庫・料金')),
+                ('synced_until', models.DateField(blank=True, null=True, verbose_name='取得済みの最終日')),
+                ('bookings_checked_at', models.DateTimeField(blank=True, null=True, verbose_name='予約の確認日時')),
+                ('last_full_sync_at', models.DateTimeField(blank=True, null=True, verbose_name='最終全件同期日時')),
+                ('last_synced_at', models.DateTimeField(blank=True, null=True, verbose_name='最終同期日時')),
+                ('last_error', models.TextField(blank=True, verbose_name='最後のエラー')),
+                ('facility', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='beds24_state', to='facilities.facility', verbose_name='施設')),
+            ],
+            options={
+                'verbose_name': 'Beds24同期状態',
+                'verbose_name_plural': 'Beds24同期状態',
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0007_beds24syncstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacilityAvailability',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField(verbose_name='年')),
+                ('nights', models.BinaryField(max_length=46, verbose_name='空き状況')),
+                ('facility', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='availability', to='facilities.facility', verbose_name='施設')),
+            ],
+            options={
+                'verbose_name': '空き状況',
+                'verbose_name_plural': '空き状況',
+                'indexes': [models.Index(fields=['year', 'facility'], name='facility_avail_year_idx')],
+                'constraints': [models.UniqueConstraint(fields=('facility', 'year'), name='unique_facility_availability_year')],
+            },
+        ),
+    ]
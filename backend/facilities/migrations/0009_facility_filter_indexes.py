@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0008_facilityavailability'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='facility',
+            index=models.Index(fields=['capacity'], name='facility_capacity_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='facility',
+            index=models.Index(fields=['num_parking'], name='facility_parking_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='facility',
+            index=models.Index(fields=['management_entity', 'capacity'], name='facility_mgmt_capacity_idx'),
+        ),
+        # 「すべてのアメニティを持つ」絞り込み用に、中間テーブル(自動生成)へ
+        # (amenity_id, facility_id) の複合インデックスを追加する (インデックスだけで集計できる)
+        migrations.RunSQL(
+            'CREATE INDEX facility_amenity_lookup_idx ON facilities_facility_amenities (amenity_id, facility_id)',
+            reverse_sql='DROP INDEX facility_amenity_lookup_idx',
+        ),
+    ]
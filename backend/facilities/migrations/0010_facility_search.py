@@ -0,0 +1,51 @@
+# 全文検索の索引 (facilities.search) を作成する
+
+from django.db import migrations
+
+SQLITE_CREATE = """
+CREATE VIRTUAL TABLE facilities_facility_search USING fts5(
+    facility_name, short_description, address, description,
+    tokenize = 'unicode61 remove_diacritics 0'
+)
+"""
+
+POSTGRESQL_CREATE = """
+CREATE TABLE facilities_facility_search (
+    facility_id bigint PRIMARY KEY REFERENCES facilities_facility (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+    document tsvector NOT NULL
+);
+CREATE INDEX facilities_facility_search_document_idx ON facilities_facility_search USING gin (document);
+"""
+
+
+def create_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(SQLITE_CREATE)
+    elif vendor == 'postgresql':
+        schema_editor.execute(POSTGRESQL_CREATE)
+    else:
+        return
+
+    # 既存の施設を登録する
+    from facilities.search import BACKENDS, FIELDS
+    Facility = apps.get_model('facilities', 'Facility')
+    rows = list(Facility.objects.using(schema_editor.connection.alias).values_list('pk', *FIELDS))
+    if rows:
+        BACKENDS[vendor]().index(rows)
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute('DROP TABLE IF EXISTS facilities_facility_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0009_facility_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
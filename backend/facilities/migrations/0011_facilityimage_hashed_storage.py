@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:39
+
+import facilities.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0010_facility_search'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='facilityimage',
+            name='image',
+            field=models.ImageField(storage=facilities.storage.facility_image_storage, upload_to='facilities/images/', verbose_name='画像'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:57
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0011_facilityimage_hashed_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('facility', '施設'), ('amenity', 'アメニティ'), ('image', '施設画像')], max_length=20, verbose_name='種類')),
+                ('object_id', models.PositiveBigIntegerField(verbose_name='削除したID')),
+                ('deleted_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='削除日時')),
+            ],
+            options={
+                'verbose_name': '削除記録',
+                'verbose_name_plural': '削除記録',
+            },
+        ),
+        migrations.AddField(
+            model_name='facilityimage',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, verbose_name='更新日時'),
+        ),
+        migrations.AddIndex(
+            model_name='amenity',
+            index=models.Index(fields=['updated_at', 'id'], name='amenity_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='facility',
+            index=models.Index(fields=['updated_at', 'id'], name='facility_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='facilityimage',
+            index=models.Index(fields=['updated_at', 'id'], name='facilityimage_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tombstone',
+            index=models.Index(fields=['deleted_at', 'id'], name='tombstone_deleted_idx'),
+        ),
+    ]
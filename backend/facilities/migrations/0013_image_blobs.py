@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0012_change_feed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacilityImageBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True, verbose_name='SHA-256')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='ファイル名')),
+                ('size', models.PositiveBigIntegerField(verbose_name='サイズ')),
+                ('ref_count', models.PositiveIntegerField(default=0, verbose_name='参照数')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='作成日時')),
+            ],
+            options={
+                'verbose_name': '施設画像のファイル',
+                'verbose_name_plural': '施設画像のファイル',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='facilityimage',
+            index=models.Index(fields=['image'], name='facilityimage_image_idx'),
+        ),
+    ]
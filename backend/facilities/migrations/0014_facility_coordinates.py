@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:16
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0013_image_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='facility',
+            name='geo_cell',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True, verbose_name='グリッドのセル'),
+        ),
+        migrations.AddField(
+            model_name='facility',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(-90), django.core.validators.MaxValueValidator(90)], verbose_name='緯度'),
+        ),
+        migrations.AddField(
+            model_name='facility',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(-180), django.core.validators.MaxValueValidator(180)], verbose_name='経度'),
+        ),
+        migrations.AddIndex(
+            model_name='facility',
+            index=models.Index(fields=['geo_cell', 'latitude', 'longitude'], name='facility_geo_cell_idx'),
+        ),
+    ]
@@ -0,0 +1,197 @@
+import hashlib
+from calendar import timegm
+
+from django.db.models import Count, Max, Sum
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
+
+from . import cache, instrumentation, routers
+
+
+class ReplicaReadMixin:
+    """GET/HEADの読み取りを読み取り用のレプリカで行うViewSet用のMixin (facilities.routers)"""
+
+    def initial(self, request, *args, **kwargs):
+        if request.method in SAFE_METHODS:
+            routers.use_replicas()
+        super().initial(request, *args, **kwargs)
+
+
+class ConditionalGetMixin:
+    """
+    ETag / Last-Modified による条件付きGETに対応するViewSet用のMixin
+
+    バージョンと更新日時だけを問い合わせて検証し、変更がなければ
+    オブジェクトの読み込みやシリアライズを行わずに304を返す。
+    ViewSet側で get_object_validator() / get_list_validator() を実装する。
+    """
+
+    def get_object_validator(self):
+        """詳細取得用: (変更を表すトークン, 最終更新日時) を返す。対象がなければNone"""
+        return None
+
+    def get_list_validator(self, queryset):
+        """一覧取得用: (変更を表すトークン, 最終更新日時) を返す"""
+        return None
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._conditional_response(
+            request, self.get_object_validator(), super().retrieve, *args, **kwargs
+        )
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        return self._conditional_response(
+            request, self.get_list_validator(queryset), super().list, *args, **kwargs
+        )
+
+    def _conditional_response(self, request, validator, view, *args, **kwargs):
+        if validator is None:
+            return view(request, *args, **kwargs)
+
+        etag, last_modified, response = check_conditional(request, validator)
+        if response is None:
+            response = view(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+        return set_validator_headers(response, etag, last_modified)
+
+
+class PayloadCacheMixin:
+    """
+    施設のシリアライズ結果をキャッシュ(facilities.cache)から返すViewSet用のMixin
+
+    一覧ではID・バージョン・更新日時だけを取得してキャッシュと照合し、
+    ミスした施設だけをprefetch付きで読み込んでシリアライズする。
+    ViewSet側で get_object_version() を実装する。
+    """
+
+    def get_object_version(self):
+        """詳細取得用: (ID, バージョン, 更新日時) を返す。対象がなければNone"""
+        raise NotImplementedError
+
+    def use_payload_cache(self):
+        """Falseを返すとキャッシュを使わずに通常どおりシリアライズする (出力の形が既定と異なる場合など)"""
+        return True
+
+    def get_cache_variant(self):
+        # 画像URLは絶対URLなので、ホストごとに別のエントリとして扱う
+        return self.request.build_absolute_uri('/')
+
+    def list(self, request, *args, **kwargs):
+        return self.payload_list_response(self.filter_queryset(self.get_queryset()))
+
+    def payload_list_response(self, queryset):
+        """querysetの施設を一覧と同じ形式(ページネーションを含む)で返す"""
+        if not self.use_payload_cache():
+            page = self.paginate_queryset(queryset)
+            if page is not None:
+                return self.get_paginated_response(self.get_serializer(page, many=True).data)
+            return Response(self.get_serializer(queryset, many=True).data)
+
+        rows = queryset.prefetch_related(None).only('id', 'version', 'updated_at')
+        page = self.paginate_queryset(rows)
+        rows = page if page is not None else list(rows)
+
+        payloads = self.get_payloads(
+            queryset, {row.pk: cache.stamp(row.version, row.updated_at) for row in rows}
+        )
+        data = [payloads[row.pk] for row in rows if row.pk in payloads]
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
+    def retrieve(self, request, *args, **kwargs):
+        row = self.get_object_version() if self.use_payload_cache() else None
+        if row is None:
+            return super().retrieve(request, *args, **kwargs)
+        pk, version, updated_at = row
+        payloads = self.get_payloads(self.get_queryset(), {pk: cache.stamp(version, updated_at)})
+        if pk not in payloads:
+            # 直前に削除された場合など
+            return super().retrieve(request, *args, **kwargs)
+        return Response(payloads[pk])
+
+    def get_payloads(self, queryset, stamps):
+        """{ID: スタンプ} に対応するペイロードを、キャッシュになければシリアライズして返す"""
+        variant = self.get_cache_variant()
+        payloads = cache.get_payloads(stamps, variant)
+        missing = [pk for pk in stamps if pk not in payloads]
+        if missing:
+            with instrumentation.section('serialize'):
+                fresh, versions = self.build_payloads(queryset, missing)
+            # 読み込んだ時点のスタンプで保存する (照合時に古ければ使われない)
+            cache.set_payloads(
+                fresh,
+                {pk: cache.stamp(version, updated_at) for pk, (version, updated_at) in versions.items()},
+                variant,
+            )
+            payloads.update(fresh)
+        return payloads
+
+    def build_payloads(self, queryset, pks):
+        """キャッシュになかった施設をシリアライズし、({ID: ペイロード}, {ID: (バージョン, 更新日時)}) を返す"""
+        instances = list(queryset.filter(pk__in=pks))
+        data = self.get_serializer(instances, many=True).data
+        return (
+            {instance.pk: item for instance, item in zip(instances, data)},
+            {instance.pk: (instance.version, instance.updated_at) for instance in instances},
+        )
+
+
+def make_etag(request, token):
+    # 同じデータでも、クエリパラメータ(ページ等)・ホスト(画像の絶対URL)・Acceptで表現が変わる
+    variant = '|'.join([
+        str(token),
+        request.get_host(),
+        request.get_full_path(),
+        request.META.get('HTTP_ACCEPT', ''),
+    ])
+    return quote_etag(hashlib.md5(variant.encode(), usedforsecurity=False).hexdigest())
+
+
+def check_conditional(request, validator):
+    """
+    バリデータ (トークン, 最終更新日時) から (ETag, Last-Modified, 304/412のレスポンス) を返す
+    変更があればレスポンスはNone (通常どおり出力する)
+    """
+    token, updated_at = validator
+    etag = make_etag(request, token)
+    last_modified = timegm(updated_at.utctimetuple()) if updated_at else None
+    return etag, last_modified, get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+
+def set_validator_headers(response, etag, last_modified):
+    response.headers['ETag'] = etag
+    if last_modified is not None:
+        response.headers['Last-Modified'] = http_date(last_modified)
+    # ブラウザがヒューリスティックにキャッシュせず、毎回ETagで再検証するようにする
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
+# 一覧のバリデータ: 件数・(バージョン合計)・最終更新日時から作る (1クエリ)
+FACILITY_LIST_SUMMARY = {'count': Count('pk'), 'versions': Sum('version'), 'last_modified': Max('updated_at')}
+UPDATED_AT_LIST_SUMMARY = {'count': Count('pk'), 'last_modified': Max('updated_at')}
+
+
+def facility_list_validator(queryset):
+    """施設一覧のバリデータ"""
+    return facility_list_token(queryset.order_by().aggregate(**FACILITY_LIST_SUMMARY))
+
+
+def updated_at_list_validator(queryset):
+    """updated_at を持つモデルの一覧用バリデータ"""
+    return updated_at_list_token(queryset.order_by().aggregate(**UPDATED_AT_LIST_SUMMARY))
+
+
+def facility_list_token(summary):
+    token = f"{summary['count']}-{summary['versions'] or 0}-{summary['last_modified']}"
+    return token, summary['last_modified']
+
+
+def updated_at_list_token(summary):
+    token = f"{summary['count']}-{summary['last_modified']}"
+    return token, summary['last_modified']
@@ -1,17 +1,56 @@
 from django.db import models
+from django.db.models import F
 from django.core.validators import MaxValueValidator, MinValueValidator
+from django.utils import timezone
+
+from . import geo
+from .storage import facility_image_storage
+
+class AmenityManager(models.Manager):
+    def get_or_create_by_names(self, names):
+        """
+        名前のリストに対応するアメニティを返す。存在しないものはまとめて作成する
+        (名前の数に関わらずクエリは最大3回)
+        """
+        names = list(dict.fromkeys(name.strip() for name in names if name.strip()))
+        found = {amenity.name: amenity for amenity in self.filter(name__in=names)}
+        missing = [name for name in names if name not in found]
+        if missing:
+            # 同時に同じ名前が作成されても一意制約で弾かれるだけにし、作成後に取得し直す
+            self.bulk_create([self.model(name=name) for name in missing], ignore_conflicts=True)
+            found.update({amenity.name: amenity for amenity in self.filter(name__in=missing)})
+        return [found[name] for name in names]
+
 
 # アメニティ管理
 class Amenity(models.Model):
     name = models.CharField("アメニティ名", max_length=100, unique=True)
+    updated_at = models.DateTimeField("更新日時", auto_now=True)                   # 条件付きGET(Last-Modified)用
+
+    objects = AmenityManager()
 
     class Meta:
         verbose_name = "アメニティ"
         verbose_name_plural = "アメニティ"
+        # 変更フィード (facilities.changes) 用
+        indexes = [
+            models.Index(fields=['updated_at', 'id'], name='amenity_updated_idx'),
+        ]
 
     def __str__(self):
         return self.name
-    
+
+
+class FacilityQuerySet(models.QuerySet):
+    def touch(self, **values):
+        """
+        バージョンと更新日時を進める (関連する画像・アメニティが変わったとき用)
+        シリアライズ結果が変わったことをETag/Last-Modifiedに反映させる
+        values を指定すると、同じUPDATE文でその列も更新する (一括更新用)
+        """
+        return self.update(**values, version=F('version') + 1, updated_at=timezone.now())
+
+
 class Facility(models.Model):
     facility_name = models.CharField("施設名", max_length=200)                      # 施設名
     prop_key = models.CharField("プロパティキー", max_length=200, blank=True)        # Beds24 Propkey
@@ -22,6 +61,11 @@ class Facility(models.Model):
     address = models.CharField("住所", max_length=200)                              # 住所
     num_parking = models.IntegerField("駐車場台数", default=0, validators=[MinValueValidator(0), MaxValueValidator(10)])    # 駐車場
     map_url = models.URLField("Google Map URL", blank=True)                         # Google MapのURL
+    # 位置 (map_url から読み取る。facilities.geo)
+    latitude = models.FloatField("緯度", null=True, blank=True, validators=[MinValueValidator(-90), MaxValueValidator(90)])
+    longitude = models.FloatField("経度", null=True, blank=True, validators=[MinValueValidator(-180), MaxValueValidator(180)])
+    # 範囲・近傍の検索用のグリッドのセル (緯度・経度から保存時に決める)
+    geo_cell = models.PositiveIntegerField("グリッドのセル", null=True, blank=True, editable=False)
 
     # Amenityモデルと多対多の関係を定義
     amenities = models.ManyToManyField(
@@ -41,8 +85,38 @@ class Facility(models.Model):
         default=ManagementType.IN_HOUSE,
     )
 
+    # 変更の検知用 (施設本体・画像・アメニティのどれかが変わるたびに進む)
+    version = models.PositiveIntegerField("バージョン", default=1, editable=False)
+    updated_at = models.DateTimeField("更新日時", auto_now=True)
+
+    objects = FacilityQuerySet.as_manager()
+
+    class Meta:
+        # 一覧の絞り込み (facilities.filters) 用
+        indexes = [
+            models.Index(fields=['capacity'], name='facility_capacity_idx'),
+            models.Index(fields=['num_parking'], name='facility_parking_idx'),
+            models.Index(fields=['management_entity', 'capacity'], name='facility_mgmt_capacity_idx'),
+            # 変更フィード (facilities.changes) 用
+            models.Index(fields=['updated_at', 'id'], name='facility_updated_idx'),
+            # 範囲・近傍の検索 (facilities.geo) 用。座標もインデックスから読む
+            models.Index(fields=['geo_cell', 'latitude', 'longitude'], name='facility_geo_cell_idx'),
+        ]
+
     def __str__(self):
         return self.facility_name
+
+    def save(self, *args, **kwargs):
+        self.geo_cell = geo.cell_for(self.latitude, self.longitude)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+            kwargs['update_fields'] = update_fields = {*update_fields, 'geo_cell'}
+        # 既存の施設を保存するたびにバージョンを進める
+        if not self._state.adding:
+            self.version += 1
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'version', 'updated_at'}
+        super().save(*args, **kwargs)
     
 
 # 施設画像を管理するためのモデル
@@ -57,9 +131,115 @@ class FacilityImage(models.Model):
     image = models.ImageField(
         "画像",
         upload_to="facilities/images/",     # MEDIA_ROOT/facilities/images に保管される
+        storage=facility_image_storage,     # ファイル名に中身のハッシュを入れる
     )
 
     caption = models.CharField("キャプション", max_length=50, blank=True)
 
+    # リサイズ済みの派生画像 [{name, width, height, format}, ...] (facilities.images で生成)
+    variants = models.JSONField("派生画像", default=list, blank=True, editable=False)
+
+    updated_at = models.DateTimeField("更新日時", auto_now=True)
+
+    class Meta:
+        indexes = [
+            # 変更フィード (facilities.changes) 用
+            models.Index(fields=['updated_at', 'id'], name='facilityimage_updated_idx'),
+            # 同じファイルを使う画像の検索用 (facilities.cleanup / facilities.images)
+            models.Index(fields=['image'], name='facilityimage_image_idx'),
+        ]
+
     def __str__(self):
         return f"{self.facility.facility_name}の画像"
+
+
+# 施設画像のファイル(中身が同じものは1つだけ保存する)と、そのファイルを使っている画像の数
+# DeduplicatingFileSystemStorage が保存時に作成・参照を増やし、画像の削除時に facilities.cleanup が参照を減らす。
+# 参照がなくなったファイルは、派生画像と一緒にコミット後に削除する
+class FacilityImageBlob(models.Model):
+    digest = models.CharField("SHA-256", max_length=64, unique=True)
+    name = models.CharField("ファイル名", max_length=255, unique=True)
+    size = models.PositiveBigIntegerField("サイズ")
+    ref_count = models.PositiveIntegerField("参照数", default=0)
+    created_at = models.DateTimeField("作成日時", auto_now_add=True)
+
+    class Meta:
+        verbose_name = "施設画像のファイル"
+        verbose_name_plural = "施設画像のファイル"
+
+    def __str__(self):
+        return f"{self.name} ({self.ref_count})"
+
+
+# 削除されたレコードの記録 (変更フィード facilities.changes で削除を伝えるため)
+# FACILITIES_TOMBSTONE_RETENTION_DAYS 日より古いものは prune_tombstones コマンドで削除する
+class Tombstone(models.Model):
+    class Kind(models.TextChoices):
+        FACILITY = "facility", "施設"
+        AMENITY = "amenity", "アメニティ"
+        IMAGE = "image", "施設画像"
+
+    kind = models.CharField("種類", max_length=20, choices=Kind.choices)
+    object_id = models.PositiveBigIntegerField("削除したID")
+    deleted_at = models.DateTimeField("削除日時", default=timezone.now)
+
+    class Meta:
+        verbose_name = "削除記録"
+        verbose_name_plural = "削除記録"
+        indexes = [
+            models.Index(fields=['deleted_at', 'id'], name='tombstone_deleted_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id} ({self.deleted_at})"
+
+
+# Beds24との同期状態 (施設ごとのチェックポイントと取得したデータ)
+class Beds24SyncState(models.Model):
+    facility = models.OneToOneField(
+        Facility,
+        verbose_name="施設",
+        related_name="beds24_state",
+        on_delete=models.CASCADE,
+    )
+    synced_keys = models.CharField("同期したキー", max_length=251, blank=True)        # prop_key:room_key (キーが変わったら全件同期し直す)
+    room = models.JSONField("部屋情報", default=dict, blank=True)                     # getPropertyの部屋タイプ
+    calendar = models.JSONField("在庫・料金", default=dict, blank=True)               # {"YYYY-MM-DD": {"available": 1, "price": "12000.00"}}
+    synced_until = models.DateField("取得済みの最終日", null=True, blank=True)
+    bookings_checked_at = models.DateTimeField("予約の確認日時", null=True, blank=True)  # 差分同期のチェックポイント
+    last_full_sync_at = models.DateTimeField("最終全件同期日時", null=True, blank=True)
+    last_synced_at = models.DateTimeField("最終同期日時", null=True, blank=True)
+    last_error = models.TextField("最後のエラー", blank=True)
+
+    class Meta:
+        verbose_name = "Beds24同期状態"
+        verbose_name_plural = "Beds24同期状態"
+
+    def __str__(self):
+        return f"{self.facility_id}の同期状態"
+
+
+# 施設の空き状況 (1施設・1年につき1行)
+# nightsは「その日の夜に宿泊できるか」を1日1ビットで表したビットマップ (1月1日が最下位ビット、366ビット = 46バイト)
+class FacilityAvailability(models.Model):
+    facility = models.ForeignKey(
+        Facility,
+        verbose_name="施設",
+        related_name="availability",
+        on_delete=models.CASCADE,
+    )
+    year = models.PositiveSmallIntegerField("年")
+    nights = models.BinaryField("空き状況", max_length=46)
+
+    class Meta:
+        verbose_name = "空き状況"
+        verbose_name_plural = "空き状況"
+        constraints = [
+            models.UniqueConstraint(fields=['facility', 'year'], name='unique_facility_availability_year'),
+        ]
+        indexes = [
+            models.Index(fields=['year', 'facility'], name='facility_avail_year_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.facility_id}の空き状況 ({self.year}年)"
@@ -0,0 +1,35 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class OptInCursorPagination(CursorPagination):
+    """
+    idをキーにしたカーソル(キーセット)ページネーション
+
+    - `?page_size=` または `?cursor=` を指定したリクエストだけページ分割する
+    - 指定がなければ従来どおり配列のまま返す (既存クライアントの移行期間用)
+    - `WHERE id > カーソル位置 ORDER BY id LIMIT n` で取得するため、何ページ目でもコストはページサイズ分
+    """
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+    # レスポンスの形を切り替えるクエリパラメータ (?paginate=false で従来の配列形式)
+    paginate_query_param = 'paginate'
+
+    def __init__(self):
+        self.page_size = getattr(settings, 'FACILITIES_PAGE_SIZE', 50)
+        self.max_page_size = getattr(settings, 'FACILITIES_MAX_PAGE_SIZE', 200)
+
+    def get_page_size(self, request):
+        if not self.is_requested(request):
+            return None
+        return super().get_page_size(request)
+
+    def is_requested(self, request):
+        """このリクエストでページネーションを行うかどうか"""
+        params = request.query_params
+        paginate = params.get(self.paginate_query_param)
+        if paginate is not None:
+            return paginate.lower() not in ('false', '0', 'no')
+        if self.cursor_query_param in params or self.page_size_query_param in params:
+            return True
+        return getattr(settings, 'FACILITIES_PAGINATE_BY_DEFAULT', False)
@@ -0,0 +1,29 @@
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:     # orjsonがなければ標準のJSONRendererと同じ処理になる
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    orjsonで出力するJSONRenderer
+
+    DRFの既定の設定(UNICODE_JSON / COMPACT_JSON / STRICT_JSON)と同じバイト列を返す。
+    インデント指定時や設定を変えている場合、orjsonが扱えない値がある場合は標準の処理に任せる。
+    """
+    options = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME) if orjson else 0
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or not (self.compact and self.strict and not self.ensure_ascii):
+            return super().render(data, accepted_media_type, renderer_context)
+        if self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            # 日時などは標準と同じ形式にするため、DRFのエンコーダーで変換する
+            ret = orjson.dumps(data, default=self.encoder_class().default, option=self.options)
+        except (TypeError, orjson.JSONEncodeError):
+            return super().render(data, accepted_media_type, renderer_context)
+        # 標準のJSONRendererと同じく、JavaScriptの文字列として安全な形にする
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
@@ -0,0 +1,164 @@
+# 読み取り用のレプリカへの振り分け (settings.DATABASE_ROUTERS)
+#
+# - 施設・アメニティのAPIの読み取り(GET/HEAD)だけをレプリカに振り分ける。
+#   管理画面・管理コマンド・バックグラウンド処理などの読み取りと、すべての書き込みはプライマリ(default)で行う
+# - 書き込んだリクエストでは、その後の読み取りもプライマリで行う。さらにレスポンスでCookieを設定し、
+#   FACILITIES_REPLICA_PIN_SECONDS 秒の間は同じクライアントの読み取りもプライマリで行う (自分の書き込みが見える)
+# - レプリカの状態を FACILITIES_REPLICA_HEALTH_INTERVAL 秒ごとに確認し、使えないレプリカは使わない
+#   (すべて使えなければプライマリで読む)
+
+import logging
+import random
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+APP_LABEL = 'facilities'
+PIN_COOKIE = 'facilities_db_pin'
+DEFAULT_PIN_SECONDS = 5
+DEFAULT_HEALTH_INTERVAL = 5
+
+
+@dataclass
+class RoutingState:
+    """1リクエスト分の振り分けの状態 (ReplicaRoutingMiddleware が作る)"""
+    use_replicas: bool = False      # このリクエストの読み取りをレプリカで行ってよいか
+    pinned: bool = False            # プライマリで読む (直前に書き込んだクライアント)
+    wrote: bool = False             # このリクエストで書き込んだ
+
+
+# sync_to_async で別スレッドに渡っても同じオブジェクトを参照するよう、状態はミュータブルなオブジェクトで持つ
+_state = ContextVar('facilities_routing_state', default=None)
+
+
+def replica_aliases():
+    return list(getattr(settings, 'FACILITIES_DATABASE_REPLICAS', []))
+
+
+def use_replicas():
+    """現在のリクエストの以降の読み取りをレプリカで行う (読み取り専用のビューから呼ぶ)"""
+    state = _state.get()
+    if state is not None:
+        state.use_replicas = True
+
+
+class ReplicaHealth:
+    """レプリカごとの確認結果を一定時間だけ覚えておく"""
+
+    def __init__(self):
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def is_healthy(self, alias):
+        interval = getattr(settings, 'FACILITIES_REPLICA_HEALTH_INTERVAL', DEFAULT_HEALTH_INTERVAL)
+        now = time.monotonic()
+        with self._lock:
+            result = self._results.get(alias)
+        if result is not None and now - result[1] < interval:
+            return result[0]
+        healthy = self.check(alias)
+        with self._lock:
+            self._results[alias] = (healthy, now)
+        return healthy
+
+    def check(self, alias):
+        """施設のテーブルを読めるか (ファイルがない・スキーマがないレプリカも使えないとみなす)"""
+        from .models import Facility
+
+        connection = connections[alias]
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(f'SELECT 1 FROM {connection.ops.quote_name(Facility._meta.db_table)} LIMIT 1')
+                cursor.fetchall()
+        except DatabaseError as e:
+            # 接続はエラーが起きたものとして、リクエストの終了時にDjangoが確認して閉じる
+            logger.warning("Database replica %s is unavailable: %s", alias, e)
+            return False
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+
+health = ReplicaHealth()
+
+
+class PrimaryReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != APP_LABEL:
+            return None
+        state = _state.get()
+        if state is None or not state.use_replicas or state.pinned or state.wrote:
+            return DEFAULT_DB_ALIAS
+        healthy = [alias for alias in replica_aliases() if health.is_healthy(alias)]
+        return random.choice(healthy) if healthy else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != APP_LABEL:
+            return None
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # レプリカから読んだインスタンスとプライマリのインスタンスを関連付けてよい (中身は同じデータベース)
+        databases = {DEFAULT_DB_ALIAS, *replica_aliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # レプリカのスキーマはプライマリから複製される
+        if db in replica_aliases():
+            return False
+        return None
+
+
+class ReplicaRoutingMiddleware:
+    """リクエストごとに RoutingState を用意し、書き込んだクライアントにCookieを設定する"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state = RoutingState(pinned=PIN_COOKIE in request.COOKIES)
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self.process_response(state, response)
+
+    async def __acall__(self, request):
+        state = RoutingState(pinned=PIN_COOKIE in request.COOKIES)
+        token = _state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self.process_response(state, response)
+
+    def process_response(self, state, response):
+        if state.wrote and replica_aliases():
+            response.set_cookie(
+                PIN_COOKIE, '1',
+                max_age=getattr(settings, 'FACILITIES_REPLICA_PIN_SECONDS', DEFAULT_PIN_SECONDS),
+                httponly=True, samesite='Lax',
+            )
+        return response
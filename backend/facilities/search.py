@@ -0,0 +1,235 @@
+# 施設の全文検索 (施設名・短い説明文・住所・説明文)
+#
+# 日本語は単語の区切りがないため、文字のバイグラム(2文字ずつ)で索引を作る。
+# 「京都駅前」は「京都 都駅 駅前 前」のように分割して保存し、検索語も同じように分割して
+# 隣接するバイグラムの並び(フレーズ)として検索するので、2文字以上の部分一致を索引だけで判定できる。
+# 各文字列の末尾の1文字も保存しておき、1文字の検索語は前方一致(「駅*」)で検索する。
+#
+# - SQLite: FTS5の仮想テーブル facilities_facility_search (rowid = 施設ID)、順位は bm25()
+# - PostgreSQL: tsvector列 + GINインデックスのテーブル facilities_facility_search、順位は ts_rank()
+# どちらのテーブルもマイグレーション(0010)で作成し、施設の保存・削除時にシグナルから更新する。
+
+import re
+import unicodedata
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+
+TABLE = 'facilities_facility_search'
+
+# 索引に含めるフィールドと、順位付けの重み (施設名での一致を最も重視する)
+FIELDS = ('facility_name', 'short_description', 'address', 'description')
+WEIGHTS = (10.0, 5.0, 3.0, 1.0)
+
+# 英数字・かな・漢字などの連続(記号や空白で区切る)
+_RUN = re.compile(r'[^\W_]+')
+
+
+def normalize(text):
+    """全角英数字・半角カナなどの表記ゆれをそろえ(NFKC)、小文字にする"""
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+
+def bigrams(run):
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+def tokenize(text):
+    """索引用: 文字列をバイグラムと、区切りごとの末尾の1文字に分割する"""
+    tokens = []
+    for run in _RUN.findall(normalize(text)):
+        tokens += bigrams(run)
+        tokens.append(run[-1])
+    return ' '.join(tokens)
+
+
+def query_terms(query):
+    """検索語を、区切りごとの (バイグラムのリスト, 1文字の場合はその文字) に分割する"""
+    return [(bigrams(run), run if len(run) == 1 else None) for run in _RUN.findall(normalize(query))]
+
+
+class SQLiteBackend:
+    """FTS5 (トークナイザはunicode61。分割済みのバイグラムを空白区切りで保存する)"""
+
+    def index(self, rows):
+        rows = [(pk, *(tokenize(value) for value in values)) for pk, *values in rows]
+        if not rows:
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {TABLE} WHERE rowid = %s", [(row[0],) for row in rows])
+            cursor.executemany(
+                f"INSERT INTO {TABLE} (rowid, {', '.join(FIELDS)}) VALUES (%s, %s, %s, %s, %s)", rows
+            )
+
+    def remove(self, facility_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {TABLE} WHERE rowid = %s", [(pk,) for pk in facility_ids])
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {TABLE}")
+
+    def match_expression(self, terms):
+        # 区切りごとのフレーズをANDで結合する: "京都 都駅" "前"*
+        phrases = []
+        for grams, single in terms:
+            phrases.append(f'"{single}"*' if single else '"' + ' '.join(grams) + '"')
+        return ' AND '.join(phrases)
+
+    def match_sql(self, terms):
+        return f"SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH %s", [self.match_expression(terms)]
+
+    def search(self, terms, limit, within=None):
+        weights = ', '.join(str(weight) for weight in WEIGHTS)
+        condition, params = restriction('rowid', within)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH %s{condition} "
+                f"ORDER BY bm25({TABLE}, {weights}) LIMIT %s",
+                [self.match_expression(terms), *params, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class PostgreSQLBackend:
+    """tsvector ('simple'設定) + GIN。フィールドの重みは setweight() の A〜D で表す"""
+
+    def document_sql(self):
+        return ' || '.join(
+            f"setweight(to_tsvector('simple', %s), '{label}')" for label in 'ABCD'[:len(FIELDS)]
+        )
+
+    def index(self, rows):
+        rows = [(pk, *(tokenize(value) for value in values)) for pk, *values in rows]
+        if not rows:
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {TABLE} (facility_id, document) VALUES (%s, {self.document_sql()}) "
+                f"ON CONFLICT (facility_id) DO UPDATE SET document = EXCLUDED.document",
+                rows,
+            )
+
+    def remove(self, facility_ids):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {TABLE} WHERE facility_id = ANY(%s)", [list(facility_ids)])
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"TRUNCATE {TABLE}")
+
+    def match_expression(self, terms):
+        # 区切りごとに隣接(<->)したバイグラムの並びにし、& で結合する: (京都 <-> 都駅) & 前:*
+        phrases = []
+        for grams, single in terms:
+            phrases.append(f"'{single}':*" if single else '(' + ' <-> '.join(f"'{gram}'" for gram in grams) + ')')
+        return ' & '.join(phrases)
+
+    def match_sql(self, terms):
+        return (
+            f"SELECT facility_id FROM {TABLE} WHERE document @@ to_tsquery('simple', %s)",
+            [self.match_expression(terms)],
+        )
+
+    def search(self, terms, limit, within=None):
+        # ts_rank の重みは {D, C, B, A} の順で指定する
+        weights = '{' + ', '.join(str(weight / WEIGHTS[0]) for weight in reversed(WEIGHTS)) + '}'
+        condition, params = restriction('facility_id', within)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT facility_id FROM {TABLE}, to_tsquery('simple', %s) query "
+                f"WHERE document @@ query{condition} "
+                f"ORDER BY ts_rank('{weights}', document, query) DESC, facility_id LIMIT %s",
+                [self.match_expression(terms), *params, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+def restriction(column, within):
+    """施設を within(施設のクエリセット)に含まれるものに限る条件のSQLとパラメータ"""
+    if within is None:
+        return '', ()
+    sql, params = within.order_by().values('pk').query.sql_with_params()
+    return f" AND {column} IN ({sql})", params
+
+
+BACKENDS = {
+    'sqlite': SQLiteBackend,
+    'postgresql': PostgreSQLBackend,
+}
+
+
+def get_backend():
+    try:
+        return BACKENDS[connection.vendor]()
+    except KeyError:
+        raise NotImplementedError(f"全文検索は {connection.vendor} に対応していません") from None
+
+
+def _rows(facility_ids):
+    from .models import Facility
+    return Facility.objects.filter(pk__in=facility_ids).values_list('pk', *FIELDS)
+
+
+def index_facilities(facility_ids):
+    """指定した施設の索引を作り直す (存在しない施設は索引から削除する)"""
+    facility_ids = set(facility_ids)
+    if not facility_ids:
+        return
+    backend = get_backend()
+    rows = list(_rows(facility_ids))
+    backend.remove(facility_ids - {row[0] for row in rows})
+    backend.index(rows)
+
+
+def remove_facilities(facility_ids):
+    facility_ids = set(facility_ids)
+    if facility_ids:
+        get_backend().remove(facility_ids)
+
+
+def rebuild(batch_size=1000):
+    """索引をすべて作り直す。索引に登録した施設数を返す"""
+    from .models import Facility
+
+    backend = get_backend()
+    count = 0
+    with transaction.atomic():
+        backend.clear()
+        batch = []
+        for row in Facility.objects.order_by('pk').values_list('pk', *FIELDS).iterator(chunk_size=batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                backend.index(batch)
+                count += len(batch)
+                batch = []
+        backend.index(batch)
+        count += len(batch)
+    return count
+
+
+def search(query, limit=None, within=None):
+    """
+    検索語に一致する施設のIDを、関連度の高い順に最大limit件返す
+    within(施設のクエリセット)を指定すると、その施設の中で順位を付ける (件数の制限は絞り込んだ後にかける)
+    """
+    terms = query_terms(query)
+    if not terms:
+        return []
+    if limit is None:
+        limit = getattr(settings, 'FACILITIES_SEARCH_LIMIT', 100)
+    if within is not None and not within.query.where:
+        within = None
+    return get_backend().search(terms, limit, within)
+
+
+def matching(query):
+    """
+    検索語に一致するすべての施設IDのサブクエリ (RawSQL。一致しない検索語ならNone)
+    順位を付けずに絞り込むとき(近い順に並べる場合など)に使う
+    """
+    terms = query_terms(query)
+    if not terms:
+        return None
+    return RawSQL(*get_backend().match_sql(terms))
@@ -1,15 +1,27 @@
 # DjangoのモデルインスタンスをJSON形式に変換したり、その逆を行う
 
+from django.conf import settings
+from django.db import transaction
 from rest_framework import serializers
+from . import changes, cleanup, geo, instrumentation, uploads
+from .images import build_srcset
 from .models import Facility, Amenity, FacilityImage
 
-class AmenitySerializer(serializers.ModelSerializer):
+class TimedRepresentationMixin:
+    """to_representation() の時間を、リクエストの計測のシリアライズ時間として記録する (facilities.instrumentation)"""
+
+    def to_representation(self, instance):
+        with instrumentation.section('serialize'):
+            return super().to_representation(instance)
+
+
+class AmenitySerializer(TimedRepresentationMixin, serializers.ModelSerializer):
     class Meta:
         model = Amenity
         fields = ['id', 'name']
 
 
-class FacilityWriteSerializer(serializers.ModelSerializer):
+class FacilityWriteSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
     amenities = serializers.PrimaryKeyRelatedField(
         many=True,
         queryset=Amenity.objects.all(),
@@ -27,6 +39,8 @@ class FacilityWriteSerializer(serializers.ModelSerializer):
             'address',
             'num_parking',
             'map_url',
+            'latitude',
+            'longitude',
             'management_entity',
             'amenities',
             'prop_key',
@@ -34,24 +48,217 @@ class FacilityWriteSerializer(serializers.ModelSerializer):
         ]
         read_only_fields = ['id']
 
-class FacilityImageSerializer(serializers.ModelSerializer):
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        if {'latitude', 'longitude'} & set(attrs):
+            # 緯度と経度は一緒に設定・削除(null)する
+            missing = [name for name in ('latitude', 'longitude') if attrs.get(name) is None]
+            if len(missing) == 1:
+                raise serializers.ValidationError({missing[0]: ['緯度と経度は両方指定してください。']})
+            if missing:
+                attrs['latitude'] = attrs['longitude'] = None
+        elif attrs.get('map_url'):
+            # 座標を指定せずに地図のURLだけを変えた場合は、URLから読み取れれば座標も合わせる
+            parsed = geo.parse_map_url(attrs['map_url'])
+            if parsed is not None:
+                attrs['latitude'], attrs['longitude'] = parsed
+        return attrs
+
+class FacilityImportSerializer(FacilityWriteSerializer):
+    """
+    一括登録(facilities.bulk)の1行分の検証用
+    アメニティはIDではなく名前で指定する (登録時にまとめて解決し、存在しない名前は作成する)
+    """
+    amenities = serializers.ListField(child=serializers.CharField(max_length=100), required=False)
+
+    class Meta(FacilityWriteSerializer.Meta):
+        fields = [name for name in FacilityWriteSerializer.Meta.fields if name != 'id']
+
+
+class FacilityIdsSerializer(serializers.Serializer):
+    """一括操作の対象の施設ID (重複は取り除く)"""
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False)
+
+    def validate_ids(self, value):
+        limit = getattr(settings, 'FACILITIES_BULK_MAX_IDS', 1000)
+        if len(value) > limit:
+            raise serializers.ValidationError(f'一度に指定できる施設は{limit}件までです。')
+        return list(dict.fromkeys(value))
+
+
+class FacilityBulkFieldsSerializer(FacilityWriteSerializer):
+    """一括更新で施設に設定する値の検証用 (アメニティは add_amenities / remove_amenities で指定する)"""
+
+    class Meta(FacilityWriteSerializer.Meta):
+        fields = [name for name in FacilityWriteSerializer.Meta.fields if name not in ('id', 'amenities')]
+
+
+class FacilityBulkUpdateSerializer(FacilityIdsSerializer):
+    """
+    一括更新の内容
+    values: すべての施設に設定する値 (FacilityWriteSerializer の部分更新と同じ検証を行う)
+    add_amenities / remove_amenities: 追加・削除するアメニティのID
+    """
+    values = serializers.DictField(required=False)
+    add_amenities = serializers.ListField(child=serializers.IntegerField(), required=False)
+    remove_amenities = serializers.ListField(child=serializers.IntegerField(), required=False)
+
+    def validate_values(self, value):
+        unknown = set(value) - set(FacilityBulkFieldsSerializer.Meta.fields)
+        if unknown:
+            raise serializers.ValidationError(f"更新できないフィールドです: {', '.join(sorted(unknown))}")
+        serializer = FacilityBulkFieldsSerializer(data=value, partial=True)
+        if not serializer.is_valid():
+            raise serializers.ValidationError(serializer.errors)
+        return serializer.validated_data
+
+    def validate(self, attrs):
+        add = list(dict.fromkeys(attrs.get('add_amenities', [])))
+        remove = list(dict.fromkeys(attrs.get('remove_amenities', [])))
+        if not (attrs.get('values') or add or remove):
+            raise serializers.ValidationError('values / add_amenities / remove_amenities のいずれかを指定してください。')
+        if set(add) & set(remove):
+            raise serializers.ValidationError({'remove_amenities': ['追加と削除に同じアメニティが指定されています。']})
+        found = set(Amenity.objects.filter(pk__in=add + remove).values_list('pk', flat=True))
+        errors = {
+            name: [f"存在しないアメニティです: {', '.join(str(pk) for pk in ids if pk not in found)}"]
+            for name, ids in (('add_amenities', add), ('remove_amenities', remove))
+            if set(ids) - found
+        }
+        if errors:
+            raise serializers.ValidationError(errors)
+        attrs['add_amenities'], attrs['remove_amenities'] = add, remove
+        return attrs
+
+
+class FacilityCompositeSerializer(FacilityWriteSerializer):
+    """
+    施設の基本情報・アメニティ・画像を1回のリクエストで作成するためのシリアライザー
+    すべて1つのトランザクションで登録し、どれかが失敗すれば何も作成しない
+    """
+    # まだ登録されていないアメニティは名前で指定できる (既存の名前なら再利用する)
+    new_amenities = serializers.ListField(
+        child=serializers.CharField(max_length=100), required=False, write_only=True
+    )
+    images = serializers.ListField(child=serializers.ImageField(), required=False, write_only=True)
+    # imagesと同じ順番のキャプション (省略可)
+    captions = serializers.ListField(
+        child=serializers.CharField(max_length=50, allow_blank=True), required=False, write_only=True
+    )
+
+    class Meta(FacilityWriteSerializer.Meta):
+        fields = FacilityWriteSerializer.Meta.fields + ['new_amenities', 'images', 'captions']
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        if len(attrs.get('captions', [])) > len(attrs.get('images', [])):
+            raise serializers.ValidationError({'captions': ['画像の数よりキャプションが多く指定されています。']})
+        return attrs
+
+    def create(self, validated_data):
+        amenities = validated_data.pop('amenities', [])
+        new_amenity_names = validated_data.pop('new_amenities', [])
+        image_files = validated_data.pop('images', [])
+        captions = validated_data.pop('captions', [])
+
+        saved = []
+        try:
+            with transaction.atomic():
+                facility = Facility.objects.create(**validated_data)
+                amenities = [*amenities, *Amenity.objects.get_or_create_by_names(new_amenity_names)]
+                if amenities:
+                    facility.amenities.set(amenities)
+                if image_files:
+                    created, errors = uploads.save_images(facility, [
+                        (index, image, captions[index] if index < len(captions) else '')
+                        for index, image in enumerate(image_files)
+                    ])
+                    saved = [instance.image.name for _, instance in created]
+                    if errors:
+                        raise serializers.ValidationError({'images': errors})
+        except Exception:
+            # 行と参照数はロールバックで取り消される。保存したファイルは、ほかの画像と共有していなければ削除する
+            cleanup.discard_rolled_back(saved)
+            raise
+        return facility
+
+
+class FacilityImageSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
 
     # facilityフィールドを追加し、書き込み時に施設IDを受け取れるように
     # facility = serializers.PrimaryKeyRelatedField(queryset=Facility.objects.all(), write_only=True, required=False)
 
+    # リサイズ済みの派生画像 (生成前は空)
+    variants = serializers.SerializerMethodField()
+    # <img srcset> / <source srcset> にそのまま使える文字列 (フォーマットごと)
+    srcset = serializers.SerializerMethodField()
+
     class Meta:
         model = FacilityImage
-        fields = ['id', 'facility', 'image', 'caption']
+        fields = ['id', 'facility', 'image', 'caption', 'variants', 'srcset']
         extra_kwargs = {
             'facility': {'write_only': True}
         }
         # read_only_fields = ['id']
 
-class FacilitySerializer(serializers.ModelSerializer):
+    def _build_url(self, instance, name):
+        url = instance.image.storage.url(name)
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request is not None else url
+
+    def get_variants(self, instance):
+        return [
+            {
+                'url': self._build_url(instance, variant['name']),
+                'width': variant['width'],
+                'height': variant['height'],
+                'format': variant['format'],
+            }
+            for variant in instance.variants
+        ]
+
+    def get_srcset(self, instance):
+        return build_srcset(instance.variants, lambda name: self._build_url(instance, name))
+
+class FacilityImageUploadSerializer(serializers.ModelSerializer):
+    """一括アップロードの1ファイル分の検証用"""
+
+    class Meta:
+        model = FacilityImage
+        fields = ['image', 'caption']
+
+
+class SelectableFieldsMixin:
+    """
+    コンテキストの 'fields' / 'expand' に応じて出力するフィールドを絞り込むシリアライザー用のMixin
+
+    - fields: 出力するフィールド名の集合 (Noneなら Meta.fields のすべて)
+      Meta.optional_fields のフィールドは、fields で指定されたときだけ出力する
+    - expand: ネストして出力する関連の集合 (Noneなら Meta.expandable_fields のすべて)
+      指定されなかった関連はIDのリストとして出力する
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        selected = self.context.get('fields')
+        expand = self.context.get('expand')
+        optional = getattr(self.Meta, 'optional_fields', ())
+        for name in list(self.fields):
+            if (selected is None and name in optional) or (selected is not None and name not in selected):
+                self.fields.pop(name)
+        if expand is not None:
+            for name in getattr(self.Meta, 'expandable_fields', ()):
+                if name in self.fields and name not in expand:
+                    self.fields[name] = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
+
+
+class FacilitySerializer(TimedRepresentationMixin, SelectableFieldsMixin, serializers.ModelSerializer):
     # 読み取り専用で、関連するアメニティと画像をネスト
     amenities = AmenitySerializer(many=True, read_only=True)
     # amenities = serializers.PrimaryKeyRelatedField(many=True, queryset=Amenity.objects.all(), required=False)
     images = FacilityImageSerializer(many=True, read_only=True)
+    # 一覧のカード表示用の代表画像 (?fields= で指定したときだけ出力する)
+    cover_image = serializers.SerializerMethodField()
 
     class Meta:
         model = Facility
@@ -66,9 +273,54 @@ class FacilitySerializer(serializers.ModelSerializer):
             'address',
             'num_parking',
             'map_url',
+            'latitude',
+            'longitude',
             'management_entity',
             'amenities',
             'images',
             'prop_key',
             'room_key',
-        ]
\ No newline at end of file
+            'version',
+            'cover_image',
+        ]
+        optional_fields = ['cover_image']
+        expandable_fields = ['amenities', 'images']
+
+    def get_cover_image(self, instance):
+        # 一覧では Prefetch(to_attr='cover_images') で施設ごとに1枚だけ取得しておく
+        images = getattr(instance, 'cover_images', None)
+        if images is None:
+            images = instance.images.order_by('pk')[:1]
+        image = next(iter(images), None)
+        return FacilityImageSerializer(image, context=self.context).data if image is not None else None
+
+
+class ChangeFeedSerializer(serializers.Serializer):
+    """変更フィードのクエリパラメータ"""
+    # 前回のレスポンスの next_since、またはISO 8601の日時 (省略すると最初から)
+    updated_since = serializers.CharField(required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=changes.MAX_LIMIT, default=changes.DEFAULT_LIMIT)
+
+    def validate_updated_since(self, value):
+        try:
+            return changes.parse_since(value)
+        except ValueError:
+            raise serializers.ValidationError('トークンまたは日時を指定してください。')
+
+
+class AvailabilitySearchSerializer(serializers.Serializer):
+    """空き施設検索のクエリパラメータ"""
+    check_in = serializers.DateField()
+    check_out = serializers.DateField()
+    guests = serializers.IntegerField(min_value=1, default=1)
+
+    # 1回の検索で指定できる最大の泊数
+    MAX_NIGHTS = 365
+
+    def validate(self, attrs):
+        nights = (attrs['check_out'] - attrs['check_in']).days
+        if nights < 1:
+            raise serializers.ValidationError({'check_out': ['チェックアウトはチェックインより後の日付を指定してください。']})
+        if nights > self.MAX_NIGHTS:
+            raise serializers.ValidationError({'check_out': [f'宿泊期間は{self.MAX_NIGHTS}泊以内で指定してください。']})
+        return attrs
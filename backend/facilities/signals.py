@@ -0,0 +1,132 @@
+# 関連モデルの変更を施設のバージョンとペイロードキャッシュに反映させるシグナル
+# (画像やアメニティが変わると施設のシリアライズ結果も変わるため)
+# 変更はイベント(facilities.events)としても配信する
+
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import cache, cleanup, events, images, search, tasks
+from .models import Amenity, Facility, FacilityImage, Tombstone
+
+
+def touch_facilities(facility_ids):
+    """指定した施設のバージョンを進め、キャッシュ済みのペイロードを破棄する"""
+    facility_ids = set(facility_ids)
+    if facility_ids:
+        Facility.objects.filter(pk__in=facility_ids).touch()
+        cache.invalidate(facility_ids)
+        events.publish_facilities(facility_ids)
+
+
+@receiver(post_save, sender=Facility)
+@receiver(post_delete, sender=Facility)
+def facility_changed(sender, instance, **kwargs):
+    cache.invalidate([instance.pk])
+
+
+@receiver(post_save, sender=Facility)
+def facility_saved(sender, instance, update_fields=None, **kwargs):
+    # 全文検索の索引を更新する (検索対象のフィールドを含まない部分的な保存では不要)
+    if update_fields is None or set(update_fields) & set(search.FIELDS):
+        search.index_facilities([instance.pk])
+
+
+@receiver(post_delete, sender=Facility)
+def facility_deleted(sender, instance, **kwargs):
+    search.remove_facilities([instance.pk])
+
+
+@receiver(post_delete, sender=Facility)
+@receiver(post_delete, sender=Amenity)
+@receiver(post_delete, sender=FacilityImage)
+def record_deletion(sender, instance, **kwargs):
+    # 変更フィード (facilities.changes) で削除を伝えるため
+    Tombstone.objects.create(kind=TOMBSTONE_KINDS[sender], object_id=instance.pk)
+
+
+TOMBSTONE_KINDS = {
+    Facility: Tombstone.Kind.FACILITY,
+    Amenity: Tombstone.Kind.AMENITY,
+    FacilityImage: Tombstone.Kind.IMAGE,
+}
+
+
+@receiver(post_save, sender=Facility)
+@receiver(post_save, sender=Amenity)
+@receiver(post_save, sender=FacilityImage)
+def publish_saved(sender, instance, created, **kwargs):
+    events.publish([change_event(instance, 'created' if created else 'updated')])
+
+
+@receiver(post_delete, sender=Facility)
+@receiver(post_delete, sender=Amenity)
+@receiver(post_delete, sender=FacilityImage)
+def publish_deleted(sender, instance, **kwargs):
+    events.publish([change_event(instance, 'deleted')])
+
+
+def change_event(instance, action):
+    if isinstance(instance, Facility):
+        # save() で進めた後のバージョン (削除ではバージョンを送らない)
+        return events.facility_event(instance.pk, action, instance.version if action != 'deleted' else None)
+    if isinstance(instance, FacilityImage):
+        return events.image_event(instance.pk, action, instance.facility_id)
+    return events.amenity_event(instance.pk, action)
+
+
+@receiver(m2m_changed, sender=Facility.amenities.through)
+def facility_amenities_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        # facility.amenities.add(...) など: instanceが施設
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            touch_facilities([instance.pk])
+    elif action in ('post_add', 'post_remove'):
+        # amenity.facility_set.add(...) など: pk_setが施設のID
+        touch_facilities(pk_set)
+    elif action == 'pre_clear':
+        # amenity.facility_set.clear(): clear後は対象の施設が分からないため事前に取得する
+        touch_facilities(instance.facility_set.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=FacilityImage)
+@receiver(post_delete, sender=FacilityImage)
+def facility_image_changed(sender, instance, **kwargs):
+    touch_facilities([instance.facility_id])
+
+
+@receiver(post_delete, sender=FacilityImage)
+def facility_image_deleted(sender, instance, **kwargs):
+    # ファイルの参照を減らし、参照がなくなったファイルはコミット後にバックグラウンドで削除する
+    # (施設の削除に伴うCASCADEでも送られる)
+    cleanup.release_images([(instance.image.name, instance.variants)])
+
+
+@receiver(pre_save, sender=FacilityImage)
+def facility_image_replacing(sender, instance, update_fields=None, **kwargs):
+    # 元画像が差し替えられたら、古い元画像(と派生画像)のファイルの参照を減らす
+    if instance._state.adding or (update_fields is not None and 'image' not in update_fields):
+        return
+    old = FacilityImage.objects.filter(pk=instance.pk).values_list('image', 'variants').first()
+    if old is not None and old[0] != instance.image.name:
+        cleanup.release_images([old])
+
+
+@receiver(post_save, sender=FacilityImage)
+def facility_image_saved(sender, instance, **kwargs):
+    # 派生画像の生成はリクエストの外(コミット後のバックグラウンド)で行う
+    # 元画像が変わっていなければ generate_variants() は何もしない
+    if instance.image:
+        tasks.schedule_on_commit(images.generate_variants, instance.pk)
+
+
+@receiver(post_save, sender=Amenity)
+def amenity_saved(sender, instance, created, **kwargs):
+    # アメニティ名の変更は、そのアメニティを持つ全施設の表示に影響する
+    if not created:
+        touch_facilities(instance.facility_set.values_list('pk', flat=True))
+
+
+@receiver(pre_delete, sender=Amenity)
+def amenity_deleted(sender, instance, **kwargs):
+    # 削除時は中間テーブルの行がCASCADEで消えるだけでm2m_changedが発火しないため、ここで反映する
+    touch_facilities(instance.facility_set.values_list('pk', flat=True))
@@ -0,0 +1,123 @@
+# 施設画像のストレージ
+#
+# ファイル名に中身のハッシュを入れて保存する (facilities/images/DSC_0041.JPG -> DSC_0041.3f2a9c0b1d4e.JPG)。
+# 同じ名前のファイルの中身は変わらないため、配信時に長期間のキャッシュ(immutable)を指定できる (facilities.media)。
+# DeduplicatingFileSystemStorage は、中身(SHA-256)が同じファイルを1つだけ保存し、
+# 別の名前でアップロードされても保存済みのファイルの名前を返す (参照数は FacilityImageBlob で数える)。
+
+import hashlib
+import posixpath
+import re
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, storages
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+HASH_LENGTH = 12
+
+# 名前の末尾の ".<ハッシュ>" (同名のファイルがある場合にDjangoが付ける "_xxxxxxx" を含む) と拡張子
+HASHED_NAME_RE = re.compile(r'^(?P<root>.+)\.(?P<hash>[0-9a-f]{%d})(?:_[0-9A-Za-z]{7})?(?P<ext>\.[^./]+)?$' % HASH_LENGTH)
+
+
+def content_digest(content):
+    """
+    中身のSHA-256 (16進数)
+    アップロード時に計算済み(facilities.uploads のアップロードハンドラー)なら、ファイルを読み直さない
+    """
+    digest = getattr(content, 'content_digest', None)
+    if digest is not None:
+        return digest
+    digest = hashlib.sha256()
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+def content_hash(content):
+    return content_digest(content)[:HASH_LENGTH]
+
+
+def name_hash(name):
+    """ハッシュ付きの名前ならハッシュを、そうでなければNoneを返す"""
+    match = HASHED_NAME_RE.match(posixpath.basename(name))
+    return match['hash'] if match else None
+
+
+def unhashed_name(name):
+    """ハッシュ付きの名前から、ハッシュを入れる前の名前を返す (ハッシュがなければそのまま)"""
+    directory, basename = posixpath.split(name)
+    match = HASHED_NAME_RE.match(basename)
+    if match is None:
+        return name
+    return posixpath.join(directory, match['root'] + (match['ext'] or ''))
+
+
+class HashedFileSystemStorage(FileSystemStorage):
+    """保存するファイルの名前に、中身のSHA-256の先頭12文字を入れるFileSystemStorage"""
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        return super().save(self.hashed_name(name, content, max_length), content, max_length=max_length)
+
+    def hashed_name(self, name, content, max_length=None):
+        """保存先の名前 (同名のファイルがあれば、保存時にさらに "_xxxxxxx" が付く)"""
+        root, ext = posixpath.splitext(name)
+        suffix = f".{content_hash(content)}{ext}"
+        # 長さの上限を超える場合は、ハッシュではなく元の名前の方を切り詰める
+        if max_length is not None and len(root) + len(suffix) > max_length:
+            directory, stem = posixpath.split(root)
+            stem = stem[:max(1, len(stem) - (len(root) + len(suffix) - max_length))]
+            root = posixpath.join(directory, stem)
+        return root + suffix
+
+
+class DeduplicatingFileSystemStorage(HashedFileSystemStorage):
+    """
+    中身が同じファイルを1つだけ保存する HashedFileSystemStorage
+
+    save() はファイルの参照を1つ増やす (画像の行が削除されたときに facilities.cleanup が減らす)。
+    派生画像は元画像の名前から決まり、元画像と一緒に共有されるため save_derivative() で保存する (参照を数えない)。
+    """
+
+    def save(self, name, content, max_length=None):
+        from .models import FacilityImageBlob
+
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        digest = content_digest(content)
+
+        blob = FacilityImageBlob.objects.filter(digest=digest).values_list('pk', 'name').first()
+        if blob is not None:
+            pk, existing = blob
+            if self.exists(existing):
+                # 参照を増やせたら(直前に削除されていなければ)、保存済みのファイルを使う
+                if FacilityImageBlob.objects.filter(pk=pk).update(ref_count=F('ref_count') + 1):
+                    return existing
+            else:
+                # ファイルが失われている: 保存し直す
+                FacilityImageBlob.objects.filter(pk=pk).delete()
+
+        saved = super().save(name, content, max_length=max_length)
+        try:
+            with transaction.atomic():
+                FacilityImageBlob.objects.create(digest=digest, name=saved, size=content.size, ref_count=1)
+        except IntegrityError:
+            # 同じ中身が同時に保存された: 先に登録された方を使う
+            super().delete(saved)
+            return self.save(name, content, max_length=max_length)
+        return saved
+
+    def save_derivative(self, name, content, max_length=None):
+        return super().save(name, content, max_length=max_length)
+
+
+def facility_image_storage():
+    """FacilityImage.image のストレージ (settings.STORAGES の "facility_images")"""
+    return storages['facility_images']
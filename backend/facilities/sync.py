@@ -0,0 +1,208 @@
+# Beds24から部屋情報・在庫・料金を取り込む同期処理
+#
+# - HTTPリクエストはスレッドプールで並行に実行し (同時実行数は concurrency まで)、DBへの書き込みは呼び出し元のスレッドで行う
+# - 施設ごとのチェックポイント(Beds24SyncState)から差分だけを取得する
+#     全件同期: 部屋情報 + 今日から horizon_days 日分の在庫・料金
+#     差分同期: 前回以降に変更された予約を確認し、影響する日付と新たに期間に入った日付の在庫・料金だけを取得する
+
+import datetime
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import availability
+from .beds24 import Beds24Client, Beds24Error
+from .models import Beds24SyncState, Facility
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SyncPlan:
+    """1施設分の同期内容 (ワーカースレッドに渡すため、モデルではなく値だけを持つ)"""
+    facility_id: int
+    prop_key: str
+    room_key: str
+    full: bool
+    bookings_checked_at: datetime.datetime = None
+    synced_until: datetime.date = None
+
+
+@dataclass
+class FetchResult:
+    started_at: datetime.datetime
+    room: dict = None
+    calendar: dict = field(default_factory=dict)
+    synced_until: datetime.date = None
+
+
+@dataclass
+class SyncReport:
+    facilities: int = 0
+    full: int = 0
+    incremental: int = 0
+    failed: int = 0
+    requests: int = 0
+    retries: int = 0
+    elapsed: float = 0.0
+    errors: dict = field(default_factory=dict)
+
+
+def parse_date(value):
+    """Beds24の日付 (YYYYMMDD / YYYY-MM-DD) を date にする"""
+    return datetime.datetime.strptime(value.replace('-', ''), '%Y%m%d').date()
+
+
+def parse_room_dates(room_dates):
+    """getRoomDatesのレスポンスを {"YYYY-MM-DD": {"available": 在庫数, "price": 料金}} にする"""
+    calendar = {}
+    for day, values in room_dates.items():
+        calendar[parse_date(day).isoformat()] = {
+            'available': int(values.get('i') or 0),
+            'price': values.get('p1'),
+        }
+    return calendar
+
+
+class Beds24Sync:
+
+    def __init__(self, client=None, concurrency=None, horizon_days=None, full_sync_interval=None, today=None):
+        self.concurrency = concurrency or settings.BEDS24_SYNC_CONCURRENCY
+        self.client = client or Beds24Client(pool_size=self.concurrency)
+        self.horizon_days = horizon_days or settings.BEDS24_SYNC_HORIZON_DAYS
+        self.full_sync_interval = full_sync_interval or datetime.timedelta(
+            hours=settings.BEDS24_FULL_SYNC_INTERVAL_HOURS
+        )
+        self.today = today or timezone.localdate()
+
+    @property
+    def horizon_end(self):
+        return self.today + datetime.timedelta(days=self.horizon_days - 1)
+
+    def run(self, facilities=None, full=False):
+        """Beds24のキーが設定された施設を同期し、SyncReportを返す"""
+        started = time.perf_counter()
+        requests_before, retries_before = self.client.request_count, self.client.retry_count
+
+        if facilities is None:
+            facilities = Facility.objects.all()
+        facilities = facilities.exclude(prop_key='').exclude(room_key='').select_related('beds24_state')
+        plans = [self.plan(facility, full) for facility in facilities]
+
+        report = SyncReport(facilities=len(plans))
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='beds24-sync') as executor:
+            futures = {executor.submit(self.fetch, plan): plan for plan in plans}
+            for future in as_completed(futures):
+                plan = futures[future]
+                try:
+                    result = future.result()
+                except Beds24Error as e:
+                    logger.warning("Beds24 sync failed for facility %s: %s", plan.facility_id, e)
+                    Beds24SyncState.objects.update_or_create(
+                        facility_id=plan.facility_id, defaults={'last_error': str(e)}
+                    )
+                    report.failed += 1
+                    report.errors[plan.facility_id] = str(e)
+                    continue
+                self.apply(plan, result)
+                if plan.full:
+                    report.full += 1
+                else:
+                    report.incremental += 1
+
+        report.requests = self.client.request_count - requests_before
+        report.retries = self.client.retry_count - retries_before
+        report.elapsed = time.perf_counter() - started
+        return report
+
+    def plan(self, facility, full=False):
+        keys = f"{facility.prop_key}:{facility.room_key}"
+        state = getattr(facility, 'beds24_state', None)
+        full = (
+            full
+            or state is None
+            or state.synced_keys != keys
+            or state.synced_until is None
+            or state.bookings_checked_at is None
+            or state.last_full_sync_at is None
+            or timezone.now() - state.last_full_sync_at >= self.full_sync_interval
+        )
+        return SyncPlan(
+            facility_id=facility.pk,
+            prop_key=facility.prop_key,
+            room_key=facility.room_key,
+            full=full,
+            bookings_checked_at=None if full else state.bookings_checked_at,
+            synced_until=None if full else state.synced_until,
+        )
+
+    def fetch(self, plan):
+        """
+        Beds24へのリクエストだけを行う (ワーカースレッドで実行される。DBには触れない)
+        レスポンスの形式が想定と違う場合も Beds24Error にし、ほかの施設の同期は続ける
+        """
+        try:
+            return self._fetch(plan)
+        except (ValueError, TypeError, AttributeError, KeyError) as e:
+            raise Beds24Error(f"unexpected response: {e!r}") from e
+
+    def _fetch(self, plan):
+        result = FetchResult(started_at=timezone.now())
+        if plan.full:
+            prop = self.client.get_property(plan.prop_key)
+            result.room = self._find_room(prop, plan.room_key)
+            date_from = self.today
+        else:
+            date_from = self._changed_since(plan)
+
+        if date_from is not None and date_from <= self.horizon_end:
+            room_dates = self.client.get_room_dates(plan.prop_key, plan.room_key, date_from, self.horizon_end)
+            result.calendar = parse_room_dates(room_dates)
+        result.synced_until = self.horizon_end
+        return result
+
+    def _changed_since(self, plan):
+        """差分同期で在庫・料金を取り直す最初の日付 (取り直す必要がなければNone)"""
+        candidates = []
+        bookings = self.client.get_bookings(plan.prop_key, plan.room_key, plan.bookings_checked_at)
+        for booking in bookings or []:
+            first_night = booking.get('firstNight')
+            if first_night:
+                candidates.append(max(self.today, parse_date(first_night)))
+        if plan.synced_until < self.horizon_end:
+            # 前回の同期以降に期間に入った日付
+            candidates.append(max(self.today, plan.synced_until + datetime.timedelta(days=1)))
+        return min(candidates) if candidates else None
+
+    def _find_room(self, prop, room_key):
+        for item in prop.get('getProperty', []) if isinstance(prop, dict) else []:
+            for room in item.get('roomTypes', []):
+                if str(room.get('roomId')) == str(room_key):
+                    return room
+        return {}
+
+    def apply(self, plan, result):
+        """取得した結果をチェックポイントと一緒に保存する"""
+        state, _ = Beds24SyncState.objects.get_or_create(facility_id=plan.facility_id)
+        calendar = {} if plan.full else state.calendar
+        calendar.update(result.calendar)
+        # 過去の日付は不要なので捨てる
+        today = self.today.isoformat()
+        state.calendar = {day: values for day, values in sorted(calendar.items()) if day >= today}
+
+        if plan.full:
+            state.room = result.room
+            state.synced_keys = f"{plan.prop_key}:{plan.room_key}"
+            state.last_full_sync_at = result.started_at
+        # 予約の確認はリクエストの開始時刻から次回に引き継ぐ (同期中の変更を取りこぼさないように)
+        state.bookings_checked_at = result.started_at
+        state.synced_until = result.synced_until
+        state.last_synced_at = timezone.now()
+        state.last_error = ''
+        state.save()
+        # 検索用の空き状況カレンダーにも反映する
+        availability.apply_calendar(plan.facility_id, result.calendar)
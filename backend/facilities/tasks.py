@@ -0,0 +1,50 @@
+# リクエストの処理とは別スレッドで実行する後処理 (画像の変換など)
+#
+# - schedule_on_commit(): トランザクションのコミット後にバックグラウンドで実行する
+# - settings.FACILITIES_TASKS_EAGER = True のときはその場で同期実行する (テスト・管理コマンド用)
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'FACILITIES_TASK_WORKERS', 2),
+                thread_name_prefix='facilities-task',
+            )
+        return _executor
+
+
+def _run(func, args, kwargs):
+    try:
+        func(*args, **kwargs)
+    except Exception:
+        logger.exception("Background task %s failed", getattr(func, '__name__', func))
+    finally:
+        # ワーカースレッドが持つDB接続を使い回さないように閉じる
+        close_old_connections()
+
+
+def run_in_background(func, *args, **kwargs):
+    """funcを別スレッドで実行する"""
+    if getattr(settings, 'FACILITIES_TASKS_EAGER', False):
+        func(*args, **kwargs)
+        return None
+    return _get_executor().submit(_run, func, args, kwargs)
+
+
+def schedule_on_commit(func, *args, **kwargs):
+    """現在のトランザクションがコミットされた後に、funcをバックグラウンドで実行する"""
+    transaction.on_commit(lambda: run_in_background(func, *args, **kwargs))
@@ -1,12 +1,47 @@
+import asyncio
 import csv
+import datetime
+import io
 import os
 import json
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+from asgiref.sync import sync_to_async
 from parameterized import parameterized
-from django.test import TestCase
+from django.core.files.base import ContentFile
+from django.core.handlers.asgi import ASGIHandler
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.db.models import Prefetch
+from django.db.models.signals import post_delete
+from django.http import FileResponse
+from django.contrib.auth import get_user_model
+from django.test import AsyncClient, Client, RequestFactory, TestCase, override_settings
+from unittest import mock, skipUnless
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.encoding import escape_uri_path
 from rest_framework.test import APITestCase
 from rest_framework import status
-from .models import Facility, Amenity, FacilityImage
+from rest_framework.renderers import JSONRenderer
+from PIL import Image
+from . import availability, bulk, changes, cleanup, events, geo, instrumentation, payloads, routers, search, storage
+from . import cache as payload_cache
+from .beds24 import Beds24Client, Beds24RateLimited
+from .beds24_stub import Beds24Stub
+from .filters import facilities_with_all_amenities
+from .renderers import FastJSONRenderer
+from .serializers import FacilitySerializer
+from .images import generate_variants
+from .models import (
+    Facility, Amenity, FacilityImage, FacilityImageBlob, Beds24SyncState, FacilityAvailability, Tombstone,
+)
+from .sync import Beds24Sync
 
 # --- モデルの単体テスト (これは残しておきます) ---
 class FacilityModelTest(TestCase):
@@ -97,6 +132,2375 @@ class DataDrivenAPITest(APITestCase):
                 self.assertEqual(value, response.data[key])
 
 
+# --- クエリ数の上限(クエリバジェット)テスト ---
+# 施設一覧: 条件付きGETの検証 + キャッシュ照合用のID一覧 + 施設 + アメニティ(prefetch) + 画像(prefetch)
+FACILITY_LIST_QUERY_BUDGET = 5
+# 施設詳細: 条件付きGETの検証 + 施設 + アメニティ(prefetch) + 画像(prefetch)
+FACILITY_RETRIEVE_QUERY_BUDGET = 4
+# ペイロードがすべてキャッシュにある場合 (検証 + ID一覧 / 検証のみ)
+FACILITY_LIST_CACHED_QUERY_BUDGET = 2
+FACILITY_RETRIEVE_CACHED_QUERY_BUDGET = 1
+
+
+def create_facilities_with_relations(count, amenities_per_facility=3, images_per_facility=2):
+    """アメニティと画像を持つ施設をまとめて作成する (bulk_createでテストの準備を高速化)"""
+    amenities = Amenity.objects.bulk_create(
+        [Amenity(name=f"アメニティ{i}") for i in range(amenities_per_facility)]
+    )
+    facilities = Facility.objects.bulk_create(
+        [Facility(facility_name=f"施設{i}", capacity=2, address=f"住所{i}") for i in range(count)]
+    )
+    Through = Facility.amenities.through
+    Through.objects.bulk_create(
+        [Through(facility_id=f.pk, amenity_id=a.pk) for f in facilities for a in amenities]
+    )
+    FacilityImage.objects.bulk_create(
+        [
+            FacilityImage(facility=f, image=f"facilities/images/{f.pk}_{i}.jpg", caption=f"画像{i}")
+            for f in facilities for i in range(images_per_facility)
+        ]
+    )
+    return facilities
+
+
+class FacilityQueryBudgetTest(APITestCase):
+
+    def setUp(self):
+        payload_cache.clear()
+
+    @parameterized.expand([(1,), (100,), (1000,)])
+    def test_list_query_count_is_constant(self, count):
+        """GET /api/facilities/ : 施設数に関わらずクエリ数がバジェット内に収まるか"""
+        create_facilities_with_relations(count)
+        url = reverse('facility-list')
+
+        with self.assertNumQueries(FACILITY_LIST_QUERY_BUDGET):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), count)
+        self.assertEqual(len(response.data[0]['amenities']), 3)
+        self.assertEqual(len(response.data[0]['images']), 2)
+
+        with self.assertNumQueries(FACILITY_LIST_CACHED_QUERY_BUDGET):
+            cached = self.client.get(url)
+        self.assertEqual(cached.data, response.data)
+
+    def test_retrieve_query_count(self):
+        """GET /api/facilities/{id}/ : 詳細取得のクエリ数がバジェット内に収まるか"""
+        facility = create_facilities_with_relations(1)[0]
+        url = reverse('facility-detail', kwargs={'pk': facility.pk})
+
+        with self.assertNumQueries(FACILITY_RETRIEVE_QUERY_BUDGET):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['amenities']), 3)
+        self.assertEqual(len(response.data['images']), 2)
+
+        with self.assertNumQueries(FACILITY_RETRIEVE_CACHED_QUERY_BUDGET):
+            cached = self.client.get(url)
+        self.assertEqual(cached.data, response.data)
+
+
+class CursorPaginationTest(APITestCase):
+
+    def setUp(self):
+        payload_cache.clear()
+        self.facilities = create_facilities_with_relations(5, amenities_per_facility=1, images_per_facility=1)
+
+    def test_unpaginated_by_default(self):
+        """パラメータなしでは従来どおり配列で返る"""
+        response = self.client.get(reverse('facility-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsInstance(response.data, list)
+        self.assertEqual(len(response.data), 5)
+
+    def test_walk_pages_with_cursor(self):
+        """?page_size= で分割し、next をたどると全件をid順に取得できる"""
+        url = reverse('facility-list') + '?page_size=2'
+        ids = []
+        while url:
+            with self.assertNumQueries(FACILITY_LIST_QUERY_BUDGET):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 2)
+            ids += [item['id'] for item in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(ids, sorted(f.pk for f in self.facilities))
+
+    def test_previous_cursor(self):
+        first = self.client.get(reverse('facility-list') + '?page_size=2')
+        self.assertIsNone(first.data['previous'])
+        second = self.client.get(first.data['next'])
+        back = self.client.get(second.data['previous'])
+        self.assertEqual(back.data['results'], first.data['results'])
+
+    @override_settings(FACILITIES_MAX_PAGE_SIZE=3)
+    def test_page_size_is_capped(self):
+        response = self.client.get(reverse('facility-list') + '?page_size=100')
+        self.assertEqual(len(response.data['results']), 3)
+
+    @override_settings(FACILITIES_PAGINATE_BY_DEFAULT=True, FACILITIES_PAGE_SIZE=2)
+    def test_opt_out_while_paginated_by_default(self):
+        """ページ分割がデフォルトでも ?paginate=false で従来の形式を取得できる"""
+        paginated = self.client.get(reverse('amenity-list'))
+        self.assertIn('next', paginated.data)
+        response = self.client.get(reverse('facility-list') + '?paginate=false')
+        self.assertIsInstance(response.data, list)
+        self.assertEqual(len(response.data), 5)
+
+    def test_images_endpoint_is_paginated(self):
+        response = self.client.get(reverse('facilityimage-list') + '?page_size=4')
+        self.assertEqual(len(response.data['results']), 4)
+        self.assertIsNotNone(response.data['next'])
+
+
+class FacilityFilterTest(APITestCase):
+
+    def setUp(self):
+        payload_cache.clear()
+        self.wifi, self.bath, self.kitchen = Amenity.objects.bulk_create(
+            [Amenity(name="Wi-Fi"), Amenity(name="浴室"), Amenity(name="キッチン")]
+        )
+        self.a = Facility.objects.create(facility_name="A", address="住所", capacity=2, num_parking=0)
+        self.b = Facility.objects.create(facility_name="B", address="住所", capacity=4, num_parking=1,
+                                         management_entity=Facility.ManagementType.CONTRACT)
+        self.c = Facility.objects.create(facility_name="C", address="住所", capacity=8, num_parking=3)
+        self.a.amenities.set([self.wifi])
+        self.b.amenities.set([self.wifi, self.bath])
+        self.c.amenities.set([self.wifi, self.bath, self.kitchen])
+
+    def get_ids(self, **params):
+        response = self.client.get(reverse('facility-list'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return sorted(item['id'] for item in response.data)
+
+    @parameterized.expand([
+        ({'capacity__gte': 4}, ['b', 'c']),
+        ({'num_parking__gte': 1}, ['b', 'c']),
+        ({'management_entity': 'CM'}, ['b']),
+        ({'amenities': ''}, ['a', 'b', 'c']),
+        ({'capacity__gte': 4, 'management_entity': 'IH'}, ['c']),
+    ])
+    def test_attribute_filters(self, params, expected):
+        self.assertEqual(self.get_ids(**params), [getattr(self, name).pk for name in expected])
+
+    def test_has_all_amenities(self):
+        self.assertEqual(self.get_ids(amenities=f"{self.wifi.pk}"), [self.a.pk, self.b.pk, self.c.pk])
+        self.assertEqual(self.get_ids(amenities=f"{self.wifi.pk},{self.bath.pk}"), [self.b.pk, self.c.pk])
+        self.assertEqual(self.get_ids(amenities=f"{self.bath.pk},{self.kitchen.pk},{self.bath.pk}"), [self.c.pk])
+
+    def test_query_count_does_not_grow_with_amenities(self):
+        ids = ",".join(str(pk) for pk in (self.wifi.pk, self.bath.pk, self.kitchen.pk))
+        with self.assertNumQueries(FACILITY_LIST_QUERY_BUDGET):
+            self.client.get(reverse('facility-list'), {'amenities': ids, 'capacity__gte': 2})
+
+    def test_has_all_amenities_is_a_single_join(self):
+        """アメニティの数に関わらず、中間テーブルは1回しか参照しない"""
+        queryset = Facility.objects.filter(pk__in=facilities_with_all_amenities([1, 2, 3, 4, 5]))
+        self.assertEqual(str(queryset.query).count('facilities_facility_amenities'), 1)
+
+    @parameterized.expand([
+        ({'capacity__gte': 'many'}, 'capacity__gte'),
+        ({'management_entity': 'XX'}, 'management_entity'),
+        ({'amenities': '1,wifi'}, 'amenities'),
+    ])
+    def test_invalid_params(self, params, field):
+        response = self.client.get(reverse('facility-list'), params)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(field, response.data)
+
+    def test_filters_apply_to_pages(self):
+        response = self.client.get(reverse('facility-list'), {'capacity__gte': 4, 'page_size': 1})
+        self.assertEqual([item['id'] for item in response.data['results']], [self.b.pk])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([item['id'] for item in response.data['results']], [self.c.pk])
+        self.assertIsNone(response.data['next'])
+
+    @parameterized.expand([
+        (Facility.objects.filter(capacity__gte=4), 'facility_capacity_idx'),
+        (Facility.objects.filter(num_parking__gte=1), 'facility_parking_idx'),
+        (Facility.objects.filter(management_entity='CM'), 'facility_mgmt_capacity_idx'),
+        (Facility.objects.filter(pk__in=facilities_with_all_amenities([1, 2])), 'COVERING INDEX facility_amenity_lookup_idx'),
+    ])
+    @skipUnless(connection.vendor == 'sqlite', "実行計画の形式はSQLiteのもの")
+    def test_query_plan_uses_index(self, queryset, index):
+        self.assertIn(index, queryset.only('id', 'version', 'updated_at').explain())
+
+
+class FacilitySearchTest(APITestCase):
+
+    def setUp(self):
+        payload_cache.clear()
+        self.kyoto = Facility.objects.create(
+            facility_name="京都駅前ゲストハウス", address="京都府京都市下京区",
+            short_description="駅から徒歩3分", description="観光に便利な町家です。",
+        )
+        self.sapporo = Facility.objects.create(
+            facility_name="Sapporo Lodge", address="北海道札幌市中央区",
+            description="京都の町家を移築した宿。ＷｉＦｉ完備。",
+        )
+        self.osaka = Facility.objects.create(facility_name="なんばの宿", address="大阪府大阪市浪速区")
+
+    def get_ids(self, query, **params):
+        response = self.client.get(reverse('facility-list'), {'q': query, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item['id'] for item in response.data]
+
+    def test_tokenize(self):
+        self.assertEqual(search.tokenize("京都駅"), "京都 都駅 駅")
+        self.assertEqual(search.tokenize("ＷｉＦｉ 完備"), "wi if fi i 完備 備")
+
+    @parameterized.expand([
+        ("京都", ['kyoto', 'sapporo']),
+        ("札幌", ['sapporo']),
+        ("下京区", ['kyoto']),
+        ("徒歩", ['kyoto']),
+        ("駅", ['kyoto']),
+        ("sapporo", ['sapporo']),
+        ("wifi", ['sapporo']),
+        ("京都 町家", ['kyoto', 'sapporo']),
+        ("京都 札幌", ['sapporo']),
+        ("東京", []),
+        ("！？", []),
+    ])
+    def test_search(self, query, expected):
+        self.assertCountEqual(self.get_ids(query), [getattr(self, name).pk for name in expected])
+
+    def test_results_are_ranked(self):
+        # 施設名での一致が説明文での一致より上位になる
+        self.assertEqual(self.get_ids("京都"), [self.kyoto.pk, self.sapporo.pk])
+
+    def test_index_follows_save_and_delete(self):
+        self.osaka.description = "京都まで電車で30分"
+        self.osaka.save()
+        self.assertIn(self.osaka.pk, self.get_ids("京都"))
+
+        self.kyoto.delete()
+        self.assertNotIn(self.kyoto.pk, search.search("京都"))
+
+    def test_combined_with_filters(self):
+        Facility.objects.filter(pk=self.kyoto.pk).update(capacity=6)
+        self.assertEqual(self.get_ids("京都", capacity__gte=4), [self.kyoto.pk])
+
+    def test_search_is_not_paginated(self):
+        response = self.client.get(reverse('facility-list'), {'q': "京都", 'page_size': 1})
+        self.assertEqual([item['id'] for item in response.data], [self.kyoto.pk, self.sapporo.pk])
+
+    @override_settings(FACILITIES_SEARCH_LIMIT=1)
+    def test_limit(self):
+        self.assertEqual(self.get_ids("京都"), [self.kyoto.pk])
+
+    @override_settings(FACILITIES_SEARCH_LIMIT=1)
+    def test_limit_applies_after_filters(self):
+        # 絞り込まなければ上限(1件)に入らない施設も、ほかのフィルターで絞り込めば返る
+        Facility.objects.filter(pk=self.sapporo.pk).update(capacity=6, management_entity='CM')
+        self.assertEqual(self.get_ids("京都", capacity__gte=6), [self.sapporo.pk])
+        self.assertEqual(self.get_ids("京都", management_entity='CM'), [self.sapporo.pk])
+        self.assertEqual(search.search("京都", within=Facility.objects.filter(capacity__gte=6)), [self.sapporo.pk])
+
+    def test_rebuild_command(self):
+        # bulk_createではシグナルが発火しないため、索引に載らない
+        Facility.objects.bulk_create([Facility(facility_name=f"函館の宿{i}", address="北海道函館市") for i in range(3)])
+        self.assertEqual(search.search("函館"), [])
+
+        out = io.StringIO()
+        call_command('rebuild_search_index', '--batch-size', '2', stdout=out)
+        self.assertIn('Indexed 6 facilities', out.getvalue())
+        self.assertEqual(len(search.search("函館")), 3)
+
+
+class GeoSearchTest(APITestCase):
+    """位置による検索 (facilities.geo)"""
+
+    def setUp(self):
+        payload_cache.clear()
+        self.kyoto = self.create("京都", 35.0, 135.76)
+        self.osaka = self.create("大阪", 34.68, 135.51)
+        self.sapporo = self.create("札幌", 43.06, 141.35, capacity=6)
+        # 日付変更線の両側
+        self.fiji_east = self.create("フィジー東", -17.8, 179.9)
+        self.fiji_west = self.create("フィジー西", -17.8, -179.9)
+        self.unknown = Facility.objects.create(facility_name="座標なし", address="住所")
+
+    def create(self, name, latitude, longitude, **kwargs):
+        return Facility.objects.create(
+            facility_name=name, address="住所", latitude=latitude, longitude=longitude, **kwargs
+        )
+
+    def get_ids(self, **params):
+        response = self.client.get(reverse('facility-list'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        return [item['id'] for item in response.data]
+
+    @parameterized.expand([
+        ("https://www.google.com/maps?q=35.0,135.76", (35.0, 135.76)),
+        ("https://maps.google.com/?q=35.0%2C135.7&z=15", (35.0, 135.7)),
+        ("https://www.google.com/maps/search/?api=1&query=-33.8568,151.2153", (-33.8568, 151.2153)),
+        ("https://www.google.com/maps?q=loc:+43.06,+141.35", (43.06, 141.35)),
+        ("https://www.google.com/maps/@34.9858,135.7588,17z", (34.9858, 135.7588)),
+        # 場所のページは地図の中心(@)よりピン(!3d!4d)を使う
+        ("https://www.google.com/maps/place/Kyoto/@34.98,135.75,15z/data=!3m1!4b1!4m6!3m5!8m2!3d34.9858!4d135.7588",
+         (34.9858, 135.7588)),
+        ("https://www.google.com/maps?q=京都駅", None),
+        ("https://maps.app.goo.gl/AbCdEf123", None),
+        ("https://www.google.com/maps?q=135.7,35.0", None),
+        ("", None),
+    ])
+    def test_parse_map_url(self, url, expected):
+        self.assertEqual(geo.parse_map_url(url), expected)
+
+    def test_cell_ranges(self):
+        self.assertEqual(self.kyoto.geo_cell, geo.cell_for(35.0, 135.76))
+        self.assertIsNone(self.unknown.geo_cell)
+        # 経度の全体を覆う範囲は、緯度帯ごとにつながった1つの範囲になる
+        self.assertEqual(len(geo.cell_ranges(35.0, -180, 35.05, 180)), 1)
+        self.assertEqual(len(geo.cell_ranges(35.0, 135.0, 35.05, 135.1)), 6)
+        # 日付変更線をまたぐ範囲は緯度帯ごとに両端の2つ (ある緯度帯の東端と次の緯度帯の西端はつながる)
+        self.assertEqual(len(geo.cell_ranges(-17.81, 179.9, -17.8, -179.9)), 3)
+        # 緯度帯が多すぎる場合は1つの範囲
+        self.assertEqual(geo.cell_ranges(30, 130, 40, 140), [
+            (geo.cell_row(30) * geo.COLUMNS, (geo.cell_row(40) + 1) * geo.COLUMNS - 1),
+        ])
+
+    def test_bbox(self):
+        self.assertCountEqual(self.get_ids(bbox="34.5,135.0,35.5,136.0"), [self.kyoto.pk, self.osaka.pk])
+        self.assertCountEqual(self.get_ids(bbox="-18,179,-17,-179"), [self.fiji_east.pk, self.fiji_west.pk])
+        self.assertCountEqual(self.get_ids(bbox="30,130,45,145"), [self.kyoto.pk, self.osaka.pk, self.sapporo.pk])
+        self.assertEqual(self.get_ids(bbox="30,130,45,145", capacity__gte=4), [self.sapporo.pk])
+
+    def test_nearest(self):
+        self.assertEqual(self.get_ids(near="34.70,135.50", k=2), [self.osaka.pk, self.kyoto.pk])
+        self.assertEqual(self.get_ids(near="34.70,135.50", radius=10), [self.osaka.pk])
+        self.assertEqual(
+            self.get_ids(near="34.70,135.50"),
+            [self.osaka.pk, self.kyoto.pk, self.sapporo.pk, self.fiji_east.pk, self.fiji_west.pk],
+        )
+        # 日付変更線の向こう側が近い
+        self.assertEqual(self.get_ids(near="-17.8,-179.95", k=2), [self.fiji_west.pk, self.fiji_east.pk])
+        self.assertEqual(self.get_ids(near="34.70,135.50", k=1, capacity__gte=4), [self.sapporo.pk])
+        self.assertEqual(self.get_ids(near="34.70,135.50", bbox="40,140,45,145"), [self.sapporo.pk])
+
+    def test_nearest_matches_brute_force(self):
+        rng = random.Random(0)
+        points = [(rng.uniform(-89, 89), rng.uniform(-180, 180)) for _ in range(100)]
+        points += [(35 + rng.gauss(0, 0.02), 135.7 + rng.gauss(0, 0.02)) for _ in range(100)]
+        Facility.objects.bulk_create([
+            Facility(facility_name=f"点{i}", address="住所", latitude=lat, longitude=lng, geo_cell=geo.cell_for(lat, lng))
+            for i, (lat, lng) in enumerate(points)
+        ])
+        rows = list(Facility.objects.exclude(latitude=None).values_list('pk', 'latitude', 'longitude'))
+        for latitude, longitude, k in [(35.0, 135.7, 20), (89.5, 10, 5), (-60, 179.99, 5), (0, 0, 50)]:
+            expected = sorted(rows, key=lambda row: geo.distance(latitude, longitude, row[1], row[2]))[:k]
+            found = geo.nearest(Facility.objects.all(), latitude, longitude, k)
+            self.assertEqual([pk for pk, _ in found], [row[0] for row in expected])
+
+    @override_settings(FACILITIES_SEARCH_LIMIT=1)
+    def test_combined_with_search(self):
+        # 検索の上限(1件)に関わらず、範囲・近傍で絞り込んだ施設の中から検索語に一致する施設を返す
+        sapporo_kyoto = self.create("京都屋", 43.07, 141.36)
+        hokkaido = "42.5,140.5,44.0,142.0"
+        self.assertEqual(self.get_ids(q="京都", bbox=hokkaido), [sapporo_kyoto.pk])
+        self.assertEqual(self.get_ids(q="京都", bbox="34.5,135.0,35.5,136.0"), [self.kyoto.pk])
+        self.assertEqual(self.get_ids(q="京都", near="43.06,141.35", k=1), [sapporo_kyoto.pk])
+        self.assertEqual(self.get_ids(q="京都", near="34.68,135.51", k=5), [self.kyoto.pk, sapporo_kyoto.pk])
+        self.assertEqual(self.get_ids(q="東京", near="34.68,135.51"), [])
+
+    def test_near_is_not_paginated(self):
+        response = self.client.get(reverse('facility-list'), {'near': "34.70,135.50", 'k': 2, 'page_size': 1})
+        self.assertEqual([item['id'] for item in response.data], [self.osaka.pk, self.kyoto.pk])
+
+    @parameterized.expand([
+        ({'bbox': '34,135,35'}, 'bbox'),
+        ({'bbox': '36,135,35,136'}, 'bbox'),
+        ({'bbox': '34,135,95,136'}, 'bbox'),
+        ({'bbox': 'nan,135,35,136'}, 'bbox'),
+        ({'near': '34.7'}, 'near'),
+        ({'near': '34.7,135.5', 'k': 0}, 'k'),
+        ({'near': '34.7,135.5', 'k': 101}, 'k'),
+        ({'near': '34.7,135.5', 'radius': '-1'}, 'radius'),
+    ])
+    def test_invalid_params(self, params, field):
+        response = self.client.get(reverse('facility-list'), params)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(field, response.data)
+
+    def test_coordinates_follow_map_url_on_write(self):
+        response = self.client.post(reverse('facility-list'), {
+            'facility_name': "新しい施設", 'address': "住所", 'map_url': "https://www.google.com/maps?q=36.56,136.66",
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        facility = Facility.objects.get(pk=response.data['id'])
+        self.assertEqual((facility.latitude, facility.longitude), (36.56, 136.66))
+        self.assertEqual(facility.geo_cell, geo.cell_for(36.56, 136.66))
+
+        url = reverse('facility-detail', kwargs={'pk': facility.pk})
+        response = self.client.patch(url, {'latitude': 36.0}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('longitude', response.data)
+        # 座標を指定した場合はURLより優先する
+        response = self.client.patch(url, {
+            'map_url': "https://www.google.com/maps?q=26.21,127.68", 'latitude': 26.2, 'longitude': 127.7,
+        }, format='json')
+        self.assertEqual((response.data['latitude'], response.data['longitude']), (26.2, 127.7))
+        response = self.client.patch(url, {'latitude': None}, format='json')
+        facility.refresh_from_db()
+        self.assertEqual((facility.latitude, facility.longitude, facility.geo_cell), (None, None, None))
+
+    def test_bulk_paths_set_cells(self):
+        bulk.update_facilities([self.unknown.pk], values={'latitude': 26.21, 'longitude': 127.68})
+        self.unknown.refresh_from_db()
+        self.assertEqual(self.unknown.geo_cell, geo.cell_for(26.21, 127.68))
+
+        rows = [(1, {'facility_name': "取り込み", 'address': "住所", 'map_url': "https://www.google.com/maps?q=33.59,130.42"}, None)]
+        bulk.import_facilities(rows)
+        imported = Facility.objects.get(facility_name="取り込み")
+        self.assertEqual((imported.latitude, imported.geo_cell), (33.59, geo.cell_for(33.59, 130.42)))
+
+    def test_geocode_command(self):
+        Facility.objects.bulk_create([
+            Facility(facility_name="函館", address="住所", map_url="https://www.google.com/maps?q=41.77,140.73"),
+            Facility(facility_name="住所だけ", address="住所", map_url="https://www.google.com/maps?q=金沢駅"),
+        ])
+        hakodate = Facility.objects.get(facility_name="函館")
+
+        out = io.StringIO()
+        call_command('geocode_facilities', '--dry-run', stdout=out)
+        self.assertIn('Scanned 2 facilities: 1 updated, 0 unchanged, 1 without coordinates in map_url', out.getvalue())
+        self.assertIn('no coordinates in https://www.google.com/maps?q=金沢駅', out.getvalue())
+        hakodate.refresh_from_db()
+        self.assertIsNone(hakodate.latitude)
+
+        call_command('geocode_facilities', '--batch-size', '1', stdout=io.StringIO())
+        version = hakodate.version
+        hakodate.refresh_from_db()
+        self.assertEqual((hakodate.latitude, hakodate.longitude), (41.77, 140.73))
+        self.assertEqual(hakodate.geo_cell, geo.cell_for(41.77, 140.73))
+        self.assertEqual(hakodate.version, version + 1)
+        self.assertEqual(self.get_ids(near="41.8,140.7", k=1), [hakodate.pk])
+
+        out = io.StringIO()
+        call_command('geocode_facilities', '--all', stdout=out)
+        self.assertIn('Scanned 2 facilities: 0 updated, 1 unchanged', out.getvalue())
+
+    @skipUnless(connection.vendor == 'sqlite', "実行計画の形式はSQLiteのもの")
+    def test_query_plan_uses_index(self):
+        queryset = Facility.objects.filter(geo.within(34.5, 135.0, 35.5, 136.0)).values_list('pk', 'latitude', 'longitude')
+        self.assertIn('COVERING INDEX facility_geo_cell_idx', queryset.explain())
+
+
+class SparseFieldsetTest(APITestCase):
+
+    def setUp(self):
+        payload_cache.clear()
+        self.facilities = create_facilities_with_relations(5, amenities_per_facility=2, images_per_facility=3)
+        self.url = reverse('facility-list')
+
+    def test_default_shape_is_unchanged(self):
+        response = self.client.get(self.url)
+        self.assertNotIn('cover_image', response.data[0])
+        self.assertEqual(response.data[0]['amenities'][0].keys(), {'id', 'name'})
+
+    def test_fields(self):
+        with self.assertNumQueries(2):  # 検証 + 施設
+            response = self.client.get(self.url, {'fields': 'id,facility_name,short_description'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[0].keys(), {'id', 'facility_name', 'short_description'})
+
+    def test_only_selected_columns_are_loaded(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url, {'fields': 'id,facility_name'})
+        select = queries.captured_queries[-1]['sql']
+        self.assertIn('facility_name', select)
+        self.assertNotIn('description', select)
+
+    def test_cover_image(self):
+        # 施設 + 代表画像 (施設ごとに1枚) の2クエリ + 検証
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url, {'fields': 'id,facility_name,cover_image'})
+        first_image = FacilityImage.objects.filter(facility=self.facilities[0]).order_by('pk').first()
+        self.assertEqual(response.data[0]['cover_image']['id'], first_image.pk)
+
+        detail = self.client.get(reverse('facility-detail', kwargs={'pk': self.facilities[0].pk}), {'fields': 'cover_image'})
+        self.assertEqual(detail.data, {'cover_image': response.data[0]['cover_image']})
+
+    def test_unexpanded_relations_are_ids(self):
+        response = self.client.get(self.url, {'fields': 'id,amenities,images', 'expand': 'amenities'})
+        facility = response.data[0]
+        self.assertEqual(facility['amenities'][0].keys(), {'id', 'name'})
+        self.assertEqual(
+            facility['images'],
+            list(FacilityImage.objects.filter(facility_id=facility['id']).order_by('pk').values_list('pk', flat=True)),
+        )
+
+    def test_expand_without_fields(self):
+        response = self.client.get(self.url, {'expand': ''})
+        self.assertEqual(len(response.data[0]['amenities']), 2)
+        self.assertIsInstance(response.data[0]['amenities'][0], int)
+        self.assertIn('description', response.data[0])
+
+    def test_with_pagination(self):
+        response = self.client.get(self.url, {'fields': 'id', 'page_size': 2})
+        self.assertEqual(response.data['results'], [{'id': f.pk} for f in self.facilities[:2]])
+
+    def test_sparse_payloads_are_not_cached(self):
+        self.client.get(self.url, {'fields': 'id'})
+        response = self.client.get(self.url)
+        self.assertIn('images', response.data[0])
+
+    @parameterized.expand([
+        ({'fields': 'id,password'}, 'fields'),
+        ({'expand': 'prop_key'}, 'expand'),
+    ])
+    def test_unknown_names(self, params, param):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(param, response.data)
+
+
+class FastPayloadTest(APITestCase):
+    """facilities.payloads + FastJSONRenderer の出力が FacilitySerializer + JSONRenderer とバイト単位で同じか"""
+
+    def setUp(self):
+        payload_cache.clear()
+        create_facilities_with_relations(3)
+        tricky = Facility.objects.create(
+            facility_name="引用符\"とバックスラッシュ\\", address="改行\n\tタブ\u2028\u2029",
+            description="制御文字\x00\x1f\x7f 絵文字😀 結合文字が\u3099", short_description="<script>&amp;</script>",
+            map_url="https://maps.google.com/?q=35.0,135.7&z=15", latitude=35.0123456789, longitude=-0.1,
+            capacity=20, num_parking=10,
+            management_entity=Facility.ManagementType.CONTRACT, prop_key="p", room_key="r",
+        )
+        tricky.amenities.set(Amenity.objects.bulk_create([Amenity(name="Ｗｉ－Ｆｉ"), Amenity(name="")]))
+        FacilityImage.objects.create(
+            facility=tricky, image="facilities/images/写真 1.jpg", caption="",
+            variants=[
+                {'name': 'facilities/images/写真 1__w640.webp', 'width': 640, 'height': 480, 'format': 'webp'},
+                {'name': 'facilities/images/写真 1__w320.webp', 'width': 320, 'height': 240, 'format': 'webp'},
+            ],
+        )
+        FacilityImage.objects.create(facility=tricky, image="", caption="画像なし")
+        Facility.objects.create(facility_name="関連なし", address="住所")
+
+    def serializer_output(self, request):
+        queryset = Facility.objects.order_by('pk').prefetch_related(
+            Prefetch('amenities', queryset=Amenity.objects.order_by('pk')),
+            Prefetch('images', queryset=FacilityImage.objects.order_by('pk')),
+        )
+        data = FacilitySerializer(queryset, many=True, context={'request': request}).data
+        return JSONRenderer().render(data)
+
+    def test_parity_with_serializer(self):
+        request = RequestFactory().get('/api/facilities/')
+        ids = list(Facility.objects.order_by('pk').values_list('pk', flat=True))
+        built, versions = payloads.build_payloads(ids, request)
+        fast = FastJSONRenderer().render([built[pk] for pk in ids])
+        self.assertEqual(fast, self.serializer_output(request))
+        self.assertEqual(versions.keys(), set(ids))
+
+    def test_api_response_parity(self):
+        fast = self.client.get(reverse('facility-list'))
+        payload_cache.clear()
+        with override_settings(FACILITIES_FAST_PAYLOADS=False):
+            slow = self.client.get(reverse('facility-list'))
+        self.assertEqual(fast.content, slow.content)
+        self.assertEqual(fast.content, self.serializer_output(fast.wsgi_request))
+
+    def test_renderer_falls_back_for_indent(self):
+        data = {'name': "施設\u2028", 'created': datetime.datetime(2026, 4, 1, 12, 0, 0, 123456, tzinfo=datetime.timezone.utc)}
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        indented = 'application/json; indent=2'
+        self.assertEqual(FastJSONRenderer().render(data, indented), JSONRenderer().render(data, indented))
+
+
+@override_settings(ROOT_URLCONF='config.asgi_urls')
+class AsyncReadViewTest(APITestCase):
+    """ASGIで使う非同期版のビュー (facilities.async_views) が同期版と同じレスポンスを返すか"""
+
+    def setUp(self):
+        payload_cache.clear()
+        self.facilities = create_facilities_with_relations(5)
+        Facility.objects.filter(pk=self.facilities[0].pk).update(capacity=6)
+        self.async_client = AsyncClient()
+
+    def sync_get(self, url, **headers):
+        with override_settings(ROOT_URLCONF='config.urls'):
+            return self.client.get(url, headers=headers)
+
+    @parameterized.expand([
+        ('/api/facilities/',),
+        ('/api/facilities/?capacity__gte=4',),
+        ('/api/facilities/?page_size=2',),
+        ('/api/facilities/?amenities=1,2&page_size=10',),
+        ('/api/amenities/',),
+        ('/api/amenities/?page_size=1',),
+    ])
+    async def test_same_response_as_sync_view(self, url):
+        expected = await sync_to_async(self.sync_get)(url)
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, expected.status_code)
+        self.assertEqual(response.content, expected.content)
+        self.assertEqual(response['ETag'], expected['ETag'])
+
+    async def test_detail(self):
+        url = f'/api/facilities/{self.facilities[0].pk}/'
+        expected = await sync_to_async(self.sync_get)(url)
+        response = await self.async_client.get(url)
+        self.assertEqual(response.content, expected.content)
+
+        not_modified = await self.async_client.get(url, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        missing = await self.async_client.get('/api/facilities/999999/')
+        self.assertEqual(missing.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_next_page_is_served_async(self):
+        first = await self.async_client.get('/api/facilities/?page_size=3')
+        second = await self.async_client.get(first.json()['next'])
+        ids = [item['id'] for item in first.json()['results'] + second.json()['results']]
+        self.assertEqual(ids, [f.pk for f in self.facilities])
+
+    async def test_invalid_filter(self):
+        response = await self.async_client.get('/api/facilities/?capacity__gte=many')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('capacity__gte', response.json())
+
+    async def test_unsupported_params_fall_back_to_sync_view(self):
+        response = await self.async_client.get('/api/facilities/?fields=id')
+        self.assertEqual(response.json()[0], {'id': self.facilities[0].pk})
+
+    async def test_writes_fall_back_to_sync_view(self):
+        response = await self.async_client.post(
+            '/api/amenities/', {'name': "サウナ"}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(await Amenity.objects.filter(name="サウナ").aexists())
+
+
+class ReplicaRoutingTest(APITestCase):
+    """読み取り用のレプリカへの振り分け (facilities.routers)。プライマリとは別のSQLiteファイルをレプリカにする"""
+    # レプリカの接続は setUpClass() で追加する ('__all__' はクラスの準備の時点のすべての接続を指す)
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        directory = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, directory, ignore_errors=True)
+        # レプリカにだけある施設を作り、どちらから読んだかを区別できるようにする
+        facility = Facility.objects.create(facility_name="レプリカの施設", capacity=2, address="住所")
+        Amenity.objects.create(name="レプリカのアメニティ")
+        connection.ensure_connection()
+        replica = sqlite3.connect(os.path.join(directory, 'replica.sqlite3'))
+        connection.connection.backup(replica)
+        replica.close()
+        cls.replica_facility_pk = facility.pk
+        facility.delete()
+        Amenity.objects.filter(name="レプリカのアメニティ").delete()
+        # スキーマのないレプリカ (使えないレプリカ)
+        sqlite3.connect(os.path.join(directory, 'empty.sqlite3')).close()
+
+        for alias, name in (('replica', 'replica.sqlite3'), ('empty_replica', 'empty.sqlite3')):
+            path = os.path.join(directory, name)
+            connections.settings[alias] = {**connections.settings['default'], 'NAME': f'file:{path}?mode=ro'}
+            cls.addClassCleanup(cls.remove_database, alias)
+        super().setUpClass()
+
+    @classmethod
+    def remove_database(cls, alias):
+        connections[alias].close()
+        del connections[alias]
+        del connections.settings[alias]
+
+    def setUp(self):
+        routers.health.clear()
+        payload_cache.clear()
+        self.facility = Facility.objects.create(facility_name="プライマリの施設", capacity=2, address="住所")
+        settings_override = override_settings(FACILITIES_DATABASE_REPLICAS=['replica'])
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def names(self, response):
+        return {facility['facility_name'] for facility in response.json()}
+
+    def test_api_reads_go_to_the_replica(self):
+        self.assertEqual(self.names(self.client.get(reverse('facility-list'))), {"レプリカの施設"})
+        detail = self.client.get(reverse('facility-detail', kwargs={'pk': self.replica_facility_pk}))
+        self.assertEqual(detail.status_code, 200)
+        amenities = self.client.get(reverse('amenity-list')).json()
+        self.assertEqual([a['name'] for a in amenities], ["レプリカのアメニティ"])
+
+    def test_writes_go_to_the_primary_and_pin_the_client(self):
+        response = self.client.post(
+            reverse('facility-list'), {'facility_name': "新しい施設", 'capacity': 2, 'address': "住所"}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(Facility.objects.using('default').filter(facility_name="新しい施設").exists())
+        self.assertIn(routers.PIN_COOKIE, response.cookies)
+        self.assertEqual(response.cookies[routers.PIN_COOKIE]['max-age'], 5)
+
+        # 書き込んだクライアントは、しばらくプライマリから読む (自分の書き込みが見える)
+        self.assertEqual(self.names(self.client.get(reverse('facility-list'))), {"プライマリの施設", "新しい施設"})
+        del self.client.cookies[routers.PIN_COOKIE]
+        self.assertEqual(self.names(self.client.get(reverse('facility-list'))), {"レプリカの施設"})
+
+    def test_reads_after_a_write_in_the_same_request_use_the_primary(self):
+        router = routers.PrimaryReplicaRouter()
+        token = routers._state.set(routers.RoutingState(use_replicas=True))
+        try:
+            self.assertEqual(router.db_for_read(Facility), 'replica')
+            self.assertEqual(router.db_for_write(Facility), 'default')
+            self.assertEqual(router.db_for_read(Facility), 'default')
+        finally:
+            routers._state.reset(token)
+
+    def test_other_reads_use_the_primary(self):
+        # リクエストの外(管理コマンド・バックグラウンド処理など)
+        self.assertEqual(Facility.objects.all().db, 'default')
+        self.assertEqual(FacilityImage.objects.all().db, 'default')
+        # 書き込みを行わないリクエストでも、Cookieは設定しない
+        response = self.client.get(reverse('facility-list'))
+        self.assertNotIn(routers.PIN_COOKIE, response.cookies)
+
+    def test_unhealthy_replicas_are_skipped(self):
+        with override_settings(FACILITIES_DATABASE_REPLICAS=['empty_replica']):
+            self.assertEqual(self.names(self.client.get(reverse('facility-list'))), {"プライマリの施設"})
+        routers.health.clear()
+        with override_settings(FACILITIES_DATABASE_REPLICAS=['empty_replica', 'replica']):
+            for _ in range(5):
+                payload_cache.clear()
+                self.assertEqual(self.names(self.client.get(reverse('facility-list'))), {"レプリカの施設"})
+
+    def test_health_checks_are_cached(self):
+        with CaptureQueriesContext(connections['replica']) as queries:
+            self.client.get(reverse('facility-list'))
+            self.client.get(reverse('facility-list'))
+        self.assertEqual(len([q for q in queries if 'LIMIT 1' in q['sql'] and 'SELECT 1 FROM' in q['sql']]), 1)
+
+    @override_settings(ROOT_URLCONF='config.asgi_urls')
+    async def test_async_views_read_from_the_replica(self):
+        response = await AsyncClient().get('/api/facilities/', headers={'accept': 'application/json'})
+        self.assertEqual(self.names(response), {"レプリカの施設"})
+
+
+class InstrumentationTest(APITestCase):
+    """リクエストごとの計測 (facilities.instrumentation)"""
+
+    def setUp(self):
+        payload_cache.clear()
+        instrumentation.histograms.clear()
+        wifi = Amenity.objects.create(name="Wi-Fi")
+        for i in range(3):
+            Facility.objects.create(facility_name=f"計測施設{i}", capacity=2, address="住所").amenities.add(wifi)
+
+    def server_timing(self, response):
+        return {
+            part.split(';')[0].strip(): part
+            for part in response['Server-Timing'].split(',')
+        }
+
+    def test_server_timing_header(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('facility-list'))
+        timing = self.server_timing(response)
+        self.assertEqual(set(timing), {'db', 'serialize', 'render', 'app', 'total'})
+        self.assertIn(f'desc="{len(queries)} queries"', timing['db'])
+        self.assertRegex(timing['total'], r'dur=\d+\.\d\d$')
+
+    def test_structured_log(self):
+        with self.assertLogs('facilities.requests', 'INFO') as logs:
+            self.client.get(reverse('facility-list'))
+        record = logs.records[-1].request_metrics
+        self.assertEqual(
+            {key: record[key] for key in ('method', 'route', 'view', 'action', 'status')},
+            {'method': 'GET', 'route': 'api/facilities/', 'view': 'facility-list', 'action': 'list', 'status': 200},
+        )
+        self.assertGreater(record['db_queries'], 0)
+        self.assertGreater(record['serialize_ms'], 0)
+        self.assertGreater(record['render_ms'], 0)
+        self.assertEqual(json.loads(logs.records[-1].getMessage()), record)
+
+    @override_settings(FACILITIES_SLOW_REQUEST_MS=0)
+    def test_slow_request_log_lists_top_queries(self):
+        with self.assertLogs('facilities.requests', 'WARNING') as logs:
+            self.client.get(reverse('facility-list'), {'fields': 'id,amenities', 'expand': 'amenities'})
+        record = logs.records[-1].request_metrics
+        self.assertTrue(logs.records[-1].getMessage().startswith('slow request '))
+        self.assertTrue(record['top_queries'])
+        self.assertEqual(sum(q['count'] for q in record['top_queries']), record['db_queries'])
+        durations = [q['ms'] for q in record['top_queries']]
+        self.assertEqual(durations, sorted(durations, reverse=True))
+
+    def test_metrics_endpoint(self):
+        pk = Facility.objects.first().pk
+        self.client.get(reverse('facility-detail', kwargs={'pk': pk}))
+        self.client.get(reverse('facility-detail', kwargs={'pk': pk}))
+        self.client.get(reverse('facility-detail', kwargs={'pk': 0}))
+
+        response = self.client.get(reverse('request-metrics'))
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4')
+        text = response.content.decode()
+        labels = 'method="GET",route="api/facilities/(?P<pk>[^/.]+)/"'
+        self.assertIn(f'facilities_request_duration_seconds_count{{{labels},status="2xx"}} 2', text)
+        self.assertIn(f'facilities_request_duration_seconds_count{{{labels},status="4xx"}} 1', text)
+        self.assertIn(f'facilities_request_duration_seconds_bucket{{{labels},status="2xx",le="+Inf"}} 2', text)
+        self.assertIn(f'facilities_request_db_queries_total{{{labels},status="2xx"}}', text)
+
+    def test_nested_sections_are_counted_once(self):
+        metrics = instrumentation.RequestMetrics()
+        token = instrumentation._current.set(metrics)
+        try:
+            with instrumentation.section('serialize'):
+                with instrumentation.section('serialize'):
+                    list(Facility.objects.all())
+        finally:
+            instrumentation._current.reset(token)
+        self.assertEqual(metrics.db_count, 1)
+        self.assertGreaterEqual(metrics.sections['serialize'], 0)
+        self.assertEqual(list(metrics.sections), ['serialize'])
+
+    def test_destroy_logs_instead_of_printing(self):
+        facility = Facility.objects.first()
+        with self.assertLogs('facilities.views', 'INFO') as logs:
+            response = self.client.delete(reverse('facility-detail', kwargs={'pk': facility.pk}))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertIn(f"(ID: {facility.pk})", logs.output[0])
+
+    @override_settings(ROOT_URLCONF='config.asgi_urls')
+    async def test_async_views_are_measured(self):
+        with self.assertLogs('facilities.requests', 'INFO') as logs:
+            response = await AsyncClient().get('/api/facilities/', headers={'accept': 'application/json'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('serialize', self.server_timing(response))
+        record = logs.records[-1].request_metrics
+        self.assertEqual(record['view'], 'async-facility-list')
+        self.assertGreater(record['db_queries'], 0)
+
+
+class BulkImportExportTest(APITestCase):
+    """施設の一括登録・一括出力 (facilities.bulk)"""
+
+    CSV = (
+        "facility_name,capacity,address,num_parking,map_url,amenities\n"
+        "町家A,4,京都府京都市,1,,Wi-Fi|駐車場\n"
+        "町家B,30,京都府京都市,,,Wi-Fi\n"
+        "\"町家\nC\",2,京都府京都市,,\"https://www.google.com/maps?q=35.0,135.7\",暖房\n"
+    )
+
+    def setUp(self):
+        self.wifi = Amenity.objects.create(name="Wi-Fi")
+
+    def post_body(self, body, content_type, **params):
+        url = reverse('facility-import')
+        if params:
+            url += '?' + '&'.join(f"{key}={value}" for key, value in params.items())
+        return self.client.generic('POST', url, body.encode(), content_type=content_type)
+
+    def test_csv_import_reports_row_errors(self):
+        response = self.post_body(self.CSV, 'text/csv')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(response.data['rows'], 3)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(response.data['failed'], 1)
+        self.assertEqual(response.data['errors'][0]['line'], 3)
+        self.assertIn('capacity', response.data['errors'][0]['errors'])
+
+        facility = Facility.objects.get(facility_name="町家A")
+        self.assertEqual((facility.capacity, facility.num_parking, facility.version), (4, 1, 1))
+        self.assertEqual(sorted(facility.amenities.values_list('name', flat=True)), ["Wi-Fi", "駐車場"])
+        multiline = Facility.objects.get(facility_name="町家\nC")
+        self.assertEqual(multiline.num_parking, 0)
+        self.assertEqual(list(multiline.amenities.values_list('name', flat=True)), ["暖房"])
+        # 既存のアメニティは名前で再利用し、新しい名前だけを作成する
+        self.assertEqual(Amenity.objects.count(), 3)
+        # bulk_createで登録した施設も検索の索引に入る
+        self.assertEqual(search.search("町家"), sorted(search.search("町家")))
+        self.assertIn(facility.pk, search.search("町家"))
+
+    def test_query_count_does_not_grow_with_rows(self):
+        def import_rows(count, offset):
+            body = "".join(
+                json.dumps({'facility_name': f"施設{offset + i}", 'address': "住所", 'amenities': ["Wi-Fi", f"新{offset}-{i % 3}"]}) + "\n"
+                for i in range(count)
+            )
+            with CaptureQueriesContext(connection) as queries:
+                response = self.post_body(body, 'application/x-ndjson')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            return len(queries)
+
+        self.assertEqual(import_rows(5, 0), import_rows(50, 100))
+        self.assertEqual(Facility.objects.count(), 55)
+        self.assertEqual(Facility.amenities.through.objects.count(), 110)
+
+    def test_chunks_are_committed_separately(self):
+        lines = [json.dumps({'facility_name': f"施設{i}", 'address': "住所"}) for i in range(5)]
+        lines.insert(2, "{not json")
+        lines.insert(4, "[1, 2]")
+        stream = io.BytesIO("\n".join(lines).encode())
+        with CaptureQueriesContext(connection) as queries:
+            report = bulk.import_facilities(bulk.read_rows(stream, 'jsonl'), chunk_size=2)
+        self.assertEqual((report.rows, report.created, report.failed), (7, 5, 2))
+        self.assertEqual([error['line'] for error in report.errors], [3, 5])
+        # テストではトランザクションの中で実行するため、チャンクごとのトランザクションはセーブポイントになる
+        self.assertEqual(sum(query['sql'].startswith('SAVEPOINT') for query in queries), 3)
+
+    def test_dry_run_with_multipart_upload(self):
+        upload = SimpleUploadedFile("facilities.csv", self.CSV.encode('utf-8-sig'), content_type='text/csv')
+        response = self.client.post(reverse('facility-import') + '?dry_run=true', {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual((response.data['created'], response.data['failed'], response.data['dry_run']), (2, 1, True))
+        self.assertFalse(Facility.objects.exists())
+
+    def test_import_with_session_authentication(self):
+        client = session_client()
+        upload = SimpleUploadedFile("facilities.csv", self.CSV.encode('utf-8'), content_type='text/csv')
+        response = client.post(reverse('facility-import'), {'file': upload})
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        # 本体をそのまま送る場合も、CSRFの検査で本体を読み切らない
+        response = client.generic(
+            'POST', reverse('facility-import') + '?dry_run=true', self.CSV.encode(), content_type='text/csv'
+        )
+        self.assertEqual((response.status_code, response.data['created']), (status.HTTP_207_MULTI_STATUS, 2))
+
+    def test_invalid_input(self):
+        response = self.post_body("facility_name,unknown\nA,1\n", 'text/csv')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("unknown", response.data['error'])
+
+        response = self.post_body("facility_name\nA\n", 'application/xml')
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+        response = self.client.generic('POST', reverse('facility-import'), b"facility_name\n\xff\n", content_type='text/csv')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("UTF-8", response.data['error'])
+
+    def test_export_round_trip(self):
+        self.post_body(self.CSV, 'text/csv')
+        response = self.client.get(reverse('facility-export'), {'output': 'csv'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertIn('filename="facilities.csv"', response['Content-Disposition'])
+        body = b"".join(response.streaming_content)
+        self.assertTrue(body.startswith(b"\xef\xbb\xbfid,facility_name,"))
+        rows = list(csv.DictReader(io.StringIO(body.decode('utf-8-sig'))))
+        self.assertEqual([row['facility_name'] for row in rows], ["町家A", "町家\nC"])
+        self.assertEqual(rows[0]['amenities'], "Wi-Fi|駐車場")
+
+        # 出力をそのまま取り込み直せる
+        Facility.objects.all().delete()
+        response = self.post_body(body.decode('utf-8'), 'text/csv')
+        self.assertEqual((response.status_code, response.data['created']), (status.HTTP_201_CREATED, 2))
+        self.assertEqual(
+            sorted(Facility.objects.get(facility_name="町家A").amenities.values_list('name', flat=True)), ["Wi-Fi", "駐車場"]
+        )
+
+    def test_export_jsonl_is_filtered_and_batched(self):
+        for capacity in range(1, 6):
+            Facility.objects.create(facility_name=f"施設{capacity}", capacity=capacity, address="住所").amenities.add(self.wifi)
+        response = self.client.get(reverse('facility-export'), {'output': 'jsonl', 'capacity__gte': 3})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['capacity'] for row in rows], [3, 4, 5])
+        self.assertEqual(rows[0]['amenities'], ["Wi-Fi"])
+
+        with CaptureQueriesContext(connection) as queries:
+            chunks = list(bulk.iter_export(Facility.objects.all(), 'jsonl', batch_size=2))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(len(queries), 6)
+
+        response = self.client.get(reverse('facility-export'), {'output': 'xml'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_export_streams_asynchronously_under_asgi(self):
+        await Facility.objects.acreate(facility_name="非同期", capacity=2, address="住所")
+        response = await AsyncClient().get('/api/facilities/export/', {'output': 'jsonl'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        body = b"".join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(json.loads(body)['facility_name'], "非同期")
+
+    def test_import_command(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'facilities.jsonl')
+        with open(path, 'w') as f:
+            f.write(json.dumps({'facility_name': "コマンド", 'address': "住所", 'amenities': ["Wi-Fi"]}) + "\n")
+            f.write(json.dumps({'address': "住所"}) + "\n")
+        out, err = io.StringIO(), io.StringIO()
+        call_command('import_facilities', path, '--chunk-size', '1', stdout=out, stderr=err)
+        self.assertIn("1 facilities created, 1 failed", out.getvalue())
+        self.assertIn("Line 2:", err.getvalue())
+        self.assertEqual(list(Facility.objects.get(facility_name="コマンド").amenities.all()), [self.wifi])
+
+
+class BulkUpdateDeleteTest(APITestCase):
+    """施設の一括更新・一括削除 (PATCH / DELETE /api/facilities/bulk/)"""
+
+    def setUp(self):
+        payload_cache.clear()
+        self.wifi = Amenity.objects.create(name="Wi-Fi")
+        self.parking = Amenity.objects.create(name="駐車場")
+        self.facilities = [
+            Facility.objects.create(facility_name=f"一括{i}", capacity=2, address="住所") for i in range(3)
+        ]
+        self.facilities[0].amenities.add(self.wifi)
+        self.ids = [facility.pk for facility in self.facilities]
+
+    def patch(self, data):
+        return self.client.patch(reverse('facility-bulk'), data, format='json')
+
+    def test_update_values(self):
+        self.client.get(reverse('facility-list'))   # キャッシュに載せる
+        versions = dict(Facility.objects.values_list('pk', 'version'))
+        response = self.patch({'ids': [*self.ids, 999999], 'values': {'management_entity': 'CM', 'capacity': 6}})
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(response.data['counts'], {'updated': 3, 'not_found': 1})
+        self.assertEqual(response.data['results'][-1], {'id': 999999, 'status': 'not_found'})
+
+        for facility in Facility.objects.filter(pk__in=self.ids):
+            self.assertEqual((facility.management_entity, facility.capacity), ('CM', 6))
+            self.assertEqual(facility.version, versions[facility.pk] + 1)
+        # キャッシュ済みのペイロードも新しい値になる
+        data = self.client.get(reverse('facility-list')).json()
+        self.assertEqual({item['management_entity'] for item in data}, {'CM'})
+
+    def test_query_count_does_not_grow_with_ids(self):
+        def update(ids):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.patch({'ids': ids, 'values': {'num_parking': 1}, 'add_amenities': [self.parking.pk]})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return len(queries)
+
+        many = [Facility.objects.create(facility_name=f"追加{i}", address="住所").pk for i in range(20)]
+        self.assertEqual(update(self.ids[:1]), update(many))
+
+    def test_add_and_remove_amenities(self):
+        response = self.patch({'ids': self.ids, 'add_amenities': [self.wifi.pk, self.parking.pk]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [result['amenities_added'] for result in response.data['results']], [1, 2, 2]
+        )
+        self.assertEqual(Facility.amenities.through.objects.filter(facility_id__in=self.ids).count(), 6)
+
+        versions = dict(Facility.objects.values_list('pk', 'version'))
+        response = self.patch({'ids': self.ids, 'remove_amenities': [self.parking.pk]})
+        self.assertEqual(response.data['counts'], {'updated': 3})
+        self.assertEqual(list(self.facilities[0].amenities.all()), [self.wifi])
+
+        # 変更のない施設はバージョンを進めない
+        response = self.patch({'ids': self.ids, 'remove_amenities': [self.parking.pk]})
+        self.assertEqual(response.data['counts'], {'unchanged': 3})
+        self.assertEqual(
+            dict(Facility.objects.values_list('pk', 'version')), {pk: version + 1 for pk, version in versions.items()}
+        )
+
+    def test_search_index_follows_renames(self):
+        self.patch({'ids': self.ids[:1], 'values': {'facility_name': "改名した町家"}})
+        self.assertEqual(search.search("改名"), self.ids[:1])
+
+    def test_validation(self):
+        cases = [
+            ({'ids': self.ids}, 'non_field_errors'),
+            ({'ids': [], 'values': {'capacity': 3}}, 'ids'),
+            ({'ids': self.ids, 'values': {'capacity': 30}}, 'values'),
+            ({'ids': self.ids, 'values': {'version': 3}}, 'values'),
+            ({'ids': self.ids, 'add_amenities': [999999]}, 'add_amenities'),
+            ({'ids': self.ids, 'add_amenities': [self.wifi.pk], 'remove_amenities': [self.wifi.pk]}, 'remove_amenities'),
+        ]
+        for data, field in cases:
+            with self.subTest(data=data):
+                response = self.patch(data)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn(field, response.data)
+        self.assertIn('capacity', self.patch(cases[2][0]).data['values'])
+
+        with override_settings(FACILITIES_BULK_MAX_IDS=2):
+            self.assertEqual(self.patch({'ids': self.ids, 'values': {'capacity': 3}}).status_code, 400)
+        self.assertEqual(self.patch({'ids': [999999], 'values': {'capacity': 3}}).status_code, 404)
+
+    def test_bulk_delete_cascades(self):
+        facility = self.facilities[0]
+        for i in range(3):
+            FacilityImage.objects.create(facility=facility, image=f"facilities/images/{i}.jpg")
+        FacilityAvailability.objects.create(facility=facility, year=2026, nights=bytes(46))
+        Beds24SyncState.objects.create(facility=facility)
+        self.client.get(reverse('facility-list'))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.delete(reverse('facility-bulk'), {'ids': [*self.ids[:2], 999999]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(response.data['results'], [
+            {'id': self.ids[0], 'status': 'deleted', 'images': 3},
+            {'id': self.ids[1], 'status': 'deleted', 'images': 0},
+            {'id': 999999, 'status': 'not_found'},
+        ])
+        # 画像の数に関わらず、関連するテーブルごとに1回のDELETE
+        # (セーブポイント2 + 対象と画像のID2 + DELETE5 + 索引1 + 削除の記録1 + ファイルの参照数1)
+        self.assertEqual(len(queries), 12)
+
+        self.assertEqual(list(Facility.objects.values_list('pk', flat=True)), self.ids[2:])
+        self.assertFalse(FacilityImage.objects.exists())
+        self.assertFalse(FacilityAvailability.objects.exists())
+        self.assertFalse(Beds24SyncState.objects.exists())
+        self.assertFalse(Facility.amenities.through.objects.filter(facility_id__in=self.ids[:2]).exists())
+        self.assertEqual(search.search("一括"), self.ids[2:])
+        self.assertEqual([item['id'] for item in self.client.get(reverse('facility-list')).json()], self.ids[2:])
+        self.assertEqual(Tombstone.objects.filter(kind='image').count(), 3)
+        self.assertEqual(
+            sorted(Tombstone.objects.filter(kind='facility').values_list('object_id', flat=True)), self.ids[:2]
+        )
+
+    def test_delete_rows_sends_no_signals(self):
+        deleted = []
+
+        def receiver(sender, instance, **kwargs):
+            deleted.append(instance.pk)
+
+        post_delete.connect(receiver, sender=Facility)
+        self.addCleanup(post_delete.disconnect, receiver, sender=Facility)
+        Facility.amenities.through.objects.filter(facility_id__in=self.ids[:3]).delete()
+
+        with self.assertNumQueries(3):
+            bulk.delete_rows(Facility, 'id', self.ids[:3], batch_size=1)
+        self.assertEqual(list(Facility.objects.values_list('pk', flat=True)), self.ids[3:])
+        self.assertEqual(deleted, [])
+
+    def test_bulk_delete_covers_every_relation(self):
+        # 施設を参照するモデルが増えたら facilities.bulk.delete_facilities() にも追加する
+        related = {relation.related_model for relation in Facility._meta.related_objects}
+        self.assertEqual(related, {FacilityImage, FacilityAvailability, Beds24SyncState})
+
+
+@override_settings(FACILITIES_CHANGE_FEED_LAG=0)
+class ChangeFeedTest(APITestCase):
+    """変更フィード (GET /api/changes/)"""
+
+    def setUp(self):
+        self.wifi = Amenity.objects.create(name="Wi-Fi")
+        self.facilities = []
+        for i in range(3):
+            facility = Facility.objects.create(facility_name=f"フィード{i}", capacity=2, address="住所")
+            facility.amenities.add(self.wifi)
+            self.facilities.append(facility)
+
+    def feed(self, since=None, **params):
+        if since is not None:
+            params['updated_since'] = since
+        response = self.client.get(reverse('change-feed'), params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def sync(self, since=None, limit=500):
+        """has_more がなくなるまでたどり、(変更のリスト, 最後のトークン) を返す"""
+        collected = []
+        while True:
+            data = self.feed(since, limit=limit)
+            collected += data['changes']
+            since = data['next_since']
+            if not data['has_more']:
+                return collected, since
+
+    def test_initial_sync_returns_everything(self):
+        changes_, _ = self.sync()
+        self.assertEqual(
+            sorted((change['type'], change['id']) for change in changes_),
+            sorted([('amenity', self.wifi.pk), *(('facility', facility.pk) for facility in self.facilities)]),
+        )
+        facility = next(change for change in changes_ if change['type'] == 'facility')
+        detail = self.client.get(reverse('facility-detail', kwargs={'pk': facility['id']})).json()
+        self.assertEqual(facility['data'], detail)
+
+    def test_only_changes_after_the_token_are_returned(self):
+        _, since = self.sync()
+        self.assertEqual(self.feed(since)['changes'], [])
+
+        self.client.patch(
+            reverse('facility-detail', kwargs={'pk': self.facilities[1].pk}), {'capacity': 5}, format='json'
+        )
+        image = FacilityImage.objects.create(facility=self.facilities[2], image="facilities/images/a.jpg", caption="外観")
+        self.client.delete(reverse('facility-detail', kwargs={'pk': self.facilities[0].pk}))
+        Amenity.objects.create(name="暖房")
+
+        data = self.feed(since)
+        self.assertFalse(data['has_more'])
+        summary = [(change['type'], change['id'], change['action']) for change in data['changes']]
+        self.assertEqual(summary, [
+            ('facility', self.facilities[1].pk, 'upserted'),
+            # 画像を登録すると施設のバージョンも進む
+            ('image', image.pk, 'upserted'),
+            ('facility', self.facilities[2].pk, 'upserted'),
+            ('facility', self.facilities[0].pk, 'deleted'),
+            ('amenity', Amenity.objects.get(name="暖房").pk, 'upserted'),
+        ])
+        self.assertEqual(data['changes'][0]['data']['capacity'], 5)
+        self.assertEqual(data['changes'][1]['facility'], self.facilities[2].pk)
+        self.assertEqual(data['changes'][1]['data']['caption'], "外観")
+
+        # トークンは単調に進み、同じ変更を二度返さない
+        self.assertGreater(
+            changes.parse_since(data['next_since']), changes.parse_since(since)
+        )
+        self.assertEqual(self.feed(data['next_since'])['changes'], [])
+
+    def test_batches_do_not_skip_changes_with_the_same_timestamp(self):
+        now = timezone.now()
+        Facility.objects.update(updated_at=now)
+        Amenity.objects.update(updated_at=now)
+        collected, _ = self.sync(limit=1)
+        self.assertEqual(len(collected), 4)
+        self.assertEqual(len({(change['type'], change['id']) for change in collected}), 4)
+
+    def test_query_count_depends_on_changes_not_portfolio(self):
+        _, since = self.sync()
+        for i in range(30):
+            Facility.objects.create(facility_name=f"追加{i}", address="住所")
+        _, since = self.sync(since)
+        Facility.objects.filter(pk=self.facilities[0].pk).touch()
+        with CaptureQueriesContext(connection) as queries:
+            data = self.feed(since)
+        self.assertEqual(len(data['changes']), 1)
+        self.assertEqual(len(queries), 7)
+
+    def test_recent_changes_wait_for_the_lag(self):
+        with override_settings(FACILITIES_CHANGE_FEED_LAG=60):
+            data = self.feed()
+            self.assertEqual(data['changes'], [])
+            # 遅らせた分のトークンから取得すれば、後で取りこぼさない
+            since = data['next_since']
+        self.assertEqual(len(self.feed(since)['changes']), 4)
+
+    def test_bulk_operations_appear_in_the_feed(self):
+        _, since = self.sync()
+        self.client.patch(reverse('facility-bulk'), {'ids': [self.facilities[0].pk], 'values': {'capacity': 4}}, format='json')
+        self.client.delete(reverse('facility-bulk'), {'ids': [self.facilities[1].pk]}, format='json')
+        summary = [(change['type'], change['id'], change['action']) for change in self.feed(since)['changes']]
+        self.assertEqual(summary, [
+            ('facility', self.facilities[0].pk, 'upserted'), ('facility', self.facilities[1].pk, 'deleted'),
+        ])
+
+    def test_iso_timestamp_and_invalid_tokens(self):
+        later = timezone.now()
+        Facility.objects.filter(pk=self.facilities[0].pk).touch()
+        data = self.feed(later.isoformat())
+        self.assertEqual([change['id'] for change in data['changes']], [self.facilities[0].pk])
+
+        for value in ['abc', '1.9.1', '2026-13-01']:
+            response = self.client.get(reverse('change-feed'), {'updated_since': value})
+            self.assertEqual(response.status_code, 400, value)
+
+    def test_old_tokens_require_resync(self):
+        old = timezone.now() - datetime.timedelta(days=31)
+        response = self.client.get(reverse('change-feed'), {'updated_since': old.isoformat()})
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+        self.assertTrue(response.json()['resync'])
+
+        Tombstone.objects.create(kind='facility', object_id=1, deleted_at=old)
+        Tombstone.objects.create(kind='facility', object_id=2)
+        out = io.StringIO()
+        call_command('prune_tombstones', stdout=out)
+        self.assertIn("Pruned 1 tombstones", out.getvalue())
+        self.assertEqual(list(Tombstone.objects.values_list('object_id', flat=True)), [2])
+
+
+class EventStreamTest(TestCase):
+    """変更のイベントの配信 (facilities.events、GET /api/events/)"""
+
+    def setUp(self):
+        self.broker = events.get_broker()
+
+    def decode(self, messages):
+        """SSEのメッセージから data のJSONを取り出す"""
+        data = b''.join(messages).decode()
+        return [json.loads(line[len('data: '):]) for line in data.splitlines() if line.startswith('data: {"')]
+
+    async def receive(self, subscription, timeout=1):
+        messages, overflowed = await subscription.get(timeout)
+        self.assertFalse(overflowed)
+        return self.decode(messages)
+
+    async def test_broker_delivers_to_matching_subscribers(self):
+        broker = events.LocalBroker()
+        everything = broker.subscribe()
+        one_facility = broker.subscribe(facility=5)
+        amenities = broker.subscribe(types=['amenity'])
+        published = [
+            events.facility_event(5, 'updated', 3),
+            events.facility_event(6, 'updated', 1),
+            events.image_event(7, 'created', 5),
+            events.amenity_event(1, 'deleted'),
+        ]
+        broker.publish(published)
+
+        self.assertEqual(await self.receive(everything), published)
+        self.assertEqual(await self.receive(one_facility), [published[0], published[2]])
+        self.assertEqual(await self.receive(amenities), [published[3]])
+        self.assertEqual(await self.receive(amenities, timeout=0.01), [])
+        for subscription in (everything, one_facility, amenities):
+            subscription.close()
+        self.assertFalse(broker.has_subscribers())
+
+    async def test_publish_from_another_thread(self):
+        broker = events.LocalBroker()
+        subscription = broker.subscribe()
+        await asyncio.to_thread(broker.publish, [events.amenity_event(1, 'created')])
+        self.assertEqual(await self.receive(subscription), [events.amenity_event(1, 'created')])
+        subscription.close()
+
+    async def test_overflow_drops_queued_events_and_requests_resync(self):
+        broker = events.LocalBroker()
+        subscription = broker.subscribe(max_queue=2)
+        broker.publish([events.amenity_event(pk, 'created') for pk in range(1, 4)])
+        messages, overflowed = await subscription.get(1)
+        self.assertTrue(overflowed)
+        self.assertEqual(self.decode(messages), [events.amenity_event(3, 'created')])
+        subscription.close()
+
+    def test_nothing_is_scheduled_without_subscribers(self):
+        self.assertFalse(self.broker.has_subscribers())
+        with self.captureOnCommitCallbacks() as callbacks:
+            Amenity.objects.create(name="Wi-Fi")
+            events.publish_facilities([1, 2])
+        self.assertEqual(callbacks, [])
+
+    async def test_model_changes_are_published_after_commit(self):
+        subscription = self.broker.subscribe()
+
+        def write():
+            with self.captureOnCommitCallbacks(execute=True):
+                facility = Facility.objects.create(facility_name="イベント", capacity=2, address="住所")
+            with self.captureOnCommitCallbacks(execute=True):
+                amenity = Amenity.objects.create(name="Wi-Fi")
+                facility.amenities.add(amenity)
+            amenity_id = amenity.pk
+            with self.captureOnCommitCallbacks(execute=True):
+                amenity.delete()
+            return facility.pk, amenity_id
+
+        try:
+            facility_id, amenity_id = await sync_to_async(write)()
+            received = await self.receive(subscription)
+        finally:
+            subscription.close()
+        self.assertEqual(received, [
+            {'type': 'facility', 'id': facility_id, 'action': 'created', 'version': 1},
+            {'type': 'amenity', 'id': amenity_id, 'action': 'created'},
+            {'type': 'facility', 'id': facility_id, 'action': 'updated', 'version': 2},
+            {'type': 'facility', 'id': facility_id, 'action': 'updated', 'version': 3},
+            {'type': 'amenity', 'id': amenity_id, 'action': 'deleted'},
+        ])
+
+    def test_payload_carries_the_event_version(self):
+        # クライアントは読み込んだ施設のバージョンより新しいイベントだけで取り直す
+        payload_cache.clear()
+        facility = Facility.objects.create(facility_name="バージョン", capacity=2, address="住所")
+        Facility.objects.filter(pk=facility.pk).touch()
+        response = self.client.get(reverse('facility-detail', kwargs={'pk': facility.pk}))
+        self.assertEqual(response.data['version'], 2)
+
+    @override_settings(FACILITIES_TASKS_EAGER=True)
+    async def test_bulk_changes_are_published(self):
+        subscription = self.broker.subscribe()
+
+        def write():
+            facility = Facility.objects.create(facility_name="一括", capacity=2, address="住所")
+            image = FacilityImage.objects.create(facility=facility, image='facilities/images/a.jpg')
+            with self.captureOnCommitCallbacks(execute=True):
+                bulk.update_facilities([facility.pk], {'capacity': 4})
+            with self.captureOnCommitCallbacks(execute=True):
+                bulk.delete_facilities([facility.pk])
+            return facility.pk, image.pk, Facility.objects.filter(pk=facility.pk).exists()
+
+        try:
+            facility_id, image_id, _ = await sync_to_async(write)()
+            received = await self.receive(subscription)
+        finally:
+            subscription.close()
+        self.assertEqual(received, [
+            {'type': 'facility', 'id': facility_id, 'action': 'updated', 'version': 3},
+            {'type': 'image', 'id': image_id, 'action': 'deleted', 'facility': facility_id},
+            {'type': 'facility', 'id': facility_id, 'action': 'deleted'},
+        ])
+
+    @override_settings(ROOT_URLCONF='config.asgi_urls', FACILITIES_EVENTS_KEEPALIVE=0.05)
+    async def test_stream_until_the_client_disconnects(self):
+        # ASGIサーバーと同じ呼び出し方で、切断(http.disconnect)まで確認する
+        sent, disconnected = asyncio.Queue(), asyncio.Event()
+
+        async def receive():
+            if not hasattr(receive, 'started'):
+                receive.started = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': '/api/events/', 'raw_path': b'/api/events/', 'query_string': b'facility=5', 'root_path': '',
+            'headers': [(b'host', b'testserver')], 'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+        }
+        server = asyncio.create_task(ASGIHandler()(scope, receive, sent.put))
+        start = await asyncio.wait_for(sent.get(), 5)
+        self.assertEqual(start['status'], 200)
+        headers = dict(start['headers'])
+        self.assertEqual(headers[b'Content-Type'], b'text/event-stream')
+        self.assertEqual(headers[b'Cache-Control'], b'no-cache')
+        self.assertEqual((await sent.get())['body'], b"retry: 3000\nevent: resync\ndata: {}\n\n")
+
+        self.broker.publish([events.facility_event(4, 'updated', 2), events.facility_event(5, 'updated', 2)])
+        self.assertEqual(
+            (await sent.get())['body'],
+            b'event: facility\ndata: {"type":"facility","id":5,"action":"updated","version":2}\n\n',
+        )
+        self.assertEqual((await sent.get())['body'], b": keep-alive\n\n")
+        self.assertEqual(self.broker.count(), 1)
+
+        disconnected.set()
+        await asyncio.wait_for(server, 5)
+        self.assertEqual(self.broker.count(), 0)
+
+    @override_settings(ROOT_URLCONF='config.asgi_urls', FACILITIES_EVENTS_MAX_CONNECTIONS=0)
+    async def test_invalid_filters_and_connection_limit(self):
+        client = AsyncClient()
+        self.assertEqual((await client.get('/api/events/', {'types': 'facility,room'})).status_code, 400)
+        self.assertEqual((await client.get('/api/events/', {'facility': 'x'})).status_code, 400)
+        response = await client.get('/api/events/')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '10')
+
+
+class ConditionalGetTest(APITestCase):
+
+    def setUp(self):
+        self.facility = create_facilities_with_relations(2)[0]
+        self.detail_url = reverse('facility-detail', kwargs={'pk': self.facility.pk})
+
+    def assertNotModified(self, url):
+        etag = self.client.get(url).headers['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.headers['ETag'], etag)
+        return etag
+
+    def assertModifiedSince(self, url, etag):
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_detail_not_modified(self):
+        """変更がなければ、施設を読み込まずに304を返す"""
+        self.assertNotModified(self.detail_url)
+
+    def test_detail_changes_on_update(self):
+        etag = self.assertNotModified(self.detail_url)
+        self.client.patch(self.detail_url, {'capacity': 5}, format='json')
+        self.assertModifiedSince(self.detail_url, etag)
+
+    def test_detail_changes_on_image_and_amenity_changes(self):
+        etag = self.assertNotModified(self.detail_url)
+        FacilityImage.objects.create(facility=self.facility, image='facilities/images/new.jpg')
+        self.assertModifiedSince(self.detail_url, etag)
+
+        etag = self.assertNotModified(self.detail_url)
+        amenity = self.facility.amenities.first()
+        amenity.name = "名前変更"
+        amenity.save()
+        self.assertModifiedSince(self.detail_url, etag)
+
+        etag = self.assertNotModified(self.detail_url)
+        self.facility.amenities.remove(amenity)
+        self.assertModifiedSince(self.detail_url, etag)
+
+        etag = self.assertNotModified(self.detail_url)
+        self.facility.amenities.first().delete()
+        self.assertModifiedSince(self.detail_url, etag)
+
+    def test_if_modified_since(self):
+        last_modified = self.client.get(self.detail_url).headers['Last-Modified']
+        response = self.client.get(self.detail_url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_list_validator(self):
+        """一覧にもコレクション単位のETagが付き、削除で変わる"""
+        url = reverse('facility-list')
+        etag = self.assertNotModified(url)
+        self.facility.delete()
+        self.assertModifiedSince(url, etag)
+
+    def test_list_etag_depends_on_page(self):
+        first = self.client.get(reverse('facility-list') + '?page_size=1')
+        second = self.client.get(first.data['next'])
+        self.assertNotEqual(first.headers['ETag'], second.headers['ETag'])
+
+    def test_amenity_list_validator(self):
+        url = reverse('amenity-list')
+        etag = self.assertNotModified(url)
+        self.client.post(url, {'name': '新しいアメニティ'}, format='json')
+        self.assertModifiedSince(url, etag)
+
+    def test_missing_facility_returns_404(self):
+        response = self.client.get(reverse('facility-detail', kwargs={'pk': 9999}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_non_integer_pk_returns_404(self):
+        for name in ('facility-detail', 'amenity-detail'):
+            response = self.client.get(reverse(name, kwargs={'pk': 'abc'}))
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class PayloadCacheTest(APITestCase):
+
+    def setUp(self):
+        payload_cache.clear()
+        self.facility = create_facilities_with_relations(3)[0]
+        self.list_url = reverse('facility-list')
+        self.detail_url = reverse('facility-detail', kwargs={'pk': self.facility.pk})
+
+    def get_facility_payload(self):
+        response = self.client.get(self.list_url)
+        return next(item for item in response.data if item['id'] == self.facility.pk)
+
+    def test_hits_and_misses_are_counted(self):
+        self.client.get(self.list_url)
+        self.assertEqual(payload_cache.stats.snapshot()['misses'], 3)
+        self.client.get(self.list_url)
+        self.client.get(self.detail_url)
+        snapshot = payload_cache.stats.snapshot()
+        self.assertEqual(snapshot['hits'], 4)
+        self.assertEqual(snapshot['sets'], 3)
+
+    def test_invalidated_on_facility_update(self):
+        self.get_facility_payload()
+        self.client.patch(self.detail_url, {'facility_name': '新しい名前'}, format='json')
+        self.assertEqual(self.get_facility_payload()['facility_name'], '新しい名前')
+
+    def test_invalidated_on_amenity_changes(self):
+        amenity = self.facility.amenities.first()
+        self.get_facility_payload()
+        amenity.name = '名前変更'
+        amenity.save()
+        self.assertIn('名前変更', [a['name'] for a in self.get_facility_payload()['amenities']])
+
+        self.facility.amenities.remove(amenity)
+        self.assertNotIn(amenity.pk, [a['id'] for a in self.get_facility_payload()['amenities']])
+
+    def test_invalidated_on_image_changes(self):
+        self.get_facility_payload()
+        image = FacilityImage.objects.create(facility=self.facility, image='facilities/images/new.jpg')
+        self.assertEqual(len(self.get_facility_payload()['images']), 3)
+        image.delete()
+        self.assertEqual(len(self.get_facility_payload()['images']), 2)
+
+    def test_invalidation_only_touches_affected_facilities(self):
+        self.client.get(self.list_url)
+        FacilityImage.objects.create(facility=self.facility, image='facilities/images/new.jpg')
+        payload_cache.stats.reset()
+        self.client.get(self.list_url)
+        snapshot = payload_cache.stats.snapshot()
+        self.assertEqual((snapshot['hits'], snapshot['misses']), (2, 1))
+
+    @override_settings(CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'facilities': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'facility-payloads-test',
+            'OPTIONS': {'MAX_ENTRIES': 2, 'CULL_FREQUENCY': 2},
+        },
+    })
+    def test_entries_are_limited(self):
+        self.client.get(self.list_url)
+        payload_cache.stats.reset()
+        self.client.get(self.list_url)
+        self.assertGreater(payload_cache.stats.snapshot()['misses'], 0)
+
+    def test_metrics_endpoint(self):
+        self.client.get(self.list_url)
+        response = self.client.get(reverse('cache-metrics'))
+        self.assertContains(response, 'facilities_payload_cache_misses_total 3')
+
+
+def make_test_image(name='photo.jpg', size=(1600, 1200), fmt='JPEG', color=(200, 120, 40)):
+    """テスト用の画像ファイル(アップロード形式)を作る"""
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, format=fmt)
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type=f'image/{fmt.lower()}')
+
+
+def session_client():
+    """ログイン済みでCSRFの検査を行うクライアント (ブラウザからのセッション認証と同じ経路)"""
+    client = Client(enforce_csrf_checks=True, headers={'X-CSRFToken': 'x' * 32})
+    client.force_login(get_user_model().objects.create_user('editor', password='password'))
+    client.cookies['csrftoken'] = 'x' * 32
+    return client
+
+
+class TemporaryMediaMixin:
+    """MEDIA_ROOTを一時ディレクトリに差し替え、派生画像の生成などを同期実行する"""
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root, FACILITIES_TASKS_EAGER=True)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.media_root = media_root
+
+
+class ImageVariantTest(TemporaryMediaMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.facility = Facility.objects.create(facility_name="画像施設", capacity=2, address="住所")
+
+    def upload(self, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('facilityimage-list'),
+                {'facility': self.facility.pk, 'image': make_test_image(**kwargs), 'caption': '外観'},
+                format='multipart',
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return FacilityImage.objects.get(pk=response.data['id'])
+
+    def test_variants_are_generated_after_upload(self):
+        image = self.upload()
+        self.assertEqual(
+            sorted((v['width'], v['format']) for v in image.variants),
+            [(320, 'jpeg'), (320, 'webp'), (640, 'jpeg'), (640, 'webp'), (1280, 'jpeg'), (1280, 'webp')],
+        )
+        for variant in image.variants:
+            self.assertTrue(os.path.exists(os.path.join(self.media_root, variant['name'])))
+            self.assertEqual(os.path.dirname(variant['name']), os.path.dirname(image.image.name))
+        self.assertEqual(image.variants[0]['height'], 240)
+
+    def test_small_images_are_not_upscaled(self):
+        image = self.upload(size=(200, 100))
+        self.assertEqual({v['width'] for v in image.variants}, {200})
+
+    def test_serializer_exposes_srcset(self):
+        self.upload()
+        response = self.client.get(reverse('facility-detail', kwargs={'pk': self.facility.pk}))
+        image = response.data['images'][0]
+        self.assertEqual(len(image['variants']), 6)
+        self.assertTrue(image['variants'][0]['url'].startswith('http://testserver/media/facilities/images/'))
+        self.assertRegex(image['srcset']['webp'], r'__w320\.[0-9a-f]{12}\.webp 320w, .*__w640\.[0-9a-f]{12}\.webp 640w, .*__w1280\.[0-9a-f]{12}\.webp 1280w$')
+
+    def test_regeneration_is_idempotent(self):
+        image = self.upload()
+        paths = [os.path.join(self.media_root, v['name']) for v in image.variants]
+        mtimes = [os.stat(p).st_mtime_ns for p in paths]
+        self.assertEqual(generate_variants(image.pk), image.variants)
+        self.assertEqual(mtimes, [os.stat(p).st_mtime_ns for p in paths])
+
+        # 作り直しても同じ名前で上書きされ、ファイルは増えない
+        regenerated = generate_variants(image.pk, force=True)
+        self.assertEqual([v['name'] for v in regenerated], [v['name'] for v in image.variants])
+        self.assertEqual(len(os.listdir(os.path.dirname(paths[0]))), 7)
+
+    def test_backfill_command(self):
+        image = self.upload()
+        FacilityImage.objects.filter(pk=image.pk).update(variants=[])
+        FacilityImage.objects.create(facility=self.facility, image='facilities/images/missing.jpg')
+
+        out, err = io.StringIO(), io.StringIO()
+        call_command('generate_image_variants', stdout=out, stderr=err)
+        self.assertIn('1 images processed, 1 skipped', out.getvalue())
+        image.refresh_from_db()
+        self.assertEqual(len(image.variants), 6)
+
+
+class MediaDeliveryTest(TemporaryMediaMixin, APITestCase):
+    """MEDIA_URL の配信 (facilities.media)。テストはDEBUG=Falseで実行される"""
+
+    def setUp(self):
+        super().setUp()
+        self.facility = Facility.objects.create(facility_name="配信施設", capacity=2, address="住所")
+
+    def upload(self, name='photo.jpg'):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('facilityimage-list'),
+                {'facility': self.facility.pk, 'image': make_test_image(name, size=(400, 300))},
+                format='multipart',
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return FacilityImage.objects.get(pk=response.data['id'])
+
+    def write_file(self, name, content):
+        path = os.path.join(self.media_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def read(self, name):
+        with open(os.path.join(self.media_root, name), 'rb') as f:
+            return f.read()
+
+    def get(self, name, **headers):
+        return self.client.get(reverse('media', kwargs={'path': name}), headers=headers)
+
+    def test_uploaded_files_have_content_hashed_names(self):
+        first, second = self.upload(), self.upload()
+        self.assertRegex(first.image.name, r'^facilities/images/photo\.[0-9a-f]{12}\.jpg$')
+        # 同じ中身のファイルは1つだけ保存し、派生画像も共有する
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertEqual(first.variants, second.variants)
+        for variant in first.variants:
+            self.assertEqual(storage.name_hash(variant['name']), storage.content_hash(ContentFile(self.read(variant['name']))))
+
+    def test_hashed_files_are_cached_forever(self):
+        image = self.upload()
+        response = self.get(image.image.name)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsInstance(response, FileResponse)
+        self.assertEqual(b''.join(response.streaming_content), self.read(image.image.name))
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['ETag'], f'"{storage.name_hash(image.image.name)}"')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(
+            sorted(response['Cache-Control'].split(', ')), ['immutable', 'max-age=31536000', 'public']
+        )
+
+    def test_conditional_requests(self):
+        image = self.upload()
+        response = self.get(image.image.name)
+        not_modified = self.get(image.image.name, if_none_match=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['Cache-Control'], response['Cache-Control'])
+        since = self.get(image.image.name, if_modified_since=response['Last-Modified'])
+        self.assertEqual(since.status_code, 304)
+        self.assertEqual(self.get(image.image.name, if_match='"other"').status_code, 412)
+
+    def test_range_requests(self):
+        content = bytes(range(256)) * 4
+        self.write_file('facilities/images/data.0123456789ab.bin', content)
+        name = 'facilities/images/data.0123456789ab.bin'
+
+        response = self.get(name, range='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 100-199/1024')
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertEqual(b''.join(response.streaming_content), content[100:200])
+
+        suffix = self.get(name, range='bytes=-24')
+        self.assertEqual(b''.join(suffix.streaming_content), content[-24:])
+        self.assertEqual(suffix['Content-Range'], 'bytes 1000-1023/1024')
+
+        open_ended = self.get(name, range='bytes=1000-')
+        self.assertEqual(b''.join(open_ended.streaming_content), content[1000:])
+
+        unsatisfiable = self.get(name, range='bytes=2000-')
+        self.assertEqual(unsatisfiable.status_code, 416)
+        self.assertEqual(unsatisfiable['Content-Range'], 'bytes */1024')
+
+        # 複数の範囲・If-Range が一致しない場合はファイル全体を返す
+        self.assertEqual(self.get(name, range='bytes=0-1,5-6').status_code, 200)
+        stale = self.get(name, range='bytes=0-9', if_range='"fedcba987654"')
+        self.assertEqual(stale.status_code, 200)
+        self.assertEqual(b''.join(stale.streaming_content), content)
+        self.assertEqual(self.get(name, range='bytes=0-9', if_range='"0123456789ab"').status_code, 206)
+
+    def test_unhashed_files_are_revalidated(self):
+        self.write_file('facilities/images/legacy.jpg', b'legacy')
+        response = self.get('facilities/images/legacy.jpg')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(response['Cache-Control'].split(', ')), ['no-cache', 'public'])
+        self.assertEqual(self.get('facilities/images/legacy.jpg', if_none_match=response['ETag']).status_code, 304)
+
+    def test_missing_and_unsafe_paths(self):
+        self.write_file('facilities/images/a.jpg', b'a')
+        self.assertEqual(self.get('facilities/images/missing.jpg').status_code, 404)
+        self.assertEqual(self.get('facilities/images').status_code, 404)
+        self.assertEqual(self.client.get('/media/../config/settings.py').status_code, 404)
+        self.assertEqual(self.get('facilities/../../etc/passwd').status_code, 404)
+        self.assertEqual(self.client.post(reverse('media', kwargs={'path': 'facilities/images/a.jpg'})).status_code, 405)
+
+    def test_head_request(self):
+        self.write_file('facilities/images/a.0123456789ab.jpg', b'0123456789')
+        response = self.client.head(reverse('media', kwargs={'path': 'facilities/images/a.0123456789ab.jpg'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(response.content, b'')
+
+    @parameterized.expand([
+        ('x-accel-redirect', 'X-Accel-Redirect', '/protected-media/facilities/images/%E5%86%99%E7%9C%9F.0123456789ab.jpg'),
+        ('x-sendfile', 'X-Sendfile', None),
+    ])
+    def test_web_server_handoff(self, accel, header, expected):
+        path = self.write_file('facilities/images/写真.0123456789ab.jpg', b'photo')
+        with override_settings(FACILITIES_MEDIA_ACCEL=accel):
+            response = self.get('facilities/images/写真.0123456789ab.jpg', range='bytes=0-1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response[header], expected or escape_uri_path(path))
+        self.assertEqual(response.content, b'')
+        self.assertIn('immutable', response['Cache-Control'])
+
+    async def test_asgi_streams_without_reading_the_whole_file(self):
+        content = os.urandom(300 * 1024)
+        await sync_to_async(self.write_file)('facilities/images/big.0123456789ab.bin', content)
+        client = AsyncClient()
+        url = reverse('media', kwargs={'path': 'facilities/images/big.0123456789ab.bin'})
+
+        response = await client.get(url)
+        self.assertTrue(response.is_async)
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), content)
+        partial = await client.get(url, headers={'range': 'bytes=70000-70009'})
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(b''.join([chunk async for chunk in partial.streaming_content]), content[70000:70010])
+
+    def test_hash_image_names_command(self):
+        legacy = self.upload()
+        old = make_test_image(size=(400, 300), color=(1, 2, 3))
+        self.write_file('facilities/images/old.jpg', old.read())
+        FacilityImage.objects.filter(pk=legacy.pk).update(image='facilities/images/old.jpg', variants=[])
+
+        out = io.StringIO()
+        call_command('hash_image_names', stdout=out)
+        self.assertIn('1 images renamed, 0 skipped', out.getvalue())
+        legacy.refresh_from_db()
+        self.assertRegex(legacy.image.name, r'^facilities/images/old\.[0-9a-f]{12}\.jpg$')
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'facilities/images/old.jpg')))
+        self.assertTrue(legacy.variants)
+        self.assertTrue(all(storage.name_hash(v['name']) for v in legacy.variants))
+
+    def test_name_helpers(self):
+        self.assertEqual(storage.unhashed_name('a/photo.0123456789ab__w320.ba9876543210.webp'), 'a/photo.0123456789ab__w320.webp')
+        self.assertEqual(storage.unhashed_name('a/photo.0123456789ab_AbC1234.jpg'), 'a/photo.jpg')
+        self.assertEqual(storage.unhashed_name('a/photo__w320.webp'), 'a/photo__w320.webp')
+        self.assertIsNone(storage.name_hash('a/photo.jpg'))
+        self.assertEqual(
+            storage.HashedFileSystemStorage().hashed_name('a/' + 'x' * 40 + '.jpg', ContentFile(b'x'), max_length=30),
+            'a/' + 'x' * 11 + f".{storage.content_hash(ContentFile(b'x'))}.jpg",
+        )
+
+
+class MediaCleanupTest(TemporaryMediaMixin, APITestCase):
+    """画像のファイルの削除 (facilities.cleanup)"""
+
+    def setUp(self):
+        super().setUp()
+        self.facility = Facility.objects.create(facility_name="削除施設", capacity=2, address="住所")
+
+    def upload(self, facility=None, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('facilityimage-list'),
+                {'facility': (facility or self.facility).pk, 'image': make_test_image(size=(700, 500), **kwargs)},
+                format='multipart',
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return FacilityImage.objects.get(pk=response.data['id'])
+
+    def paths(self, image):
+        return [os.path.join(self.media_root, name) for name in cleanup.image_file_names(image.image.name, image.variants)]
+
+    def assertFilesExist(self, paths, exist=True):
+        self.assertEqual([os.path.exists(path) for path in paths], [exist] * len(paths))
+
+    def test_files_are_deleted_after_commit(self):
+        image = self.upload()
+        paths = self.paths(image)
+        self.assertEqual(len(paths), 5)     # 元画像 + 幅(320, 640) x 形式(webp, jpeg)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.delete(reverse('facilityimage-detail', kwargs={'pk': image.pk}))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        # リクエストの中では削除しない
+        self.assertFilesExist(paths)
+        for callback in callbacks:
+            callback()
+        self.assertFilesExist(paths, exist=False)
+
+    def test_rolled_back_deletion_keeps_files(self):
+        image = self.upload()
+        with self.captureOnCommitCallbacks() as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                image.delete()
+                raise RuntimeError
+        self.assertEqual(callbacks, [])
+        self.assertFilesExist(self.paths(image))
+
+    def test_facility_deletion_and_bulk_deletion_delete_image_files(self):
+        other = Facility.objects.create(facility_name="一括削除施設", capacity=2, address="住所")
+        first, second = self.upload(), self.upload(facility=other, color=(10, 20, 30))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(reverse('facility-detail', kwargs={'pk': self.facility.pk}))
+        self.assertFilesExist(self.paths(first), exist=False)
+        self.assertFilesExist(self.paths(second))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            bulk.delete_facilities([other.pk])
+        self.assertFilesExist(self.paths(second), exist=False)
+
+    def test_replacing_the_original_deletes_old_files(self):
+        image = self.upload()
+        old_paths = self.paths(image)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(
+                reverse('facilityimage-detail', kwargs={'pk': image.pk}),
+                {'image': make_test_image(size=(700, 500), color=(10, 20, 30))}, format='multipart',
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        image.refresh_from_db()
+        self.assertFilesExist(old_paths, exist=False)
+        self.assertFilesExist(self.paths(image))
+
+    def write_orphan(self, name, age):
+        path = os.path.join(self.media_root, 'facilities/images', name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * 100)
+        modified = time.time() - age
+        os.utime(path, (modified, modified))
+        return path
+
+    def test_collect_media_garbage(self):
+        image = self.upload()
+        old = self.write_orphan('old.0123456789ab__w320.0123456789ab.webp', age=2 * 60 * 60)
+        recent = self.write_orphan('uploading.0123456789ab.jpg', age=10)
+
+        out = io.StringIO()
+        call_command('collect_media_garbage', '--dry-run', stdout=out)
+        self.assertIn('facilities/images/old.0123456789ab__w320.0123456789ab.webp (100 bytes)', out.getvalue())
+        self.assertIn('Scanned 7 files: 1 orphaned', out.getvalue())
+        self.assertIn('1 skipped as newer than 3600s', out.getvalue())
+        self.assertTrue(os.path.exists(old))
+
+        out = io.StringIO()
+        call_command('collect_media_garbage', '--batch-size', '2', stdout=out)
+        self.assertIn('deleted 1 files, reclaimed 100 bytes', out.getvalue())
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(recent))
+        self.assertFilesExist(self.paths(image))
+
+        report = cleanup.collect_garbage(min_age=0, batch_size=2)
+        self.assertEqual((report.orphaned, report.deleted, report.reclaimed_bytes), (1, 1, 100))
+        self.assertFalse(os.path.exists(recent))
+        self.assertFilesExist(self.paths(image))
+
+    def test_identical_uploads_share_files_until_the_last_reference(self):
+        other = Facility.objects.create(facility_name="同じ写真の施設", capacity=2, address="住所")
+        first, second = self.upload(), self.upload(facility=other)
+        self.assertEqual((first.image.name, first.variants), (second.image.name, second.variants))
+        blob = FacilityImageBlob.objects.get(name=first.image.name)
+        self.assertEqual((blob.ref_count, blob.size), (2, os.path.getsize(self.paths(first)[0])))
+        self.assertEqual(len(blob.digest), 64)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(reverse('facilityimage-detail', kwargs={'pk': first.pk}))
+        self.assertFilesExist(self.paths(second))
+        self.assertEqual(FacilityImageBlob.objects.get(pk=blob.pk).ref_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            bulk.delete_facilities([other.pk])
+        self.assertFilesExist(self.paths(second), exist=False)
+        self.assertFalse(FacilityImageBlob.objects.exists())
+
+    def test_dedupe_images(self):
+        image = self.upload()
+        with open(self.paths(image)[0], 'rb') as f:
+            content = f.read()
+        copy = self.write_legacy('copy.jpg', content)
+        copy_variant = self.write_legacy('copy__w320.jpg', b'x' * 100)
+        unique = self.write_legacy('unique.jpg', b'y' * 50)
+        variants = [{'name': 'facilities/images/copy__w320.jpg', 'width': 320, 'height': 229, 'format': 'jpeg'}]
+        FacilityImage.objects.bulk_create([
+            FacilityImage(facility=self.facility, image='facilities/images/copy.jpg', variants=variants),
+            FacilityImage(facility=self.facility, image='facilities/images/copy.jpg', variants=variants),
+            FacilityImage(facility=self.facility, image='facilities/images/unique.jpg'),
+        ])
+
+        out = io.StringIO()
+        call_command('dedupe_images', '--dry-run', stdout=out)
+        self.assertIn(f'facilities/images/copy.jpg -> {image.image.name}', out.getvalue())
+        self.assertIn(f'Scanned 3 files: 1 duplicates used by 2 images, 0 unreadable; would save {len(content) + 100} bytes',
+                      out.getvalue())
+        self.assertTrue(os.path.exists(copy))
+        self.assertEqual(FacilityImage.objects.filter(image='facilities/images/copy.jpg').count(), 2)
+
+        out = io.StringIO()
+        call_command('dedupe_images', '--batch-size', '1', stdout=out)
+        self.assertIn(f'deleted 2 files, saved {len(content) + 100} bytes', out.getvalue())
+        self.assertFalse(os.path.exists(copy))
+        self.assertFalse(os.path.exists(copy_variant))
+        self.assertTrue(os.path.exists(unique))
+        self.assertEqual(
+            [(row.image.name, row.variants) for row in FacilityImage.objects.exclude(image='facilities/images/unique.jpg')],
+            [(image.image.name, image.variants)] * 3,
+        )
+        self.assertFilesExist(self.paths(image))
+        self.assertEqual(
+            dict(FacilityImageBlob.objects.values_list('name', 'ref_count')),
+            {image.image.name: 3, 'facilities/images/unique.jpg': 1},
+        )
+
+        # 新しいアップロードも登録済みのファイルを使う
+        self.assertEqual(self.upload().image.name, image.image.name)
+
+    def write_legacy(self, name, content):
+        path = os.path.join(self.media_root, 'facilities/images', name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+
+class BatchImageUploadTest(TemporaryMediaMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.facility = Facility.objects.create(facility_name="一括アップロード施設", capacity=2, address="住所")
+        self.url = reverse('facility-upload-images', kwargs={'pk': self.facility.pk})
+
+    def post(self, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(self.url, data, format='multipart')
+
+    def test_upload_many_files_in_one_request(self):
+        files = [make_test_image(f'photo{i}.jpg', size=(400, 300)) for i in range(5)]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post({'images': files, 'captions': [f'写真{i}' for i in range(5)]})
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 5)
+        self.assertEqual(self.facility.images.count(), 5)
+        self.assertEqual(
+            [r['image']['caption'] for r in response.data['results']],
+            [f'写真{i}' for i in range(5)],
+        )
+        inserts = [q for q in queries if q['sql'].startswith('INSERT INTO "facilities_facilityimage"')]
+        self.assertEqual(len(inserts), 1)
+        # 派生画像もコミット後に生成される
+        self.assertTrue(all(image.variants for image in self.facility.images.all()))
+
+    def test_bad_file_does_not_abort_the_rest(self):
+        bad = SimpleUploadedFile('notes.jpg', b'not an image', content_type='image/jpeg')
+        response = self.post({'images': [make_test_image('a.jpg'), bad, make_test_image('b.png', fmt='PNG')]})
+
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual([r['status'] for r in response.data['results']], ['created', 'error', 'created'])
+        self.assertIn('image', response.data['results'][1]['errors'])
+        self.assertEqual(self.facility.images.count(), 2)
+
+    def test_missing_captions_default_to_blank(self):
+        response = self.post({'images': [make_test_image('a.jpg'), make_test_image('b.jpg')], 'captions': ['外観']})
+        self.assertEqual([r['image']['caption'] for r in response.data['results']], ['外観', ''])
+
+    def test_all_files_invalid(self):
+        bad = SimpleUploadedFile('notes.txt', b'text', content_type='text/plain')
+        response = self.post({'images': [bad]})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['failed'], 1)
+
+    def test_upload_with_session_authentication(self):
+        # CSRFの検査が request.POST を読む前に、アップロードハンドラを差し替えておく
+        with self.captureOnCommitCallbacks(execute=True):
+            response = session_client().post(self.url, {'images': [make_test_image('a.jpg')]})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.facility.images.count(), 1)
+
+    def test_no_files(self):
+        response = self.post({'captions': ['外観']})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_upload_invalidates_facility_payload(self):
+        detail_url = reverse('facility-detail', kwargs={'pk': self.facility.pk})
+        self.client.get(detail_url)
+        self.post({'images': [make_test_image('a.jpg')]})
+        self.assertEqual(len(self.client.get(detail_url).data['images']), 1)
+
+
+class CompositeCreateTest(TemporaryMediaMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('facility-composite')
+        self.wifi = Amenity.objects.create(name="Wi-Fi")
+
+    def post(self, data, format='multipart'):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(self.url, data, format=format)
+
+    def test_create_everything_in_one_request(self):
+        response = self.post({
+            'facility_name': '一括作成施設',
+            'capacity': 4,
+            'address': '函館市',
+            'amenities': [self.wifi.pk],
+            'new_amenities': ['テレビ', 'Wi-Fi'],
+            'images': [make_test_image('a.jpg'), make_test_image('b.jpg')],
+            'captions': ['外観', '寝室'],
+        })
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['facility_name'], '一括作成施設')
+        self.assertEqual(sorted(a['name'] for a in response.data['amenities']), ['Wi-Fi', 'テレビ'])
+        self.assertEqual([i['caption'] for i in response.data['images']], ['外観', '寝室'])
+        self.assertEqual(Amenity.objects.count(), 2)
+        self.assertTrue(response.data['images'][0]['image'].startswith('http://testserver/media/'))
+
+    def test_create_with_session_authentication(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = session_client().post(self.url, {
+                'facility_name': 'セッション施設', 'capacity': 2, 'address': '住所', 'images': [make_test_image('a.jpg')],
+            })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data['images']), 1)
+
+    def test_json_without_images(self):
+        response = self.post(
+            {'facility_name': 'JSON施設', 'capacity': 2, 'address': '住所', 'new_amenities': ['駐車場']},
+            format='json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([a['name'] for a in response.data['amenities']], ['駐車場'])
+        self.assertEqual(response.data['images'], [])
+
+    def test_invalid_image_creates_nothing(self):
+        bad = SimpleUploadedFile('notes.jpg', b'not an image', content_type='image/jpeg')
+        response = self.post({
+            'facility_name': '失敗する施設',
+            'capacity': 2,
+            'address': '住所',
+            'new_amenities': ['新アメニティ'],
+            'images': [make_test_image('a.jpg'), bad],
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('images', response.data)
+        self.assertFalse(Facility.objects.exists())
+        self.assertFalse(Amenity.objects.filter(name='新アメニティ').exists())
+        self.assertFalse(FacilityImage.objects.exists())
+
+    def test_failed_upload_keeps_shared_files(self):
+        # 既存の画像と同じ中身のファイルを含むリクエストが失敗しても、共有しているファイルは消さない
+        facility = Facility.objects.create(facility_name="既存の施設", capacity=2, address="住所")
+        with self.captureOnCommitCallbacks(execute=True):
+            existing = FacilityImage.objects.create(facility=facility, image=make_test_image('original.jpg'))
+        storage = FacilityImage._meta.get_field('image').storage
+        save, saved = type(storage).save, []
+
+        def failing_save(self, name, content, max_length=None):
+            if content.name == 'broken.jpg':
+                raise OSError("No space left on device")
+            saved.append(save(self, name, content, max_length=max_length))
+            return saved[-1]
+
+        with mock.patch.object(type(storage), 'save', failing_save):
+            response = self.post({
+                'facility_name': '失敗する施設',
+                'capacity': 2,
+                'address': '住所',
+                'images': [
+                    make_test_image('copy.jpg'),
+                    make_test_image('fresh.jpg', color=(10, 20, 30)),
+                    make_test_image('broken.jpg', color=(30, 20, 10)),
+                ],
+            })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(saved[0], existing.image.name)
+        self.assertTrue(storage.exists(existing.image.name))
+        self.assertEqual(FacilityImageBlob.objects.get(name=existing.image.name).ref_count, 1)
+        # 共有していないファイルは削除される
+        self.assertFalse(storage.exists(saved[1]))
+        self.assertFalse(FacilityImageBlob.objects.filter(name=saved[1]).exists())
+
+    def test_invalid_facility_fields(self):
+        response = self.post({'facility_name': '', 'capacity': 50, 'address': '住所'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(set(response.data), {'facility_name', 'capacity'})
+        self.assertFalse(Facility.objects.exists())
+
+
+class AmenityManagerTest(TestCase):
+    def test_get_or_create_by_names(self):
+        existing = Amenity.objects.create(name="Wi-Fi")
+        with self.assertNumQueries(3):
+            amenities = Amenity.objects.get_or_create_by_names(["Wi-Fi", " テレビ ", "テレビ", ""])
+        self.assertEqual([a.name for a in amenities], ["Wi-Fi", "テレビ"])
+        self.assertEqual(amenities[0].pk, existing.pk)
+        self.assertIsNotNone(amenities[1].pk)
+
+
+class Beds24SyncTest(TestCase):
+
+    def setUp(self):
+        self.stub = Beds24Stub().start()
+        self.addCleanup(self.stub.stop)
+        self.client_ = Beds24Client(base_url=self.stub.url, api_key='test', pool_size=4, sleep=lambda seconds: None)
+        self.addCleanup(self.client_.close)
+        self.today = datetime.date(2026, 4, 1)
+        self.facilities = Facility.objects.bulk_create([
+            Facility(facility_name=f"同期施設{i}", address="住所", prop_key=f"prop{i}", room_key=f"room{i}")
+            for i in range(10)
+        ])
+        Facility.objects.create(facility_name="キーなし", address="住所")
+
+    def make_sync(self, **kwargs):
+        return Beds24Sync(client=self.client_, concurrency=4, horizon_days=30, today=self.today, **kwargs)
+
+    def test_full_sync(self):
+        report = self.make_sync().run()
+
+        self.assertEqual((report.facilities, report.full, report.failed), (10, 10, 0))
+        self.assertEqual(self.stub.calls['getProperty'], 10)
+        self.assertEqual(self.stub.calls['getRoomDates'], 10)
+        state = Beds24SyncState.objects.get(facility=self.facilities[0])
+        self.assertEqual(len(state.calendar), 30)
+        self.assertEqual(state.calendar['2026-04-01'], {'available': 1, 'price': '10000.00'})
+        self.assertEqual(state.room['roomId'], 'room0')
+        self.assertEqual(state.synced_until, datetime.date(2026, 4, 30))
+        # 接続はプールのサイズまでしか作られず、使い回される
+        self.assertLessEqual(self.stub.connections, 4)
+        self.assertLessEqual(self.client_.pool.created, 4)
+
+    def test_incremental_sync_fetches_only_changes(self):
+        self.make_sync().run()
+        self.stub.calls.clear()
+
+        report = self.make_sync().run()
+        self.assertEqual((report.full, report.incremental), (0, 10))
+        self.assertEqual(self.stub.calls['getBookings'], 10)
+        self.assertEqual(self.stub.calls['getRoomDates'], 0)
+
+        self.stub.book('room3', datetime.date(2026, 4, 10), datetime.date(2026, 4, 12))
+        self.stub.calls.clear()
+        self.make_sync().run()
+        self.assertEqual(self.stub.calls['getRoomDates'], 1)
+        calendar = Beds24SyncState.objects.get(facility=self.facilities[3]).calendar
+        self.assertEqual(calendar['2026-04-11']['available'], 0)
+        self.assertEqual(calendar['2026-04-13']['available'], 1)
+        self.assertEqual(len(calendar), 30)
+        # 検索用の空き状況カレンダーにも反映される
+        self.assertFalse(availability.is_available(self.facilities[3].pk, datetime.date(2026, 4, 10), datetime.date(2026, 4, 12)))
+        self.assertTrue(availability.is_available(self.facilities[3].pk, datetime.date(2026, 4, 13), datetime.date(2026, 4, 15)))
+
+    def test_rolling_window_fetches_new_days(self):
+        self.make_sync().run(Facility.objects.filter(pk=self.facilities[0].pk))
+        self.stub.calls.clear()
+
+        self.today = datetime.date(2026, 4, 3)
+        self.make_sync().run(Facility.objects.filter(pk=self.facilities[0].pk))
+        self.assertEqual(self.stub.calls['getRoomDates'], 1)
+        calendar = Beds24SyncState.objects.get(facility=self.facilities[0]).calendar
+        self.assertEqual(min(calendar), '2026-04-03')
+        self.assertEqual(max(calendar), '2026-05-02')
+
+    def test_full_sync_when_keys_change(self):
+        self.make_sync().run()
+        Facility.objects.filter(pk=self.facilities[0].pk).update(room_key='room99')
+        report = self.make_sync().run()
+        self.assertEqual((report.full, report.incremental), (1, 9))
+
+    def test_backs_off_on_rate_limit(self):
+        self.stub.fail_next(status=429, count=3, retry_after=0)
+        report = self.make_sync().run()
+        self.assertEqual(report.failed, 0)
+        self.assertEqual(report.retries, 3)
+
+    def test_gives_up_after_max_retries(self):
+        self.client_.max_retries = 1
+        self.stub.fail_next(status=429, count=2)
+        with self.assertRaises(Beds24RateLimited):
+            self.client_.get_property('prop0')
+
+    def test_failures_are_recorded_per_facility(self):
+        self.client_.api_key = ''
+        report = self.make_sync().run()
+        self.assertEqual(report.failed, 10)
+        state = Beds24SyncState.objects.get(facility=self.facilities[0])
+        self.assertIn('Unauthorized', state.last_error)
+        self.assertIsNone(state.synced_until)
+
+    def test_malformed_responses_fail_only_that_facility(self):
+        self.stub.corrupt('prop2', b'<html>Service Unavailable</html>')
+        self.stub.corrupt('prop5', b'{"2026-13-45": {"i": "x"}}', method='getRoomDates')
+        report = self.make_sync().run()
+
+        self.assertEqual((report.full, report.failed), (8, 2))
+        self.assertIn('invalid JSON response', report.errors[self.facilities[2].pk])
+        self.assertIn('unexpected response', report.errors[self.facilities[5].pk])
+        self.assertIn('invalid JSON response', Beds24SyncState.objects.get(facility=self.facilities[2]).last_error)
+        self.assertEqual(len(Beds24SyncState.objects.get(facility=self.facilities[0]).calendar), 30)
+
+    def test_command(self):
+        out = io.StringIO()
+        with override_settings(BEDS24_API_KEY='test'):
+            call_command('sync_beds24', '--url', self.stub.url, '--concurrency', '2', stdout=out)
+        self.assertIn('10 facilities (10 full, 0 incremental, 0 failed)', out.getvalue())
+
+
+
+class AvailabilityTest(APITestCase):
+
+    def setUp(self):
+        payload_cache.clear()
+        self.small = Facility.objects.create(facility_name="2人用", address="住所", capacity=2)
+        self.large = Facility.objects.create(facility_name="6人用", address="住所", capacity=6)
+        for facility in (self.small, self.large):
+            availability.set_range(facility.pk, datetime.date(2026, 12, 1), datetime.date(2027, 2, 1))
+        self.url = reverse('facility-available')
+
+    def test_nights_by_year(self):
+        masks = availability.nights_by_year(datetime.date(2026, 12, 30), datetime.date(2027, 1, 2))
+        self.assertEqual(masks, {2026: 0b11 << 363, 2027: 0b1})
+
+    def test_search_within_and_across_years(self):
+        self.assertEqual(
+            availability.search(datetime.date(2026, 12, 5), datetime.date(2026, 12, 8)),
+            [self.small.pk, self.large.pk],
+        )
+        availability.set_range(self.small.pk, datetime.date(2027, 1, 1), datetime.date(2027, 1, 2), available=False)
+        self.assertEqual(
+            availability.search(datetime.date(2026, 12, 30), datetime.date(2027, 1, 3)),
+            [self.large.pk],
+        )
+
+    def test_checkout_day_is_not_required(self):
+        # チェックアウト日の夜は空いていなくてもよい
+        self.assertTrue(availability.is_available(self.small.pk, datetime.date(2027, 1, 30), datetime.date(2027, 2, 1)))
+        self.assertFalse(availability.is_available(self.small.pk, datetime.date(2027, 1, 30), datetime.date(2027, 2, 2)))
+
+    def test_unknown_dates_are_unavailable(self):
+        self.assertEqual(availability.search(datetime.date(2028, 1, 1), datetime.date(2028, 1, 3)), [])
+
+    def test_guests_are_matched_against_capacity(self):
+        self.assertEqual(
+            availability.search(datetime.date(2026, 12, 5), datetime.date(2026, 12, 8), guests=4),
+            [self.large.pk],
+        )
+
+    def test_apply_calendar(self):
+        availability.apply_calendar(self.small.pk, {
+            '2026-12-10': {'available': 0, 'price': '10000.00'},
+            '2026-11-30': {'available': 2, 'price': '10000.00'},
+        })
+        self.assertFalse(availability.is_available(self.small.pk, datetime.date(2026, 12, 9), datetime.date(2026, 12, 11)))
+        self.assertTrue(availability.is_available(self.small.pk, datetime.date(2026, 11, 30), datetime.date(2026, 12, 10)))
+        self.assertEqual(FacilityAvailability.objects.filter(facility=self.small).count(), 2)
+
+    def test_search_is_a_single_query(self):
+        with self.assertNumQueries(1):
+            availability.search(datetime.date(2026, 12, 30), datetime.date(2027, 1, 3))
+
+    def test_endpoint(self):
+        response = self.client.get(self.url, {'check_in': '2026-12-05', 'check_out': '2026-12-08', 'guests': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([facility['id'] for facility in response.data], [self.large.pk])
+
+    @parameterized.expand([
+        ({'check_in': '2026-12-05'},),
+        ({'check_in': '2026-12-08', 'check_out': '2026-12-08'},),
+        ({'check_in': '2026-01-01', 'check_out': '2027-06-01'},),
+        ({'check_in': '2026-12-05', 'check_out': '2026-12-08', 'guests': 0},),
+    ])
+    def test_endpoint_rejects_invalid_params(self, params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+
 
 
 
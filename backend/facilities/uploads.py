@@ -0,0 +1,92 @@
+# 施設画像の一括アップロード
+#
+# - multipartのファイルはメモリに載せず一時ファイルへ書き出し、ストレージへはファイルの移動/チャンク単位のコピーで保存する
+# - FacilityImageはbulk_createでまとめて登録する (1ファイルごとのINSERT・トランザクションを避ける)
+# - アップロードハンドラーは受信しながら中身のSHA-256を計算する。ストレージ(facilities.storage)は
+#   この値で重複を判定するため、保存前にファイルを読み直さない (settings.FILE_UPLOAD_HANDLERS)
+
+import hashlib
+import logging
+
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+from django.db import transaction
+
+from . import cleanup, events, images, tasks
+from .models import FacilityImage
+from .signals import touch_facilities
+
+logger = logging.getLogger(__name__)
+
+
+class HashingUploadHandlerMixin:
+    """受信したデータからSHA-256を計算し、できあがったファイルの content_digest に入れる"""
+
+    def new_file(self, *args, **kwargs):
+        # MemoryFileUploadHandler.new_file() は StopFutureHandlers で抜けるため、先に用意する
+        self.digest = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        # メモリに置かない(次のハンドラーに任せる)ファイルは、次のハンドラーで計算する
+        if getattr(self, 'activated', True):
+            self.digest.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.content_digest = self.digest.hexdigest()
+        return file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadHandlerMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadHandlerMixin, TemporaryFileUploadHandler):
+    pass
+
+
+def use_streaming_upload_handlers(request):
+    """アップロードされたファイルをサイズに関わらず一時ファイルへ書き出す (認証のCSRFの検査・request.data より前に呼ぶ)"""
+    django_request = getattr(request, '_request', request)
+    django_request.upload_handlers = [HashingTemporaryFileUploadHandler(django_request)]
+
+
+def save_images(facility, uploads):
+    """
+    検証済みのファイルをストレージに保存し、FacilityImageをまとめて登録する
+
+    uploads: [(番号, UploadedFile, キャプション), ...]
+    戻り値: ([(番号, 登録したFacilityImage), ...], {番号: エラーメッセージ})
+    """
+    field = FacilityImage._meta.get_field('image')
+    pending, errors = [], {}
+    for index, upload, caption in uploads:
+        instance = FacilityImage(facility=facility, caption=caption)
+        try:
+            name = field.generate_filename(instance, upload.name)
+            instance.image = field.storage.save(name, upload, max_length=field.max_length)
+        except OSError as e:
+            logger.warning("Could not store uploaded image %s: %s", upload.name, e)
+            errors[index] = "ファイルを保存できませんでした。"
+            continue
+        pending.append((index, instance))
+
+    if not pending:
+        return [], errors
+
+    try:
+        with transaction.atomic():
+            FacilityImage.objects.bulk_create([instance for _, instance in pending])
+    except Exception:
+        # 行の登録に失敗した場合は、保存したファイル(の参照)も残さない
+        cleanup.release_images([(instance.image.name, []) for _, instance in pending])
+        raise
+
+    # bulk_createではシグナルが発火しないため、post_saveと同じ後処理をここで行う
+    touch_facilities([facility.pk])
+    events.publish([events.image_event(instance.pk, 'created', facility.pk) for _, instance in pending])
+    for _, instance in pending:
+        tasks.schedule_on_commit(images.generate_variants, instance.pk)
+    return pending, errors
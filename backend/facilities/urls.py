@@ -1,6 +1,8 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import index, FacilityViewSet, FacilityImageViewSet, AmenityViewSet
+from .views import (
+    index, cache_metrics, request_metrics, FacilityViewSet, FacilityImageViewSet, AmenityViewSet, ChangeFeedView,
+)
 
 
 # DefaultRouterを作成
@@ -13,6 +15,9 @@ router.register(r'images', FacilityImageViewSet)
 
 urlpatterns = [
     path('', include(router.urls)),
-    path('index/', index, name="index")
+    path('index/', index, name="index"),
+    path('metrics/cache/', cache_metrics, name="cache-metrics"),
+    path('metrics/requests/', request_metrics, name="request-metrics"),
+    path('changes/', ChangeFeedView.as_view(), name="change-feed"),
 ]
 
@@ -1,40 +1,385 @@
+import logging
+
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.conf import settings
+from django.db.models import Prefetch
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, StreamingHttpResponse
 
 from rest_framework import viewsets, status
+from rest_framework.decorators import action
+from rest_framework.exceptions import UnsupportedMediaType, ValidationError
+from rest_framework.parsers import JSONParser, MultiPartParser
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response
+from rest_framework.views import APIView
+from . import availability, bulk, cache, changes, instrumentation, payloads, uploads
+from .filters import FacilityBoundingBoxFilter, FacilityFilterBackend, FacilityNearestFilter, FacilitySearchFilter
+from .mixins import (
+    ConditionalGetMixin, PayloadCacheMixin, ReplicaReadMixin, facility_list_validator, updated_at_list_validator,
+)
 from .models import Facility, Amenity, FacilityImage
-from .serializers import FacilitySerializer, FacilityImageSerializer, AmenitySerializer, FacilityWriteSerializer
+from .pagination import OptInCursorPagination
+from .renderers import FastJSONRenderer
+from .serializers import (
+    FacilitySerializer, FacilityImageSerializer, AmenitySerializer, FacilityWriteSerializer,
+    FacilityImageUploadSerializer, FacilityCompositeSerializer, AvailabilitySearchSerializer,
+    FacilityIdsSerializer, FacilityBulkUpdateSerializer, ChangeFeedSerializer,
+)
+
+logger = logging.getLogger(__name__)
+
 
 def index(request):
     return HttpResponse("hello, world.")
 
 
-class FacilityViewSet(viewsets.ModelViewSet):
+def cache_metrics(request):
+    """ペイロードキャッシュのカウンタをPrometheusのテキスト形式で返す"""
+    lines = []
+    for name, value in cache.stats.snapshot().items():
+        metric = f"facilities_payload_cache_{name}_total"
+        lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+    return HttpResponse("\n".join(lines) + "\n", content_type="text/plain; version=0.0.4")
+
+
+def request_metrics(request):
+    """ルートごとの応答時間のヒストグラムとSQLの合計をPrometheusのテキスト形式で返す (このプロセスの分)"""
+    return HttpResponse(instrumentation.histograms.prometheus(), content_type="text/plain; version=0.0.4")
+
+
+class FacilityViewSet(ReplicaReadMixin, ConditionalGetMixin, PayloadCacheMixin, viewsets.ModelViewSet):
     queryset = Facility.objects.all()
     serializer_class = FacilitySerializer
+    pagination_class = OptInCursorPagination
+    # 全文検索・近傍の検索は上位だけを返すため、ほかのフィルターで絞り込んだ後に行う
+    filter_backends = [FacilityFilterBackend, FacilityBoundingBoxFilter, FacilitySearchFilter, FacilityNearestFilter]
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+
+    # 読み取り系のアクション (?fields= / ?expand= に対応する)
+    read_actions = ['list', 'retrieve', 'available']
+    # ファイルを受け取るアクション (アップロードされたファイルを一時ファイルへ書き出す)
+    upload_actions = ['bulk_import', 'composite', 'upload_images']
+
+    def initialize_request(self, request, *args, **kwargs):
+        # セッション認証のCSRFの検査が request.POST を読むより前に、アップロードハンドラを差し替える
+        if self.action_map.get(request.method.lower()) in self.upload_actions:
+            uploads.use_streaming_upload_handlers(request)
+        return super().initialize_request(request, *args, **kwargs)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if self.action in self.read_actions:
+            # 不正な ?fields= / ?expand= は、条件付きGETの照合より前に400にする
+            self.get_field_selection()
+
+    def get_field_selection(self):
+        """
+        ?fields=id,facility_name&expand=images を
+        (出力するフィールドの集合, ネストする関連の集合) にする。指定がなければそれぞれNone
+        """
+        if not hasattr(self, '_field_selection'):
+            meta = FacilitySerializer.Meta
+            self._field_selection = (
+                self._parse_names('fields', meta.fields),
+                self._parse_names('expand', meta.expandable_fields),
+            )
+        return self._field_selection
+
+    def _parse_names(self, param, allowed):
+        value = self.request.query_params.get(param)
+        if value is None:
+            return None
+        names = {name.strip() for name in value.split(',') if name.strip()}
+        unknown = names - set(allowed)
+        if unknown:
+            raise ValidationError({param: [f"指定できないフィールドです: {', '.join(sorted(unknown))}"]})
+        return names
+
+    def use_payload_cache(self):
+        # キャッシュには既定の形のペイロードだけを保存する
+        return self.get_field_selection() == (None, None)
+
+    def build_payloads(self, queryset, pks):
+        # 既定の形のペイロードは、シリアライザーを使わずに .values() から組み立てる
+        if getattr(settings, 'FACILITIES_FAST_PAYLOADS', True):
+            return payloads.build_payloads(pks, self.request)
+        return super().build_payloads(queryset, pks)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.action in self.read_actions:
+            context['fields'], context['expand'] = self.get_field_selection()
+        return context
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        # 読み取り系のアクションでは、ネストしたアメニティと画像をまとめて取得する
+        # (施設数に関わらずクエリ数が一定になる: 施設 + アメニティ + 画像 = 3クエリ)
+        # ?fields= / ?expand= が指定された場合は、出力するものだけを読み込む
+        if self.action in self.read_actions:
+            fields, expand = self.get_field_selection()
+            queryset = queryset.prefetch_related(*self.get_prefetches(fields, expand))
+            if fields is not None:
+                columns = [field.name for field in Facility._meta.concrete_fields if field.name in fields]
+                queryset = queryset.only(*columns or ['pk'])
+        return queryset
+
+    def get_prefetches(self, fields, expand):
+        prefetches = []
+        # (関連名, モデル, IDのリストとして出力する場合に読み込む列)
+        relations = [('amenities', Amenity, ['pk']), ('images', FacilityImage, ['pk', 'facility'])]
+        for name, model, id_columns in relations:
+            if fields is not None and name not in fields:
+                continue
+            if expand is None or name in expand:
+                # 並び順を固定する (facilities.payloads の出力と同じ順にする)
+                prefetches.append(Prefetch(name, queryset=model.objects.order_by('pk')))
+            else:
+                prefetches.append(Prefetch(name, queryset=model.objects.only(*id_columns)))
+        if fields is not None and 'cover_image' in fields:
+            # 施設ごとに先頭の1枚だけを取得する (ウィンドウ関数で1クエリ)
+            prefetches.append(Prefetch(
+                'images', queryset=FacilityImage.objects.order_by('pk')[:1], to_attr='cover_images'
+            ))
+        return prefetches
+
+    def paginate_queryset(self, queryset):
+        # 全文検索(?q=)・近傍の検索(?near=)の結果は関連度・距離の順の上位だけを返すため、ページ分割しない
+        if FacilitySearchFilter.get_query(self.request) or FacilityNearestFilter.get_near(self.request):
+            return None
+        return super().paginate_queryset(queryset)
+
+    def get_object_version(self):
+        # 条件付きGETとキャッシュの照合で共有するため、1リクエストにつき1回だけ問い合わせる
+        if not hasattr(self, '_object_version'):
+            try:
+                self._object_version = (
+                    Facility.objects.filter(pk=self.kwargs['pk'])
+                    .values_list('pk', 'version', 'updated_at')
+                    .first()
+                )
+            except (TypeError, ValueError):
+                self._object_version = None
+        return self._object_version
+
+    def get_object_validator(self):
+        row = self.get_object_version()
+        if row is None:
+            return None
+        pk, version, updated_at = row
+        return f"{pk}-{version}-{updated_at}", updated_at
+
+    def get_list_validator(self, queryset):
+        return facility_list_validator(queryset)
 
     def get_serializer_class(self):
         if self.action in ['create', 'update', 'partial_update']:
             return FacilityWriteSerializer
         return self.serializer_class
 
+    @action(detail=False, methods=['get'])
+    def available(self, request):
+        """
+        GET /api/facilities/available/?check_in=YYYY-MM-DD&check_out=YYYY-MM-DD&guests=N
+        指定した期間に、N人で宿泊できる施設の一覧を返す (レスポンスの形式は一覧と同じ)
+        """
+        params = AvailabilitySearchSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        facility_ids = availability.search(**params.validated_data)
+        queryset = self.filter_queryset(self.get_queryset()).filter(pk__in=facility_ids)
+        return self.payload_list_response(queryset)
+
+    @action(detail=False, methods=['post'], url_path='import', url_name='import',
+            parser_classes=[MultiPartParser, bulk.UnreadBodyParser])
+    def bulk_import(self, request):
+        """
+        POST /api/facilities/import/ : CSV / JSON Lines の施設をまとめて登録する (facilities.bulk)
+        本体にそのまま送る (Content-Type: text/csv / application/x-ndjson) か、multipartの file で送る。
+        入力は1行ずつ読みながら登録する。?dry_run=true で検証だけを行う。レスポンスは行ごとのエラーを含む報告
+        """
+        if request.content_type.startswith('multipart/'):
+            stream = request.FILES.get('file')
+            if stream is None:
+                return Response({'file': ['ファイルが指定されていません。']}, status=status.HTTP_400_BAD_REQUEST)
+            fmt = bulk.guess_format(stream.name, stream.content_type)
+        else:
+            # request.data を使わずに本体を直接読む (本体全体をメモリに載せない)
+            stream = request._request
+            fmt = bulk.guess_format(content_type=request.content_type)
+        if fmt is None:
+            raise UnsupportedMediaType(request.content_type)
+
+        dry_run = request.query_params.get('dry_run', '').lower() in ('1', 'true')
+        report = bulk.import_facilities(bulk.read_rows(stream, fmt), dry_run=dry_run)
+
+        if report.error is not None or not report.created and report.failed:
+            response_status = status.HTTP_400_BAD_REQUEST
+        elif report.failed:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_200_OK if dry_run else status.HTTP_201_CREATED
+        return Response(report.as_dict(), status=response_status)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """
+        GET /api/facilities/export/?output=csv|jsonl : 施設をCSV / JSON Linesで出力する (一覧と同じ絞り込みに対応)
+        ?format= はDRFがレスポンスの形式の指定に使うため、?output= で指定する
+        """
+        fmt = request.query_params.get('output', 'csv')
+        if fmt not in bulk.FORMATS:
+            raise ValidationError({'output': ["csv または jsonl を指定してください。"]})
+        queryset = self.filter_queryset(self.get_queryset())
+        if isinstance(request._request, ASGIRequest):
+            content = bulk.aiter_export(queryset, fmt)
+        else:
+            content = bulk.iter_export(queryset, fmt)
+        response = StreamingHttpResponse(content, content_type=bulk.CONTENT_TYPES[fmt])
+        response.headers['Content-Disposition'] = f'attachment; filename="facilities.{fmt}"'
+        return response
+
+    @action(detail=False, methods=['patch'], url_path='bulk', url_name='bulk')
+    def bulk_update(self, request):
+        """
+        PATCH /api/facilities/bulk/ : 複数の施設をまとめて更新する (1トランザクション。施設の数に関わらずSQLの回数は一定)
+        {"ids": [1, 2], "values": {"management_entity": "CM"}, "add_amenities": [3], "remove_amenities": [4]}
+        レスポンスは施設IDごとの結果 (存在しない施設は not_found)
+        """
+        serializer = FacilityBulkUpdateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return self.bulk_response(bulk.update_facilities(**serializer.validated_data))
+
+    @bulk_update.mapping.delete
+    def bulk_destroy(self, request):
+        """DELETE /api/facilities/bulk/ : {"ids": [1, 2]} の施設を、画像などの関連する行と一緒にまとめて削除する"""
+        serializer = FacilityIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return self.bulk_response(bulk.delete_facilities(serializer.validated_data['ids']))
+
+    def bulk_response(self, results):
+        counts = {}
+        for result in results:
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+        if counts.get('not_found') == len(results):
+            response_status = status.HTTP_404_NOT_FOUND
+        elif 'not_found' in counts:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_200_OK
+        return Response({'counts': counts, 'results': results}, status=response_status)
+
+    @action(detail=False, methods=['post'], parser_classes=[MultiPartParser, JSONParser])
+    def composite(self, request):
+        """
+        POST /api/facilities/composite/ : 施設・アメニティ・画像を1回のリクエスト(1トランザクション)で作成する
+        レスポンスは施設詳細と同じ形式なので、作成後に改めてGETする必要はない
+        """
+        serializer = FacilityCompositeSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        facility = serializer.save()
+
+        facility = Facility.objects.prefetch_related('amenities', 'images').get(pk=facility.pk)
+        data = FacilitySerializer(facility, context=self.get_serializer_context()).data
+        return Response(data, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['post'], url_path='images', parser_classes=[MultiPartParser])
+    def upload_images(self, request, pk=None):
+        """
+        POST /api/facilities/{id}/images/ : 複数の画像を1回のリクエストでアップロードする
+        multipartの images (ファイル、複数可) と captions (同じ順番、省略可) を受け取り、ファイルごとの結果を返す
+        """
+        facility = self.get_object()
+        files = request.FILES.getlist('images')
+        captions = request.data.getlist('captions')
+        if not files:
+            return Response({'images': ['ファイルが指定されていません。']}, status=status.HTTP_400_BAD_REQUEST)
+
+        # 1ファイルずつ検証し、不正なファイルがあっても残りは登録する
+        results = [{'index': index, 'filename': upload.name} for index, upload in enumerate(files)]
+        valid = []
+        for index, upload in enumerate(files):
+            caption = captions[index] if index < len(captions) else ''
+            serializer = FacilityImageUploadSerializer(data={'image': upload, 'caption': caption})
+            if serializer.is_valid():
+                valid.append((index, upload, serializer.validated_data.get('caption', '')))
+            else:
+                results[index].update(status='error', errors=serializer.errors)
+
+        created, errors = uploads.save_images(facility, valid)
+        for index, message in errors.items():
+            results[index].update(status='error', errors={'image': [message]})
+        for index, instance in created:
+            results[index].update(
+                status='created',
+                image=FacilityImageSerializer(instance, context=self.get_serializer_context()).data,
+            )
+
+        if not created:
+            response_status = status.HTTP_400_BAD_REQUEST
+        elif len(created) < len(files):
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_201_CREATED
+        return Response(
+            {'created': len(created), 'failed': len(files) - len(created), 'results': results},
+            status=response_status,
+        )
+
     def destroy(self, request, *args, **kwargs):
         try:
             instance = self.get_object()
-            print(f"Attempting to delete facility: {instance.facility_name} (ID: {instance.id})")
+            logger.info("Deleting facility %s (ID: %s)", instance.facility_name, instance.id)
             self.perform_destroy(instance)
             return Response(status=status.HTTP_204_NO_CONTENT)
         except Exception as e:
-            print(f"Error during facility deletion: {e}")
+            logger.exception("Error during facility deletion")
             return Response({'detail': f'Error during deletion: {e}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
     
 class FacilityImageViewSet(viewsets.ModelViewSet):
     queryset = FacilityImage.objects.all()
     serializer_class = FacilityImageSerializer
+    pagination_class = OptInCursorPagination
 
 
-class AmenityViewSet(viewsets.ModelViewSet):
+class AmenityViewSet(ReplicaReadMixin, ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Amenity.objects.all()
-    serializer_class = AmenitySerializer
\ No newline at end of file
+    serializer_class = AmenitySerializer
+    pagination_class = OptInCursorPagination
+
+    def get_object_validator(self):
+        try:
+            updated_at = Amenity.objects.filter(pk=self.kwargs['pk']).values_list('updated_at', flat=True).first()
+        except (TypeError, ValueError):
+            return None
+        if updated_at is None:
+            return None
+        return f"{self.kwargs['pk']}-{updated_at}", updated_at
+
+    def get_list_validator(self, queryset):
+        return updated_at_list_validator(queryset)
+
+
+class ChangeFeedView(APIView):
+    """
+    GET /api/changes/?updated_since=<トークン>&limit=500 : 変更フィード (facilities.changes)
+    トークン以降に作成・変更・削除された施設・アメニティ・画像を古い順に返す。
+    レスポンスの next_since を次の updated_since に指定し、has_more が true の間は続けて取得する。
+    読み取り用のレプリカは遅れて反映されるため使わない (トークンより前の変更を取りこぼさないように)
+    """
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+
+    def get(self, request):
+        params = ChangeFeedSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        try:
+            data = changes.get_changes(
+                params.validated_data.get('updated_since'), params.validated_data['limit'], request
+            )
+        except changes.ResyncRequired:
+            return Response(
+                {'detail': "トークンが古すぎます。updated_since を指定せずに取得し直してください。", 'resync': True},
+                status=status.HTTP_410_GONE,
+            )
+        return Response(data)
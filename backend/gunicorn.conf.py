@@ -0,0 +1,28 @@
+# gunicorn の設定
+#
+# 既定では uvicorn のワーカーで ASGI アプリケーション(config.asgi)を動かす:
+#   gunicorn config.asgi:application -c gunicorn.conf.py
+# 各ワーカーはイベントループで接続を扱うため、応答の遅いクライアントがいてもスレッドを占有しない。
+# 施設・アメニティの読み取りは非同期版のビュー(facilities.async_views)で処理する。
+#
+# 環境変数で上書きできる (docker-compose.yml を参照)
+
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'uvicorn_worker.UvicornWorker')
+# WSGIのワーカー(gthread)で動かす場合のスレッド数
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# 処理が止まったワーカーを再起動するまでの秒数 / 終了時に処理中のリクエストを待つ秒数
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+
+# 開発用: コードの変更を検知してワーカーを再起動する
+reload = os.environ.get('GUNICORN_RELOAD') == '1'
+
+accesslog = os.environ.get('GUNICORN_ACCESSLOG', '-')
+errorlog = '-'
@@ -65,69 +65,36 @@ function FacilityCreatePage() {
         e.preventDefault();
         setFormErrors({});
 
-        // 1. Create facility with basic info first
+        // 基本情報・アメニティ・画像を1回のリクエストで送信する (サーバー側で1つのトランザクションとして作成)
+        const payload = new FormData();
         const { amenities, ...basicFormData } = formData;
-        let newFacilityId;
+        Object.entries(basicFormData).forEach(([key, value]) => payload.append(key, value));
+        amenities.forEach(amenityId => payload.append('amenities', amenityId));
+        selectedImages.forEach(imageFile => payload.append('images', imageFile));
 
         try {
-            const facilityResponse = await fetch(`${import.meta.env.VITE_API_BASE_URL}/facilities/`, {
+            const response = await fetch(`${import.meta.env.VITE_API_BASE_URL}/facilities/composite/`, {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify(basicFormData),
+                body: payload,
             });
 
-            const facilityData = await facilityResponse.json();
-            if (!facilityResponse.ok) {
-                // Handle basic info validation errors
-                if (facilityResponse.status === 400) {
-                    setFormErrors(facilityData);
-                } else {
-                    throw new Error(`施設の基本情報の作成に失敗しました: ${facilityResponse.statusText}`);
-                }
-                return; // Stop if facility creation fails
-            }
-            newFacilityId = facilityData.id;
-
-            // 2. Update amenities if any are selected
-            if (amenities.length > 0) {
-                const amenityResponse = await fetch(`${import.meta.env.VITE_API_BASE_URL}/facilities/${newFacilityId}/`, {
-                    method: 'PATCH',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ amenities: amenities }),
-                });
-                if (!amenityResponse.ok) {
-                    throw new Error('アメニティ情報の更新に失敗しました。');
-                }
-            }
-
-            // 3. Upload images if any are selected
-            if (selectedImages.length > 0) {
-                const uploadPromises = selectedImages.map(imageFile => {
-                    const imagePayload = new FormData();
-                    imagePayload.append('facility', newFacilityId);
-                    imagePayload.append('image', imageFile);
-
-                    return fetch(`${import.meta.env.VITE_API_BASE_URL}/images/`, {
-                        method: 'POST',
-                        body: imagePayload,
-                    });
-                });
-
-                const responses = await Promise.all(uploadPromises);
-                const failedUploads = responses.filter(res => !res.ok);
-                if (failedUploads.length > 0) {
-                    throw new Error(`${failedUploads.length}件の画像のアップロードに失敗しました。`);
+            const data = await response.json();
+            if (!response.ok) {
+                // Handle validation errors (何も作成されていない)
+                if (response.status === 400) {
+                    setFormErrors(data);
+                    return;
                 }
+                throw new Error(`施設の作成に失敗しました: ${response.statusText}`);
             }
 
-            // 4. All done, navigate to the new facility's page
+            // All done, navigate to the new facility's page
             alert('新しい施設が正常に作成されました。');
-            navigate('/');
+            navigate(`/facilities/${data.id}`);
 
         } catch (err) {
-            console.error('API Error (作成プロセス全体):', err);
-            // Inform user that something went wrong in the multi-step process
-            alert(`作成処理中にエラーが発生しました: ${err.message}\n施設情報が不完全な状態で作成された可能性があります。`);
+            console.error('API Error (施設作成):', err);
+            alert(`作成処理中にエラーが発生しました: ${err.message}`);
         }
     };
 
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useParams, useNavigate } from 'react-router-dom';
 import FacilityForm from '../components/FacilityForm';
 import '../styles/FacilityDetailsPage.css';
@@ -21,6 +21,11 @@ function FacilityDetailsPage() {
     // Image States
     const [selectedImage, setSelectedImage] = useState(null);
 
+    // 表示中の施設のバージョン (これより新しい変更のイベントが届いたときだけ取り直す)
+    const lastVersionRef = useRef(0);
+    // 変更のイベント(SSE)の接続
+    const eventsRef = useRef(null);
+
     const fetchFacilityData = async () => {
         setLoading(true);
         try {
@@ -36,6 +41,7 @@ function FacilityDetailsPage() {
             const amenitiesData = await amenitiesRes.json();
             
             setFacility(facilityData);
+            lastVersionRef.current = Math.max(lastVersionRef.current, facilityData.version || 0);
             setAllAmenities(amenitiesData);
             setFormData({
                 ...facilityData,
@@ -54,6 +60,56 @@ function FacilityDetailsPage() {
         fetchFacilityData();
     }, [id]);
 
+    // 編集中はフォームの入力を上書きしない (イベントのハンドラから参照する)
+    const isEditingRef = useRef(isEditing);
+    isEditingRef.current = isEditing;
+
+    // 施設の情報だけを取り直す (アメニティ一覧は取り直さない)
+    const refreshFacility = async () => {
+        const res = await fetch(`${import.meta.env.VITE_API_BASE_URL}/facilities/${id}/`);
+        if (!res.ok) return;
+        const facilityData = await res.json();
+        setFacility(facilityData);
+        lastVersionRef.current = Math.max(lastVersionRef.current, facilityData.version || 0);
+        if (!isEditingRef.current) {
+            setFormData({ ...facilityData, amenities: facilityData.amenities.map(a => a.id) });
+        }
+    };
+
+    // 他の画面での変更をサーバーからのイベント(SSE: /events/、ASGIサーバーのみ)で受け取る
+    useEffect(() => {
+        if (typeof EventSource === 'undefined') return undefined;
+        const source = new EventSource(`${import.meta.env.VITE_API_BASE_URL}/events/?facility=${id}&types=facility`);
+        eventsRef.current = source;
+        let connected = false;
+        source.addEventListener('facility', (e) => {
+            const event = JSON.parse(e.data);
+            if (event.action === 'deleted') {
+                setError('この施設は削除されました。');
+            } else if (event.version > lastVersionRef.current) {
+                lastVersionRef.current = event.version;
+                refreshFacility();
+            }
+        });
+        // 再接続したとき・イベントを取りこぼしたときは取り直す (接続した直後の1回は読み込み済みなので不要)
+        source.addEventListener('resync', () => {
+            if (connected) refreshFacility();
+            connected = true;
+        });
+        return () => {
+            source.close();
+            eventsRef.current = null;
+        };
+    }, [id]);
+
+    // 自分の変更を画面に反映する。イベントを受け取れる間はイベントで取り直すため、ここでは取得しない
+    const refreshUnlessSubscribed = async () => {
+        const source = eventsRef.current;
+        if (!source || source.readyState !== EventSource.OPEN) {
+            await refreshFacility();
+        }
+    };
+
     const handleInputChange = (e) => {
         const { name, value } = e.target;
         setFormData(prev => ({ ...prev, [name]: value }));
@@ -129,7 +185,7 @@ function FacilityDetailsPage() {
             if (!response.ok) throw new Error('画像のアップロードに失敗しました');
 
             setSelectedImage(null); // リセット
-            await fetchFacilityData();
+            await refreshUnlessSubscribed();
             alert('画像がアップロードされました');
         } catch (err) {
             console.error('API ERROR (画像アップロード):', err);
@@ -146,7 +202,7 @@ function FacilityDetailsPage() {
 
             if (!response.ok) throw new Error('画像の削除に失敗しました');
 
-            await fetchFacilityData();
+            await refreshUnlessSubscribed();
             alert('画像を削除しました');
         } catch (err) {
             console.error('API Error (画像削除):', err);
@@ -254,7 +310,11 @@ function FacilityDetailsPage() {
                 <div className="image-list">
                     {facility.images && facility.images.map( image => (
                         <div key={image.id} className="image-item">
-                            <img src={image.image} alt={image.caption || '施設画像'} style={{ width: '150px', height: 'auto' }} />
+                            {/* 派生画像(リサイズ版)があれば、表示幅に合ったものをブラウザに選ばせる */}
+                            <picture>
+                                {image.srcset?.webp && <source type="image/webp" srcSet={image.srcset.webp} sizes="150px" />}
+                                <img src={image.image} srcSet={image.srcset?.jpeg} sizes="150px" alt={image.caption || '施設画像'} style={{ width: '150px', height: 'auto' }} />
+                            </picture>
                             <button onClick={() => handleImageDelete(image.id)}>削除</button>
                         </div>
                     ))}
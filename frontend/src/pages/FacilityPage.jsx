@@ -2,6 +2,11 @@ import { useState, useEffect } from 'react'
 import { Link } from 'react-router-dom';
 import '../styles/FacilityPage.css'; // 作成したCSSをインポート
 
+// 1回のリクエストで取得する施設の件数
+const PAGE_SIZE = 50;
+// カードの表示に使うフィールドだけを取得する (説明文・アメニティ・全画像は詳細ページで取得)
+const CARD_FIELDS = 'id,facility_name,short_description,cover_image';
+
 function FacilityPage() {
 
     // APIから取得した施設データを保存
@@ -11,6 +16,9 @@ function FacilityPage() {
 
     // エラーが発生した際の情報を保存するためのState
     const [error, setError] = useState(null);
+    // 次のページのURL (カーソルページネーション)。nullなら最後のページ
+    const [nextUrl, setNextUrl] = useState(null);
+    const [loadingMore, setLoadingMore] = useState(false);
 
     // useEffectフック: コンポーネントが最初に描画された後に一度だけ実行される
     useEffect(() => {
@@ -19,7 +27,7 @@ function FacilityPage() {
             try{
                 // Django APIのエンドポイントにGETリクエストを送信
                 // const response = await fetch('http://localhost:8000/api/facilities/');
-                const response = await fetch(`${import.meta.env.VITE_API_BASE_URL}/facilities/`);
+                const response = await fetch(`${import.meta.env.VITE_API_BASE_URL}/facilities/?page_size=${PAGE_SIZE}&fields=${CARD_FIELDS}`);
 
                 // レスポンスが成功でなければエラーを表示
                 if (!response.ok){
@@ -29,7 +37,8 @@ function FacilityPage() {
                 // レスポンスボディをJSONとして解析
                 const data = await response.json();
                 // 取得したデータでfacilities Stateを更新
-                setFacilities(data);
+                setFacilities(data.results);
+                setNextUrl(data.next);
             } catch(err) {
                 console.error('API Error:', err)
                 // エラーが発生した場合、error stateを更新
@@ -45,6 +54,25 @@ function FacilityPage() {
     // 第二引数の空の配列[]は、useEffectがマウント時に一度だけ実行されることを示す
     }, []); 
 
+    // 「もっと見る」: nextのURLをたどって次のページを追加する
+    const handleLoadMore = async () => {
+        setLoadingMore(true);
+        try {
+            const response = await fetch(nextUrl);
+            if (!response.ok) {
+                throw new Error('データの取得に失敗しました');
+            }
+            const data = await response.json();
+            setFacilities(prev => [...prev, ...data.results]);
+            setNextUrl(data.next);
+        } catch (err) {
+            console.error('API Error:', err);
+            setError(err.message);
+        } finally {
+            setLoadingMore(false);
+        }
+    };
+
     // ローディング中の表示
     if (loading){
         return <div>ローディング中...</div>
@@ -68,10 +96,31 @@ function FacilityPage() {
             <ul className="facility-list"> {/* classNameを追加 */}
                 {facilities.map(facility => (
                     <li key={facility.id} className="facility-list-item"> {/* classNameを追加 */}
+                        {facility.cover_image && (
+                            <img
+                                className="facility-list-thumbnail"
+                                src={facility.cover_image.image}
+                                srcSet={facility.cover_image.srcset?.jpeg}
+                                sizes="120px"
+                                alt={facility.cover_image.caption || facility.facility_name}
+                                loading="lazy"
+                            />
+                        )}
                         <Link to={`/facilities/${facility.id}`}>{facility.facility_name}</Link>
+                        {facility.short_description && (
+                            <p className="facility-list-description">{facility.short_description}</p>
+                        )}
                     </li>
                 ))}
             </ul>
+
+            {nextUrl && (
+                <div className="actions-container">
+                    <button className="button" onClick={handleLoadMore} disabled={loadingMore}>
+                        {loadingMore ? 'ローディング中...' : 'もっと見る'}
+                    </button>
+                </div>
+            )}
         </div>
     );
 }